@@ -0,0 +1,340 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Micro-benchmarks of ndk's hot functions, with a mode comparing two runs
+
+Times event validation and building, parsing of events, tags, filters and
+messages, filter matching and serialization, on fixtures shaped like real
+traffic: short notes, unicode-heavy notes, a 2,000-tag contact list and zap
+receipts. Each case is timed --repeat times and reported per call; the best
+of those is what --compare uses, since on a busy machine other work only ever
+makes a run slower.
+
+Usage: PYTHONPATH=. python benchmarks/core_primitives.py [--only TEXT] [--output FILE]
+           [--baseline FILE] [--threshold PERCENT]
+       PYTHONPATH=. python benchmarks/core_primitives.py --compare OLD.json NEW.json
+
+With --baseline or --compare, exits non-zero if any case got slower by more
+than --threshold percent.
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import typing
+
+from ndk import crypto, serialize, types
+from ndk.event import (
+    contact_list_event,
+    event,
+    event_builder,
+    event_filter,
+    event_tags,
+    text_note_event,
+    zap_receipt_event,
+)
+from ndk.messages import event_message, message_factory, relay_event, request
+
+UNICODE_CONTENT = (
+    "GM nostr ☀️🌻🫂 — 今日はいい天気ですね。"
+    "مرحبا بالعالم، هذه ملاحظة تجريبية. "
+    "Ñandú, façade, naïve, Zürich, ĳssel, 𝕟𝕠𝕤𝕥𝕣 "
+    "👩‍👩‍👧‍👦🏳️‍🌈 🇯🇵🇧🇷 é ä "
+    "Привет, как дела? 안녕하세요! "
+) * 8
+
+ZAP_REQUEST = 9734  # NIP-57, only ever seen inside a zap receipt's description
+
+BOLT11 = "lnbc210n1pj" + "".join(
+    random.Random(0).choices("qpzry9x8gf2tvdw0s3jn54khce6mua7l", k=360)
+)
+
+
+def build_note(keys: crypto.KeyPair, content: str) -> event.Event:
+    tags = event_tags.EventTags([["t", "nostr"], ["client", "benchmark"]])
+    return text_note_event.TextNoteEvent.build(
+        keys, types.EventKind.TEXT_NOTE, tags=tags, content=content
+    )
+
+
+def build_contact_list(
+    keys: crypto.KeyPair, follows: list[crypto.PublicKeyStr]
+) -> event.Event:
+    tags = [
+        ["p", pk, "wss://relay.example.com"] if i % 10 == 0 else ["p", pk]
+        for i, pk in enumerate(follows)
+    ]
+    return contact_list_event.ContactListEvent.build(
+        keys, types.EventKind.CONTACT_LIST, tags=event_tags.EventTags(tags)
+    )
+
+
+def build_zap_receipt(
+    wallet: crypto.KeyPair, sender: crypto.KeyPair, recipient: str, note_id: str
+) -> event.Event:
+    zap_request = event.RegularEvent.build(
+        sender,
+        ZAP_REQUEST,
+        tags=event_tags.EventTags(
+            [
+                ["relays", "wss://relay.example.com", "wss://nos.example.org"],
+                ["amount", "21000"],
+                [
+                    "lnurl",
+                    "lnurl1dp68gurn8ghj7um9wfmxjcm99e3k7mf0v9cxj0m385ekvcenxc6r2c35xvukxefcv5mkvv34x5ekzd3ev56nyd3hxqurzepexejxxepnxscrvwfnv9nxzcn9xq6xyefhvgcxxcmyxymnserxfq5fns",
+                ],
+                ["p", recipient],
+                ["e", note_id],
+            ]
+        ),
+        content="Onward 🤙",
+    )
+    tags = event_tags.EventTags(
+        [
+            ["p", recipient],
+            ["e", note_id],
+            ["bolt11", BOLT11],
+            ["description", serialize.serialize_as_str(zap_request.__dict__)],
+            [
+                "preimage",
+                "5d006d2cf1e73c7148e7519a4c68adc81642ce0e25a432b2434c99f97344c15f",
+            ],
+        ]
+    )
+    return zap_receipt_event.ZapReceiptEvent.build(
+        wallet, types.EventKind.ZAP_RECEIPT, tags=tags
+    )
+
+
+def make_cases() -> dict[str, typing.Callable[[], typing.Any]]:
+    """Benchmark name -> function making one call of it"""
+    keys = crypto.KeyPair()
+    follows = [crypto.KeyPair().public for _ in range(2000)]
+
+    note = build_note(keys, "Just setting up my nostr relay")
+    unicode_note = build_note(keys, UNICODE_CONTENT)
+    contact_list = build_contact_list(keys, follows)
+    zap = build_zap_receipt(crypto.KeyPair(), keys, follows[0], note.id)
+
+    # what comes off the wire, before any ndk types are built from it
+    dicts = {
+        name: serialize.deserialize_str(serialize.serialize_as_str(ev.__dict__))
+        for name, ev in [
+            ("note", note),
+            ("unicode", unicode_note),
+            ("contact_list", contact_list),
+            ("zap_receipt", zap),
+        ]
+    }
+
+    follows_filter = {"authors": follows[:500], "kinds": [1, 6], "since": 1700000000}
+    tag_filter = {"#p": [follows[1999]], "kinds": [3]}
+    req = request.Request(
+        "feed",
+        [
+            follows_filter,
+            {"#p": [keys.public], "kinds": [1, 7, 9735], "limit": 100},
+            {"ids": [note.id[:8]]},
+        ],
+    ).serialize()
+
+    cases: dict[str, typing.Callable[[], typing.Any]] = {}
+    for name, ev in [
+        ("note", note),
+        ("unicode", unicode_note),
+        ("contact_list", contact_list),
+        ("zap_receipt", zap),
+    ]:
+        cases[f"validate/{name}"] = ev.validate
+    cases["build/note"] = lambda: build_note(keys, "Just setting up my nostr relay")
+    cases["build/contact_list"] = lambda: build_contact_list(keys, follows)
+
+    # without validation, which the validate/ cases time on their own
+    for name, d in dicts.items():
+        cases[f"from_dict/{name}"] = functools.partial(
+            event_builder.from_validated_dict, d
+        )
+    cases["event_tags/contact_list"] = lambda: event_tags.EventTags(
+        dicts["contact_list"]["tags"]
+    )
+    cases["event_tags/zap_receipt"] = lambda: event_tags.EventTags(
+        dicts["zap_receipt"]["tags"]
+    )
+
+    cases["filter_from_dict/authors_500"] = lambda: event_filter.EventFilter.from_dict(
+        follows_filter
+    )
+    cases["filter_from_dict/tag"] = lambda: event_filter.EventFilter.from_dict(
+        tag_filter
+    )
+    authors = event_filter.EventFilter.from_dict(follows_filter)
+    by_tag = event_filter.EventFilter.from_dict(tag_filter)
+    cases["matches_event/authors_500"] = lambda: authors.matches_event(note)
+    cases["matches_event/p_tag_contact_list"] = lambda: by_tag.matches_event(
+        contact_list
+    )
+
+    for name, ev in [
+        ("note", note),
+        ("unicode", unicode_note),
+        ("contact_list", contact_list),
+    ]:
+        cases[f"serialize/{name}"] = functools.partial(
+            serialize.serialize_as_str, ev.__dict__
+        )
+
+    msgs = {
+        "event_note": event_message.Event.from_event(note).serialize(),
+        "event_contact_list": event_message.Event.from_event(contact_list).serialize(),
+        "req": req,
+        "relay_event_zap": relay_event.RelayEvent("feed", zap.__dict__).serialize(),
+    }
+    for name, msg in msgs.items():
+        cases[f"from_str/{name}"] = functools.partial(message_factory.from_str, msg)
+
+    for name, ev in [("note", note), ("unicode", unicode_note), ("zap", zap)]:
+        relay_ev = relay_event.RelayEvent("feed", ev.__dict__)
+        cases[f"relay_event_serialize/{name}"] = relay_ev.serialize
+
+    return cases
+
+
+def time_case(fn: typing.Callable[[], typing.Any], repeat: int) -> dict:
+    """ns per call, the median and best of repeat runs of at least 0.2s each"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    per_call = [t / number * 1e9 for t in timer.repeat(repeat, number)]
+    return {
+        "ns_per_op": statistics.median(per_call),
+        "best_ns": min(per_call),
+        "number": number,
+    }
+
+
+def commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(only: str, repeat: int) -> dict:
+    results = {}
+    for name, fn in make_cases().items():
+        if only not in name:
+            continue
+        results[name] = time_case(fn, repeat)
+        print(
+            f"{name:<36} {results[name]['ns_per_op'] / 1000:10.2f}us"
+            f" (best {results[name]['best_ns'] / 1000:.2f}us)"
+        )
+
+    return {
+        "benchmark": "core_primitives",
+        "commit": commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "params": {"repeat": repeat},
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    """Prints the change in each case new ran, returning the regressed ones"""
+    print(f"{'':<36} {'old':>12} {'new':>12} {'change':>8}")
+    regressed = []
+    for name in new["results"]:
+        if name not in old["results"]:
+            print(f"{name:<36} {'-':>12}")
+            continue
+
+        before = old["results"][name]["best_ns"]
+        after = new["results"][name]["best_ns"]
+        change = (after / before - 1) * 100
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(
+            f"{name:<36} {before / 1000:10.2f}us {after / 1000:10.2f}us"
+            f" {change:+7.1f}%{flag}"
+        )
+
+    print(
+        f"{len(regressed)} of the cases got more than {threshold}% slower"
+        f" ({old.get('commit')} -> {new.get('commit')})"
+    )
+    return regressed
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--only", default="", help="run cases whose name has this")
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the run against this JSON file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON files"
+    )
+    parser.add_argument("--threshold", type=float, default=10, help="percent")
+    args = parser.parse_args()
+
+    # unknown kinds like zap receipts are logged as warnings when parsed
+    logging.disable(logging.WARNING)
+
+    if args.compare:
+        old, new = map(load, args.compare)
+    else:
+        new = run(args.only, args.repeat)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(new, f, indent=2)
+                f.write("\n")
+        if not args.baseline:
+            return
+        old = load(args.baseline)
+        print()
+
+    sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compare NIP-45 COUNT against REQ-and-count for a popular pubkey's followers
+
+Usage: PYTHONPATH=. python benchmarks/count_followers.py [--followers N] [--db-url HOST]
+"""
+
+import argparse
+import asyncio
+import time
+
+from ndk import crypto, types
+from ndk.event import contact_list_event, event_tags
+from ndk.messages import close, count, message_factory, request
+from ndk.relay import (
+    auth_handler,
+    event_handler,
+    event_notifier,
+    message_dispatcher,
+    message_handler,
+    subscription_handler,
+)
+from ndk.relay.event_repo import event_repo, memory_event_repo, postgres_event_repo
+
+
+async def create_repo(db_url: str) -> event_repo.EventRepo:
+    if db_url:
+        return await postgres_event_repo.PostgresEventRepo.create(
+            db_url, 5432, "nostr", "nostr", "nostr"
+        )
+    return memory_event_repo.MemoryEventRepo()
+
+
+async def populate(repo: event_repo.EventRepo, popular: str, followers: int):
+    for _ in range(followers):
+        # every follower also follows a handful of other accounts
+        tags = [["p", popular]] + [["p", crypto.KeyPair().public] for _ in range(5)]
+        await repo.add(
+            contact_list_event.ContactListEvent.build(
+                crypto.KeyPair(),
+                kind=types.EventKind.CONTACT_LIST,
+                tags=event_tags.EventTags(tags),
+            )
+        )
+
+
+async def timed(iterations: int, coro_fn) -> tuple[float, int]:
+    result = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = await coro_fn()
+    return (time.perf_counter() - start) / iterations, result
+
+
+async def run(followers: int, iterations: int, db_url: str):
+    repo = await create_repo(db_url)
+    popular = crypto.KeyPair().public
+    print(f"Populating {followers} contact lists following {popular[:8]}...")
+    await populate(repo, popular, followers)
+
+    auth = auth_handler.AuthHandler("wss://benchmark", allow_all=True)
+    sh = subscription_handler.SubscriptionHandler(asyncio.Queue())
+    eh = event_handler.EventHandler(repo, event_notifier.EventNotifier())
+    md = message_dispatcher.MessageDispatcher(
+        message_handler.MessageHandler(auth, repo, sh, eh)
+    )
+
+    fltr = {"kinds": [types.EventKind.CONTACT_LIST], "#p": [popular]}
+
+    async def req_and_count() -> int:
+        responses = await md.process_message(request.Request("req", [fltr]).serialize())
+        await md.process_message(close.Close("req").serialize())
+        return len(responses) - 1  # trailing EOSE
+
+    async def count_only() -> int:
+        responses = await md.process_message(
+            count.CountRequest("count", [fltr]).serialize()
+        )
+        msg = message_factory.from_str(responses[0])
+        assert isinstance(msg, count.CountResponse)
+        return msg.count
+
+    req_seconds, req_total = await timed(iterations, req_and_count)
+    count_seconds, count_total = await timed(iterations, count_only)
+    assert req_total == count_total, (req_total, count_total)
+
+    print(f"REQ-and-count: {req_seconds * 1000:8.2f} ms/query ({req_total} events)")
+    print(f"COUNT:         {count_seconds * 1000:8.2f} ms/query ({count_total})")
+    print(f"Speedup:       {req_seconds / count_seconds:8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--followers", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--db-url", default="", help="benchmark Postgres instead of memory"
+    )
+    args = parser.parse_args()
+
+    asyncio.run(run(args.followers, args.iterations, args.db_url))
+
+
+if __name__ == "__main__":
+    main()
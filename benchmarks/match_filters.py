@@ -0,0 +1,159 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Events matched per second against 1, 100 and 10,000 live filters
+
+Compares compiled filters (what SubscriptionGroups uses) against matching
+with a fresh tag dict per filter call, as EventFilter.matches_event did
+before filters were compiled.
+
+Usage: PYTHONPATH=. python benchmarks/match_filters.py [--events N]
+"""
+
+import argparse
+import collections
+import random
+import string
+import time
+
+from ndk import crypto
+from ndk.event import event, event_filter, event_tags
+
+KINDS = [0, 1, 2, 3, 6, 7, 9735]
+
+
+def baseline_matches(fltr: event_filter.EventFilter, ev: event.Event) -> bool:
+    if fltr.ids and not any(ev.id.startswith(x) for x in fltr.ids):
+        return False
+    if fltr.authors and not any(ev.pubkey.startswith(x) for x in fltr.authors):
+        return False
+    if fltr.kinds and ev.kind not in fltr.kinds:
+        return False
+    if fltr.generic_tags:
+        if not ev.tags:
+            return False
+        ev_tags = collections.defaultdict(list)
+        for tag in ev.tags:
+            if tag[0] in string.ascii_letters:
+                ev_tags[tag[0]].append(tag[1])
+        for identifier, lst in fltr.generic_tags.items():
+            if identifier not in ev_tags:
+                return False
+            if not any(val in ev_tags[identifier] for val in lst):
+                return False
+    if fltr.until and ev.created_at >= fltr.until:
+        return False
+    if fltr.since and ev.created_at <= fltr.since:
+        return False
+    return True
+
+
+def make_events(count: int, pubkeys: list[str]) -> list[event.Event]:
+    evs = []
+    for _ in range(count):
+        tags = [["p", random.choice(pubkeys)] for _ in range(random.randint(0, 6))]
+        tags += [["t", f"topic{random.randrange(50)}"]]
+        evs.append(
+            event.RegularEvent.build(
+                crypto.KeyPair(),
+                kind=random.choice(KINDS),
+                tags=event_tags.EventTags(tags),
+                content="benchmark",
+            )
+        )
+    return evs
+
+
+def make_filters(count: int, pubkeys: list[str]) -> list[event_filter.EventFilter]:
+    fltrs = []
+    for _ in range(count):
+        shape = random.randrange(3)
+        if shape == 0:  # someone's feed
+            fltrs.append(
+                event_filter.EventFilter(
+                    authors=random.sample(pubkeys, 50), kinds=[1, 6, 9735]
+                )
+            )
+        elif shape == 1:  # mentions
+            fltrs.append(
+                event_filter.EventFilter(
+                    kinds=[1, 7], generic_tags={"p": [random.choice(pubkeys)]}
+                )
+            )
+        else:  # hashtags, with some author prefixes
+            fltrs.append(
+                event_filter.EventFilter(
+                    authors=random.sample([pk[:8] for pk in pubkeys], 5),
+                    generic_tags={"t": [f"topic{random.randrange(50)}"]},
+                )
+            )
+    return fltrs
+
+
+def match_baseline(
+    fltrs: list[event_filter.EventFilter], evs: list[event.Event]
+) -> int:
+    return sum(baseline_matches(f, ev) for ev in evs for f in fltrs)
+
+
+def match_compiled(
+    fltrs: list[event_filter.EventFilter], evs: list[event.Event]
+) -> int:
+    matchers = [f.compile() for f in fltrs]
+    return sum(m.matches(ev) for ev in evs for m in matchers)
+
+
+def timed(fn, *args) -> tuple[float, int]:
+    start = time.perf_counter()
+    matched = fn(*args)
+    return time.perf_counter() - start, matched
+
+
+def run(num_events: int, sizes: list[int]):
+    random.seed(1)
+    pubkeys = [str(crypto.KeyPair().public) for _ in range(500)]
+    evs = make_events(num_events, pubkeys)
+
+    print(f"{'filters':>8} {'baseline ev/s':>14} {'compiled ev/s':>14} {'speedup':>8}")
+    for size in sizes:
+        fltrs = make_filters(size, pubkeys)
+        baseline_s, baseline_matched = timed(match_baseline, fltrs, evs)
+        compiled_s, compiled_matched = timed(match_compiled, fltrs, evs)
+        assert baseline_matched == compiled_matched
+
+        print(
+            f"{size:>8} {num_events / baseline_s:>14.0f} "
+            f"{num_events / compiled_s:>14.0f} {baseline_s / compiled_s:>7.1f}x"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=200)
+    parser.add_argument("--filters", type=int, nargs="+", default=[1, 100, 10000])
+    args = parser.parse_args()
+
+    run(args.events, args.filters)
+
+
+if __name__ == "__main__":
+    main()
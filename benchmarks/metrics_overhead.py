@@ -0,0 +1,165 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Throughput cost of the relay's /metrics instrumentation
+
+Runs the same mix of EVENT, REQ and CLOSE messages through two relay stacks,
+one with RelayMetrics wired in. Each message is handed to both, in random
+order, and timed on each, so whatever else the machine is doing, and
+whichever of the two runs a message first, falls on both stacks alike. The
+overhead is the extra CPU time the instrumented stack took in total. Exits
+non-zero if the overhead is above the budget.
+
+There is no socket I/O and the repo is in memory, so the instrumentation is a
+larger share of each message than it is in a deployed relay.
+
+Usage: PYTHONPATH=. python benchmarks/metrics_overhead.py [--events N] [--rounds N]
+"""
+
+import argparse
+import asyncio
+import gc
+import random
+import sys
+import time
+import typing
+
+from ndk import crypto
+from ndk.event import event
+from ndk.messages import close, event_message, request
+from ndk.relay import (
+    auth_handler,
+    event_handler,
+    event_notifier,
+    message_dispatcher,
+    message_handler,
+    metrics,
+    subscription_handler,
+)
+from ndk.relay.event_repo import (
+    event_repo,
+    instrumented_event_repo,
+    memory_event_repo,
+)
+
+
+def build_dispatchers(
+    connections: int, relay_metrics: typing.Optional[metrics.RelayMetrics]
+) -> list[message_dispatcher.MessageDispatcher]:
+    """Connections sharing one repo and live subscriptions, as in relay/server.py"""
+    repo: event_repo.EventRepo = memory_event_repo.MemoryEventRepo()
+    groups = subscription_handler.SubscriptionGroups(
+        relay_metrics.fanout if relay_metrics else None
+    )
+    if relay_metrics is not None:
+        repo = instrumented_event_repo.InstrumentedEventRepo(
+            repo, relay_metrics.repo_latency
+        )
+    notifier = event_notifier.EventNotifier()
+    notifier.register(groups.handle_event)
+
+    dispatchers = []
+    for _ in range(connections):
+        auth = auth_handler.AuthHandler("wss://benchmark", allow_all=True)
+        sh = subscription_handler.SubscriptionHandler(
+            asyncio.Queue(), subscription_handler.SubscriptionHandlerConfig(), groups
+        )
+        eh = event_handler.EventHandler(repo, notifier)
+        mh = message_handler.MessageHandler(auth, repo, sh, eh)
+        dispatchers.append(
+            message_dispatcher.MessageDispatcher(mh, relay_metrics=relay_metrics)
+        )
+    return dispatchers
+
+
+def make_messages(num_events: int) -> list[str]:
+    keys = [crypto.KeyPair() for _ in range(20)]
+    msgs = []
+    for i in range(num_events):
+        ev = event.RegularEvent.build(keys[i % len(keys)], kind=1, content=str(i))
+        msgs.append(event_message.Event.from_event(ev).serialize())
+        if i % 10 == 0:
+            msgs.append(request.Request("q", [{"kinds": [1], "limit": 20}]).serialize())
+            msgs.append(close.Close("q").serialize())
+    return msgs
+
+
+async def run_round(msgs: list[str], connections: int) -> tuple[float, float]:
+    """CPU seconds the baseline and the instrumented stack spent handling msgs"""
+    relay_metrics = metrics.RelayMetrics(metrics.Registry())
+    # each stack has a repo of its own, so both can take the same events
+    stacks = [
+        build_dispatchers(connections, None),
+        build_dispatchers(connections, relay_metrics),
+    ]
+    for dispatchers in stacks:
+        for md in dispatchers:
+            await md.process_message(
+                request.Request("live", [{"kinds": [1]}]).serialize()
+            )
+
+    rng = random.Random(len(msgs))
+    spent = [0.0, 0.0]
+    # CPU time, so other processes taking the CPU away don't count
+    gc.disable()
+    for i, msg in enumerate(msgs):
+        for stack in (0, 1) if rng.random() < 0.5 else (1, 0):
+            start = time.process_time()
+            await stacks[stack][i % connections].process_message(msg)
+            spent[stack] += time.process_time() - start
+    gc.enable()
+
+    assert relay_metrics.messages()[("EVENT",)] > 0
+    return spent[0], spent[1]
+
+
+async def run(num_events: int, rounds: int, connections: int, budget: float) -> bool:
+    baseline = instrumented = 0.0
+    handled = 0
+    for _ in range(rounds):
+        msgs = make_messages(num_events)
+        spent = await run_round(msgs, connections)
+        baseline += spent[0]
+        instrumented += spent[1]
+        handled += len(msgs)
+
+    overhead = (instrumented / baseline - 1) * 100
+    print(f"baseline:     {handled / baseline:10.0f} msg/s")
+    print(f"instrumented: {handled / instrumented:10.0f} msg/s")
+    print(f"overhead:     {overhead:10.2f}% (budget {budget}%)")
+    return overhead <= budget
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=150, help="per round")
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--budget", type=float, default=2.0, help="percent")
+    args = parser.parse_args()
+
+    ok = asyncio.run(run(args.events, args.rounds, args.connections, args.budget))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""The whole relay stack driven by thousands of in-memory connections
+
+Serves --connections MemoryWebSockets with relay/server.py's handler_wrapper
+on a MEMORY repo, each holding a live subscription to some of --authors
+pubkeys, then publishes --events pre-signed notes round-robin over them and
+waits for every OK and every delivery. No sockets, TLS or other processes are
+involved, so the time is the relay's own CPU cost, and with --profile the
+same run under cProfile is repeatable enough to compare between commits.
+
+Usage: PYTHONPATH=. python benchmarks/relay_in_process.py [--connections N]
+           [--events N] [--profile FILE]
+"""
+
+import argparse
+import asyncio
+import configparser
+import cProfile
+import functools
+import os
+import pstats
+import random
+import time
+
+from ndk import crypto
+from ndk.event import event
+from ndk.messages import event_message, request
+from ndk.relay import (
+    event_handler,
+    event_notifier,
+    load_shedder,
+    memory_transport,
+    metrics,
+    subscription_handler,
+)
+from ndk.relay.event_repo import instrumented_event_repo, memory_event_repo
+from relay import config, server
+
+
+def relay_state() -> server.RelayState:
+    """As relay/server.py sets up MEMORY mode, without the background tasks"""
+    relay_metrics = metrics.RelayMetrics(metrics.Registry())
+    state = server.RelayState(
+        instrumented_event_repo.InstrumentedEventRepo(
+            memory_event_repo.MemoryEventRepo(), relay_metrics.repo_latency
+        ),
+        event_notifier.EventNotifier(),
+        subscription_handler.SubscriptionGroups(relay_metrics.fanout),
+        event_handler.IngestStats(),
+        load_shedder.LoadShedder(),
+        relay_metrics,
+    )
+    state.ev_notifier.register(state.groups.handle_event)
+    return state
+
+
+def load_config() -> config.RelayConfig:
+    ini_parser = configparser.ConfigParser()
+    ini_parser.read(
+        os.path.join(os.path.dirname(__file__), os.pardir, "relay", "config.ini")
+    )
+    return config.RelayConfig(ini_parser)
+
+
+class Progress:
+    def __init__(self, oks: int, deliveries: int):
+        self.oks = 0
+        self.deliveries = 0
+        self._expected = (oks, deliveries)
+        self.finished = asyncio.Event()
+
+    def check(self):
+        if (self.oks, self.deliveries) >= self._expected:
+            self.finished.set()
+
+
+class Client:
+    """Counts the OKs and deliveries arriving on one connection"""
+
+    def __init__(self, ws: memory_transport.MemoryWebSocket, done: Progress):
+        self.ws = ws
+        self._done = done
+
+    async def read(self):
+        while True:
+            try:
+                data = await self.ws.recv()
+            except Exception:  # pylint: disable=broad-except
+                return
+            if data.startswith('["OK"'):
+                self._done.oks += 1
+            elif data.startswith('["EVENT"'):
+                self._done.deliveries += 1
+            else:
+                continue
+            self._done.check()
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    authors = [crypto.KeyPair() for _ in range(args.authors)]
+    follows = [
+        rng.sample(range(args.authors), args.follows) for _ in range(args.connections)
+    ]
+    evs = [
+        event.RegularEvent.build(
+            authors[i % args.authors], kind=1, content=f"note {i} #nostr"
+        )
+        for i in range(args.events)
+    ]
+    msgs = [event_message.Event.from_event(ev).serialize() for ev in evs]
+    followers = [0] * args.authors
+    for f in follows:
+        for a in f:
+            followers[a] += 1
+    expected = sum(followers[i % args.authors] for i in range(args.events))
+
+    state = relay_state()
+    memory_server = memory_transport.MemoryServer(
+        functools.partial(server.handler_wrapper, load_config(), state)
+    )
+    progress = Progress(args.events, expected)
+    clients = []
+    for f in follows:
+        ws = await memory_server.connect()
+        await ws.recv()  # AUTH challenge
+        fltr = {"authors": [authors[a].public for a in f], "kinds": [1]}
+        await ws.send(request.Request("live", [fltr]).serialize())
+        await ws.recv()  # EOSE
+        clients.append(Client(ws, progress))
+    readers = [asyncio.create_task(c.read()) for c in clients]
+
+    profile = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    if profile is not None:
+        profile.enable()
+    for i, msg in enumerate(msgs):
+        await clients[i % len(clients)].ws.send(msg)
+    await progress.finished.wait()
+    if profile is not None:
+        profile.disable()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    await memory_server.close()
+    await asyncio.gather(*readers)
+
+    if profile is not None:
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+
+    return {
+        "events": args.events,
+        "deliveries": progress.deliveries,
+        "elapsed": elapsed,
+        "events_per_s": args.events / elapsed,
+        "deliveries_per_s": progress.deliveries / elapsed,
+        "cpu_us_per_event": cpu / args.events * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--authors", type=int, default=500)
+    parser.add_argument("--follows", type=int, default=20, help="per connection")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--profile", help="write cProfile stats to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(
+        f"{results['events']} events, {results['deliveries']} deliveries"
+        f" in {results['elapsed']:.2f}s"
+    )
+    print(f"events/s:     {results['events_per_s']:10.0f}")
+    print(f"deliveries/s: {results['deliveries_per_s']:10.0f}")
+    print(f"cpu/event:    {results['cpu_us_per_event']:10.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,527 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""End-to-end load test of relay/server.py over real websockets
+
+Starts the relay in MEMORY mode, or POSTGRES with --db-url, then opens
+--publishers connections sending a mix of event kinds at --rate events per
+second each, and --subscribers connections each holding one live
+subscription and running a stored-events REQ every --query-interval seconds.
+Reports percentiles of:
+
+    publish_ok   EVENT sent -> its OK
+    delivery     EVENT sent -> received by each subscription it matches
+    req_eose     REQ sent -> its EOSE
+
+plus throughput, and writes them as JSON with --output, to compare commits.
+Publishers send on a fixed schedule whether or not the relay keeps up, and
+latencies are measured from when a message was due, so a relay falling
+behind shows up as latency instead of a slower generator.
+
+The generator and the relay share the machine unless --relay-url points at
+a relay started elsewhere. Postgres tables are dropped first, so never point
+--db-url at a database holding real data.
+
+Usage: PYTHONPATH=. python benchmarks/relay_load.py [--publishers N]
+           [--subscribers N] [--duration S] [--db-url HOST] [--output FILE]
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import typing
+
+from websockets.client import connect
+
+from ndk import crypto, types
+from ndk.event import event, event_tags
+from ndk.messages import close, event_message, request
+
+# kind, weight: mostly notes and reactions, as on public relays
+KIND_MIX = [
+    (types.EventKind.TEXT_NOTE, 55),
+    (types.EventKind.REACTION, 25),
+    (types.EventKind.REPOST, 10),
+    (types.EventKind.SET_METADATA, 5),
+    (types.EventKind.CONTACT_LIST, 5),
+]
+N_AUTHORS = 200
+# subscription id of every subscriber's live subscription
+LIVE = "live"
+
+
+def percentiles(samples: list[float]) -> dict:
+    """Nearest-rank percentiles of samples in seconds, reported in ms"""
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+def build_event(
+    rng: random.Random,
+    authors: list[crypto.KeyPair],
+    recent: list[str],
+    i: int,
+    created_at: int,
+) -> event.Event:
+    keys = rng.choice(authors)
+    kind = rng.choices([k for k, _ in KIND_MIX], [w for _, w in KIND_MIX])[0]
+    responses = (types.EventKind.REPOST, types.EventKind.REACTION)
+    if kind in responses and not recent:
+        # nothing to respond to yet
+        kind = types.EventKind.TEXT_NOTE
+    if kind == types.EventKind.SET_METADATA:
+        content = json.dumps({"name": f"author {i}", "about": "load test"})
+        return event.ReplaceableEvent.build(keys, kind, created_at, content=content)
+    if kind == types.EventKind.CONTACT_LIST:
+        tags = [["p", rng.choice(authors).public] for _ in range(rng.randint(1, 50))]
+        return event.ReplaceableEvent.build(
+            keys, kind, created_at, event_tags.EventTags(tags)
+        )
+    tags = [["p", rng.choice(authors).public]]
+    if kind in responses:
+        tags.append(["e", rng.choice(recent)])
+    content = {
+        types.EventKind.REACTION: "+",
+        types.EventKind.REPOST: "",
+    }.get(kind, f"note {i} about #nostr and relays")
+    return event.RegularEvent.build(
+        keys, kind, created_at, event_tags.EventTags(tags), content
+    )
+
+
+def build_events(
+    n: int, authors: list[crypto.KeyPair], seed: int, start: float, rate: float
+) -> list[event.Event]:
+    """n events created rate per second from start"""
+    rng = random.Random(seed)
+    evs: list[event.Event] = []
+    recent: list[str] = []
+    for i in range(n):
+        ev = build_event(rng, authors, recent, i, int(start + i / rate))
+        if ev.kind == 1:
+            recent = (recent + [ev.id])[-100:]
+        evs.append(ev)
+    return evs
+
+
+def live_filter(rng: random.Random, authors: list[crypto.KeyPair], now: int) -> dict:
+    """Filter of a subscription for new events, like a client's home feed"""
+    shape = rng.random()
+    if shape < 0.6:
+        follows = [keys.public for keys in rng.sample(authors, 30)]
+        return {"authors": follows, "kinds": [1, 6], "since": now}
+    if shape < 0.9:
+        return {"#p": [rng.choice(authors).public], "since": now}
+    return {"kinds": [1], "since": now}
+
+
+def stored_filter(
+    rng: random.Random, authors: list[crypto.KeyPair], stored: list[event.Event]
+) -> dict:
+    """Filter of a one-off REQ for stored events"""
+    shape = rng.random()
+    author = rng.choice(authors).public
+    if shape < 0.3:
+        return {"authors": [author], "limit": 50}
+    if shape < 0.5:
+        return {"authors": [author], "kinds": [0, 3]}
+    if shape < 0.7:
+        return {"#p": [author], "kinds": [1, 7], "limit": 100}
+    if shape < 0.85 and stored:
+        return {"#e": [rng.choice(stored).id], "kinds": [7]}
+    if shape < 0.95 and stored:
+        return {"ids": [rng.choice(stored).id[:8]]}
+    return {"kinds": [1], "limit": 100}
+
+
+@dataclasses.dataclass
+class Results:
+    publish_ok: list[float] = dataclasses.field(default_factory=list)
+    delivery: list[float] = dataclasses.field(default_factory=list)
+    req_eose: list[float] = dataclasses.field(default_factory=list)
+    # OK false, by the machine-readable prefix of the message
+    rejected: dict[str, int] = dataclasses.field(default_factory=dict)
+    # due but not answered before the run ended
+    missing_ok: int = 0
+    missing_eose: int = 0
+    # a message the relay failed to handle may only get a NOTICE
+    notices: int = 0
+    seed_missing_ok: int = 0
+
+
+class Connection:
+    """Websocket to the relay, matching OK and EOSE responses to what asked for them"""
+
+    def __init__(self, ws, due: dict[str, float], results: Results):
+        self._ws = ws
+        # when each published event was due, shared by every connection
+        self._due = due
+        self._results = results
+        # an id published twice is answered twice
+        self._pending: dict[str, list[asyncio.Future]] = {}
+        self._reader = asyncio.create_task(self._read())
+
+    async def _read(self):
+        async for data in self._ws:
+            now = time.perf_counter()
+            msg = json.loads(data)
+            # stored events sent for the REQs aren't deliveries
+            if msg[0] == "EVENT" and msg[1] == LIVE:
+                due = self._due.get(msg[2]["id"])
+                if due is not None:
+                    self._results.delivery.append(now - due)
+            elif msg[0] == "NOTICE":
+                self._results.notices += 1
+            elif msg[0] == "OK" or msg[0] == "EOSE":
+                futs = self._pending.get(msg[1], [])
+                while futs:
+                    fut = futs.pop(0)
+                    # skips the ones that timed out
+                    if not fut.done():
+                        fut.set_result(msg)
+                        break
+                if not futs:
+                    self._pending.pop(msg[1], None)
+
+    def expect(self, key: str) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(key, []).append(fut)
+        return fut
+
+    async def send(self, data: str):
+        await self._ws.send(data)
+
+    async def close(self):
+        self._reader.cancel()
+        await self._ws.close()
+
+
+async def publish(
+    conn: Connection,
+    evs: list[event.Event],
+    *,
+    rate: float,
+    start: float,
+    due: dict[str, float],
+    results: Results,
+):
+    waits = []
+    for i, ev in enumerate(evs):
+        at = start + i / rate
+        delay = at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        due[ev.id] = at
+        fut = conn.expect(ev.id)
+        await conn.send(event_message.Event.from_event(ev).serialize())
+        waits.append(asyncio.create_task(await_ok(fut, at, results)))
+    await asyncio.gather(*waits)
+
+
+async def await_ok(fut: asyncio.Future, due: float, results: Results):
+    try:
+        msg = await asyncio.wait_for(fut, timeout=10)
+    except asyncio.TimeoutError:
+        results.missing_ok += 1
+        return
+    results.publish_ok.append(time.perf_counter() - due)
+    if not msg[2]:
+        prefix = msg[3].split(":", 1)[0]
+        results.rejected[prefix] = results.rejected.get(prefix, 0) + 1
+
+
+async def query(
+    conn: Connection,
+    rng: random.Random,
+    *,
+    authors: list[crypto.KeyPair],
+    stored: list[event.Event],
+    interval: float,
+    until: float,
+    results: Results,
+):
+    # spread the subscribers' queries over the interval
+    await asyncio.sleep(rng.random() * interval)
+    i = 0
+    while time.perf_counter() < until:
+        sub_id = f"q{i}"
+        i += 1
+        fut = conn.expect(sub_id)
+        sent = time.perf_counter()
+        await conn.send(
+            request.Request(sub_id, [stored_filter(rng, authors, stored)]).serialize()
+        )
+        try:
+            await asyncio.wait_for(fut, timeout=10)
+            results.req_eose.append(time.perf_counter() - sent)
+        except asyncio.TimeoutError:
+            results.missing_eose += 1
+        await conn.send(close.Close(sub_id).serialize())
+        await asyncio.sleep(max(0.0, min(sent + interval, until) - time.perf_counter()))
+
+
+async def store(url: str, evs: list[event.Event], results: Results):
+    """Stores events for the REQs to find, before anything is measured"""
+    async with connect(url, max_size=None) as ws:
+        conn = Connection(ws, {}, results)
+        for i in range(0, len(evs), 100):
+            batch = evs[i : i + 100]
+            futs = [conn.expect(ev.id) for ev in batch]
+            for ev in batch:
+                await conn.send(event_message.Event.from_event(ev).serialize())
+            _, pending = await asyncio.wait(futs, timeout=30)
+            results.seed_missing_ok += len(pending)
+        await conn.close()
+
+
+async def run_load(args, url: str) -> dict:
+    authors = [crypto.KeyPair() for _ in range(N_AUTHORS)]
+    rng = random.Random(args.seed)
+    per_publisher = int(args.rate * args.duration)
+    print(f"Signing {args.stored + per_publisher * args.publishers} events...")
+    now = time.time()
+    # stored one a second up to now, published as they're sent
+    stored = build_events(args.stored, authors, args.seed, now - args.stored, 1)
+    published = [
+        build_events(per_publisher, authors, args.seed + 1 + i, now, args.rate)
+        for i in range(args.publishers)
+    ]
+    results = Results()
+    await store(url, stored, results)
+    due: dict[str, float] = {}
+    conns = [
+        Connection(await connect(url, max_size=None), due, results)
+        for _ in range(args.publishers + args.subscribers)
+    ]
+    publishers, subscribers = conns[: args.publishers], conns[args.publishers :]
+    # each live subscription is set once its EOSE arrives
+    subscribed = [conn.expect(LIVE) for conn in subscribers]
+    for conn in subscribers:
+        await conn.send(
+            request.Request(LIVE, [live_filter(rng, authors, int(now))]).serialize()
+        )
+    await asyncio.gather(*subscribed)
+
+    print(
+        f"Publishing {args.rate} events/s on each of {args.publishers} connections"
+        f" to {args.subscribers} subscribers for {args.duration}s..."
+    )
+    start = time.perf_counter() + 0.1
+    queries = []
+    if args.query_interval > 0:
+        queries = [
+            query(
+                conn,
+                random.Random(rng.random()),
+                authors=authors,
+                stored=stored,
+                interval=args.query_interval,
+                until=start + args.duration,
+                results=results,
+            )
+            for conn in subscribers
+        ]
+    querying = asyncio.gather(*queries)
+    await asyncio.gather(
+        *[
+            publish(conn, evs, rate=args.rate, start=start, due=due, results=results)
+            for conn, evs in zip(publishers, published)
+        ]
+    )
+    # until the last OK
+    elapsed = time.perf_counter() - start
+    await querying
+    # deliveries still in flight
+    await asyncio.sleep(1)
+
+    for conn in conns:
+        await conn.close()
+
+    return {
+        "publish_ok": percentiles(results.publish_ok),
+        "delivery": percentiles(results.delivery),
+        "req_eose": percentiles(results.req_eose),
+        "throughput": {
+            "events_per_s": round(len(results.publish_ok) / elapsed, 1),
+            "deliveries_per_s": round(len(results.delivery) / elapsed, 1),
+            "queries_per_s": round(len(results.req_eose) / elapsed, 1),
+        },
+        "errors": {
+            "rejected": results.rejected,
+            "missing_ok": results.missing_ok,
+            "missing_eose": results.missing_eose,
+            "notices": results.notices,
+            "seed_missing_ok": results.seed_missing_ok,
+        },
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(url: str, relay: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while True:
+        if relay.poll() is not None:
+            raise RuntimeError(f"Relay exited with {relay.returncode}")
+        try:
+            async with connect(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+def start_relay(port: int, db_url: str) -> subprocess.Popen:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        PYTHONPATH=root,
+        RELAY_HOST="127.0.0.1",
+        RELAY_PORT=str(port),
+        RELAY_LOG_LEVEL="WARNING",
+        MODE="MEMORY",
+    )
+    if db_url:
+        env.update(
+            MODE="POSTGRES",
+            DB_HOST=db_url,
+            DB_NAME="nostr",
+            DB_USER="nostr",
+            DB_PASSWORD="nostr",
+            DROP_DB="1",
+        )
+    return subprocess.Popen(
+        [sys.executable, os.path.join(root, "relay", "server.py")], env=env
+    )
+
+
+def commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    relay = None
+    url = args.relay_url
+    if not url:
+        port = free_port()
+        url = f"ws://127.0.0.1:{port}"
+        relay = start_relay(port, args.db_url)
+    try:
+        if relay is not None:
+            await wait_until_up(url, relay)
+        results = await run_load(args, url)
+    finally:
+        if relay is not None:
+            relay.terminate()
+            relay.wait()
+
+    return {
+        "benchmark": "relay_load",
+        "commit": commit(),
+        "timestamp": int(time.time()),
+        "mode": "external"
+        if args.relay_url
+        else "POSTGRES"
+        if args.db_url
+        else "MEMORY",
+        "params": {
+            "publishers": args.publishers,
+            "subscribers": args.subscribers,
+            "rate": args.rate,
+            "duration": args.duration,
+            "query_interval": args.query_interval,
+            "stored": args.stored,
+            "seed": args.seed,
+        },
+        **results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--publishers", type=int, default=10)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=5, help="events/s per publisher")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument(
+        "--query-interval", type=float, default=2, help="seconds, 0 for no REQs"
+    )
+    parser.add_argument("--stored", type=int, default=1000, help="events seeded first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db-url", default="", help="run the relay on Postgres")
+    parser.add_argument("--relay-url", default="", help="load an already running relay")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+
+    for name in ["publish_ok", "delivery", "req_eose"]:
+        p = report[name]
+        if p["count"]:
+            print(
+                f"{name:<11} {p['count']:7} p50 {p['p50']:8.2f}ms p90 {p['p90']:8.2f}ms"
+                f" p99 {p['p99']:8.2f}ms max {p['max']:8.2f}ms"
+            )
+    print(f"throughput  {report['throughput']}")
+    print(f"errors      {report['errors']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Replay traffic recorded by a relay against another, reporting its latencies
+
+Reads a capture written by the relay's [Recording] section and sends each
+recorded connection's frames to --relay-url on a websocket of its own, at
+the times they were recorded (--speed 1), N times faster (--speed N) or as
+fast as they can be sent (--speed 0). Reports percentiles of the time to
+each message's answer:
+
+    EVENT  -> its OK
+    REQ    -> its EOSE
+    COUNT  -> its COUNT
+
+measured from when the frame was due, so a relay falling behind the
+recorded pace shows up as latency. --output writes them as JSON, and
+--compare prints how they changed between two replays, e.g. of the same
+capture before and after a schema, index or cache change.
+
+EVENTs the relay already stores are answered as duplicates, so replay into
+a relay that doesn't have the capture's events yet for their stored cost.
+Recorded AUTH events answered another connection's challenge and fail.
+
+Usage: PYTHONPATH=. python benchmarks/replay_traffic.py CAPTURE --relay-url URL
+           [--speed N] [--output FILE]
+       PYTHONPATH=. python benchmarks/replay_traffic.py --compare OLD.json NEW.json
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import time
+import typing
+
+from websockets import exceptions as websockets_exceptions
+from websockets.client import connect
+
+from ndk.relay import traffic_recorder
+
+# message sent -> the message answering it, matched on the event or sub id
+ANSWERS = {"EVENT": "OK", "REQ": "EOSE", "COUNT": "COUNT"}
+ANSWERED = {answer: sent for sent, answer in ANSWERS.items()}
+
+
+def percentiles(samples: list[float]) -> dict:
+    """Nearest-rank percentiles of samples in seconds, reported in ms"""
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+class Results:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+        # OKs by the prefix of their reason, e.g. duplicate, or accepted
+        self.oks: collections.Counter = collections.Counter()
+        self.missing: collections.Counter = collections.Counter()
+        self.notices = 0
+        self.failed_connections = 0
+
+
+def answer_key(frame: str) -> typing.Optional[tuple[str, str]]:
+    """The answer a sent frame waits for, as (message type, event or sub id)"""
+    try:
+        msg = json.loads(frame)
+        if msg[0] == "EVENT":
+            return ("OK", msg[1]["id"])
+        if msg[0] in ANSWERS:
+            return (ANSWERS[msg[0]], msg[1])
+    except (ValueError, LookupError, TypeError):
+        pass
+    return None
+
+
+class ReplayedConnection:
+    """Sends the frames of one recorded connection, timing their answers"""
+
+    def __init__(self, url: str, results: Results, timeout: float):
+        self.frames: asyncio.Queue[typing.Optional[tuple[float, str]]] = asyncio.Queue()
+        self._url = url
+        self._results = results
+        self._timeout = timeout
+        self._pending: dict[tuple[str, str], list[float]] = {}
+        self._answered = asyncio.Event()
+
+    async def run(self):
+        try:
+            async with connect(self._url, max_size=None) as ws:
+                reader = asyncio.create_task(self._read(ws))
+                while True:
+                    item = await self.frames.get()
+                    if item is None:
+                        break
+                    due, frame = item
+                    self._expect(frame, due)
+                    await ws.send(frame)
+
+                if self._pending:
+                    self._answered.clear()
+                    try:
+                        await asyncio.wait_for(self._answered.wait(), self._timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                reader.cancel()
+        except (OSError, websockets_exceptions.WebSocketException):
+            self._results.failed_connections += 1
+
+        for key, waiting in self._pending.items():
+            self._results.missing[ANSWERED[key[0]]] += len(waiting)
+        self._pending.clear()
+
+    def _expect(self, frame: str, due: float):
+        key = answer_key(frame)
+        if key is not None:
+            self._pending.setdefault(key, []).append(due)
+
+    async def _read(self, ws):
+        async for data in ws:
+            now = time.monotonic()
+            msg = json.loads(data)
+            if msg[0] == "NOTICE":
+                self._results.notices += 1
+                continue
+            if msg[0] == "OK":
+                reason = msg[3].split(":")[0] if len(msg) > 3 else ""
+                self._results.oks[reason or ("accepted" if msg[2] else "")] += 1
+
+            waiting = self._pending.get((msg[0], msg[1]))
+            if not waiting:
+                continue
+            due = waiting.pop(0)
+            if not waiting:
+                del self._pending[(msg[0], msg[1])]
+            self._results.latencies[ANSWERED[msg[0]]].append(now - due)
+            if not self._pending:
+                self._answered.set()
+
+
+async def replay(capture: str, url: str, speed: float, timeout: float) -> dict:
+    results = Results()
+    conns: dict[int, ReplayedConnection] = {}
+    tasks = []
+    frames = 0
+    start = time.monotonic()
+    first: typing.Optional[float] = None
+
+    def open_conn(conn: int) -> ReplayedConnection:
+        replayed = ReplayedConnection(url, results, timeout)
+        conns[conn] = replayed
+        tasks.append(asyncio.create_task(replayed.run()))
+        return replayed
+
+    for record in traffic_recorder.read(capture):
+        if first is None:
+            first = record["t"]
+        due = time.monotonic()
+        if speed > 0:
+            due = start + (record["t"] - first) / speed
+            if due > time.monotonic():
+                await asyncio.sleep(due - time.monotonic())
+        else:
+            # lets the connections send what's queued so far
+            await asyncio.sleep(0)
+
+        conn = record["conn"]
+        if "frame" in record:
+            # its open record was dropped, or recording began after it
+            replayed = conns.get(conn) or open_conn(conn)
+            replayed.frames.put_nowait((due, record["frame"]))
+            frames += 1
+        elif record["event"] == "open":
+            open_conn(conn)
+        elif conn in conns:
+            conns.pop(conn).frames.put_nowait(None)
+
+    for replayed in conns.values():
+        replayed.frames.put_nowait(None)
+    await asyncio.gather(*tasks)
+
+    return {
+        "connections": len(tasks),
+        "frames": frames,
+        "elapsed": round(time.monotonic() - start, 3),
+        "latency": {
+            msg_type: percentiles(samples)
+            for msg_type, samples in sorted(results.latencies.items())
+        },
+        "oks": dict(results.oks),
+        "missing": dict(results.missing),
+        "notices": results.notices,
+        "failed_connections": results.failed_connections,
+    }
+
+
+def commit() -> typing.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_latencies(latency: dict):
+    for msg_type, p in latency.items():
+        print(
+            f"{msg_type:<6} {p['count']:7} p50 {p['p50']:8.2f}ms p90 {p['p90']:8.2f}ms"
+            f" p99 {p['p99']:8.2f}ms max {p['max']:8.2f}ms"
+        )
+
+
+def compare(old: dict, new: dict):
+    """Prints how each message type's latency percentiles changed"""
+    print(f"{'':<12} {'old':>10} {'new':>10} {'change':>8}")
+    for msg_type in sorted(old["latency"].keys() | new["latency"].keys()):
+        before = old["latency"].get(msg_type, {"count": 0})
+        after = new["latency"].get(msg_type, {"count": 0})
+        if not before["count"] or not after["count"]:
+            print(f"{msg_type:<12} answered in only one replay")
+            continue
+        for q in ["p50", "p90", "p99"]:
+            change = (after[q] / before[q] - 1) * 100 if before[q] else 0.0
+            print(
+                f"{msg_type + ' ' + q:<12} {before[q]:8.2f}ms {after[q]:8.2f}ms"
+                f" {change:+7.1f}%"
+            )
+    for field in ["oks", "missing", "notices", "failed_connections"]:
+        if old[field] != new[field]:
+            print(f"{field}: {old[field]} -> {new[field]}")
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("capture", nargs="?", help="capture file to replay")
+    parser.add_argument("--relay-url", help="relay to replay against")
+    parser.add_argument(
+        "--speed", type=float, default=1, help="times recorded pace, 0 for max"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=10, help="seconds to wait for answers"
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*map(load, args.compare))
+        return
+    if not args.capture or not args.relay_url:
+        parser.error("a capture and --relay-url are needed to replay")
+
+    results = asyncio.run(
+        replay(args.capture, args.relay_url, args.speed, args.timeout)
+    )
+    report = {
+        "benchmark": "replay_traffic",
+        "commit": commit(),
+        "timestamp": int(time.time()),
+        "capture": os.path.basename(args.capture),
+        "params": {"speed": args.speed, "timeout": args.timeout},
+        **results,
+    }
+
+    print(
+        f"{report['frames']} frames on {report['connections']} connections"
+        f" in {report['elapsed']:.2f}s"
+    )
+    print_latencies(report["latency"])
+    print(f"oks      {report['oks']}")
+    print(
+        f"errors   missing {report['missing']}, {report['notices']} notices,"
+        f" {report['failed_connections']} failed connections"
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
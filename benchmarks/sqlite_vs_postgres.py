@@ -0,0 +1,151 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compare the embedded SqliteEventRepo and LogEventRepo against PostgresEventRepo
+
+Usage: PYTHONPATH=. python benchmarks/sqlite_vs_postgres.py [--events N] [--db-url HOST]
+
+Postgres is only benchmarked when --db-url is set. Its tables are dropped first,
+so never point this at a database holding real data.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from ndk import crypto
+from ndk.event import event, event_filter, event_tags
+from ndk.relay.event_repo import (
+    event_repo,
+    log_event_repo,
+    memory_event_repo,
+    postgres_event_repo,
+    sqlite_event_repo,
+)
+
+KINDS = [1, 1, 1, 7, 3]
+
+
+def build_workload(
+    n: int, n_authors: int
+) -> tuple[list[event.Event], list[list[event_filter.EventFilter]]]:
+    rng = random.Random(0)
+    authors = [crypto.KeyPair() for _ in range(n_authors)]
+    now = int(time.time())
+
+    evs: list[event.Event] = []
+    for i in range(n):
+        tags = [["p", rng.choice(authors).public]]
+        if evs and rng.random() < 0.5:
+            tags.append(["e", rng.choice(evs).id])
+        evs.append(
+            event.RegularEvent.build(
+                rng.choice(authors),
+                kind=rng.choice(KINDS),
+                created_at=now - n + i,
+                tags=event_tags.EventTags(tags),
+                content=f"note {i} about nostr relays",
+            )
+        )
+
+    queries = []
+    for _ in range(50):
+        author = rng.choice(authors).public
+        queries.extend(
+            [
+                [event_filter.EventFilter(authors=[author], limit=50)],
+                [event_filter.EventFilter(authors=[author], kinds=[1], limit=20)],
+                [event_filter.EventFilter(kinds=[7], limit=100)],
+                [event_filter.EventFilter(generic_tags={"p": [author]}, limit=100)],
+                [event_filter.EventFilter(ids=[rng.choice(evs).id[:8]])],
+            ]
+        )
+    return evs, queries
+
+
+async def bench(
+    name: str,
+    repo: event_repo.EventRepo,
+    evs: list[event.Event],
+    queries: list[list[event_filter.EventFilter]],
+):
+    start = time.perf_counter()
+    for ev in evs:
+        await repo.add(ev)
+    insert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for fltrs in queries:
+        await repo.get(fltrs)
+    query_seconds = time.perf_counter() - start
+
+    # concurrent clients, which is where reads off the event loop matter
+    start = time.perf_counter()
+    await asyncio.gather(*[repo.get(fltrs) for fltrs in queries])
+    concurrent_seconds = time.perf_counter() - start
+
+    print(
+        f"{name:<10} "
+        f"{len(evs) / insert_seconds:10.0f} inserts/s "
+        f"{query_seconds / len(queries) * 1000:8.2f} ms/query "
+        f"{len(queries) / concurrent_seconds:10.0f} queries/s concurrent"
+    )
+
+
+async def run(n: int, n_authors: int, db_url: str):
+    print(f"Building {n} events from {n_authors} authors...")
+    evs, queries = build_workload(n, n_authors)
+
+    await bench("memory", memory_event_repo.MemoryEventRepo(), evs, queries)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite = await sqlite_event_repo.SqliteEventRepo.create(
+            os.path.join(tmp, "events.db")
+        )
+        await bench("sqlite", sqlite, evs, queries)
+        sqlite.close()
+
+        log = await log_event_repo.LogEventRepo.create(os.path.join(tmp, "events"))
+        await bench("log", log, evs, queries)
+        log.close()
+
+    if db_url:
+        postgres = await postgres_event_repo.PostgresEventRepo.create(
+            db_url, 5432, "nostr", "nostr", "nostr", drop_db=True
+        )
+        await bench("postgres", postgres, evs, queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--authors", type=int, default=200)
+    parser.add_argument("--db-url", default="", help="also benchmark Postgres")
+    args = parser.parse_args()
+
+    asyncio.run(run(args.events, args.authors, args.db_url))
+
+
+if __name__ == "__main__":
+    main()
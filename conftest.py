@@ -170,13 +170,14 @@ async def local_relay(
         relay_url = "wss://tests"
 
     auth = auth_handler.AuthHandler(relay_url)
-    sh = subscription_handler.SubscriptionHandler(response_queue)
+    groups = subscription_handler.SubscriptionGroups()
+    sh = subscription_handler.SubscriptionHandler(response_queue, groups=groups)
     repo = memory_event_repo.MemoryEventRepo()
     ev_notifier = event_notifier.EventNotifier()
     eh = event_handler.EventHandler(repo, ev_notifier)
     msg_handler = message_handler.MessageHandler(auth, repo, sh, eh)
     md = message_dispatcher.MessageDispatcher(msg_handler)
-    eh.register_received_cb(sh.handle_event)
+    eh.register_received_cb(groups.handle_event)
     await response_queue.put(auth.build_auth_message())
 
     handler_task = asyncio.create_task(
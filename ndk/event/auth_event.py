@@ -31,7 +31,7 @@ class AuthEvent(event.Event):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def validate(self):
+    def check(self):
         if self.kind != types.EventKind.AUTH:
             raise ValueError(f"AuthEvent must have kind {types.EventKind.AUTH}")
 
@@ -40,14 +40,14 @@ class AuthEvent(event.Event):
             raise ValueError("AuthEvent must be created within 10 minutes of now")
 
         relay_tag = self.tags.get("relay")
-        if relay_tag == []:
+        if not relay_tag:
             raise ValueError("AuthEvent must have a relay tag")
 
         challenge_tag = self.tags.get("challenge")
-        if challenge_tag == []:
+        if not challenge_tag:
             raise ValueError("AuthEvent must have a challenge tag")
 
-        return super().validate()
+        return super().check()
 
     @classmethod
     def from_parts(
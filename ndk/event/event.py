@@ -48,15 +48,31 @@ class Event:
             self.validate()
 
     def validate(self):
+        self.check()
+        self.verify()
+
+    def check(self):
+        """Kind-specific checks of the fields, without any hashing or crypto
+
+        Subclasses extend this for their kind's rules.
+        """
         if self.kind == types.EventKind.INVALID:
             raise exceptions.ValidationError(f"Invalid event kind {self.kind}")
 
+    def verify(self):
+        """Checks the id is the hash of the event and sig is its signature"""
         payload = serialize.serialize_as_bytes(
             [0, self.pubkey, self.created_at, self.kind, self.tags, self.content]
         )
 
         hashed_payload = hashlib.sha256(payload)
 
+        # comparing the hash is much cheaper than checking the signature
+        if hashed_payload.hexdigest() != self.id:
+            raise exceptions.ValidationError(
+                f"ID does not match hash of payload: {self}"
+            )
+
         try:
             if not self.sig.verify(self.pubkey, hashed_payload.digest()):
                 raise exceptions.ValidationError(
@@ -68,10 +84,16 @@ class Event:
                 f"Signature validation failed: {self}"
             ) from exc
 
-        if hashed_payload.hexdigest() != self.id:
-            raise exceptions.ValidationError(
-                f"ID does not match hash of payload: {self}"
-            )
+    def get_expiration(self) -> typing.Optional[int]:
+        """NIP-40 expiration timestamp, ignored if it isn't an integer"""
+        tags = self.tags.get("expiration")
+        if len(tags) == 0:
+            return None
+
+        try:
+            return int(tags[0][1])
+        except ValueError:
+            return None
 
     @classmethod
     def build(
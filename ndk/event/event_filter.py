@@ -19,14 +19,15 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
-import collections
 import dataclasses
 import logging
+import math
+import re
 import string
 import typing
 
 from ndk import crypto, types
-from ndk.event import event
+from ndk.event import event, event_tags
 
 # "ids": <a list of event ids or prefixes>,
 # "authors": <a list of pubkeys or prefixes, the pubkey of an event must be one of these>,
@@ -36,10 +37,113 @@ from ndk.event import event
 # "since": <an integer unix timestamp, events must be newer than this to pass>,
 # "until": <an integer unix timestamp, events must be older than this to pass>,
 # "limit": <maximum number of events to be returned in the initial query>
+# "search": <a NIP-50 query string, every word must appear in the content>
 
 
 logger = logging.getLogger(__name__)
 
+_WORD = re.compile(r"[^\W_]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased words of event content, as indexed for NIP-50 search"""
+    return _WORD.findall(text.lower())
+
+
+def search_terms(query: str) -> list[str]:
+    """Words of a NIP-50 query, skipping unsupported key:value extensions"""
+    return tokenize(" ".join(word for word in query.split() if ":" not in word))
+
+
+def search_rank(content: str, terms: set[str]) -> float:
+    """Relevance of content to the search terms, higher is better
+
+    Term frequency damped by content length, the same as Postgres'
+    ts_rank with normalization 1.
+    """
+    words = tokenize(content)
+    if not words:
+        return 0.0
+    return sum(1 for word in words if word in terms) / (1 + math.log(len(words)))
+
+
+def filters_key(fltrs: list["EventFilter"]) -> tuple[tuple, ...]:
+    """Hashable form of a REQ's filters, equal for any order of the filters"""
+    return tuple(sorted({fltr.key() for fltr in fltrs}, key=repr))
+
+
+class _Prefixes:
+    """Exact values or prefixes, matched with one set lookup per distinct length"""
+
+    __slots__ = ("values", "lengths")
+
+    def __init__(self, values: list[str]):
+        self.values = frozenset(values)
+        self.lengths = tuple(sorted({len(value) for value in self.values}))
+
+    def matches(self, s: str) -> bool:
+        if len(self.lengths) == 1:
+            return s[: self.lengths[0]] in self.values
+        return any(s[:n] in self.values for n in self.lengths)
+
+
+class CompiledFilter:
+    """An EventFilter turned into set lookups, for matching it against many events
+
+    Tag conditions use the event's tag index, built once per event and shared
+    by every filter it is matched against.
+    """
+
+    __slots__ = ("ids", "authors", "kinds", "tags", "since", "until", "terms")
+
+    def __init__(self, fltr: "EventFilter"):
+        self.ids = _Prefixes(fltr.ids) if fltr.ids else None
+        self.authors = _Prefixes(fltr.authors) if fltr.authors else None
+        self.kinds = frozenset(fltr.kinds) if fltr.kinds else None
+        self.tags = tuple(
+            (name, frozenset(values))
+            for name, values in (fltr.generic_tags or {}).items()
+        )
+        self.since = fltr.since
+        self.until = fltr.until
+        self.terms = frozenset(search_terms(fltr.search)) if fltr.search else None
+
+    def matches(self, ev: event.Event) -> bool:
+        # cheapest checks first
+        if self.kinds is not None and ev.kind not in self.kinds:
+            return False
+
+        if self.until and ev.created_at >= self.until:
+            return False
+
+        if self.since and ev.created_at <= self.since:
+            return False
+
+        if self.authors is not None and not self.authors.matches(ev.pubkey):
+            return False
+
+        if self.ids is not None and not self.ids.matches(ev.id):
+            return False
+
+        if self.tags:
+            if not ev.tags:
+                # no tags in ev, but filter requires them
+                return False
+
+            ev_tags = (
+                ev.tags.values_by_name()
+                if isinstance(ev.tags, event_tags.EventTags)
+                else event_tags.index_tags(ev.tags)
+            )
+            for name, values in self.tags:
+                if values.isdisjoint(ev_tags.get(name, ())):
+                    return False
+
+        if self.terms and not self.terms.issubset(tokenize(ev.content)):
+            return False
+
+        return True
+
 
 @dataclasses.dataclass
 class EventFilter:
@@ -50,6 +154,7 @@ class EventFilter:
     since: typing.Optional[int] = None
     until: typing.Optional[int] = None
     limit: typing.Optional[int] = None
+    search: typing.Optional[str] = None
 
     def check_value(self, field_name, val_type):
         if not isinstance(self.__dict__[field_name], val_type):
@@ -112,6 +217,9 @@ class EventFilter:
             self.check_value("limit", int)
             if self.limit < 0:
                 raise ValueError("Limit must be greater than or equal to 0")
+        if self.search is not None:
+            self.check_value("search", str)
+            self.set_falsy_to_none("search")
 
         if self.kinds is not None:
             for kind in self.kinds:
@@ -131,42 +239,38 @@ class EventFilter:
                     d[k] = v
         return d
 
-    def matches_event(self, ev: event.Event) -> bool:
-        if self.ids and not any(ev.id.startswith(x) for x in self.ids):
-            return False
+    def key(self) -> tuple:
+        """Hashable form of the filter, equal for filters that differ only in order"""
+        return self.live_key() + (self.limit,)
 
-        if self.authors and not any(ev.pubkey.startswith(x) for x in self.authors):
-            return False
+    def live_key(self) -> tuple:
+        """key() without the limit, which only bounds the stored events returned"""
 
-        if self.kinds and ev.kind not in self.kinds:
-            return False
+        def items(lst: typing.Optional[list]) -> typing.Optional[tuple]:
+            return tuple(sorted(set(lst))) if lst else None
 
+        tags = None
         if self.generic_tags:
-            if not ev.tags:
-                # no tags in ev, but filter requires them
-                return False
-
-            ev_tags = collections.defaultdict(list)
-            for tag in ev.tags:
-                # allow generic queries for all `#[alpha]` based on NIP-12
-                if tag[0] in string.ascii_letters:
-                    ev_tags[tag[0]].append(tag[1])
-
-            for identifier, lst in self.generic_tags.items():
-                if identifier not in ev_tags:
-                    # identifier required in filter, but event has no tags w/ identifier
-                    return False
-                elif not any(val in ev_tags[identifier] for val in lst):
-                    # ev has required identifier, but values in filter don't match ev values
-                    return False
-
-        if self.until and ev.created_at >= self.until:
-            return False
+            tags = tuple(
+                sorted((k, items(v)) for k, v in self.generic_tags.items() if v)
+            )
+
+        return (
+            items(self.ids),
+            items(self.authors),
+            items(self.kinds),
+            tags,
+            self.since,
+            self.until,
+            self.search,
+        )
 
-        if self.since and ev.created_at <= self.since:
-            return False
+    def compile(self) -> "CompiledFilter":
+        """Predicate for matching many events against this filter"""
+        return CompiledFilter(self)
 
-        return True
+    def matches_event(self, ev: event.Event) -> bool:
+        return self.compile().matches(ev)
 
     @classmethod
     def from_dict(cls, d: dict) -> "EventFilter":
@@ -184,6 +288,7 @@ class EventFilter:
             since=d.get("since"),
             until=d.get("until"),
             limit=d.get("limit"),
+            search=d.get("search"),
         )
 
 
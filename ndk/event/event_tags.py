@@ -19,6 +19,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import itertools
 import typing
 
 from ndk import crypto, types
@@ -48,6 +49,13 @@ class EventTag(list):
 
         return super().__new__(cls, *value)
 
+    @classmethod
+    def from_validated(cls, value: list[str]) -> "EventTag":
+        """Tag of already validated values, skipping the checks"""
+        tag = list.__new__(cls)
+        tag.extend(value)
+        return tag
+
 
 class PublicKeyTag(EventTag):
     def __init__(self, value: list[str]):
@@ -143,7 +151,21 @@ class UnknownEventTag(EventTag):
     pass
 
 
+def index_tags(tags: list[list[str]]) -> dict[str, set[str]]:
+    """Values of the tags by tag name, e.g. {"p": {pubkey, ...}}"""
+    index: dict[str, set[str]] = {}
+    for tag in tags:
+        if len(tag) >= 2:
+            index.setdefault(tag[0], set()).add(tag[1])
+    return index
+
+
 class EventTags(list):
+    # built on first use and rebuilt if tags were added or removed since
+    _by_name: typing.Optional[dict[str, list[EventTag]]] = None
+    _values: typing.Optional[dict[str, set[str]]] = None
+    _indexed_len = -1
+
     def __init__(self, tags: typing.Optional[list[list[str]]] = None):
         if tags is None:
             tags = []
@@ -155,19 +177,66 @@ class EventTags(list):
                 f"{self.__class__.__name__} must be a str, not {type(tags)}"
             )
 
-        if not all(isinstance(item, list) for item in tags):
+        if not all(map(isinstance, tags, itertools.repeat(list))):
             raise ValueError(
                 f"{self.__class__.__name__} must be a list of lists, not {tags}"
             )
 
+        if set(map(type, itertools.chain.from_iterable(tags))) <= {str}:
+            self._add_all(tags)
+            return
+
         for tag in tags:
             if len(tag) < 2:
                 raise ValueError(f"Tag must have at least 2 items, not {tag}")
 
             self.add(self._parse_tag(tag))
 
+    def _add_all(self, tags: list[list[str]]):
+        """Adds tags of str, validating the values of p and e tags in bulk
+
+        Contact lists hold thousands of p tags, so rather than validating each
+        pubkey on its own they are checked together, then wrapped unchecked.
+        """
+        if tags and min(map(len, tags)) < 2:
+            short = next(tag for tag in tags if len(tag) < 2)
+            raise ValueError(f"Tag must have at least 2 items, not {short}")
+
+        bulk = {"p": PublicKeyTag, "e": EventIdTag}
+        crypto.PublicKeyStr.validate_many(
+            [tag[1] for tag in tags if tag[0] == "p" and len(tag) == 2]
+        )
+        types.EventID.validate_many(
+            [tag[1] for tag in tags if tag[0] == "e" and len(tag) == 2]
+        )
+
+        for tag in tags:
+            if len(tag) == 2 and tag[0] in bulk:
+                self.append(bulk[tag[0]].from_validated(tag))
+            else:
+                self.append(self._parse_tag(tag))
+
+    def _index(self) -> dict[str, list[EventTag]]:
+        if self._by_name is None or self._indexed_len != len(self):
+            by_name: dict[str, list[EventTag]] = {}
+            for tag in self:
+                by_name.setdefault(tag[0], []).append(tag)
+            self._by_name = by_name
+            self._values = None
+            self._indexed_len = len(self)
+        return self._by_name
+
     def get(self, identifier: str) -> list[EventTag]:
-        return [tag for tag in self if tag[0] == identifier]
+        return list(self._index().get(identifier, ()))
+
+    def values_by_name(self) -> dict[str, set[str]]:
+        """Tag values by tag name, shared by every filter matched against the event"""
+        by_name = self._index()
+        if self._values is None:
+            self._values = {
+                name: {tag[1] for tag in tags} for name, tags in by_name.items()
+            }
+        return self._values
 
     def _parse_tag(self, tag: list[str]) -> EventTag:
         if tag[0] == "p":
@@ -31,13 +31,13 @@ class ParameterizedReplaceableEvent(event.ReplaceableEvent):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def validate(self):
+    def check(self):
         if not 30000 <= self.kind < 40000:
             raise ValueError(
                 "ParameterizedReplaceableEvent must be in range [20000-30000)"
             )
 
-        return super().validate()
+        return super().check()
 
     def get_normalized_d_tag_value(self) -> typing.Optional[str]:
         """Implement NIP-33 behavior to normalize d tags across variants"""
@@ -42,7 +42,7 @@ class ReactionEvent(event.RegularEvent):
             keys=keys, kind=types.EventKind.REACTION, content=content, tags=tags
         )
 
-    def validate(self):
+    def check(self):
         if len(self.tags) < 2:
             raise exceptions.ValidationError(
                 f"{self.__class__.__name__} must have 2 or more tags: {self}"
@@ -58,4 +58,4 @@ class ReactionEvent(event.RegularEvent):
                 f"{self.__class__.__name__}  must have one or more 'e' tags: {self}"
             )
 
-        return super().validate()
+        return super().check()
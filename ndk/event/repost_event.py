@@ -40,7 +40,7 @@ class RepostEvent(event.RegularEvent):
             keys=keys, kind=types.EventKind.REPOST, content=content, tags=tags
         )
 
-    def validate(self):
+    def check(self):
         if len(self.tags) not in (1, 2):
             raise exceptions.ValidationError(
                 f"Repost event must have 1 or 2 tags: {self}"
@@ -51,4 +51,4 @@ class RepostEvent(event.RegularEvent):
                 f"Repost event w/ 2 tags must have a 'p' tag: {self}"
             )
 
-        return super().validate()
+        return super().check()
@@ -23,7 +23,7 @@
 import pytest
 
 from ndk import crypto, types
-from ndk.event import metadata_event
+from ndk.event import event_tags, metadata_event, text_note_event
 
 
 @pytest.fixture
@@ -39,3 +39,19 @@ def test_event_validate_invalid(event):
 
 def test_event_eq_bad_other(event):
     assert not event == 1
+
+
+@pytest.mark.parametrize(
+    "tags,expected",
+    [
+        ([], None),
+        ([["expiration", "1600000000"]], 1600000000),
+        ([["expiration", "soon"]], None),
+    ],
+)
+def test_get_expiration(tags, expected):
+    ev = text_note_event.TextNoteEvent.from_content(
+        crypto.KeyPair(), "hi", tags=event_tags.EventTags(tags)
+    )
+
+    assert ev.get_expiration() == expected
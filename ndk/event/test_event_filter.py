@@ -25,7 +25,7 @@ import mock
 import pytest
 
 from ndk import crypto
-from ndk.event import event_filter
+from ndk.event import event_filter, event_tags
 
 VALID_PUBKEY = crypto.PublicKeyStr("a" * 64)
 WRONG_PUBKEY = crypto.PublicKeyStr("b" * 64)
@@ -341,6 +341,38 @@ def test_matches_until_later():
     assert not f.matches_event(mock_ev)
 
 
+def test_init_bad_type_search():
+    with pytest.raises(ValueError):
+        event_filter.EventFilter(search=1)  # type: ignore
+
+
+@pytest.mark.parametrize(
+    "search, content, matches",
+    [
+        ("nostr", "Hello Nostr!", True),
+        ("hello nostr", "nostr says hello", True),
+        ("hello relay", "Hello Nostr!", False),
+        ("nost", "Hello Nostr!", False),
+        ("nostr language:en", "Hello Nostr!", True),
+        ("language:en", "anything", True),
+    ],
+)
+def test_matches_search(search, content, matches):
+    f = event_filter.EventFilter(search=search)
+
+    mock_ev = mock.MagicMock()
+    mock_ev.content = content
+    mock_ev.created_at = 1
+    assert f.matches_event(mock_ev) == matches
+
+
+def test_search_from_dict_and_to_req():
+    f = event_filter.EventFilter.from_dict({"search": "best apps", "kinds": [1]})
+
+    assert f.search == "best apps"
+    assert f.for_req() == {"kinds": [1], "search": "best apps"}
+
+
 def test_to_req():
     f = event_filter.EventFilter(ids=["1", "2"])
     assert f.for_req() == {"ids": ["1", "2"]}
@@ -369,6 +401,7 @@ def test_from_dict_nonalpha_generic_ignored():
         ("kinds", []),
         ("generic_tags", {}),
         ("generic_tags", {"d": []}),
+        ("search", ""),
     ],
 )
 def test_to_req_empty_obj_excluded(field, value):
@@ -482,3 +515,87 @@ def test_authenticated_filter_none_auth_pubkey():
         event_filter.AuthenticatedEventFilter.from_dict_and_auth_pubkey(
             f.for_req(), None
         )
+
+
+def test_key_ignores_order_and_duplicates():
+    a = event_filter.EventFilter(
+        authors=["b", "a"], kinds=[1, 0, 1], generic_tags={"p": ["y", "x"]}, limit=5
+    )
+    b = event_filter.EventFilter(
+        authors=["a", "b"], kinds=[0, 1], generic_tags={"p": ["x", "y"]}, limit=5
+    )
+
+    assert a.key() == b.key()
+    assert hash(a.key()) == hash(b.key())
+
+
+def test_key_differs_for_different_filters():
+    assert (
+        event_filter.EventFilter(kinds=[1]).key()
+        != event_filter.EventFilter(kinds=[1], limit=1).key()
+    )
+    assert (
+        event_filter.EventFilter(generic_tags={"p": ["x"]}).key()
+        != event_filter.EventFilter(generic_tags={"e": ["x"]}).key()
+    )
+
+
+def test_live_key_ignores_limit():
+    assert (
+        event_filter.EventFilter(kinds=[1]).live_key()
+        == event_filter.EventFilter(kinds=[1], limit=1).live_key()
+    )
+    assert (
+        event_filter.EventFilter(kinds=[1], since=1).live_key()
+        != event_filter.EventFilter(kinds=[1]).live_key()
+    )
+
+
+def test_filters_key_ignores_filter_order():
+    a = event_filter.EventFilter(kinds=[0])
+    b = event_filter.EventFilter(authors=["a"])
+
+    assert event_filter.filters_key([a, b]) == event_filter.filters_key([b, a, b])
+
+
+def test_matches_event_exact_ids_and_prefixes():
+    exact = "c" * 64
+    f = event_filter.EventFilter(ids=["ab", "abcd", "f", exact])
+
+    mock_ev = mock.MagicMock()
+    for ev_id in ["ab" + "0" * 62, "abcd" + "0" * 60, "f" * 64, exact]:
+        mock_ev.id = ev_id
+        assert f.matches_event(mock_ev)
+
+    for ev_id in ["a" + "0" * 63, "c" * 63 + "d", "0" * 64]:
+        mock_ev.id = ev_id
+        assert not f.matches_event(mock_ev)
+
+
+def test_compiled_filters_share_the_event_tag_index():
+    fltrs = [
+        event_filter.EventFilter(generic_tags={"t": ["nostr"]}),
+        event_filter.EventFilter(generic_tags={"t": ["python"], "r": ["x"]}),
+        event_filter.EventFilter(generic_tags={"r": ["y"]}),
+    ]
+    compiled = [fltr.compile() for fltr in fltrs]
+
+    mock_ev = mock.MagicMock()
+    mock_ev.tags = event_tags.EventTags([["t", "nostr"], ["r", "x"], ["t", "python"]])
+    indexes = []
+    build = event_tags.EventTags.values_by_name
+
+    def values_by_name(tags):
+        indexes.append(build(tags))
+        return indexes[-1]
+
+    with mock.patch.object(
+        event_tags.EventTags,
+        "values_by_name",
+        autospec=True,
+        side_effect=values_by_name,
+    ):
+        assert [c.matches(mock_ev) for c in compiled] == [True, True, False]
+
+    assert len(indexes) == 3
+    assert indexes[0] is indexes[1] is indexes[2]
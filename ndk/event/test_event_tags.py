@@ -19,6 +19,7 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import mock
 import pytest
 
 from ndk import crypto, types
@@ -244,10 +245,70 @@ def test_event_tags_add_multiple_maintain_order():
 
 def test_event_tags_get_nothing():
     et = event_tags.EventTags()
-    assert et.get("p") == []
+    assert not et.get("p")
 
 
 def test_event_tags_add_get():
     et = event_tags.EventTags()
     et.add(event_tags.PublicKeyTag.from_pubkey(VALID_PUBKEY_STR))
     assert len(et.get("p")) == 1
+
+
+def test_event_tags_values_by_name():
+    et = event_tags.EventTags([["t", "a"], ["t", "b"], ["r", "c", "extra"]])
+    assert et.values_by_name() == {"t": {"a", "b"}, "r": {"c"}}
+    assert et.values_by_name() is et.values_by_name()
+
+
+def test_event_tags_values_by_name_rebuilt_after_add():
+    et = event_tags.EventTags([["t", "a"]])
+    assert et.values_by_name() == {"t": {"a"}}
+
+    et.add(event_tags.PublicKeyTag.from_pubkey(VALID_PUBKEY_STR))
+    assert et.values_by_name() == {"t": {"a"}, "p": {VALID_PUBKEY_STR}}
+
+
+def test_event_tags_get_sees_added_tags():
+    et = event_tags.EventTags([["t", "a"]])
+    assert not et.get("p")
+
+    et.add(event_tags.PublicKeyTag.from_pubkey(VALID_PUBKEY_STR))
+    assert et.get("p") == [["p", VALID_PUBKEY_STR]]
+    assert et.get("t") == [["t", "a"]]
+
+
+def test_event_tags_get_returns_a_copy():
+    et = event_tags.EventTags([["t", "a"]])
+    et.get("t").clear()
+    assert et.get("t") == [["t", "a"]]
+
+
+def test_event_tags_large_contact_list_validated_in_bulk():
+    pubkeys = [f"{i:064x}" for i in range(5000)]
+    tags = [["p", pubkey] for pubkey in pubkeys] + [["e", VALID_EVENT_ID_STR]]
+
+    with mock.patch.object(
+        crypto.PublicKeyStr, "validate", side_effect=crypto.PublicKeyStr.validate
+    ) as validate:
+        et = event_tags.EventTags(tags)
+
+    validate.assert_not_called()
+    assert et == tags
+    assert all(isinstance(tag, event_tags.PublicKeyTag) for tag in et.get("p"))
+    assert isinstance(et.get("e")[0], event_tags.EventIdTag)
+
+
+@pytest.mark.parametrize(
+    "bad_tag",
+    [
+        ["p", "not hex"],
+        ["p", "a" * 63],
+        ["e", "z" * 64],
+        ["p", VALID_PUBKEY_STR, "http://not-a-relay"],
+        ["p"],
+    ],
+)
+def test_event_tags_bulk_validation_still_rejects(bad_tag):
+    tags = [["p", VALID_PUBKEY_STR]] * 100 + [bad_tag]
+    with pytest.raises(ValueError):
+        event_tags.EventTags(tags)
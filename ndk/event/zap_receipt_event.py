@@ -33,7 +33,7 @@ class ZapReceiptEvent(event.Event):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def validate(self):
+    def check(self):
         if self.kind != types.EventKind.ZAP_RECEIPT:
             raise ValueError(
                 f"ZapReceiptEvent must have kind {types.EventKind.ZAP_RECEIPT}"
@@ -44,7 +44,7 @@ class ZapReceiptEvent(event.Event):
 
         for identifier in ["p", "bolt11", "description"]:
             relay_tag = self.tags.get(identifier)
-            if relay_tag == []:
+            if not relay_tag:
                 raise ValueError(f"ZapReceiptEvent must have a {identifier} tag")
 
-        return super().validate()
+        return super().check()
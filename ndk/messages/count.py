@@ -0,0 +1,94 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import dataclasses
+
+from ndk import serialize
+from ndk.messages import message
+
+
+class Count(message.ReadableMessage):
+    @classmethod
+    def deserialize_list(cls, lst: list):
+        assert len(lst) > 0
+        assert lst[0] == "COUNT"
+
+        if len(lst) < 3:
+            raise TypeError(
+                f"Unexpected format of COUNT message. Expected more than two items, but got: {lst}"
+            )
+
+        if len(lst) == 3 and isinstance(lst[2], dict) and "count" in lst[2]:
+            return CountResponse.deserialize_list(lst)
+        else:
+            return CountRequest.deserialize_list(lst)
+
+
+@dataclasses.dataclass
+class CountRequest(message.ReadableMessage, message.WriteableMessage):
+    """NIP-45 request sent from a client to count the events matching the filters"""
+
+    sub_id: str
+    filter_list: list[dict]
+
+    def __post_init__(self):
+        super().__post_init__()
+
+        if len(self.filter_list) == 0:
+            raise TypeError(f"List of filters must be greater than 0: {self}")
+
+    @classmethod
+    def deserialize_list(cls, lst: list):
+        assert len(lst) > 0
+        assert lst[0] == "COUNT"
+
+        if len(lst) < 3:
+            raise TypeError(
+                f"Unexpected format of COUNT message. Expected more than two items, but got: {lst}"
+            )
+
+        return cls(lst[1], [*lst[2:]])
+
+    def serialize(self) -> str:
+        return serialize.serialize_as_str(["COUNT", self.sub_id, *self.filter_list])
+
+
+@dataclasses.dataclass
+class CountResponse(message.ReadableMessage, message.WriteableMessage):
+    """NIP-45 response sent from the server with the number of matching events"""
+
+    sub_id: str
+    count: int
+
+    @classmethod
+    def deserialize_list(cls, lst: list):
+        assert len(lst) > 0
+        assert lst[0] == "COUNT"
+
+        if len(lst) != 3 or not isinstance(lst[2], dict) or "count" not in lst[2]:
+            raise TypeError(
+                f"Unexpected format of COUNT response. Expected a count object, but got: {lst}"
+            )
+
+        return cls(lst[1], lst[2]["count"])
+
+    def serialize(self) -> str:
+        return serialize.serialize_as_str(["COUNT", self.sub_id, {"count": self.count}])
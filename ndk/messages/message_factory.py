@@ -27,6 +27,7 @@ from ndk.messages import (
     auth,
     close,
     command_result,
+    count,
     eose,
     event_message,
     message,
@@ -62,6 +63,7 @@ def from_str(data: str) -> message.Message:
         "REQ": request.Request,
         "CLOSE": close.Close,
         "AUTH": auth.Auth,
+        "COUNT": count.Count,
     }
 
     if hdr not in factories:
@@ -44,3 +44,8 @@ class RelayEvent(message.ReadableMessage, message.WriteableMessage):
 
     def serialize(self) -> str:
         return serialize.serialize_as_str(["EVENT", self.sub_id, self.event_dict])
+
+    @staticmethod
+    def serialize_raw(sub_id: str, event_json: str) -> str:
+        """Wraps an already serialized event without parsing it again"""
+        return f'["EVENT",{serialize.serialize_as_str(sub_id)},{event_json}]'
@@ -0,0 +1,95 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import pytest
+
+from ndk import serialize
+from ndk.messages import count, message_factory
+
+
+def test_init_empty_filters():
+    with pytest.raises(TypeError):
+        count.CountRequest("1", [])
+
+
+def test_init_wrong_type_count():
+    with pytest.raises(TypeError):
+        count.CountResponse("1", "1")  # type: ignore
+
+
+def test_count_message_too_short():
+    msg = ["COUNT", "sub-id"]
+
+    with pytest.raises(TypeError):
+        count.Count.deserialize_list(msg)
+
+
+def test_request_multiple_filters():
+    msg = ["COUNT", "sub-id", {"kinds": [3]}, {}]
+
+    r = count.Count.deserialize_list(msg)
+
+    assert isinstance(r, count.CountRequest)
+    assert r.filter_list == [{"kinds": [3]}, {}]
+
+
+def test_response():
+    msg = ["COUNT", "sub-id", {"count": 5}]
+
+    r = count.Count.deserialize_list(msg)
+
+    assert isinstance(r, count.CountResponse)
+    assert r.count == 5
+
+
+def test_response_bad_format():
+    msg = ["COUNT", "sub-id", {"count": 5}, {}]
+
+    with pytest.raises(TypeError):
+        count.CountResponse.deserialize_list(msg)
+
+
+def test_serialize_request():
+    r = count.CountRequest("1", [{}])
+
+    assert serialize.deserialize_str(r.serialize()) == ["COUNT", "1", {}]
+
+
+def test_serialize_response():
+    r = count.CountResponse("1", 10)
+
+    assert serialize.deserialize_str(r.serialize()) == ["COUNT", "1", {"count": 10}]
+
+
+def test_factory_request():
+    msg = ["COUNT", "sub-id", {}]
+
+    r = message_factory.from_str(serialize.serialize_as_str(msg))
+
+    assert isinstance(r, count.CountRequest)
+
+
+def test_factory_response():
+    msg = ["COUNT", "sub-id", {"count": 0}]
+
+    r = message_factory.from_str(serialize.serialize_as_str(msg))
+
+    assert isinstance(r, count.CountResponse)
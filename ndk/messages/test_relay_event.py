@@ -68,6 +68,16 @@ def test_serialize():
     assert serialize.deserialize_str(n.serialize()) == ["EVENT", "subscription-id", {}]
 
 
+def test_serialize_raw_matches_serialize():
+    event_dict = {"id": "1", "content": 'quote " and ünicode', "tags": [["p", "1"]]}
+
+    raw = relay_event.RelayEvent.serialize_raw(
+        'sub "1"', serialize.serialize_as_str(event_dict)
+    )
+
+    assert raw == relay_event.RelayEvent('sub "1"', event_dict).serialize()
+
+
 def test_factory():
     msg = ["EVENT", "subscription-id", {}]
 
@@ -0,0 +1,209 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Scalable Bloom filter of event ids, for skipping duplicate lookups at ingest
+
+A miss means the id was never added, so looking it up in the repo can be
+skipped. A hit may be a false positive, so it is confirmed against the repo.
+Ids are never removed, and a removed event just stays a false positive.
+
+The filter grows by adding a bigger layer whenever the newest one is full.
+Each layer gets a tighter error rate, so the overall false positive rate stays
+under the configured one however many ids are added (Almeida et al., 2007).
+
+File layout, all integers big-endian:
+
+    header: magic (8 bytes) | layer count (u32)
+    layer:  capacity (u64) | count (u64) | hashes (u32) | bits (u64) | bit array
+"""
+
+import dataclasses
+import hashlib
+import math
+import os
+import struct
+import typing
+
+MAGIC = b"NDKBLOOM"
+HEADER = struct.Struct(">8sI")
+LAYER = struct.Struct(">QQIQ")
+
+
+class BloomFilterError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class BloomConfig:
+    initial_capacity: int = 100_000
+    error_rate: float = 0.001
+    # capacity multiplier and error rate ratio of each new layer
+    growth: int = 2
+    tightening: float = 0.5
+
+
+def _hashes(key: str) -> tuple[int, int]:
+    # event ids are already sha256 digests, so they're used as is
+    try:
+        h1, h2 = int(key[:16], 16), int(key[16:32], 16)
+    except ValueError:
+        h1 = -1
+    if h1 < 0 or len(key) != 64:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+    # odd step, so probes never repeat while fewer than the bit count
+    return h1, h2 | 1
+
+
+class _Layer:
+    __slots__ = ("capacity", "count", "hashes", "size", "bits")
+
+    def __init__(
+        self,
+        capacity: int,
+        hashes: int,
+        size: int,
+        count: int = 0,
+        bits: typing.Optional[bytearray] = None,
+    ):
+        self.capacity = capacity
+        self.count = count
+        self.hashes = hashes
+        self.size = size
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def sized(cls, capacity: int, error_rate: float) -> "_Layer":
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hashes = max(1, round(size / capacity * math.log(2)))
+        return cls(capacity, hashes, size)
+
+    def add(self, h1: int, h2: int):
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hashes: tuple[int, int]) -> bool:
+        h1, h2 = hashes
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter:
+    _cfg: BloomConfig
+    _layers: list[_Layer]
+
+    def __init__(self, cfg: BloomConfig = BloomConfig()):
+        self._cfg = cfg
+        self._layers = [
+            _Layer.sized(cfg.initial_capacity, cfg.error_rate * (1 - cfg.tightening))
+        ]
+
+    def __len__(self) -> int:
+        """Number of distinct keys added, give or take false positives"""
+        return sum(layer.count for layer in self._layers)
+
+    def __contains__(self, key: str) -> bool:
+        hashes = _hashes(key)
+        for layer in self._layers:
+            if hashes in layer:
+                return True
+        return False
+
+    @property
+    def size_bytes(self) -> int:
+        return sum(len(layer.bits) for layer in self._layers)
+
+    def add(self, key: str):
+        hashes = _hashes(key)
+        for layer in self._layers:
+            if hashes in layer:
+                return
+
+        last = self._layers[-1]
+        if last.count >= last.capacity:
+            n = len(self._layers)
+            last = _Layer.sized(
+                last.capacity * self._cfg.growth,
+                self._cfg.error_rate
+                * (1 - self._cfg.tightening)
+                * self._cfg.tightening**n,
+            )
+            self._layers.append(last)
+        last.add(*hashes)
+
+    def update(self, keys: typing.Iterable[str]):
+        for key in keys:
+            self.add(key)
+
+    def write(self, path: str):
+        """Atomically replaces path with the filter"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(self._layers)))
+            for layer in self._layers:
+                f.write(
+                    LAYER.pack(layer.capacity, layer.count, layer.hashes, layer.size)
+                )
+                f.write(layer.bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def read(cls, path: str, cfg: BloomConfig = BloomConfig()) -> "ScalableBloomFilter":
+        """Filter written by write(), cfg only applies to layers added from now on"""
+        with open(path, "rb") as f:
+            data = f.read()
+
+        try:
+            magic, num_layers = HEADER.unpack_from(data)
+            if magic != MAGIC:
+                raise BloomFilterError(f"{path} is not a bloom filter")
+
+            layers = []
+            offset = HEADER.size
+            for _ in range(num_layers):
+                capacity, count, hashes, size = LAYER.unpack_from(data, offset)
+                offset += LAYER.size
+                end = offset + (size + 7) // 8
+                if end > len(data):
+                    raise BloomFilterError(f"{path} is truncated")
+                layers.append(
+                    _Layer(capacity, hashes, size, count, bytearray(data[offset:end]))
+                )
+                offset = end
+        except struct.error as exc:
+            raise BloomFilterError(f"{path} is truncated") from exc
+
+        if not layers:
+            raise BloomFilterError(f"{path} has no layers")
+
+        bloom = cls(cfg)
+        bloom._layers = layers
+        return bloom
@@ -19,11 +19,13 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import contextlib
 import dataclasses
+import typing
 
 from ndk import exceptions
-from ndk.event import event
-from ndk.relay import event_notifier
+from ndk.event import event, event_builder
+from ndk.relay import bloom_filter, event_notifier, tracing
 from ndk.relay.event_repo import event_repo
 
 
@@ -33,37 +35,129 @@ class EventHandlerConfig:
     max_content_length: int = 8196
 
 
+# ingestion stages, cheapest first
+STAGES = ("size", "structure", "kind", "duplicate", "signature")
+
+
+@dataclasses.dataclass
+class IngestStats:
+    """Events accepted, and rejected per stage, shared by all connections"""
+
+    accepted: int = 0
+    # duplicate checks answered by the bloom filter alone
+    lookups_skipped: int = 0
+    rejected: dict[str, int] = dataclasses.field(
+        default_factory=lambda: dict.fromkeys(STAGES, 0)
+    )
+
+
 class EventHandler:
     _received_event_notifier: event_notifier.EventNotifier
     _repo: event_repo.EventRepo
     _config = EventHandlerConfig
+    _stats: IngestStats
+    _stored_ids: typing.Optional[bloom_filter.ScalableBloomFilter]
 
     def __init__(
         self,
         repo: event_repo.EventRepo,
         notifier: event_notifier.EventNotifier,
         cfg: EventHandlerConfig = EventHandlerConfig(),
+        stats: typing.Optional[IngestStats] = None,
+        stored_ids: typing.Optional[bloom_filter.ScalableBloomFilter] = None,
     ):
+        """stored_ids must hold the id of every event in repo, if given"""
         self._received_event_notifier = notifier
         self._repo = repo
         self._cfg = cfg
+        self._stats = stats if stats is not None else IngestStats()
+        self._stored_ids = stored_ids
 
-    async def handle_event(self, ev: event.Event):
-        if ev.content is not None and len(ev.content) > self._cfg.max_content_length:
+    @property
+    def stats(self) -> IngestStats:
+        return self._stats
+
+    @contextlib.contextmanager
+    def _stage(self, name: str):
+        try:
+            yield
+        except Exception:
+            self._stats.rejected[name] += 1
+            raise
+
+    async def ingest(self, fields: dict) -> typing.Optional[event.Event]:
+        """Builds and validates an event from its wire dict, cheapest checks first
+
+        Returns None if the event is already stored, without verifying its
+        signature. With stored_ids, the repo is only asked about probable
+        duplicates. Raises like event_builder.from_dict() for a rejected event.
+        """
+        with self._stage("size"):
+            content, tags = fields.get("content"), fields.get("tags")
+            # malformed values are left for the structure checks
+            if isinstance(content, str):
+                self._check_content(content)
+            if isinstance(tags, list):
+                self._check_tags(tags)
+
+        with self._stage("structure"):
+            ev = event_builder.from_dict(fields, skip_validate=True)
+            self._check_created_at(ev.created_at)
+
+        with self._stage("kind"):
+            ev.check()
+
+        if self._stored_ids is not None and ev.id not in self._stored_ids:
+            self._stats.lookups_skipped += 1
+        elif await self._repo.has_event(ev.id):
+            self._stats.rejected["duplicate"] += 1
+            tracing.mark("validate")
+            return None
+
+        with self._stage("signature"):
+            ev.verify()
+
+        self._stats.accepted += 1
+        tracing.mark("validate")
+        return ev
+
+    @staticmethod
+    def _check_created_at(created_at):
+        # bool is an int, and the repos index timestamps as unsigned 64-bit ints
+        if (
+            isinstance(created_at, bool)
+            or not isinstance(created_at, int)
+            or not 0 <= created_at < 2**64
+        ):
+            raise exceptions.ValidationError(
+                f"created_at must be a non-negative integer, got {created_at!r}"
+            )
+
+    def _check_content(self, content: str):
+        if len(content) > self._cfg.max_content_length:
             raise exceptions.ValidationError(
                 f"Relay doesn't support content greater than {self._cfg.max_content_length} bytes"
             )
 
-        if len(ev.tags) > self._cfg.max_event_tags:
+    def _check_tags(self, tags: list):
+        if len(tags) > self._cfg.max_event_tags:
             raise exceptions.ValidationError(
                 f"Relay doesn't support more than {self._cfg.max_event_tags} tags"
             )
 
+    async def handle_event(self, ev: event.Event):
+        if ev.content is not None:
+            self._check_content(ev.content)
+        self._check_tags(ev.tags)
+
         if isinstance(ev, event.PersistentEvent):
             await self._repo.add(ev)
+            if self._stored_ids is not None:
+                self._stored_ids.add(ev.id)
 
         if isinstance(ev, event.BroadcastEvent):
             await self._received_event_notifier.handle_event(ev)
+            tracing.mark("fanout")
 
     def register_received_cb(
         self, cb: event_notifier.EventNotifierCb
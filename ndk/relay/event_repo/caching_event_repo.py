@@ -0,0 +1,220 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""EventRepo decorator caching get() results until a write could change them
+
+Entries are keyed by the canonical form of their filters, so the same REQ
+with its fields in another order shares an entry. A new event invalidates
+exactly the entries with a filter that matches it, checked the same way live
+subscriptions are. A removed event invalidates the entries holding it.
+
+Writes the wrapped repo makes on its own, like retention evictions and
+expiration sweeps, are not seen here, so entries also expire after `ttl`
+seconds, or when the first of their events expires per NIP-40.
+"""
+
+import collections
+import dataclasses
+import time
+import typing
+
+from ndk import serialize, types
+from ndk.event import event, event_filter
+from ndk.relay import tracing
+from ndk.relay.event_repo import event_repo
+
+CacheKey = tuple[tuple, ...]
+
+# invalidation candidates for entries whose filters don't restrict kinds
+_ANY_KIND = -1
+
+
+@dataclasses.dataclass
+class CacheConfig:
+    max_entries: int = 10_000
+    # total events held by all entries
+    max_events: int = 500_000
+    ttl: float = 60.0
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+@dataclasses.dataclass
+class _Entry:
+    fltrs: list[event_filter.CompiledFilter]
+    evs: list[event.Event]
+    expires_at: float
+    kinds: set[int]
+    serialized: typing.Optional[list[str]] = None
+
+
+class CachingEventRepo(event_repo.WrappingEventRepo):
+    _cfg: CacheConfig
+    _entries: collections.OrderedDict[CacheKey, _Entry]
+    _by_kind: dict[int, set[CacheKey]]
+    _by_id: dict[types.EventID, set[CacheKey]]
+    _cached_events: int
+    _writes: int
+    _stats: CacheStats
+
+    def __init__(self, repo: event_repo.EventRepo, cfg: CacheConfig = CacheConfig()):
+        self._cfg = cfg
+        self._entries = collections.OrderedDict()
+        self._by_kind = {}
+        self._by_id = {}
+        self._cached_events = 0
+        self._writes = 0
+        self._stats = CacheStats()
+        super().__init__(repo)
+
+    @property
+    def stats(self) -> CacheStats:
+        return self._stats
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def add(self, ev: event.Event) -> types.EventID:
+        ev_id = await super().add(ev)
+
+        self._writes += 1
+        # the wrapped repo removes the events ev replaces without going through
+        # self.remove(), so entries holding any of the author's events of that
+        # kind are dropped as well
+        replaceable = isinstance(ev, event.ReplaceableEvent)
+        keys = self._by_kind.get(ev.kind, set()) | self._by_kind.get(_ANY_KIND, set())
+        for key in keys:
+            entry = self._entries[key]
+            if any(fltr.matches(ev) for fltr in entry.fltrs) or (
+                replaceable
+                and any(
+                    held.pubkey == ev.pubkey and held.kind == ev.kind
+                    for held in entry.evs
+                )
+            ):
+                self._invalidate(key)
+
+        return ev_id
+
+    async def remove(self, event_id: types.EventID):
+        await super().remove(event_id)
+
+        self._writes += 1
+        for key in list(self._by_id.get(event_id, [])):
+            self._invalidate(key)
+
+    def _invalidate(self, key: CacheKey):
+        self._drop(key)
+        self._stats.invalidations += 1
+
+    def _drop(self, key: CacheKey):
+        entry = self._entries.pop(key)
+        self._cached_events -= len(entry.evs)
+
+        for kind in entry.kinds:
+            self._by_kind[kind].discard(key)
+            if not self._by_kind[kind]:
+                del self._by_kind[kind]
+
+        for ev in entry.evs:
+            self._by_id[ev.id].discard(key)
+            if not self._by_id[ev.id]:
+                del self._by_id[ev.id]
+
+    def _store(self, key: CacheKey, entry: _Entry):
+        if len(entry.evs) > self._cfg.max_events:
+            return
+
+        self._entries[key] = entry
+        self._cached_events += len(entry.evs)
+        for kind in entry.kinds:
+            self._by_kind.setdefault(kind, set()).add(key)
+        for ev in entry.evs:
+            self._by_id.setdefault(ev.id, set()).add(key)
+
+        while (
+            len(self._entries) > self._cfg.max_entries
+            or self._cached_events > self._cfg.max_events
+        ):
+            self._drop(next(iter(self._entries)))
+            self._stats.evictions += 1
+
+    def _lookup(self, key: CacheKey) -> typing.Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= time.time():
+            self._drop(key)
+            entry = None
+
+        if entry is None:
+            self._stats.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self._stats.hits += 1
+        return entry
+
+    async def _entry(self, fltrs: list[event_filter.EventFilter]) -> _Entry:
+        key = event_filter.filters_key(fltrs)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry
+
+        writes = self._writes
+        evs = await self._repo.get(fltrs)
+
+        expires_at = time.time() + self._cfg.ttl
+        for ev in evs:
+            expiration = ev.get_expiration()
+            if expiration is not None:
+                expires_at = min(expires_at, expiration)
+
+        kinds: set[int] = set()
+        for fltr in fltrs:
+            kinds.update(fltr.kinds or [_ANY_KIND])
+
+        entry = _Entry([fltr.compile() for fltr in fltrs], evs, expires_at, kinds)
+        # a write while fetching may or may not be in evs, so don't keep them
+        if writes == self._writes and key not in self._entries:
+            self._store(key, entry)
+        return entry
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        return list((await self._entry(fltrs)).evs)
+
+    async def get_serialized(self, fltrs: list[event_filter.EventFilter]) -> list[str]:
+        entry = await self._entry(fltrs)
+        tracing.mark("query")
+        if entry.serialized is None:
+            entry.serialized = [
+                serialize.serialize_as_str(ev.__dict__) for ev in entry.evs
+            ]
+        return list(entry.serialized)
@@ -20,10 +20,12 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import abc
+import typing
 
-from ndk import types
+from ndk import serialize, types
 from ndk.event import event, event_filter
 from ndk.event import parameterized_replaceable_event as pre
+from ndk.relay import tracing
 
 
 class EventRepo(abc.ABC):
@@ -33,6 +35,7 @@ class EventRepo(abc.ABC):
         if isinstance(ev, event.ReplaceableEvent):
             await self._delete_old_events(ev)
 
+        tracing.mark("persist")
         return ev_id
 
     async def _delete_old_events(self, ev: event.Event):
@@ -80,6 +83,72 @@ class EventRepo(abc.ABC):
     async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
         pass
 
+    async def get_serialized(self, fltrs: list[event_filter.EventFilter]) -> list[str]:
+        """Same as get(), but each event already serialized as a JSON object
+
+        Repos that store the wire format override this to skip re-serialization,
+        marking the "query" stage once the events are fetched too.
+        """
+        evs = await self.get(fltrs)
+        tracing.mark("query")
+        return [serialize.serialize_as_str(ev.__dict__) for ev in evs]
+
+    @abc.abstractmethod
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        """Number of events matching any of the filters, ignoring their limits (NIP-45)"""
+
     @abc.abstractmethod
     async def remove(self, event_id: types.EventID):
         pass
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        """Whether an event with this id is stored
+
+        Repos with an id index override this to skip building a query.
+        """
+        fltr = event_filter.EventFilter(ids=[event_id], limit=1)
+        return bool(await self.get([fltr]))
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        """Ids of every stored event, e.g. for rebuilding a bloom filter of them"""
+        for ev in await self.get([event_filter.EventFilter()]):
+            yield ev.id
+
+
+class WrappingEventRepo(EventRepo):
+    """Base of the decorators around another repo, which stores the events
+
+    Every call is passed on to the wrapped repo, whose add() also deletes the
+    events a replaceable event replaces and marks the trace.
+    """
+
+    _repo: EventRepo
+
+    def __init__(self, repo: EventRepo):
+        self._repo = repo
+        super().__init__()
+
+    async def add(self, ev: event.Event) -> types.EventID:
+        return await self._repo.add(ev)
+
+    # add() already stores through the wrapped repo
+    _persist = add
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        return await self._repo.get(fltrs)
+
+    async def get_serialized(self, fltrs: list[event_filter.EventFilter]) -> list[str]:
+        return await self._repo.get_serialized(fltrs)
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        return await self._repo.count(fltrs)
+
+    async def remove(self, event_id: types.EventID):
+        await self._repo.remove(event_id)
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        return await self._repo.has_event(event_id)
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        async for event_id in self._repo.stored_ids():
+            yield event_id
@@ -0,0 +1,87 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""EventRepo decorator timing each call into the wrapped repo
+
+Sits directly above the storage repo, below any cache, so the latencies are
+those of the storage itself.
+"""
+
+import time
+
+from ndk import types
+from ndk.event import event, event_filter
+from ndk.relay import metrics
+from ndk.relay.event_repo import event_repo
+
+METHODS = ("add", "get", "get_serialized", "count", "remove", "has_event")
+
+
+class InstrumentedEventRepo(event_repo.WrappingEventRepo):
+    _latency: dict[str, metrics.HistogramSeries]
+
+    def __init__(self, repo: event_repo.EventRepo, latency: metrics.Histogram):
+        # resolved once, not on every call
+        self._latency = {method: latency.series(method) for method in METHODS}
+        super().__init__(repo)
+
+    async def add(self, ev: event.Event) -> types.EventID:
+        start = time.perf_counter()
+        try:
+            return await super().add(ev)
+        finally:
+            self._latency["add"].observe(time.perf_counter() - start)
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        start = time.perf_counter()
+        try:
+            return await super().get(fltrs)
+        finally:
+            self._latency["get"].observe(time.perf_counter() - start)
+
+    async def get_serialized(self, fltrs: list[event_filter.EventFilter]) -> list[str]:
+        start = time.perf_counter()
+        try:
+            return await super().get_serialized(fltrs)
+        finally:
+            self._latency["get_serialized"].observe(time.perf_counter() - start)
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        start = time.perf_counter()
+        try:
+            return await super().count(fltrs)
+        finally:
+            self._latency["count"].observe(time.perf_counter() - start)
+
+    async def remove(self, event_id: types.EventID):
+        start = time.perf_counter()
+        try:
+            await super().remove(event_id)
+        finally:
+            self._latency["remove"].observe(time.perf_counter() - start)
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        start = time.perf_counter()
+        try:
+            return await super().has_event(event_id)
+        finally:
+            self._latency["has_event"].observe(time.perf_counter() - start)
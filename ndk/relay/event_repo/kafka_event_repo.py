@@ -20,11 +20,13 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import asyncio
+import typing
 
 import aiokafka
 
 from ndk import types
 from ndk.event import event, event_filter
+from ndk.relay import metrics
 from ndk.relay.event_repo import event_repo, kafka_events
 
 
@@ -33,12 +35,14 @@ class KafkaEventRepo(event_repo.EventRepo):
     _repo: event_repo.EventRepo
     _started: bool
     _topic: str
+    _produce_latency: typing.Optional[metrics.Histogram]
 
     def __init__(
         self,
         kafka_url: str,
         repo: event_repo.EventRepo,
         topic: str,
+        produce_latency: typing.Optional[metrics.Histogram] = None,
     ):
         self._producer = aiokafka.AIOKafkaProducer(
             bootstrap_servers=kafka_url,
@@ -49,6 +53,7 @@ class KafkaEventRepo(event_repo.EventRepo):
         self._repo = repo
         self._started = False
         self._topic = topic
+        self._produce_latency = produce_latency
         super().__init__()
 
     def __del__(self):
@@ -64,12 +69,19 @@ class KafkaEventRepo(event_repo.EventRepo):
     async def _persist(self, ev: event.Event) -> types.EventID:
         assert self._started
         kafka_event = kafka_events.CreatOrUpdateEvent.create(ev)
-        await self._producer.send_and_wait(self._topic, kafka_event)
+        if self._produce_latency is None:
+            await self._producer.send_and_wait(self._topic, kafka_event)
+        else:
+            with self._produce_latency.time():
+                await self._producer.send_and_wait(self._topic, kafka_event)
 
         return ev.id
 
     async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
         return await self._repo.get(fltrs)
 
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        return await self._repo.count(fltrs)
+
     async def remove(self, event_id: types.EventID):
         await self._repo.remove(event_id)
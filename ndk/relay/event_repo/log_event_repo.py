@@ -0,0 +1,1004 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Append-only, file backed event store
+
+Events are appended as JSON lines to numbered segment files. Writers that
+arrive together share one fsync. Four fixed-width indexes point into the
+segments:
+
+- id: (id, created_at)
+- author: (pubkey, kind, created_at)
+- tag: (hash of name and value, created_at)
+- time: (created_at, kind)
+
+Every record is big-endian, so byte order is key order. Flushed indexes are
+sorted files that are memory-mapped and binary-searched in place. Records
+written since the last flush live in small in-memory sorted lists, which
+are rebuilt on startup by replaying only the tail of the log.
+
+Deletes append to a tombstone file. compact() rewrites the segments without
+deleted, superseded replaceable or expired events, then rebuilds the indexes.
+"""
+
+import asyncio
+import bisect
+import contextlib
+import copy
+import dataclasses
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import mmap
+import os
+import string
+import struct
+import time
+import typing
+
+from ndk import exceptions, serialize, types
+from ndk.event import event, event_builder, event_filter
+from ndk.event import parameterized_replaceable_event as pre
+from ndk.relay import tracing
+from ndk.relay.event_repo import event_repo
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "MANIFEST"
+
+# (segment, offset, length) of an event's JSON in the log
+POINTER = struct.Struct(">IQI")
+_TIME = struct.Struct(">Q")
+_KIND = struct.Struct(">I")
+_MAX_TIME = 2**64 - 1
+
+
+@dataclasses.dataclass(frozen=True)
+class _Layout:
+    name: str
+    key: struct.Struct
+    # position of created_at within the key
+    time_offset: int
+
+    @property
+    def size(self) -> int:
+        return self.key.size + POINTER.size
+
+
+ID_LAYOUT = _Layout("id", struct.Struct(">32sQ"), 32)
+AUTHOR_LAYOUT = _Layout("author", struct.Struct(">32sIQ"), 36)
+TAG_LAYOUT = _Layout("tag", struct.Struct(">16sQ"), 16)
+TIME_LAYOUT = _Layout("time", struct.Struct(">QI"), 0)
+
+
+@dataclasses.dataclass
+class LogConfig:
+    segment_bytes: int = 64 * 1024 * 1024
+    # extra time a commit waits for concurrent writers to share its fsync,
+    # writers arriving while an fsync runs always share the next one
+    fsync_delay: float = 0.0
+    # index records kept in memory before they are merged into the files
+    index_flush_records: int = 100_000
+
+
+class _Record(typing.NamedTuple):
+    """Parsed event that is only checked against filters, never returned"""
+
+    id: str
+    pubkey: str
+    created_at: int
+    kind: int
+    tags: list
+    content: str
+    sig: str
+
+
+class _MappedRecords(typing.Sequence[bytes]):
+    """Fixed-width records of a sorted index file, usable with bisect"""
+
+    def __init__(self, mm: typing.Optional[mmap.mmap], size: int):
+        self._mm = mm
+        self._size = size
+        self._len = len(mm) // size if mm is not None else 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    @typing.overload
+    def __getitem__(self, i: int) -> bytes:
+        ...
+
+    @typing.overload
+    def __getitem__(self, i: slice) -> typing.Sequence[bytes]:
+        ...
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._len))]
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        assert self._mm is not None
+        return self._mm[i * self._size : (i + 1) * self._size]
+
+
+def _descending(
+    src: typing.Sequence[bytes], lo: bytes, hi: bytes
+) -> typing.Iterator[bytes]:
+    i, j = bisect.bisect_left(src, lo), bisect.bisect_right(src, hi)
+    for k in range(j - 1, i - 1, -1):
+        yield src[k]
+
+
+class _Index:
+    layout: _Layout
+    memtable: list[bytes]
+    records: _MappedRecords
+
+    def __init__(self, layout: _Layout):
+        self.layout = layout
+        self.memtable = []
+        self.records = _MappedRecords(None, layout.size)
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._mm: typing.Optional[mmap.mmap] = None
+
+    def open(self, path: str):
+        self.close()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # pylint: disable-next=consider-using-with
+            self._file = open(path, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.records = _MappedRecords(self._mm, self.layout.size)
+
+    def close(self):
+        self.records = _MappedRecords(None, self.layout.size)
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def add(self, record: bytes):
+        bisect.insort(self.memtable, record)
+
+    def snapshot(self) -> "_Index":
+        """Copy for a query thread that later adds don't change"""
+        view = copy.copy(self)
+        view.memtable = list(self.memtable)
+        return view
+
+    def count(self, lo: bytes, hi: bytes) -> int:
+        return sum(
+            max(0, bisect.bisect_right(src, hi) - bisect.bisect_left(src, lo))
+            for src in (self.records, self.memtable)
+        )
+
+    def descending(self, lo: bytes, hi: bytes) -> typing.Iterator[bytes]:
+        return heapq.merge(
+            _descending(self.records, lo, hi),
+            _descending(self.memtable, lo, hi),
+            reverse=True,
+        )
+
+    def write(self, path: str, extra: typing.Iterable[bytes]):
+        """Writes the mapped records merged with extra to a new file at path"""
+        with open(path, "wb") as f:
+            for record in heapq.merge(self.records, extra):
+                f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+@dataclasses.dataclass
+class _Range:
+    index: _Index
+    lo: bytes
+    hi: bytes
+    # records within the range are already in created_at order
+    time_ordered: bool
+    kinds: typing.Optional[set[int]] = None
+
+
+def _pad(prefix: bytes, size: int, fill: bytes) -> bytes:
+    return prefix + fill * (size - len(prefix))
+
+
+def _hex_range(prefix: str) -> typing.Optional[tuple[bytes, bytes]]:
+    """32 byte bounds of every id or pubkey starting with the hex prefix"""
+    if len(prefix) > 64 or any(c not in string.hexdigits for c in prefix):
+        return None
+    return (
+        bytes.fromhex(prefix.lower().ljust(64, "0")),
+        bytes.fromhex(prefix.lower().ljust(64, "f")),
+    )
+
+
+def _tag_hash(name: str, value: str) -> bytes:
+    return hashlib.blake2b(
+        f"{name}\0{value}".encode("utf-8"), digest_size=TAG_LAYOUT.key.size - 8
+    ).digest()
+
+
+def _indexed_tags(tags: list) -> set[tuple[str, str]]:
+    # only single letter tags are queryable per NIP-12
+    return {
+        (tag[0], tag[1])
+        for tag in tags
+        if len(tag) > 1 and len(tag[0]) == 1 and tag[0] in string.ascii_letters
+    }
+
+
+def _expiration(tags: list) -> typing.Optional[int]:
+    for tag in tags:
+        if len(tag) > 1 and tag[0] == "expiration":
+            try:
+                return int(tag[1])
+            except ValueError:
+                return None
+    return None
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_all(fds: list[int]):
+    try:
+        for fd in fds:
+            os.fsync(fd)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+class LogEventRepo(event_repo.EventRepo):
+    _path: str
+    _cfg: LogConfig
+    _indexes: dict[str, _Index]
+    _generation: int
+    _segments: list[int]
+    _indexed: tuple[int, int]
+    _tombstones: set[bytes]
+    _tombstones_name: str
+    _readers: dict[int, int]
+
+    def __init__(self, path: str, cfg: LogConfig = LogConfig()):
+        self._path = path
+        self._cfg = cfg
+        self._indexes = {
+            layout.name: _Index(layout)
+            for layout in [ID_LAYOUT, AUTHOR_LAYOUT, TAG_LAYOUT, TIME_LAYOUT]
+        }
+        self._generation = 0
+        self._segments = [0]
+        self._indexed = (0, 0)
+        self._tombstones = set()
+        self._tombstones_name = "tombstones-0"
+        self._readers = {}
+        self._active_fd = -1
+        self._active_size = 0
+        self._tombstones_fd = -1
+        self._write_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._sync_lock = asyncio.Lock()
+        self._sync_future: typing.Optional[asyncio.Future] = None
+        # queries run on worker threads, files are only swapped between them
+        self._swap_lock = asyncio.Lock()
+        self._queries = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        super().__init__()
+
+    @classmethod
+    async def create(cls, path: str, cfg: LogConfig = LogConfig()) -> "LogEventRepo":
+        repo = cls(path, cfg)
+        start = time.monotonic()
+        repo._open()
+        logger.info(
+            "Opened event log at %s in %.3fs (%s segments)",
+            path,
+            time.monotonic() - start,
+            len(repo._segments),
+        )
+        return repo
+
+    def close(self):
+        for fd in [self._active_fd, self._tombstones_fd, *self._readers.values()]:
+            if fd >= 0:
+                os.close(fd)
+        self._active_fd = self._tombstones_fd = -1
+        self._readers = {}
+        for index in self._indexes.values():
+            index.close()
+
+    # -- files --------------------------------------------------------------
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self._path, name)
+
+    @staticmethod
+    def _segment_name(segment: int) -> str:
+        return f"{segment:08d}.log"
+
+    def _index_name(self, layout: _Layout, generation: int) -> str:
+        return f"index-{generation}.{layout.name}"
+
+    def _write_manifest(self):
+        tmp = self._file(MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(
+                serialize.serialize_as_str(
+                    {
+                        "generation": self._generation,
+                        "segments": self._segments,
+                        "indexed": list(self._indexed),
+                        "tombstones": self._tombstones_name,
+                    }
+                )
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file(MANIFEST))
+        _fsync_dir(self._path)
+
+    def _live_files(self) -> set[str]:
+        return (
+            {MANIFEST, self._tombstones_name}
+            | {self._segment_name(segment) for segment in self._segments}
+            | {
+                self._index_name(index.layout, self._generation)
+                for index in self._indexes.values()
+            }
+        )
+
+    def _remove_garbage(self):
+        """Deletes files left behind by flushes, compactions or crashes"""
+        live = self._live_files()
+        for name in os.listdir(self._path):
+            if name not in live:
+                os.remove(self._file(name))
+
+    def _open(self):
+        os.makedirs(self._path, exist_ok=True)
+        if os.path.exists(self._file(MANIFEST)):
+            with open(self._file(MANIFEST), encoding="utf-8") as f:
+                manifest = serialize.deserialize_str(f.read())
+            self._generation = manifest["generation"]
+            self._segments = manifest["segments"]
+            self._indexed = tuple(manifest["indexed"])
+            self._tombstones_name = manifest["tombstones"]
+        else:
+            self._write_manifest()
+
+        self._remove_garbage()
+
+        for index in self._indexes.values():
+            index.open(self._file(self._index_name(index.layout, self._generation)))
+
+        self._tombstones_fd = os.open(
+            self._file(self._tombstones_name), os.O_RDWR | os.O_CREAT | os.O_APPEND
+        )
+        with open(self._file(self._tombstones_name), "rb") as f:
+            data = f.read()
+        self._tombstones = {
+            data[i : i + POINTER.size]
+            for i in range(0, len(data) - POINTER.size + 1, POINTER.size)
+        }
+
+        self._replay()
+
+        active = self._file(self._segment_name(self._segments[-1]))
+        self._active_fd = os.open(active, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        self._active_size = os.path.getsize(active)
+        for segment in self._segments:
+            self._open_reader(segment)
+
+    def _replay(self):
+        """Re-indexes everything appended after the last index flush"""
+        indexed_segment, indexed_offset = self._indexed
+        for segment in self._segments:
+            if segment < indexed_segment:
+                continue
+
+            path = self._file(self._segment_name(segment))
+            if not os.path.exists(path):
+                continue
+
+            offset = indexed_offset if segment == indexed_segment else 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+
+            for line in data.split(b"\n")[:-1]:
+                try:
+                    d = json.loads(line)
+                except ValueError:
+                    break
+                pointer = POINTER.pack(segment, offset, len(line))
+                offset += len(line) + 1
+                try:
+                    self._index(d, pointer)
+                except exceptions.ValidationError:
+                    # appended before such events were rejected
+                    logger.warning("Skipping unindexable event %s", d.get("id"))
+
+            if offset != os.path.getsize(path):
+                # a torn write from a crash, the event was never acknowledged
+                logger.warning("Truncating %s to %s", path, offset)
+                os.truncate(path, offset)
+
+    def _open_reader(self, segment: int):
+        self._readers[segment] = os.open(
+            self._file(self._segment_name(segment)), os.O_RDONLY
+        )
+
+    def _read(self, pointer: bytes) -> bytes:
+        segment, offset, length = POINTER.unpack(pointer)
+        return os.pread(self._readers[segment], length, offset)
+
+    # -- writes -------------------------------------------------------------
+
+    def _index_keys(self, d: dict) -> list[tuple[_Index, bytes]]:
+        """Key of the event in each index, to be followed by its pointer
+
+        Raises ValidationError for an event the keys can't hold, so it's never
+        appended to a segment that then can't be replayed.
+        """
+        created_at, kind = d["created_at"], d["kind"]
+        # bool is an int, but not a timestamp
+        if (
+            isinstance(created_at, bool)
+            or not isinstance(created_at, int)
+            or not 0 <= created_at <= _MAX_TIME
+        ):
+            raise exceptions.ValidationError(
+                f"created_at must be an unsigned 64-bit integer, got {created_at!r}"
+            )
+
+        try:
+            keys = [
+                (
+                    self._indexes["id"],
+                    ID_LAYOUT.key.pack(bytes.fromhex(d["id"]), created_at),
+                ),
+                (
+                    self._indexes["author"],
+                    AUTHOR_LAYOUT.key.pack(
+                        bytes.fromhex(d["pubkey"]), kind, created_at
+                    ),
+                ),
+                (self._indexes["time"], TIME_LAYOUT.key.pack(created_at, kind)),
+            ]
+            for name, value in _indexed_tags(d["tags"]):
+                keys.append(
+                    (
+                        self._indexes["tag"],
+                        TAG_LAYOUT.key.pack(_tag_hash(name, value), created_at),
+                    )
+                )
+        except (struct.error, ValueError) as exc:
+            raise exceptions.ValidationError(f"Event can't be indexed: {exc}") from exc
+        return keys
+
+    def _index(self, d: dict, pointer: bytes):
+        for index, key in self._index_keys(d):
+            index.add(key + pointer)
+
+    def _roll_segment(self):
+        os.fsync(self._active_fd)
+        os.close(self._active_fd)
+        self._segments.append(self._segments[-1] + 1)
+        self._active_fd = os.open(
+            self._file(self._segment_name(self._segments[-1])),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+        )
+        self._active_size = 0
+        self._open_reader(self._segments[-1])
+        self._write_manifest()
+
+    def _append(self, data: bytes) -> bytes:
+        line = data + b"\n"
+        if (
+            self._active_size
+            and self._active_size + len(line) > self._cfg.segment_bytes
+        ):
+            self._roll_segment()
+
+        pointer = POINTER.pack(self._segments[-1], self._active_size, len(data))
+        _write_all(self._active_fd, line)
+        self._active_size += len(line)
+        return pointer
+
+    async def _commit(self):
+        """Waits until everything written so far is durable"""
+        if self._sync_future is None:
+            self._sync_future = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._group_fsync(self._sync_future))
+        await asyncio.shield(self._sync_future)
+
+    async def _group_fsync(self, fut: asyncio.Future):
+        async with self._sync_lock:
+            await asyncio.sleep(self._cfg.fsync_delay)
+            # writes from here on wait for the next group
+            self._sync_future = None
+            await self._fsync(fut)
+
+    async def _fsync(self, fut: asyncio.Future):
+        # duplicated so a segment roll can't close them mid-sync
+        fds = [os.dup(self._active_fd), os.dup(self._tombstones_fd)]
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _fsync_all, fds)
+        except OSError as exc:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(None)
+
+    def _lookup(self, event_id: str) -> typing.Optional[bytes]:
+        key = bytes.fromhex(event_id)
+        index = self._indexes["id"]
+        for record in index.descending(
+            _pad(key, ID_LAYOUT.size, b"\x00"), _pad(key, ID_LAYOUT.size, b"\xff")
+        ):
+            pointer = record[-POINTER.size :]
+            if pointer not in self._tombstones:
+                return pointer
+        return None
+
+    async def _persist(self, ev: event.Event) -> types.EventID:
+        async with self._write_lock:
+            if self._lookup(ev.id) is not None:
+                return ev.id
+
+            d = ev.__dict__
+            keys = self._index_keys(d)
+            pointer = self._append(serialize.serialize_as_bytes(d))
+            for index, key in keys:
+                index.add(key + pointer)
+
+        await self._commit()
+
+        if self._pending() >= self._cfg.index_flush_records:
+            await self.flush()
+
+        return ev.id
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        return self._lookup(event_id) is not None
+
+    async def remove(self, event_id: types.EventID):
+        async with self._write_lock:
+            pointer = self._lookup(event_id)
+            if pointer is None:
+                raise ValueError(f"Event {event_id} does not exist")
+
+            _write_all(self._tombstones_fd, pointer)
+            self._tombstones.add(pointer)
+
+        await self._commit()
+
+    def _pending(self) -> int:
+        return sum(len(index.memtable) for index in self._indexes.values())
+
+    async def flush(self):
+        """Merges the in-memory index records into new index files"""
+        async with self._flush_lock:
+            snapshot = {name: list(idx.memtable) for name, idx in self._indexes.items()}
+            if not any(snapshot.values()):
+                return
+
+            # every record appended before this point is in the snapshot
+            indexed = (self._segments[-1], self._active_size)
+            generation = self._generation + 1
+
+            def write():
+                for name, index in self._indexes.items():
+                    index.write(
+                        self._file(self._index_name(index.layout, generation)),
+                        snapshot[name],
+                    )
+
+            await asyncio.get_running_loop().run_in_executor(None, write)
+
+            async with self._exclusive():
+                for name, index in self._indexes.items():
+                    index.open(self._file(self._index_name(index.layout, generation)))
+                    flushed = set(snapshot[name])
+                    index.memtable = [r for r in index.memtable if r not in flushed]
+
+                self._generation = generation
+                self._indexed = indexed
+                self._write_manifest()
+                self._remove_garbage()
+
+    # -- reads --------------------------------------------------------------
+
+    @contextlib.asynccontextmanager
+    async def _exclusive(self) -> typing.AsyncIterator[None]:
+        """Holds off new queries and waits for the running ones to finish"""
+        async with self._swap_lock:
+            await self._idle.wait()
+            yield
+
+    async def _run_query(self, fn: typing.Callable, *args):
+        async with self._swap_lock:
+            self._queries += 1
+            self._idle.clear()
+            indexes = {name: idx.snapshot() for name, idx in self._indexes.items()}
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, fn, indexes, *args
+            )
+        finally:
+            self._queries -= 1
+            if not self._queries:
+                self._idle.set()
+
+    def _time_range(
+        self, index: _Index, prefix: bytes, fltr: event_filter.EventFilter, **kwargs
+    ) -> _Range:
+        # since/until are exclusive and ignored when falsy, same as matches_event()
+        since = fltr.since + 1 if fltr.since else 0
+        until = fltr.until - 1 if fltr.until else _MAX_TIME
+        size = index.layout.size
+        return _Range(
+            index,
+            _pad(prefix + _TIME.pack(max(0, since)), size, b"\x00"),
+            _pad(prefix + _TIME.pack(max(0, until)), size, b"\xff"),
+            True,
+            **kwargs,
+        )
+
+    def _plan(
+        self, indexes: dict[str, _Index], fltr: event_filter.EventFilter
+    ) -> list[_Range]:
+        """Pick the index ranges with the fewest records that still cover the filter"""
+        plans = [
+            [
+                self._time_range(
+                    indexes["time"],
+                    b"",
+                    fltr,
+                    kinds=set(fltr.kinds) if fltr.kinds else None,
+                )
+            ]
+        ]
+
+        if fltr.ids:
+            index = indexes["id"]
+            plan = []
+            for lo, hi in filter(None, map(_hex_range, fltr.ids)):
+                plan.append(
+                    _Range(
+                        index,
+                        _pad(lo, ID_LAYOUT.size, b"\x00"),
+                        _pad(hi, ID_LAYOUT.size, b"\xff"),
+                        False,
+                    )
+                )
+            plans.append(plan)
+
+        if fltr.authors:
+            index = indexes["author"]
+            plan = []
+            for author in fltr.authors:
+                bounds = _hex_range(author)
+                if bounds is None:
+                    continue
+                if len(author) == 64 and fltr.kinds:
+                    plan.extend(
+                        self._time_range(index, bounds[0] + _KIND.pack(kind), fltr)
+                        for kind in set(fltr.kinds)
+                    )
+                else:
+                    plan.append(
+                        _Range(
+                            index,
+                            _pad(bounds[0], AUTHOR_LAYOUT.size, b"\x00"),
+                            _pad(bounds[1], AUTHOR_LAYOUT.size, b"\xff"),
+                            False,
+                        )
+                    )
+            plans.append(plan)
+
+        if fltr.generic_tags:
+            index = indexes["tag"]
+            for identifier, values in fltr.generic_tags.items():
+                plans.append(
+                    [
+                        self._time_range(index, _tag_hash(identifier, value), fltr)
+                        for value in set(values)
+                    ]
+                )
+
+        return min(plans, key=lambda plan: sum(r.index.count(r.lo, r.hi) for r in plan))
+
+    @staticmethod
+    def _newest_first(rng: _Range) -> typing.Iterator[tuple[int, bytes]]:
+        records = rng.index.descending(rng.lo, rng.hi)
+        if rng.kinds is not None:
+            # the time index carries the kind, so skip without reading the event
+            kinds = rng.kinds
+            records = (
+                r for r in records if _KIND.unpack_from(r, _TIME.size)[0] in kinds
+            )
+
+        offset = rng.index.layout.time_offset
+        entries = (
+            (_TIME.unpack_from(r, offset)[0], r[-POINTER.size :]) for r in records
+        )
+        if not rng.time_ordered:
+            return iter(sorted(entries, reverse=True))
+        return entries
+
+    def _matching(
+        self, indexes: dict[str, _Index], fltr: event_filter.EventFilter, now: int
+    ) -> typing.Iterator[tuple[dict, bytes]]:
+        """(event dict, stored JSON) for every match, newest first"""
+        streams = [self._newest_first(rng) for rng in self._plan(indexes, fltr)]
+        matches = fltr.compile().matches
+        prev = None
+        for entry in heapq.merge(*streams, reverse=True):
+            if entry == prev:  # same event reached through multiple ranges
+                continue
+            prev = entry
+
+            pointer = entry[1]
+            if pointer in self._tombstones:
+                continue
+
+            data = self._read(pointer)
+            d = json.loads(data)
+            expiration = _expiration(d["tags"])
+            if expiration is not None and expiration <= now:
+                continue  # expired per NIP-40, dropped by the next compaction
+
+            if matches(typing.cast(event.Event, _Record(**d))):
+                yield d, data
+
+    def _query(
+        self, indexes: dict[str, _Index], fltr: event_filter.EventFilter, now: int
+    ) -> list[tuple[float, dict, bytes]]:
+        if not fltr.search:
+            return [
+                (0.0, d, data)
+                for d, data in itertools.islice(
+                    self._matching(indexes, fltr, now), fltr.limit or None
+                )
+            ]
+
+        terms = set(event_filter.search_terms(fltr.search))
+        ranked = (
+            (event_filter.search_rank(d["content"], terms), d, data)
+            for d, data in self._matching(indexes, fltr, now)
+        )
+
+        def key(item: tuple[float, dict, bytes]) -> tuple[float, int]:
+            return item[0], item[1]["created_at"]
+
+        if fltr.limit:
+            return heapq.nlargest(fltr.limit, ranked, key=key)
+        return sorted(ranked, key=key, reverse=True)
+
+    def _fetch(
+        self, indexes: dict[str, _Index], fltrs: list[event_filter.EventFilter]
+    ) -> list[tuple[dict, bytes]]:
+        fetched: dict[str, tuple[float, dict, bytes]] = {}
+        now = int(time.time())
+        for fltr in fltrs:
+            for rank, d, data in self._query(indexes, fltr, now):
+                if d["id"] not in fetched or fetched[d["id"]][0] < rank:
+                    fetched[d["id"]] = (rank, d, data)
+
+        # NIP-50 results are ordered by relevance, everything else by recency
+        ordered = sorted(
+            fetched.values(),
+            key=lambda item: (item[0], item[1]["created_at"]),
+            reverse=True,
+        )
+        return [(d, data) for _, d, data in ordered]
+
+    def _count(
+        self, indexes: dict[str, _Index], fltrs: list[event_filter.EventFilter]
+    ) -> int:
+        now = int(time.time())
+        return len(
+            {d["id"] for fltr in fltrs for d, _ in self._matching(indexes, fltr, now)}
+        )
+
+    def _ids(self, indexes: dict[str, _Index]) -> list[types.EventID]:
+        index = indexes["id"]
+        return [
+            types.EventID(record[:32].hex())
+            for record in heapq.merge(index.records, index.memtable)
+            if record[-POINTER.size :] not in self._tombstones
+        ]
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        fetched = await self._run_query(self._fetch, fltrs)
+        return [event_builder.from_validated_dict(d) for d, _ in fetched]
+
+    async def get_serialized(self, fltrs: list[event_filter.EventFilter]) -> list[str]:
+        fetched = await self._run_query(self._fetch, fltrs)
+        tracing.mark("query")
+        return [data.decode("utf-8") for _, data in fetched]
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        return await self._run_query(self._count, fltrs)
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        # only the id index is read, never the events themselves
+        for event_id in await self._run_query(self._ids):
+            yield event_id
+
+    # -- compaction ---------------------------------------------------------
+
+    @staticmethod
+    def _replacement_key(d: dict) -> typing.Optional[tuple]:
+        ev = event_builder.from_validated_dict(d)
+        if isinstance(ev, pre.ParameterizedReplaceableEvent):
+            return ev.pubkey, ev.kind, ev.get_normalized_d_tag_value()
+        if isinstance(ev, event.ReplaceableEvent):
+            return ev.pubkey, ev.kind
+        return None
+
+    def _survivors(self, segments: list[int], now: int) -> list[bytes]:
+        """Pointers of every event that a compaction keeps, in log order"""
+        survivors: dict[bytes, None] = {}
+        newest: dict[tuple, tuple[int, bytes]] = {}
+        for segment in segments:
+            offset = 0
+            with open(self._file(self._segment_name(segment)), "rb") as f:
+                for line in f:
+                    pointer = POINTER.pack(segment, offset, len(line) - 1)
+                    offset += len(line)
+                    if pointer in self._tombstones:
+                        continue
+
+                    d = json.loads(line)
+                    expiration = _expiration(d["tags"])
+                    if expiration is not None and expiration <= now:
+                        continue
+
+                    key = self._replacement_key(d)
+                    if key is not None:
+                        if key in newest:
+                            if newest[key][0] > d["created_at"]:
+                                continue
+                            del survivors[newest[key][1]]
+                        newest[key] = (d["created_at"], pointer)
+
+                    survivors[pointer] = None
+        return list(survivors)
+
+    def _rewrite(
+        self, segments: list[int], generation: int, now: int
+    ) -> tuple[list[int], int]:
+        """Copies the survivors into new segments and indexes them from scratch
+
+        Runs on a worker thread, so it only reads the live files with its own
+        descriptors and writes files that nothing else uses yet.
+        """
+        survivors = self._survivors(segments, now)
+        readers: dict[int, int] = {}
+        new_segments = [segments[-1] + 1]
+        size = 0
+        records: dict[str, list[bytes]] = {name: [] for name in self._indexes}
+
+        out = open(  # pylint: disable=consider-using-with
+            self._file(self._segment_name(new_segments[-1])), "wb"
+        )
+        try:
+            for pointer in survivors:
+                segment, offset, length = POINTER.unpack(pointer)
+                if segment not in readers:
+                    readers[segment] = os.open(
+                        self._file(self._segment_name(segment)), os.O_RDONLY
+                    )
+                data = os.pread(readers[segment], length, offset)
+                try:
+                    keys = self._index_keys(json.loads(data))
+                except exceptions.ValidationError:
+                    # appended before such events were rejected
+                    continue
+                if size and size + len(data) + 1 > self._cfg.segment_bytes:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    out.close()
+                    new_segments.append(new_segments[-1] + 1)
+                    size = 0
+                    out = open(  # pylint: disable=consider-using-with
+                        self._file(self._segment_name(new_segments[-1])), "wb"
+                    )
+
+                new_pointer = POINTER.pack(new_segments[-1], size, len(data))
+                out.write(data + b"\n")
+                size += len(data) + 1
+                for index, key in keys:
+                    records[index.layout.name].append(key + new_pointer)
+            out.flush()
+            os.fsync(out.fileno())
+        finally:
+            out.close()
+            for fd in readers.values():
+                os.close(fd)
+
+        for name, index in self._indexes.items():
+            with open(
+                self._file(self._index_name(index.layout, generation)), "wb"
+            ) as f:
+                f.writelines(sorted(records[name]))
+                f.flush()
+                os.fsync(f.fileno())
+
+        return new_segments, size
+
+    async def compact(self):
+        """Rewrites the log without deleted, replaced or expired events
+
+        Reads carry on while the new files are written, writes wait.
+        """
+        async with self._write_lock, self._flush_lock:
+            await self._commit()
+
+            start = time.monotonic()
+            old_segments = list(self._segments)
+            generation = self._generation + 1
+            new_segments, size = await asyncio.get_running_loop().run_in_executor(
+                None, self._rewrite, old_segments, generation, int(time.time())
+            )
+
+            async with self._exclusive():
+                self.close()
+                self._segments = new_segments
+                self._generation = generation
+                self._indexed = (new_segments[-1], size)
+                self._tombstones_name = f"tombstones-{generation}"
+                for index in self._indexes.values():
+                    index.memtable = []
+                self._write_manifest()
+                self._open()
+
+            logger.info(
+                "Compacted %s segments into %s in %.3fs",
+                len(old_segments),
+                len(new_segments),
+                time.monotonic() - start,
+            )
+
+    async def start_compactor(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.compact()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Failed to compact event log", exc_info=exc)
@@ -19,46 +19,589 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
+import bisect
 import collections
+import dataclasses
+import gc
+import heapq
+import itertools
+import logging
+import string
+import time
+import typing
 
-from ndk import types
+from ndk import exceptions, types
 from ndk.event import event, event_filter
-from ndk.relay.event_repo import event_repo
+from ndk.relay.event_repo import event_repo, retention, snapshot
+
+logger = logging.getLogger(__name__)
+
+# Every index is a list of (created_at, event_id) kept in ascending order so that
+# queries can walk it newest-first and stop as soon as the limit is reached.
+IndexKey = tuple[int, types.EventID]
+TagKey = tuple[str, str]
+S = typing.TypeVar("S", bound=str)
+
+# sorts after every hex character, making (ts, _MAX_ID) the upper bound of ts
+_MAX_ID = "\U0010ffff"
+
+# Above this many removals from one list, rebuilding it in a single pass is
+# cheaper than deleting the entries one at a time
+_BULK_DISCARD_THRESHOLD = 64
+
+
+def _discard(lst: list, item) -> bool:
+    i = bisect.bisect_left(lst, item)
+    if i < len(lst) and lst[i] == item:
+        del lst[i]
+        return True
+    return False
+
+
+def _discard_all(lst: list, items: set):
+    if len(items) > _BULK_DISCARD_THRESHOLD:
+        lst[:] = [item for item in lst if item not in items]
+    else:
+        for item in items:
+            _discard(lst, item)
+
+
+def _discard_all_from(index: dict, key, items: set) -> bool:
+    """Remove items from index[key], returns True if the key no longer exists"""
+    lst = index.get(key)
+    if lst is None:
+        return False
+
+    _discard_all(lst, items)
+    if not lst:
+        del index[key]
+        return True
+
+    return False
+
+
+def _prefix_range(lst: list[S], prefix: str) -> list[S]:
+    lo = bisect.bisect_left(lst, prefix)
+    hi = bisect.bisect_left(lst, prefix + _MAX_ID, lo)
+    return lst[lo:hi]
+
+
+def _time_bounds(
+    keys: list[IndexKey], fltr: event_filter.EventFilter
+) -> tuple[int, int]:
+    # since/until are exclusive and ignored when falsy, same as matches_event()
+    lo, hi = 0, len(keys)
+    if fltr.since:
+        lo = bisect.bisect_right(keys, (fltr.since, _MAX_ID))
+    if fltr.until:
+        hi = bisect.bisect_left(keys, (fltr.until, ""), lo)
+    return lo, max(lo, hi)
+
+
+def _newest_first(keys: list[IndexKey], lo: int, hi: int) -> typing.Iterator[IndexKey]:
+    return (keys[i] for i in range(hi - 1, lo - 1, -1))
+
+
+def _indexed_tags(ev: event.Event) -> set[TagKey]:
+    # only single letter tags are queryable per NIP-12
+    return {
+        (tag[0], tag[1])
+        for tag in ev.tags
+        if len(tag[0]) == 1 and tag[0] in string.ascii_letters
+    }
+
+
+@dataclasses.dataclass
+class _RetentionBucket:
+    policy: retention.RetentionPolicy
+    timeline: list[IndexKey] = dataclasses.field(default_factory=list)
+    bytes_used: int = 0
 
 
 class MemoryEventRepo(event_repo.EventRepo):
     _stored_events: dict[types.EventID, event.Event]
+    _timeline: list[IndexKey]
+    _ids: list[types.EventID]
+    _authors: list[str]
+    _by_kind: dict[int, list[IndexKey]]
+    _by_author: dict[str, list[IndexKey]]
+    _by_tag: dict[TagKey, list[IndexKey]]
+    _by_term: dict[str, list[IndexKey]]
+    _expirations: dict[types.EventID, int]
+    _expiry_queue: list[tuple[int, types.EventID]]
+    _buckets: list[_RetentionBucket]
+    _kind_to_bucket: dict[int, typing.Optional[int]]
+    _max_bytes: typing.Optional[int]
+    _bytes_used: int
+    _evicted_count: int
 
-    def __init__(self):
+    def __init__(
+        self,
+        policies: typing.Optional[list[retention.RetentionPolicy]] = None,
+        max_bytes: typing.Optional[int] = None,
+    ):
         self._stored_events = {}
+        self._timeline = []
+        self._ids = []
+        self._authors = []
+        self._by_kind = {}
+        self._by_author = {}
+        self._by_tag = {}
+        self._by_term = {}
+        self._expirations = {}
+        self._expiry_queue = []
+        self._buckets = [_RetentionBucket(policy) for policy in policies or []]
+        self._kind_to_bucket = {}
+        self._max_bytes = max_bytes
+        self._bytes_used = 0
+        self._evicted_count = 0
         super().__init__()
 
-    async def _persist(self, ev: event.Event) -> types.EventID:
+    @property
+    def bytes_used(self) -> int:
+        """Approximate memory held by the stored events and their indexes"""
+        return self._bytes_used
+
+    @property
+    def evicted_count(self) -> int:
+        return self._evicted_count
+
+    @property
+    def oldest_created_at(self) -> typing.Optional[int]:
+        return self._timeline[0][0] if self._timeline else None
+
+    def _bucket_index(self, kind: int) -> typing.Optional[int]:
+        if kind not in self._kind_to_bucket:
+            self._kind_to_bucket[kind] = retention.find_policy(
+                [bucket.policy for bucket in self._buckets], kind
+            )
+        return self._kind_to_bucket[kind]
+
+    def _index(
+        self, ev: event.Event, insert: typing.Callable[[list, typing.Any], None]
+    ):
+        """Adds ev to the store, insert puts each item in its index list
+
+        Whatever can raise is worked out before the first index changes, and
+        ev is only stored once it's in all of them, so it's never half indexed.
+        """
+        # sorted against every other key, so it has to compare with them
+        if isinstance(ev.created_at, bool) or not isinstance(ev.created_at, int):
+            raise exceptions.ValidationError(
+                f"created_at must be an integer, got {ev.created_at!r}"
+            )
+        key = (ev.created_at, ev.id)
+        tag_keys = list(_indexed_tags(ev))
+        terms = set(event_filter.tokenize(ev.content))
+        expiration = ev.get_expiration()
+        size = retention.approximate_size(ev)
+        i = self._bucket_index(ev.kind)
+
+        insert(self._timeline, key)
+        insert(self._ids, ev.id)
+
+        insert(self._by_kind.setdefault(ev.kind, []), key)
+
+        if ev.pubkey not in self._by_author:
+            insert(self._authors, ev.pubkey)
+        insert(self._by_author.setdefault(ev.pubkey, []), key)
+
+        for tag_key in tag_keys:
+            insert(self._by_tag.setdefault(tag_key, []), key)
+
+        for term in terms:
+            insert(self._by_term.setdefault(term, []), key)
+
+        if expiration is not None:
+            self._expirations[ev.id] = expiration
+            insert(self._expiry_queue, (expiration, ev.id))
+
+        self._bytes_used += size
+        if i is not None:
+            insert(self._buckets[i].timeline, key)
+            self._buckets[i].bytes_used += size
+
         self._stored_events[ev.id] = ev
+
+    async def _persist(self, ev: event.Event) -> types.EventID:
+        if ev.id in self._stored_events:
+            return ev.id
+
+        self._index(ev, bisect.insort)
+
+        buckets = []
+        i = self._bucket_index(ev.kind)
+        if i is not None:
+            buckets.append(self._buckets[i])
+        self._enforce_retention(buckets, int(time.time()))
+
         return ev.id
 
+    def load(self, evs: typing.Iterable[event.Event]) -> int:
+        """Bulk adds already validated events, returns how many were new
+
+        Appends to every index and sorts each one once at the end, which is
+        far cheaper than keeping them sorted event by event. Replaceable
+        events are not deduplicated, so load a consistent set like a snapshot.
+        """
+        n = len(self._stored_events)
+        for ev in evs:
+            if ev.id not in self._stored_events:
+                self._index(ev, list.append)
+
+        lists: typing.Iterable[list] = itertools.chain(
+            [self._timeline, self._ids, self._authors, self._expiry_queue],
+            self._by_kind.values(),
+            self._by_author.values(),
+            self._by_tag.values(),
+            self._by_term.values(),
+            (bucket.timeline for bucket in self._buckets),
+        )
+        for lst in lists:
+            lst.sort()
+
+        self._enforce_retention(self._buckets, int(time.time()))
+        return len(self._stored_events) - n
+
+    async def save_snapshot(self, path: str) -> int:
+        """Writes every stored event to path on a worker thread
+
+        Only the references to the events are copied on the event loop, the
+        events themselves are never modified once stored.
+        """
+        evs = list(self._stored_events.values())
+        return await asyncio.get_running_loop().run_in_executor(
+            None, snapshot.write, path, evs
+        )
+
+    def load_snapshot(self, path: str) -> int:
+        # every loaded event lives until evicted, so collecting while loading
+        # millions of them only burns time
+        gc.disable()
+        try:
+            return self.load(snapshot.read(path))
+        finally:
+            gc.enable()
+
+    async def start_snapshotter(self, path: str, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                start = time.monotonic()
+                n = await self.save_snapshot(path)
+                logger.info(
+                    "Saved %s events to %s in %.3fs", n, path, time.monotonic() - start
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                # the next interval tries again, so one failure can't end them
+                logger.error("Failed to save snapshot to %s", path, exc_info=exc)
+
+    def _count_over_budget(
+        self, keys: list[IndexKey], start: int, used: int, budget: int
+    ) -> int:
+        """Returns how many of the oldest keys must go for used to fit in budget
+
+        The first `start` keys are already being evicted for another reason.
+        """
+        used -= sum(
+            retention.approximate_size(self._stored_events[key[1]])
+            for key in keys[:start]
+        )
+        if used <= budget:
+            return start
+
+        n = start
+        target = retention.low_watermark(budget)
+        while n < len(keys) and used > target:
+            used -= retention.approximate_size(self._stored_events[keys[n][1]])
+            n += 1
+        return n
+
+    def _bucket_victims(self, bucket: _RetentionBucket, now: int) -> list[IndexKey]:
+        policy = bucket.policy
+        n = 0
+        if policy.time is not None:
+            n = bisect.bisect_left(bucket.timeline, (now - policy.time, ""))
+
+        if policy.count is not None and len(bucket.timeline) - n > policy.count:
+            n = len(bucket.timeline) - retention.low_watermark(policy.count)
+
+        if policy.bytes is not None:
+            n = self._count_over_budget(
+                bucket.timeline, n, bucket.bytes_used, policy.bytes
+            )
+
+        return bucket.timeline[:n]
+
+    def _enforce_retention(self, buckets: typing.Iterable[_RetentionBucket], now: int):
+        victims = []
+        for bucket in buckets:
+            victims.extend(self._bucket_victims(bucket, now))
+        self._evict(victims)
+
+        if self._max_bytes is not None and self._bytes_used > self._max_bytes:
+            n = self._count_over_budget(
+                self._timeline, 0, self._bytes_used, self._max_bytes
+            )
+            self._evict(self._timeline[:n])
+
+    def _evict(self, keys: list[IndexKey]):
+        if keys:
+            self._unindex([self._stored_events[key[1]] for key in keys])
+            self._evicted_count += len(keys)
+
+    async def sweep(self):
+        """Evict expired events and everything the retention policies no longer allow"""
+        now = int(time.time())
+        n = bisect.bisect_right(self._expiry_queue, (now, _MAX_ID))
+        self._evict(
+            [
+                (self._stored_events[ev_id].created_at, ev_id)
+                for _, ev_id in self._expiry_queue[:n]
+            ]
+        )
+
+        self._enforce_retention(self._buckets, now)
+
+    async def start_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    def _id_candidates(self, prefixes: list[str]) -> list[IndexKey]:
+        keys: set[IndexKey] = set()
+        for prefix in prefixes:
+            for ev_id in _prefix_range(self._ids, prefix):
+                keys.add((self._stored_events[ev_id].created_at, ev_id))
+        return sorted(keys)
+
+    def _author_candidates(self, prefixes: list[str]) -> list[list[IndexKey]]:
+        pubkeys = set()
+        for prefix in prefixes:
+            if prefix in self._by_author:
+                pubkeys.add(prefix)
+            else:
+                pubkeys.update(_prefix_range(self._authors, prefix))
+        return [self._by_author[pubkey] for pubkey in pubkeys]
+
+    def _plan(self, fltr: event_filter.EventFilter) -> list[list[IndexKey]]:
+        """Pick the index lists with the fewest entries that still cover the filter
+
+        Every field in a filter must match, so any single field's index is a
+        superset of the result. The remaining fields are checked per event.
+        """
+        plans: list[list[list[IndexKey]]] = [[self._timeline]]
+
+        if fltr.ids:
+            plans.append([self._id_candidates(fltr.ids)])
+
+        if fltr.authors:
+            plans.append(self._author_candidates(fltr.authors))
+
+        if fltr.kinds:
+            plans.append(
+                [self._by_kind[k] for k in set(fltr.kinds) if k in self._by_kind]
+            )
+
+        if fltr.generic_tags:
+            for identifier, values in fltr.generic_tags.items():
+                plans.append(
+                    [
+                        self._by_tag[(identifier, val)]
+                        for val in set(values)
+                        if (identifier, val) in self._by_tag
+                    ]
+                )
+
+        if fltr.search:
+            # every term must appear, so any one posting list covers the filter
+            for term in set(event_filter.search_terms(fltr.search)):
+                plans.append([self._by_term.get(term, [])])
+
+        def cost(plan: list[list[IndexKey]]) -> int:
+            return sum(hi - lo for lo, hi in (_time_bounds(k, fltr) for k in plan))
+
+        return min(plans, key=cost)
+
+    def _exact_plan(
+        self, fltr: event_filter.EventFilter
+    ) -> typing.Optional[list[list[IndexKey]]]:
+        """Disjoint index lists holding exactly the filter's matches within since/until
+
+        Returns None when the matches can only be found by checking each event.
+        """
+        if fltr.ids or fltr.search:
+            return None
+
+        if not fltr.authors and not fltr.kinds and not fltr.generic_tags:
+            return [self._timeline]
+
+        if fltr.authors and not fltr.kinds and not fltr.generic_tags:
+            return self._author_candidates(fltr.authors)
+
+        if fltr.kinds and not fltr.authors and not fltr.generic_tags:
+            return [self._by_kind[k] for k in set(fltr.kinds) if k in self._by_kind]
+
+        if fltr.generic_tags and not fltr.authors and not fltr.kinds:
+            # an event can carry several values of the same tag, so only a
+            # single value is guaranteed not to count an event twice
+            if len(fltr.generic_tags) == 1:
+                [(identifier, values)] = fltr.generic_tags.items()
+                if len(set(values)) == 1:
+                    return [self._by_tag.get((identifier, values[0]), [])]
+
+        return None
+
+    def _has_expired(self, now: int) -> bool:
+        return bool(self._expiry_queue) and self._expiry_queue[0][0] <= now
+
+    def _matching(
+        self, fltr: event_filter.EventFilter, now: int
+    ) -> typing.Iterator[event.Event]:
+        streams = [
+            _newest_first(keys, *_time_bounds(keys, fltr)) for keys in self._plan(fltr)
+        ]
+        merged = (
+            streams[0] if len(streams) == 1 else heapq.merge(*streams, reverse=True)
+        )
+
+        matches = fltr.compile().matches
+        prev = None
+        for key in merged:
+            if key == prev:  # same event reached through multiple index values
+                continue
+            prev = key
+
+            if self._expirations.get(key[1], now + 1) <= now:
+                continue  # expired per NIP-40, removed by the next sweep
+
+            ev = self._stored_events[key[1]]
+            if matches(ev):
+                yield ev
+
+    def _query(self, fltr: event_filter.EventFilter, now: int) -> list[event.Event]:
+        return list(itertools.islice(self._matching(fltr, now), fltr.limit or None))
+
+    def _search(
+        self, fltr: event_filter.EventFilter, now: int
+    ) -> list[tuple[float, event.Event]]:
+        """Matches ranked by relevance, keeping only the best `limit` of them"""
+        assert fltr.search
+        terms = set(event_filter.search_terms(fltr.search))
+        ranked = (
+            (event_filter.search_rank(ev.content, terms), ev)
+            for ev in self._matching(fltr, now)
+        )
+
+        def key(item: tuple[float, event.Event]) -> tuple[float, int]:
+            return item[0], item[1].created_at
+
+        if fltr.limit:
+            return heapq.nlargest(fltr.limit, ranked, key=key)
+        return sorted(ranked, key=key, reverse=True)
+
     async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
         fetched: collections.OrderedDict[
             types.EventID, event.Event
         ] = collections.OrderedDict()
+        ranks: dict[types.EventID, float] = {}
 
+        now = int(time.time())
         for fltr in fltrs:
-            tmp = [
-                event
-                for event in self._stored_events.values()
-                if fltr.matches_event(event)
-            ]
+            if fltr.search:
+                for rank, ev in self._search(fltr, now):
+                    fetched.setdefault(ev.id, ev)
+                    ranks[ev.id] = max(rank, ranks.get(ev.id, 0.0))
+                continue
 
-            if fltr.limit is not None:
-                tmp = tmp[-fltr.limit :]
-
-            for ev in tmp:
+            for ev in self._query(fltr, now):
                 if ev.id not in fetched:
                     fetched[ev.id] = ev
 
-        return sorted(fetched.values(), key=lambda ev: ev.created_at, reverse=True)
+        # NIP-50 results are ordered by relevance, everything else by recency
+        return sorted(
+            fetched.values(),
+            key=lambda ev: (ranks.get(ev.id, 0.0), ev.created_at),
+            reverse=True,
+        )
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        now = int(time.time())
+        if len(fltrs) == 1 and not self._has_expired(now):
+            plan = self._exact_plan(fltrs[0])
+            if plan is not None:
+                return sum(
+                    hi - lo for lo, hi in (_time_bounds(k, fltrs[0]) for k in plan)
+                )
+
+        if len(fltrs) == 1:
+            return sum(1 for _ in self._matching(fltrs[0], now))
+
+        return len({ev.id for fltr in fltrs for ev in self._matching(fltr, now)})
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        return event_id in self._stored_events
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        for event_id in list(self._stored_events):
+            yield event_id
 
     async def remove(self, event_id: types.EventID):
         if event_id not in self._stored_events:
             raise ValueError(f"Event {event_id} not found")
-        del self._stored_events[event_id]
+
+        self._unindex([self._stored_events[event_id]])
+
+    def _unindex(self, evs: list[event.Event]):
+        keys: set[IndexKey] = set()
+        ids: set[types.EventID] = set()
+        by_kind = collections.defaultdict(set)
+        by_author = collections.defaultdict(set)
+        by_tag = collections.defaultdict(set)
+        by_term = collections.defaultdict(set)
+        by_bucket: dict[int, set[IndexKey]] = collections.defaultdict(set)
+        expiring: set[tuple[int, types.EventID]] = set()
+
+        for ev in evs:
+            key = (ev.created_at, ev.id)
+            keys.add(key)
+            ids.add(ev.id)
+            by_kind[ev.kind].add(key)
+            by_author[ev.pubkey].add(key)
+            for tag_key in _indexed_tags(ev):
+                by_tag[tag_key].add(key)
+            for term in set(event_filter.tokenize(ev.content)):
+                by_term[term].add(key)
+
+            if ev.id in self._expirations:
+                expiring.add((self._expirations.pop(ev.id), ev.id))
+
+            size = retention.approximate_size(ev)
+            self._bytes_used -= size
+            i = self._bucket_index(ev.kind)
+            if i is not None:
+                by_bucket[i].add(key)
+                self._buckets[i].bytes_used -= size
+
+            del self._stored_events[ev.id]
+
+        _discard_all(self._timeline, keys)
+        _discard_all(self._ids, ids)
+        _discard_all(self._expiry_queue, expiring)
+
+        for kind, items in by_kind.items():
+            _discard_all_from(self._by_kind, kind, items)
+
+        for pubkey, items in by_author.items():
+            if _discard_all_from(self._by_author, pubkey, items):
+                _discard(self._authors, pubkey)
+
+        for tag_key, items in by_tag.items():
+            _discard_all_from(self._by_tag, tag_key, items)
+
+        for term, items in by_term.items():
+            _discard_all_from(self._by_term, term, items)
+
+        for i, items in by_bucket.items():
+            _discard_all(self._buckets[i].timeline, items)
@@ -20,7 +20,11 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import asyncio
+import dataclasses
+import json
 import logging
+import time
+import typing
 
 import sqlalchemy
 from sqlalchemy import exc as sqlalchemy_exc
@@ -29,10 +33,13 @@ from sqlalchemy.ext import asyncio as pq_asyncio
 
 from ndk import types
 from ndk.event import event, event_builder, event_filter
-from ndk.relay.event_repo import event_repo
+from ndk.relay.event_repo import event_repo, retention, single_flight, slow_query_log
 
 logger = logging.getLogger(__name__)
 
+# no stemming or stop words, so results agree with EventFilter.matches_event()
+SEARCH_CONFIG = "simple"
+
 METADATA = sqlalchemy.MetaData()
 EVENTS_TABLE = sqlalchemy.Table(
     "events",
@@ -44,7 +51,20 @@ EVENTS_TABLE = sqlalchemy.Table(
     sqlalchemy.Column("kind", sqlalchemy.Integer),
     sqlalchemy.Column("content", sqlalchemy.TEXT),
     sqlalchemy.Column("sig", sqlalchemy.String(128)),
+    sqlalchemy.Column("expiration", sqlalchemy.Integer, nullable=True),
+    sqlalchemy.Column(
+        "content_tsv",
+        postgresql.TSVECTOR,
+        sqlalchemy.Computed(f"to_tsvector('{SEARCH_CONFIG}', content)", persisted=True),
+    ),
     sqlalchemy.UniqueConstraint("event_id"),
+    sqlalchemy.Index(
+        "ix_events_expiration",
+        "expiration",
+        postgresql_where=sqlalchemy.text("expiration IS NOT NULL"),
+    ),
+    sqlalchemy.Index("ix_events_kind_created_at", "kind", "created_at"),
+    sqlalchemy.Index("ix_events_content_tsv", "content_tsv", postgresql_using="gin"),
 )
 
 TAGS_TABLE = sqlalchemy.Table(
@@ -70,12 +90,112 @@ EVENT_TAGS_TABLE = sqlalchemy.Table(
     sqlalchemy.Column("tag_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("tags.id")),
 )
 
+# create_all() only creates missing tables, so columns and indexes added after
+# the initial schema are brought in here
+MIGRATIONS = [
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS expiration INTEGER",
+    "CREATE INDEX IF NOT EXISTS ix_events_expiration ON events (expiration) "
+    "WHERE expiration IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_events_kind_created_at ON events (kind, created_at)",
+    "ALTER TABLE events ADD COLUMN IF NOT EXISTS content_tsv tsvector GENERATED ALWAYS "
+    f"AS (to_tsvector('{SEARCH_CONFIG}', content)) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_events_content_tsv ON events USING gin (content_tsv)",
+]
+
+
+@dataclasses.dataclass
+class SweepConfig:
+    # upper bound of rows deleted per transaction, shrinks while batches are slow
+    batch_size: int = 500
+    min_batch_size: int = 10
+    target_batch_seconds: float = 0.1
+    # pause between batches so WAL shipping and vacuum can keep up
+    batch_pause: float = 0.05
+    lock_timeout_ms: int = 100
+
+
+@dataclasses.dataclass
+class SweepStats:
+    batches: int = 0
+    deleted: int = 0
+    seconds: float = 0.0
+    lock_wait_seconds: float = 0.0
+    lock_timeouts: int = 0
+
+    def rows_per_second(self) -> float:
+        return self.deleted / self.seconds if self.seconds else 0.0
+
+    def merge(self, other: "SweepStats"):
+        for field in dataclasses.fields(self):
+            setattr(
+                self, field.name, getattr(self, field.name) + getattr(other, field.name)
+            )
+
+
+def search_query(fltr: event_filter.EventFilter):
+    """tsquery requiring every search term, or None if there is nothing to search"""
+    if not fltr.search:
+        return None
+
+    terms = event_filter.search_terms(fltr.search)
+    if not terms:
+        return None
+
+    # inlined, as a bound regconfig can't be rendered into a slow query's SQL
+    return sqlalchemy.func.plainto_tsquery(
+        sqlalchemy.literal_column(f"'{SEARCH_CONFIG}'"), " ".join(terms)
+    )
+
+
+def kinds_clause(policy: retention.RetentionPolicy):
+    if policy.kinds is None:
+        return sqlalchemy.true()
+
+    return sqlalchemy.or_(
+        *[
+            (
+                EVENTS_TABLE.c.kind.between(spec[0], spec[1])
+                if isinstance(spec, list)
+                else EVENTS_TABLE.c.kind == spec
+            )
+            for spec in policy.kinds
+        ]
+    )
+
 
 class PostgresEventRepo(event_repo.EventRepo):
     _engine: pq_asyncio.AsyncEngine
-
-    def __init__(self, engine: pq_asyncio.AsyncEngine):
+    _policies: list[retention.RetentionPolicy]
+    _sweep_cfg: SweepConfig
+    _batch_size: int
+    _sweep_stats: SweepStats
+    _queries: single_flight.SingleFlight[tuple, typing.Any]
+    _writes: int
+    _slow_queries: typing.Optional[slow_query_log.SlowQueryLog]
+
+    def __init__(
+        self,
+        engine: pq_asyncio.AsyncEngine,
+        policies: typing.Optional[list[retention.RetentionPolicy]] = None,
+        sweep_cfg: SweepConfig = SweepConfig(),
+        slow_query_cfg: slow_query_log.SlowQueryConfig = slow_query_log.SlowQueryConfig(),
+    ):
         self._engine = engine
+        self._policies = policies or []
+        self._sweep_cfg = sweep_cfg
+        self._batch_size = sweep_cfg.batch_size
+        self._sweep_stats = SweepStats()
+        self._queries = single_flight.SingleFlight()
+        # queries only join one in flight that started after the latest write,
+        # so a REQ never misses an event stored before it arrived
+        self._writes = 0
+        self._slow_queries = None
+        if slow_query_cfg.enabled():
+            self._slow_queries = slow_query_log.SlowQueryLog(slow_query_cfg)
+
+        if any(policy.bytes is not None for policy in self._policies):
+            logger.warning("Retention bytes limits are ignored by PostgresEventRepo")
+
         super().__init__()
 
     @classmethod
@@ -89,7 +209,19 @@ class PostgresEventRepo(event_repo.EventRepo):
         return engine
 
     @classmethod
-    async def create(cls, host, port, user, password, database, drop_db=False):
+    async def create(
+        cls,
+        host,
+        port,
+        user,
+        password,
+        database,
+        drop_db=False,
+        *,
+        policies: typing.Optional[list[retention.RetentionPolicy]] = None,
+        sweep_cfg: SweepConfig = SweepConfig(),
+        slow_query_cfg: slow_query_log.SlowQueryConfig = slow_query_log.SlowQueryConfig(),
+    ):
         engine = await cls.create_engine(host, port, user, password, database)
 
         async with engine.begin() as conn:
@@ -103,14 +235,28 @@ class PostgresEventRepo(event_repo.EventRepo):
 
             await conn.run_sync(METADATA.create_all)
 
+            for migration in MIGRATIONS:
+                await conn.execute(sqlalchemy.text(migration))
+
         logger.info("Database initialized")
-        return PostgresEventRepo(engine)
+        return PostgresEventRepo(engine, policies, sweep_cfg, slow_query_cfg)
+
+    @property
+    def slow_queries(self) -> typing.Optional[slow_query_log.SlowQueryLog]:
+        return self._slow_queries
+
+    @property
+    def coalescing_stats(self) -> single_flight.SingleFlightStats:
+        """Queries run and queries saved by sharing identical ones in flight"""
+        return self._queries.stats
 
     async def _persist(self, ev: event.Event) -> types.EventID:
         max_retries = 3
         for attempt in range(1, max_retries + 1):
             try:
-                return await self._insert(ev)
+                ev_id = await self._insert(ev)
+                self._writes += 1
+                return ev_id
             except sqlalchemy_exc.IntegrityError as e:
                 if "unique constraint" in str(e).lower() and attempt < max_retries:
                     logger.warning(
@@ -136,6 +282,7 @@ class PostgresEventRepo(event_repo.EventRepo):
                     kind=ev.kind,
                     content=ev.content,
                     sig=ev.sig,
+                    expiration=ev.get_expiration(),
                 )
                 .on_conflict_do_nothing(index_elements=[EVENTS_TABLE.c.event_id])
                 .returning(EVENTS_TABLE.c.id)
@@ -247,36 +394,8 @@ class PostgresEventRepo(event_repo.EventRepo):
 
         return EVENTS_TABLE.c.id.in_(subquery)
 
-    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
-        query = (
-            sqlalchemy.select(
-                EVENTS_TABLE.c.event_id,
-                EVENTS_TABLE.c.pubkey,
-                EVENTS_TABLE.c.created_at,
-                EVENTS_TABLE.c.kind,
-                EVENTS_TABLE.c.content,
-                EVENTS_TABLE.c.sig,
-                sqlalchemy.text(
-                    "string_agg(CONCAT_WS('__', tags.identifier, tags.value, array_to_string(tags.additional_data, ',')), ',' ORDER BY event_tags.id ASC) as tags_combined"
-                ),
-            )
-            .select_from(
-                EVENTS_TABLE.outerjoin(EVENT_TAGS_TABLE).outerjoin(
-                    TAGS_TABLE, EVENT_TAGS_TABLE.c.tag_id == TAGS_TABLE.c.id
-                )
-            )
-            .group_by(
-                EVENTS_TABLE.c.event_id,
-                EVENTS_TABLE.c.pubkey,
-                EVENTS_TABLE.c.created_at,
-                EVENTS_TABLE.c.kind,
-                EVENTS_TABLE.c.content,
-                EVENTS_TABLE.c.sig,
-            )
-        )
-
+    def filters_clause(self, fltrs: list[event_filter.EventFilter]):
         queries = []
-        limit = float("-inf")
         for f in fltrs:
             conditions = []
             if f.ids:
@@ -318,42 +437,166 @@ class PostgresEventRepo(event_repo.EventRepo):
             if f.until:
                 conditions.append(EVENTS_TABLE.c.created_at < f.until)  # type: ignore[arg-type]
 
-            if f.limit:
-                limit = max(limit, f.limit)
+            tsquery = search_query(f)
+            if tsquery is not None:
+                conditions.append(EVENTS_TABLE.c.content_tsv.op("@@")(tsquery))
 
             queries.append(sqlalchemy.and_(*conditions))
 
-        final = query.where(sqlalchemy.or_(*queries)).order_by(
-            sqlalchemy.desc(EVENTS_TABLE.c.created_at)
+        not_expired = sqlalchemy.or_(
+            EVENTS_TABLE.c.expiration.is_(None),
+            EVENTS_TABLE.c.expiration > int(time.time()),
+        )
+        return sqlalchemy.and_(sqlalchemy.or_(*queries), not_expired)
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        evs = await self._queries.do(
+            ("get", self._writes, event_filter.filters_key(fltrs)),
+            lambda: self._get(fltrs),
+        )
+        return list(evs)
+
+    async def _get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        query = (
+            sqlalchemy.select(
+                EVENTS_TABLE.c.event_id,
+                EVENTS_TABLE.c.pubkey,
+                EVENTS_TABLE.c.created_at,
+                EVENTS_TABLE.c.kind,
+                EVENTS_TABLE.c.content,
+                EVENTS_TABLE.c.sig,
+                sqlalchemy.text(
+                    "string_agg(CONCAT_WS('__', tags.identifier, tags.value, array_to_string(tags.additional_data, ',')), ',' ORDER BY event_tags.id ASC) as tags_combined"
+                ),
+            )
+            .select_from(
+                EVENTS_TABLE.outerjoin(EVENT_TAGS_TABLE).outerjoin(
+                    TAGS_TABLE, EVENT_TAGS_TABLE.c.tag_id == TAGS_TABLE.c.id
+                )
+            )
+            .group_by(
+                EVENTS_TABLE.c.id,
+                EVENTS_TABLE.c.event_id,
+                EVENTS_TABLE.c.pubkey,
+                EVENTS_TABLE.c.created_at,
+                EVENTS_TABLE.c.kind,
+                EVENTS_TABLE.c.content,
+                EVENTS_TABLE.c.sig,
+            )
         )
-        if limit != float("-inf"):
-            final = final.limit(int(limit))
-        # query_str = final.compile(dialect=self._engine.dialect).string
-        # logger.debug(query_str)
 
+        # NIP-50 results are ordered by relevance, everything else by recency
+        order_by = [sqlalchemy.desc(EVENTS_TABLE.c.created_at)]
+        tsqueries = [q for q in map(search_query, fltrs) if q is not None]
+        if tsqueries:
+            rank = sqlalchemy.func.greatest(
+                *[
+                    sqlalchemy.func.ts_rank(EVENTS_TABLE.c.content_tsv, q, 1)
+                    for q in tsqueries
+                ]
+            )
+            order_by.insert(0, sqlalchemy.desc(rank))
+
+        limit = max((f.limit for f in fltrs if f.limit), default=None)
+        final = query.where(self.filters_clause(fltrs)).order_by(*order_by)
+        if limit is not None:
+            final = final.limit(limit)
+
+        start = time.perf_counter()
         async with self._engine.connect() as conn:
             result = (await conn.execute(final)).fetchall()
-
-            return [
-                event_builder.from_validated_dict(
-                    {
-                        "id": row[0],
-                        "pubkey": row[1],
-                        "created_at": row[2],
-                        "kind": row[3],
-                        "content": row[4],
-                        "sig": row[5],
-                        "tags": [
+        seconds = time.perf_counter() - start
+        if self._slow_queries is not None and self._slow_queries.is_slow(seconds):
+            self._record_slow_query(fltrs, final, len(result), seconds)
+
+        return [
+            event_builder.from_validated_dict(
+                {
+                    "id": row[0],
+                    "pubkey": row[1],
+                    "created_at": row[2],
+                    "kind": row[3],
+                    "content": row[4],
+                    "sig": row[5],
+                    "tags": [
+                        (
                             tag.split("__")[:-1]
                             if tag.endswith("__")
                             else tag.split("__")
-                            for tag in row[6].split(",")
-                            if row[6]
-                        ],
-                    }
+                        )
+                        for tag in row[6].split(",")
+                        if row[6]
+                    ],
+                }
+            )
+            for row in result
+        ]
+
+    def _record_slow_query(
+        self,
+        fltrs: list[event_filter.EventFilter],
+        statement: sqlalchemy.Select,
+        rows: int,
+        seconds: float,
+    ):
+        assert self._slow_queries is not None
+        # explained with bound parameters, the filter values never become SQL
+        compiled = statement.compile(
+            dialect=self._engine.dialect,
+            compile_kwargs={"render_postcompile": True},
+        )
+        params = tuple(compiled.params[name] for name in compiled.positiontup or [])
+        try:
+            # only for reading, the log has the parameters inlined
+            sql = str(
+                statement.compile(
+                    dialect=self._engine.dialect,
+                    compile_kwargs={"literal_binds": True},
+                )
+            )
+        except sqlalchemy_exc.CompileError:
+            sql = str(compiled)
+
+        async def explain():
+            async with self._engine.connect() as conn:
+                result = await conn.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + str(compiled), params
                 )
-                for row in result
-            ]
+                plan = result.scalar_one()
+            return json.loads(plan) if isinstance(plan, str) else plan
+
+        self._slow_queries.record(fltrs, sql, rows, seconds, explain)
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        return await self._queries.do(
+            ("count", self._writes, event_filter.filters_key(fltrs)),
+            lambda: self._count(fltrs),
+        )
+
+    async def _count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        query = (
+            sqlalchemy.select(sqlalchemy.func.count())  # pylint: disable=not-callable
+            .select_from(EVENTS_TABLE)
+            .where(self.filters_clause(fltrs))
+        )
+
+        async with self._engine.connect() as conn:
+            return (await conn.execute(query)).scalar_one()
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        query = sqlalchemy.select(EVENTS_TABLE.c.id).where(
+            EVENTS_TABLE.c.event_id == event_id
+        )
+
+        async with self._engine.connect() as conn:
+            return (await conn.execute(query)).first() is not None
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        query = sqlalchemy.select(EVENTS_TABLE.c.event_id)
+
+        async with self._engine.connect() as conn:
+            async for row in await conn.stream(query):
+                yield row.event_id
 
     async def remove(self, event_id: types.EventID):
         async with self._engine.begin() as conn:
@@ -370,3 +613,172 @@ class PostgresEventRepo(event_repo.EventRepo):
                 EVENTS_TABLE.c.event_id == event_id
             )
             await conn.execute(delete_stmt)
+
+        self._writes += 1
+
+    @property
+    def sweep_stats(self) -> SweepStats:
+        """Totals across every sweep since startup"""
+        return self._sweep_stats
+
+    def _victim_queries(self, now: int) -> list[tuple[str, typing.Callable]]:
+        """Returns (reason, build_query(batch_size)) for everything to delete"""
+        ids = sqlalchemy.select(EVENTS_TABLE.c.id)
+        queries: list[tuple[str, typing.Callable]] = [
+            (
+                "expired",
+                lambda n: ids.where(EVENTS_TABLE.c.expiration <= now)
+                .order_by(EVENTS_TABLE.c.expiration)
+                .limit(n),
+            )
+        ]
+
+        # an event is governed by the first policy matching its kind
+        earlier: list = []
+        for policy in self._policies:
+            governed = kinds_clause(policy)
+            if earlier:
+                governed = sqlalchemy.and_(
+                    governed, sqlalchemy.not_(sqlalchemy.or_(*earlier))
+                )
+            earlier.append(kinds_clause(policy))
+
+            if policy.time is not None:
+                cutoff = now - policy.time
+                queries.append(
+                    (
+                        "retention time",
+                        lambda n, governed=governed, cutoff=cutoff: ids.where(
+                            governed, EVENTS_TABLE.c.created_at < cutoff
+                        )
+                        .order_by(EVENTS_TABLE.c.created_at)
+                        .limit(n),
+                    )
+                )
+
+            if policy.count is not None:
+                # ranked in a subquery, since SKIP LOCKED drops locked rows
+                # before an OFFSET counts them, which would shift the cutoff
+                ranked = (
+                    sqlalchemy.select(
+                        EVENTS_TABLE.c.id,
+                        sqlalchemy.func.row_number()
+                        .over(
+                            order_by=(
+                                sqlalchemy.desc(EVENTS_TABLE.c.created_at),
+                                EVENTS_TABLE.c.id,
+                            )
+                        )
+                        .label("rank"),
+                    )
+                    .where(governed)
+                    .subquery()
+                )
+                queries.append(
+                    (
+                        "retention count",
+                        lambda n, ranked=ranked, count=policy.count: ids.where(
+                            EVENTS_TABLE.c.id.in_(
+                                sqlalchemy.select(ranked.c.id).where(
+                                    ranked.c.rank > count
+                                )
+                            )
+                        ).limit(n),
+                    )
+                )
+
+        return queries
+
+    async def _delete_batch(self, victims) -> tuple[int, float]:
+        """Deletes one batch in its own transaction, returns (deleted, lock wait)"""
+        async with self._engine.begin() as conn:
+            await conn.execute(
+                sqlalchemy.text(
+                    f"SET LOCAL lock_timeout = {int(self._sweep_cfg.lock_timeout_ms)}"
+                )
+            )
+
+            start = time.monotonic()
+            ids = (
+                (await conn.execute(victims.with_for_update(skip_locked=True)))
+                .scalars()
+                .all()
+            )
+            lock_wait = time.monotonic() - start
+
+            if ids:
+                await conn.execute(
+                    EVENTS_TABLE.delete().where(EVENTS_TABLE.c.id.in_(ids))
+                )
+
+        return len(ids), lock_wait
+
+    def _resize_batch(self, seconds: float):
+        if seconds > self._sweep_cfg.target_batch_seconds:
+            self._batch_size = max(
+                self._sweep_cfg.min_batch_size, self._batch_size // 2
+            )
+        else:
+            self._batch_size = min(self._sweep_cfg.batch_size, self._batch_size * 2)
+
+    async def sweep(self, now: typing.Optional[int] = None) -> SweepStats:
+        """Deletes expired events and retention policy victims in small batches"""
+        if now is None:
+            now = int(time.time())
+
+        stats = SweepStats()
+        for reason, build_query in self._victim_queries(now):
+            while True:
+                batch_size = self._batch_size
+                start = time.monotonic()
+                try:
+                    deleted, lock_wait = await self._delete_batch(
+                        build_query(batch_size)
+                    )
+                except sqlalchemy_exc.DBAPIError as exc:
+                    if "lock timeout" not in str(exc).lower():
+                        raise
+                    stats.lock_timeouts += 1
+                    stats.lock_wait_seconds += time.monotonic() - start
+                    self._batch_size = self._sweep_cfg.min_batch_size
+                    logger.warning("Sweep of %s events hit lock timeout", reason)
+                    break
+
+                seconds = time.monotonic() - start
+                stats.batches += 1
+                stats.deleted += deleted
+                stats.seconds += seconds
+                stats.lock_wait_seconds += lock_wait
+                logger.debug(
+                    "Swept %s %s events in %.3fs (%.0f rows/s, %.3fs lock wait)",
+                    deleted,
+                    reason,
+                    seconds,
+                    deleted / seconds if seconds else 0.0,
+                    lock_wait,
+                )
+
+                self._resize_batch(seconds)
+                if deleted < batch_size:
+                    break
+                await asyncio.sleep(self._sweep_cfg.batch_pause)
+
+        self._sweep_stats.merge(stats)
+        if stats.deleted or stats.lock_timeouts:
+            logger.info(
+                "Sweep deleted %s events in %s batches (%.0f rows/s, %.3fs lock wait, %s lock timeouts)",
+                stats.deleted,
+                stats.batches,
+                stats.rows_per_second(),
+                stats.lock_wait_seconds,
+                stats.lock_timeouts,
+            )
+        return stats
+
+    async def start_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Failed to sweep events", exc_info=exc)
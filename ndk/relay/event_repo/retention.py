@@ -0,0 +1,122 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Event retention policies based on the NIP-11 `retention` format
+
+Example::
+
+    policies = [
+        RetentionPolicy.from_dict({"kinds": [0, 1, [5, 7]], "time": 3600}),
+        RetentionPolicy.from_dict({"time": 3600, "count": 10000}),
+    ]
+
+An event is governed by the first policy whose kinds match it. A policy without
+kinds matches every kind.
+"""
+
+import dataclasses
+import typing
+
+from ndk.event import event
+
+KindSpec = typing.Union[int, list[int]]
+
+# Rough CPython cost of an event object, its strings and its index entries
+EVENT_OVERHEAD_BYTES = 1024
+TAG_OVERHEAD_BYTES = 128
+
+# Once a limit is exceeded, evict down to this fraction below it so the cost of
+# compacting the indexes is paid once per batch instead of once per insert
+EVICTION_HEADROOM = 0.05
+
+
+def approximate_size(ev: event.Event) -> int:
+    return (
+        EVENT_OVERHEAD_BYTES
+        + len(ev.content)
+        + sum(TAG_OVERHEAD_BYTES + sum(len(val) for val in tag) for tag in ev.tags)
+    )
+
+
+def low_watermark(limit: int) -> int:
+    return limit - int(limit * EVICTION_HEADROOM)
+
+
+@dataclasses.dataclass
+class RetentionPolicy:
+    kinds: typing.Optional[list[KindSpec]] = None
+    time: typing.Optional[int] = None
+    count: typing.Optional[int] = None
+    bytes: typing.Optional[int] = None
+
+    def __post_init__(self):
+        if self.kinds is not None:
+            if not isinstance(self.kinds, list):
+                raise ValueError("kinds must be a list")
+            for spec in self.kinds:
+                if isinstance(spec, list):
+                    if len(spec) != 2 or not all(isinstance(k, int) for k in spec):
+                        raise ValueError(f"kind ranges must be [start, end]: {spec}")
+                elif not isinstance(spec, int):
+                    raise ValueError(f"kinds must be ints or ranges: {spec}")
+
+        for field_name in ["time", "count", "bytes"]:
+            val = self.__dict__[field_name]
+            if val is not None and (not isinstance(val, int) or val < 0):
+                raise ValueError(f"{field_name} must be a non-negative int")
+
+    def applies_to(self, kind: int) -> bool:
+        if self.kinds is None:
+            return True
+
+        for spec in self.kinds:
+            if isinstance(spec, list):
+                if spec[0] <= kind <= spec[1]:
+                    return True
+            elif spec == kind:
+                return True
+
+        return False
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "RetentionPolicy":
+        unknown = set(d.keys()) - {"kinds", "time", "count", "bytes"}
+        if unknown:
+            raise ValueError(f"Unknown retention policy fields: {unknown}")
+
+        return cls(
+            kinds=d.get("kinds"),
+            time=d.get("time"),
+            count=d.get("count"),
+            bytes=d.get("bytes"),
+        )
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in self.__dict__.items() if v is not None}
+
+
+def find_policy(policies: list[RetentionPolicy], kind: int) -> typing.Optional[int]:
+    """Returns the index of the first policy governing kind, if any"""
+    for i, policy in enumerate(policies):
+        if policy.applies_to(kind):
+            return i
+
+    return None
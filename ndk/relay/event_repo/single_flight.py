@@ -0,0 +1,71 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Coalesces concurrent identical calls into one
+
+While a call for a key is in flight, later calls for the same key wait for
+its result instead of starting their own. The shared call runs in its own
+task, so cancelling one waiter doesn't cancel it for the others.
+"""
+
+import asyncio
+import dataclasses
+import typing
+
+K = typing.TypeVar("K", bound=typing.Hashable)
+T = typing.TypeVar("T")
+
+
+@dataclasses.dataclass
+class SingleFlightStats:
+    calls: int = 0
+    # calls that waited for one already in flight instead of running
+    saved: int = 0
+
+
+class SingleFlight(typing.Generic[K, T]):
+    _in_flight: dict[K, asyncio.Future[T]]
+    _stats: SingleFlightStats
+
+    def __init__(self):
+        self._in_flight = {}
+        self._stats = SingleFlightStats()
+
+    @property
+    def stats(self) -> SingleFlightStats:
+        return self._stats
+
+    async def do(self, key: K, fn: typing.Callable[[], typing.Awaitable[T]]) -> T:
+        self._stats.calls += 1
+
+        fut = self._in_flight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._in_flight[key] = fut
+            fut.add_done_callback(lambda _: self._forget(key, fut))
+        else:
+            self._stats.saved += 1
+
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: K, fut: asyncio.Future[T]):
+        if self._in_flight.get(key) is fut:
+            del self._in_flight[key]
@@ -0,0 +1,165 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Log of the queries a repo was slow to answer, to find the filters that hurt
+
+Every query over the threshold is logged with the filters that asked for it,
+in the form clients send them so the REQ can be replayed, along with the SQL
+it compiled to, the rows returned and how long it took. A sample of them also
+get the database's plan for the SQL, fetched in the background.
+
+Entries are appended to a JSON lines file, which is moved to <path>.1 once it
+reaches max_bytes, so at most twice that is kept on disk.
+"""
+
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import random
+import time
+import typing
+
+from ndk.event import event_filter
+
+logger = logging.getLogger(__name__)
+
+Explain = typing.Callable[[], typing.Awaitable[typing.Any]]
+
+
+@dataclasses.dataclass
+class SlowQueryConfig:
+    # seconds a query may take before it's logged, None to log none
+    threshold: typing.Optional[float] = None
+    # entries are only logged, not written, without a path
+    path: typing.Optional[str] = None
+    max_bytes: int = 10 * 1024 * 1024
+    # fraction of the slow queries whose plan is captured
+    explain_rate: float = 0.0
+
+    def enabled(self) -> bool:
+        return self.threshold is not None
+
+
+@dataclasses.dataclass
+class SlowQueryStats:
+    logged: int = 0
+    explained: int = 0
+    # entries lost because EXPLAIN or writing them failed
+    failed: int = 0
+
+
+def _append(path: str, max_bytes: int, entry: dict):
+    line = json.dumps(entry) + "\n"
+    try:
+        if os.path.getsize(path) + len(line) > max_bytes:
+            os.replace(path, path + ".1")
+    except FileNotFoundError:
+        pass
+
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+def read(path: str) -> typing.Iterator[dict]:
+    """Entries of a slow query log, oldest first, including the rotated file"""
+    for p in [path + ".1", path]:
+        try:
+            with open(p, encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
+        except FileNotFoundError:
+            pass
+
+
+class SlowQueryLog:
+    _cfg: SlowQueryConfig
+    _stats: SlowQueryStats
+    _pending: set[asyncio.Task]
+    _write_lock: asyncio.Lock
+
+    def __init__(self, cfg: SlowQueryConfig):
+        self._cfg = cfg
+        self._stats = SlowQueryStats()
+        self._pending = set()
+        # one append at a time, or a rotation could clobber the rotated file
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def stats(self) -> SlowQueryStats:
+        return self._stats
+
+    def is_slow(self, seconds: float) -> bool:
+        return self._cfg.threshold is not None and seconds >= self._cfg.threshold
+
+    def record(
+        self,
+        fltrs: list[event_filter.EventFilter],
+        sql: str,
+        rows: int,
+        seconds: float,
+        explain: typing.Optional[Explain] = None,
+    ):
+        """Logs a slow query, explaining and writing it in the background
+
+        explain fetches the query's plan, it's only called for a sample of them.
+        """
+        self._stats.logged += 1
+        filters = [fltr.for_req() for fltr in fltrs]
+        logger.warning("Slow query took %.3fs for %s rows: %s", seconds, rows, filters)
+        if self._cfg.path is None:
+            return
+
+        entry = {
+            "ts": time.time(),
+            "seconds": seconds,
+            "rows": rows,
+            "filters": filters,
+            "sql": sql,
+        }
+        if random.random() >= self._cfg.explain_rate:
+            explain = None
+        task = asyncio.create_task(self._write(entry, explain))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _write(self, entry: dict, explain: typing.Optional[Explain]):
+        assert self._cfg.path is not None
+        try:
+            if explain is not None:
+                entry["plan"] = await explain()
+                self._stats.explained += 1
+            async with self._write_lock:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, _append, self._cfg.path, self._cfg.max_bytes, entry
+                )
+        except Exception as exc:  # pylint: disable=broad-except
+            self._stats.failed += 1
+            logger.error(
+                "Failed to write slow query to %s", self._cfg.path, exc_info=exc
+            )
+
+    async def flush(self):
+        """Waits for the entries still being explained or written"""
+        if self._pending:
+            await asyncio.wait(list(self._pending))
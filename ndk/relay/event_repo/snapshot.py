@@ -0,0 +1,143 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compact binary snapshots of events, used for warm restarts of in-memory repos
+
+Layout, all integers big-endian:
+
+    header: magic (8 bytes) | event count (u64)
+    event:  id (32) | pubkey (32) | sig (64) | created_at (u64) | kind (u32)
+            | tags length (u32) | content length (u32) | tags JSON | content UTF-8
+
+Snapshots only ever hold events that were validated when they arrived, so
+reading them skips signature validation entirely. Events whose fields don't
+fit the layout are left out, and logged.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import typing
+
+from ndk import serialize
+from ndk.event import event, event_builder
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"NDKSNAP1"
+HEADER = struct.Struct(">8sQ")
+RECORD = struct.Struct(">32s32s64sQIII")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _encode(ev: event.Event) -> bytes:
+    # struct would store True as 1
+    if isinstance(ev.created_at, bool):
+        raise ValueError(f"created_at must be an integer, got {ev.created_at!r}")
+
+    tags = serialize.serialize_as_bytes(ev.tags)
+    content = ev.content.encode("utf-8")
+    return (
+        RECORD.pack(
+            bytes.fromhex(ev.id),
+            bytes.fromhex(ev.pubkey),
+            bytes.fromhex(ev.sig),
+            ev.created_at,
+            ev.kind,
+            len(tags),
+            len(content),
+        )
+        + tags
+        + content
+    )
+
+
+def write(path: str, evs: typing.Sequence[event.Event]) -> int:
+    """Atomically replaces path with a snapshot of evs, returns how many it holds
+
+    A crash while writing leaves the previous snapshot in place.
+    """
+    tmp = f"{path}.tmp"
+    written = 0
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0))
+        for ev in evs:
+            try:
+                f.write(_encode(ev))
+            except (struct.error, ValueError, AttributeError) as exc:
+                logger.warning("Leaving event %s out of the snapshot: %s", ev.id, exc)
+                continue
+            written += 1
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, written))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return written
+
+
+def read(path: str) -> typing.Iterator[event.Event]:
+    """Yields every event in the snapshot at path, without validating them"""
+    if os.path.getsize(path) < HEADER.size:
+        raise SnapshotError(f"{path} is too short to be a snapshot")
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, count = HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not a snapshot")
+
+        offset = HEADER.size
+        for _ in range(count):
+            if offset + RECORD.size > len(mm):
+                raise SnapshotError(f"{path} is truncated")
+            (
+                ev_id,
+                pubkey,
+                sig,
+                created_at,
+                kind,
+                tags_len,
+                content_len,
+            ) = RECORD.unpack_from(mm, offset)
+            offset += RECORD.size
+
+            if offset + tags_len + content_len > len(mm):
+                raise SnapshotError(f"{path} is truncated")
+            tags = serialize.deserialize_bytes(mm[offset : offset + tags_len])
+            offset += tags_len
+            content = mm[offset : offset + content_len].decode("utf-8")
+            offset += content_len
+
+            yield event_builder.from_validated_dict(
+                {
+                    "id": ev_id.hex(),
+                    "pubkey": pubkey.hex(),
+                    "created_at": created_at,
+                    "kind": kind,
+                    "tags": tags,
+                    "content": content,
+                    "sig": sig.hex(),
+                }
+            )
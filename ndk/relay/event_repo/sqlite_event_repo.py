@@ -0,0 +1,537 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
+import logging
+import sqlite3
+import string
+import threading
+import time
+import typing
+
+from ndk import serialize, types
+from ndk.event import event, event_builder, event_filter
+from ndk.relay.event_repo import event_repo, retention
+
+logger = logging.getLogger(__name__)
+
+# sorts after every hex character, making [prefix, prefix + _MAX_CHAR) a prefix range
+_MAX_CHAR = "\U0010ffff"
+
+# event ids fetched per round trip by stored_ids()
+_ID_BATCH_SIZE = 10_000
+
+_COLUMNS = (
+    "events.event_id, events.pubkey, events.created_at, events.kind, "
+    "events.tags, events.content, events.sig"
+)
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        event_id TEXT NOT NULL UNIQUE,
+        pubkey TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        kind INTEGER NOT NULL,
+        tags TEXT NOT NULL,
+        content TEXT NOT NULL,
+        sig TEXT NOT NULL,
+        expiration INTEGER
+    )
+    """,
+    # one index per NIP-01 filter shape, each ending in created_at so that
+    # queries walk it newest-first and stop at the limit without sorting
+    "CREATE INDEX IF NOT EXISTS ix_events_created_at ON events (created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_events_kind_created_at ON events (kind, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_events_pubkey_created_at "
+    "ON events (pubkey, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_events_pubkey_kind_created_at "
+    "ON events (pubkey, kind, created_at)",
+    "CREATE INDEX IF NOT EXISTS ix_events_expiration ON events (expiration) "
+    "WHERE expiration IS NOT NULL",
+    # the primary key covers generic tag queries, so they never touch the table
+    """
+    CREATE TABLE IF NOT EXISTS tags (
+        event INTEGER NOT NULL REFERENCES events (id) ON DELETE CASCADE,
+        name TEXT NOT NULL,
+        value TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (name, value, created_at, event)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_tags_event ON tags (event)",
+    # unicode61 splits words the same way as event_filter.tokenize()
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+        content,
+        content='events',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 0'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS events_fts_delete AFTER DELETE ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+]
+
+
+@dataclasses.dataclass
+class SqliteConfig:
+    # bytes of the database file mapped into memory, 0 disables mmap
+    mmap_size: int = 256 * 1024 * 1024
+    # page cache per connection
+    cache_size_kib: int = 64 * 1024
+    read_threads: int = 4
+    # rows deleted per transaction by the sweeper
+    sweep_batch_size: int = 500
+
+
+def _indexed_tags(ev: event.Event) -> set[tuple[str, str]]:
+    # only single letter tags are queryable per NIP-12
+    return {
+        (tag[0], tag[1])
+        for tag in ev.tags
+        if len(tag) > 1 and len(tag[0]) == 1 and tag[0] in string.ascii_letters
+    }
+
+
+def _prefix_clause(column: str, prefixes: list[str], params: list) -> str:
+    clauses = []
+    for prefix in prefixes:
+        if len(prefix) == 64:
+            clauses.append(f"{column} = ?")
+            params.append(prefix)
+        else:
+            # a range rather than LIKE so the index is used
+            clauses.append(f"({column} >= ? AND {column} < ?)")
+            params.extend([prefix, prefix + _MAX_CHAR])
+    return "(" + " OR ".join(clauses) + ")"
+
+
+def _in_clause(column: str, values: list, params: list) -> str:
+    params.extend(values)
+    return f"{column} IN ({', '.join('?' * len(values))})"
+
+
+def _match_expr(fltr: event_filter.EventFilter) -> typing.Optional[str]:
+    """FTS5 query requiring every search term, or None if there is nothing to search"""
+    if not fltr.search:
+        return None
+
+    terms = event_filter.search_terms(fltr.search)
+    if not terms:
+        return None
+
+    # terms are alphanumeric, quoting keeps FTS5 from reading them as operators
+    return " ".join(f'"{term}"' for term in terms)
+
+
+def _where(fltr: event_filter.EventFilter, now: int, params: list) -> str:
+    """SQL condition for every filter field except search"""
+    conditions = ["(events.expiration IS NULL OR events.expiration > ?)"]
+    params.append(now)
+
+    if fltr.ids:
+        conditions.append(_prefix_clause("events.event_id", fltr.ids, params))
+
+    if fltr.authors:
+        conditions.append(_prefix_clause("events.pubkey", fltr.authors, params))
+
+    if fltr.kinds:
+        conditions.append(_in_clause("events.kind", fltr.kinds, params))
+
+    if fltr.generic_tags:
+        for identifier, values in fltr.generic_tags.items():
+            params.append(identifier)
+            conditions.append(
+                "events.id IN (SELECT event FROM tags WHERE name = ? AND "
+                + _in_clause("value", values, params)
+                + ")"
+            )
+
+    if fltr.since:
+        conditions.append("events.created_at > ?")
+        params.append(fltr.since)
+
+    if fltr.until:
+        conditions.append("events.created_at < ?")
+        params.append(fltr.until)
+
+    return " AND ".join(conditions)
+
+
+def _kinds_clause(policy: retention.RetentionPolicy, params: list) -> str:
+    if policy.kinds is None:
+        return "1"
+
+    clauses = []
+    for spec in policy.kinds:
+        if isinstance(spec, list):
+            clauses.append("events.kind BETWEEN ? AND ?")
+            params.extend(spec)
+        else:
+            clauses.append("events.kind = ?")
+            params.append(spec)
+    return "(" + " OR ".join(clauses) + ")"
+
+
+class SqliteEventRepo(event_repo.EventRepo):
+    """Embedded event store for single node relays
+
+    Writes go through one dedicated thread since SQLite allows a single writer,
+    while reads run concurrently on a thread pool against the WAL.
+    """
+
+    _path: str
+    _cfg: SqliteConfig
+    _policies: list[retention.RetentionPolicy]
+    _local: threading.local
+    _connections: list[sqlite3.Connection]
+    _connections_lock: threading.Lock
+    _writer: concurrent.futures.ThreadPoolExecutor
+    _readers: concurrent.futures.ThreadPoolExecutor
+
+    def __init__(
+        self,
+        path: str,
+        policies: typing.Optional[list[retention.RetentionPolicy]] = None,
+        cfg: SqliteConfig = SqliteConfig(),
+    ):
+        self._path = path
+        self._cfg = cfg
+        self._policies = policies or []
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sqlite-writer"
+        )
+        self._readers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=cfg.read_threads, thread_name_prefix="sqlite-reader"
+        )
+
+        if any(policy.bytes is not None for policy in self._policies):
+            logger.warning("Retention bytes limits are ignored by SqliteEventRepo")
+
+        super().__init__()
+
+    @classmethod
+    async def create(
+        cls,
+        path: str,
+        policies: typing.Optional[list[retention.RetentionPolicy]] = None,
+        cfg: SqliteConfig = SqliteConfig(),
+    ) -> "SqliteEventRepo":
+        repo = cls(path, policies, cfg)
+        await repo._write(repo._create_schema)
+        logger.info("Database initialized at %s", path)
+        return repo
+
+    def close(self):
+        self._readers.shutdown()
+        self._writer.shutdown()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Connection owned by the calling thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, transactions are explicit in _transaction()
+            conn = sqlite3.connect(
+                self._path, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA temp_store = MEMORY")
+            conn.execute("PRAGMA busy_timeout = 5000")
+            conn.execute(f"PRAGMA mmap_size = {int(self._cfg.mmap_size)}")
+            conn.execute(f"PRAGMA cache_size = -{int(self._cfg.cache_size_kib)}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Iterator[sqlite3.Connection]:
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    async def _write(self, fn: typing.Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._writer, fn, *args)
+
+    async def _read(self, fn: typing.Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, fn, *args
+        )
+
+    def _create_schema(self):
+        conn = self._connection()
+        # persistent, so readers opened later are in WAL mode as well
+        conn.execute("PRAGMA journal_mode = WAL")
+        with self._transaction():
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    async def _persist(self, ev: event.Event) -> types.EventID:
+        return await self._write(self._insert, ev)
+
+    def _insert(self, ev: event.Event) -> types.EventID:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO events "
+                "(event_id, pubkey, created_at, kind, tags, content, sig, expiration) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    ev.id,
+                    ev.pubkey,
+                    ev.created_at,
+                    ev.kind,
+                    serialize.serialize_as_str(ev.tags),
+                    ev.content,
+                    ev.sig,
+                    ev.get_expiration(),
+                ),
+            )
+
+            # if it is already in the db, do nothing
+            if cursor.rowcount == 0:
+                return ev.id
+
+            conn.executemany(
+                "INSERT OR IGNORE INTO tags (event, name, value, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (cursor.lastrowid, name, value, ev.created_at)
+                    for name, value in _indexed_tags(ev)
+                ],
+            )
+
+        return ev.id
+
+    def _select(
+        self, fltr: event_filter.EventFilter, now: int
+    ) -> list[tuple[float, event.Event]]:
+        """(rank, event) for one filter, ranked by relevance when searching"""
+        params: list = []
+        match = _match_expr(fltr)
+        if match is None:
+            where = _where(fltr, now, params)
+            sql = (
+                f"SELECT {_COLUMNS}, 0.0 FROM events WHERE {where} "
+                "ORDER BY events.created_at DESC"
+            )
+        else:
+            params.append(match)
+            where = _where(fltr, now, params)
+            sql = (
+                f"SELECT {_COLUMNS}, -bm25(events_fts) FROM events_fts "
+                "JOIN events ON events.id = events_fts.rowid "
+                f"WHERE events_fts MATCH ? AND {where} "
+                "ORDER BY bm25(events_fts), events.created_at DESC"
+            )
+
+        if fltr.limit:
+            sql += " LIMIT ?"
+            params.append(fltr.limit)
+
+        return [
+            (
+                row[7],
+                event_builder.from_validated_dict(
+                    {
+                        "id": row[0],
+                        "pubkey": row[1],
+                        "created_at": row[2],
+                        "kind": row[3],
+                        "tags": serialize.deserialize_str(row[4]),
+                        "content": row[5],
+                        "sig": row[6],
+                    }
+                ),
+            )
+            for row in self._connection().execute(sql, params)
+        ]
+
+    def _get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        fetched: dict[types.EventID, event.Event] = {}
+        ranks: dict[types.EventID, float] = {}
+
+        now = int(time.time())
+        for fltr in fltrs:
+            for rank, ev in self._select(fltr, now):
+                fetched.setdefault(ev.id, ev)
+                ranks[ev.id] = max(rank, ranks.get(ev.id, 0.0))
+
+        # NIP-50 results are ordered by relevance, everything else by recency
+        return sorted(
+            fetched.values(),
+            key=lambda ev: (ranks[ev.id], ev.created_at),
+            reverse=True,
+        )
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        return await self._read(self._get, fltrs)
+
+    def _count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        now = int(time.time())
+        params: list = []
+        clauses = []
+        for fltr in fltrs:
+            clause = _where(fltr, now, params)
+            match = _match_expr(fltr)
+            if match is not None:
+                clause += (
+                    " AND events.id IN "
+                    "(SELECT rowid FROM events_fts WHERE events_fts MATCH ?)"
+                )
+                params.append(match)
+            clauses.append(f"({clause})")
+
+        sql = f"SELECT count(*) FROM events WHERE {' OR '.join(clauses)}"
+        return self._connection().execute(sql, params).fetchone()[0]
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        return await self._read(self._count, fltrs)
+
+    def _ids_after(self, rowid: int) -> list[tuple[int, types.EventID]]:
+        sql = "SELECT id, event_id FROM events WHERE id > ? ORDER BY id LIMIT ?"
+        return self._connection().execute(sql, (rowid, _ID_BATCH_SIZE)).fetchall()
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        # pages by rowid so no reader thread is held while the caller iterates
+        rowid = 0
+        while rows := await self._read(self._ids_after, rowid):
+            for rowid, event_id in rows:
+                yield event_id
+
+    def _delete(self, event_id: types.EventID):
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM events WHERE event_id = ?", (event_id,))
+            if cursor.rowcount == 0:
+                raise ValueError(f"Event {event_id} does not exist")
+
+    async def remove(self, event_id: types.EventID):
+        await self._write(self._delete, event_id)
+
+    def _victim_queries(self, now: int) -> list[tuple[str, str, list, int]]:
+        """Returns (reason, select ids sql, params, offset) for everything to delete
+
+        The sql ends in LIMIT ? OFFSET ? so it can be run one batch at a time.
+        """
+        queries = [
+            (
+                "expired",
+                "SELECT id FROM events WHERE expiration <= ? "
+                "ORDER BY expiration LIMIT ? OFFSET ?",
+                [now],
+                0,
+            )
+        ]
+
+        # an event is governed by the first policy matching its kind
+        earlier: list[tuple[str, list]] = []
+        for policy in self._policies:
+            params: list = []
+            governed = _kinds_clause(policy, params)
+            for clause, clause_params in earlier:
+                governed += f" AND NOT {clause}"
+                params.extend(clause_params)
+            kinds_params: list = []
+            earlier.append((_kinds_clause(policy, kinds_params), kinds_params))
+
+            if policy.time is not None:
+                queries.append(
+                    (
+                        "retention time",
+                        f"SELECT id FROM events WHERE {governed} AND created_at < ? "
+                        "ORDER BY created_at LIMIT ? OFFSET ?",
+                        params + [now - policy.time],
+                        0,
+                    )
+                )
+
+            if policy.count is not None:
+                queries.append(
+                    (
+                        "retention count",
+                        f"SELECT id FROM events WHERE {governed} "
+                        "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                        params,
+                        policy.count,
+                    )
+                )
+
+        return queries
+
+    def _delete_batch(self, sql: str, params: list) -> int:
+        with self._transaction() as conn:
+            cursor = conn.execute(f"DELETE FROM events WHERE id IN ({sql})", params)
+            return cursor.rowcount
+
+    async def sweep(self, now: typing.Optional[int] = None) -> int:
+        """Deletes expired events and retention policy victims, returns the count"""
+        if now is None:
+            now = int(time.time())
+
+        batch_size = self._cfg.sweep_batch_size
+        deleted = 0
+        for reason, sql, params, offset in self._victim_queries(now):
+            while True:
+                n = await self._write(
+                    self._delete_batch, sql, params + [batch_size, offset]
+                )
+                deleted += n
+                logger.debug("Swept %s %s events", n, reason)
+                if n < batch_size:
+                    break
+
+        if deleted:
+            logger.info("Sweep deleted %s events", deleted)
+        return deleted
+
+    async def start_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Failed to sweep events", exc_info=exc)
@@ -0,0 +1,177 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import asyncio
+import time
+
+import mock
+import pytest
+
+from ndk import crypto, serialize
+from ndk.event import event, event_filter, event_tags, metadata_event
+from ndk.relay.event_repo import caching_event_repo, memory_event_repo
+
+
+@pytest.fixture
+def inner():
+    return memory_event_repo.MemoryEventRepo()
+
+
+@pytest.fixture
+def repo(inner):
+    return caching_event_repo.CachingEventRepo(inner)
+
+
+def note(keys, kind=1000, **kwargs) -> event.Event:
+    return event.RegularEvent.build(keys, kind=kind, **kwargs)
+
+
+async def test_repeated_gets_hit(repo, inner, keys):
+    await repo.add(note(keys))
+
+    with mock.patch.object(inner, "get", wraps=inner.get) as inner_get:
+        first = await repo.get(
+            [event_filter.EventFilter(authors=[keys.public], kinds=[1000, 1001])]
+        )
+        second = await repo.get(
+            [event_filter.EventFilter(kinds=[1001, 1000], authors=[keys.public])]
+        )
+
+    assert first == second
+    assert inner_get.call_count == 1
+    assert repo.stats.hits == 1
+    assert repo.stats.hit_ratio == 0.5
+
+
+async def test_matching_event_invalidates(repo, keys):
+    fltr = event_filter.EventFilter(authors=[keys.public], kinds=[1000])
+    assert not await repo.get([fltr])
+
+    ev = note(keys)
+    await repo.add(ev)
+
+    assert await repo.get([fltr]) == [ev]
+    assert repo.stats.invalidations == 1
+
+
+async def test_unrelated_events_keep_entries(repo, keys):
+    await repo.get([event_filter.EventFilter(authors=[keys.public], kinds=[1000])])
+    await repo.get([event_filter.EventFilter(kinds=[1000], until=100)])
+
+    await repo.add(note(keys, kind=1001))
+    await repo.add(note(crypto.KeyPair(), kind=1000))
+    await repo.add(note(keys, kind=1000, created_at=200))
+
+    # only the entry for keys' kind 1000 events could have changed
+    assert repo.stats.invalidations == 1
+    assert len(repo) == 1
+
+
+async def test_remove_invalidates_entries_holding_the_event(repo, keys):
+    ev = note(keys)
+    await repo.add(ev)
+    fltr = event_filter.EventFilter(ids=[ev.id])
+    assert await repo.get([fltr]) == [ev]
+
+    await repo.remove(ev.id)
+
+    assert not await repo.get([fltr])
+
+
+async def test_replaced_event_is_not_served(repo, keys):
+    old = metadata_event.MetadataEvent.from_metadata_parts(keys, name="old")
+    await repo.add(old)
+    fltr = event_filter.EventFilter(ids=[old.id])
+    assert await repo.get([fltr]) == [old]
+
+    new = metadata_event.MetadataEvent.build(
+        keys, kind=0, created_at=old.created_at + 1, content='{"name":"new"}'
+    )
+    await repo.add(new)
+
+    assert not await repo.get([fltr])
+
+
+async def test_lru_eviction(inner, keys):
+    repo = caching_event_repo.CachingEventRepo(
+        inner, caching_event_repo.CacheConfig(max_entries=2)
+    )
+    await repo.add(note(keys))
+    fltrs = [[event_filter.EventFilter(limit=i)] for i in range(1, 4)]
+
+    await repo.get(fltrs[0])
+    await repo.get(fltrs[1])
+    await repo.get(fltrs[0])
+    await repo.get(fltrs[2])
+
+    assert len(repo) == 2
+    assert repo.stats.evictions == 1
+    await repo.get(fltrs[0])
+    assert repo.stats.hits == 2
+
+
+async def test_entries_expire(repo, keys):
+    now = time.time()
+    ev = note(keys, tags=event_tags.EventTags([["expiration", str(int(now) + 10)]]))
+    await repo.add(ev)
+    await repo.get([event_filter.EventFilter()])
+
+    with mock.patch("time.time", return_value=now + 10):
+        assert not await repo.get([event_filter.EventFilter()])
+    assert repo.stats.hits == 0
+
+
+async def test_write_during_fetch_is_not_cached(repo, inner, keys):
+    fltr = event_filter.EventFilter(kinds=[1000])
+    fetching = asyncio.Event()
+    release = asyncio.Event()
+    inner_get = inner.get
+
+    async def slow_get(fltrs):
+        result = await inner_get(fltrs)
+        fetching.set()
+        await release.wait()
+        return result
+
+    with mock.patch.object(inner, "get", side_effect=slow_get):
+        task = asyncio.create_task(repo.get([fltr]))
+        await fetching.wait()
+        ev = note(keys)
+        await repo.add(ev)
+        release.set()
+        assert not await task
+
+    assert await repo.get([fltr]) == [ev]
+
+
+async def test_serialized_results_are_cached(repo, keys):
+    ev = note(keys)
+    await repo.add(ev)
+
+    with mock.patch.object(
+        serialize, "serialize_as_str", wraps=serialize.serialize_as_str
+    ) as serialize_as_str:
+        first = await repo.get_serialized([event_filter.EventFilter()])
+        second = await repo.get_serialized([event_filter.EventFilter()])
+
+    assert first == second == [serialize.serialize_as_str(ev.__dict__)]
+    assert serialize_as_str.call_count == 1
@@ -21,16 +21,29 @@
 # pylint: disable=redefined-outer-name
 
 import asyncio
+import random
 import time
 
 import mock
 import pytest
+import sqlalchemy
 
 from ndk import crypto
 from ndk.event import event, event_filter, event_tags, metadata_event
 from ndk.event import parameterized_replaceable_event as pre
 from ndk.event import text_note_event
-from ndk.relay.event_repo import memory_event_repo, postgres_event_repo
+from ndk.relay import metrics, tracing
+from ndk.relay.event_repo import (
+    caching_event_repo,
+    instrumented_event_repo,
+    log_event_repo,
+    memory_event_repo,
+    postgres_event_repo,
+    retention,
+    slow_query_log,
+    sqlite_event_repo,
+    tiered_event_repo,
+)
 
 
 @pytest.fixture
@@ -47,7 +60,47 @@ def db(db_url):
     )
 
 
-@pytest.fixture(params=["fake", "db"])
+@pytest.fixture
+def sqlite(tmp_path):
+    repo = asyncio.get_event_loop().run_until_complete(
+        sqlite_event_repo.SqliteEventRepo.create(str(tmp_path / "events.db"))
+    )
+    yield repo
+    repo.close()
+
+
+@pytest.fixture
+def log(tmp_path):
+    repo = asyncio.get_event_loop().run_until_complete(
+        log_event_repo.LogEventRepo.create(str(tmp_path / "events"))
+    )
+    yield repo
+    repo.close()
+
+
+@pytest.fixture
+def tiered():
+    return asyncio.get_event_loop().run_until_complete(
+        tiered_event_repo.TieredEventRepo.create(memory_event_repo.MemoryEventRepo())
+    )
+
+
+@pytest.fixture
+def cached():
+    return caching_event_repo.CachingEventRepo(memory_event_repo.MemoryEventRepo())
+
+
+@pytest.fixture
+def instrumented():
+    return instrumented_event_repo.InstrumentedEventRepo(
+        memory_event_repo.MemoryEventRepo(),
+        metrics.Histogram("repo_seconds", "test", ("method",)),
+    )
+
+
+@pytest.fixture(
+    params=["fake", "db", "sqlite", "log", "tiered", "cached", "instrumented"]
+)
 def repo(request):
     return request.getfixturevalue(request.param)
 
@@ -506,3 +559,428 @@ async def test_handle_parameterized_replaceable_event_behavior_valid_d_replaced(
     )
     assert len(evs) == 1
     assert evs[0] == newer_ev
+
+
+async def test_limit_returns_newest_across_kinds(repo, keys):
+    evs = [
+        event.RegularEvent.build(keys, kind=1000 + (i % 3), created_at=100 + i)
+        for i in range(10)
+    ]
+    for ev in reversed(evs):
+        await repo.add(ev)
+
+    items = await repo.get(
+        [event_filter.EventFilter(kinds=[1000, 1001, 1002], limit=4)]
+    )
+
+    assert items == list(reversed(evs))[:4]
+
+
+async def test_since_until_are_exclusive(repo, keys):
+    evs = [
+        event.RegularEvent.build(keys, kind=1000, created_at=100 + i) for i in range(5)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+
+    items = await repo.get(
+        [event_filter.EventFilter(authors=[keys.public], since=100, until=104)]
+    )
+
+    assert items == list(reversed(evs[1:4]))
+
+
+async def test_get_selective_filter_with_other_fields(repo, keys):
+    keys2 = crypto.KeyPair()
+    ev1 = build_text_note(keys, [["p", keys2.public]])
+    ev2 = build_text_note(keys2, [["p", keys2.public]])
+    await repo.add(ev1)
+    await repo.add(ev2)
+
+    items = await repo.get(
+        [
+            event_filter.EventFilter(
+                ids=[ev1.id[:8], ev2.id[:8]],
+                authors=[keys.public],
+                generic_tags={"p": [keys2.public]},
+            )
+        ]
+    )
+
+    assert items == [ev1]
+
+
+async def test_remove_clears_all_lookups(repo, keys):
+    ev = build_text_note(keys, [["e", keys.public], ["p", keys.public]])
+    await repo.add(ev)
+    await repo.remove(ev.id)
+
+    items = await repo.get(
+        [
+            event_filter.EventFilter(ids=[ev.id[:8]]),
+            event_filter.EventFilter(authors=[keys.public[:8]]),
+            event_filter.EventFilter(kinds=[ev.kind], authors=[keys.public]),
+            event_filter.EventFilter(generic_tags={"e": [keys.public]}),
+            event_filter.EventFilter(search="hello", authors=[keys.public]),
+        ]
+    )
+
+    assert len(items) == 0
+
+
+async def test_expired_events_not_returned(repo, keys):
+    expired = build_text_note(keys, [["expiration", str(int(time.time()) - 1)]])
+    live = build_text_note(keys, [["expiration", str(int(time.time()) + 3600)]])
+    await repo.add(expired)
+    await repo.add(live)
+
+    items = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+
+    assert items == [live]
+
+
+async def test_count_ignores_limit(repo, keys):
+    for i in range(3):
+        await repo.add(build_text_note(keys, [["t", str(i)]]))
+
+    total = await repo.count([event_filter.EventFilter(authors=[keys.public], limit=1)])
+
+    assert total == 3
+
+
+async def test_count_followers(repo, keys):
+    followed = crypto.KeyPair()
+    for _ in range(3):
+        await repo.add(
+            event.RegularEvent.build(
+                crypto.KeyPair(),
+                kind=3,
+                tags=event_tags.EventTags([["p", followed.public], ["p", keys.public]]),
+            )
+        )
+    await repo.add(build_text_note(keys, [["p", followed.public]]))
+
+    total = await repo.count(
+        [event_filter.EventFilter(kinds=[3], generic_tags={"p": [followed.public]})]
+    )
+
+    assert total == 3
+
+
+async def test_count_multiple_filters_counts_event_once(repo, keys):
+    ev = build_text_note(keys, [["e", keys.public]])
+    await repo.add(ev)
+
+    total = await repo.count(
+        [
+            event_filter.EventFilter(authors=[keys.public]),
+            event_filter.EventFilter(generic_tags={"e": [keys.public]}),
+            event_filter.EventFilter(ids=[ev.id]),
+        ]
+    )
+
+    assert total == 1
+
+
+async def test_count_excludes_expired(repo, keys):
+    await repo.add(build_text_note(keys, [["expiration", str(int(time.time()) - 1)]]))
+    await repo.add(build_text_note(keys))
+
+    assert await repo.count([event_filter.EventFilter(authors=[keys.public])]) == 1
+
+
+async def test_search_combines_with_other_fields(repo, keys):
+    match = event.RegularEvent.build(keys, kind=1000, content="Best nostr apps")
+    wrong_kind = event.RegularEvent.build(keys, kind=1001, content="Best nostr apps")
+    wrong_words = event.RegularEvent.build(keys, kind=1000, content="Best apps")
+    for ev in [match, wrong_kind, wrong_words]:
+        await repo.add(ev)
+
+    items = await repo.get(
+        [
+            event_filter.EventFilter(
+                authors=[keys.public], kinds=[1000], search="NOSTR apps"
+            )
+        ]
+    )
+
+    assert items == [match]
+
+
+async def test_search_ranks_before_limit(repo, keys):
+    now = int(time.time())
+    relevant = event.RegularEvent.build(
+        keys, kind=1000, created_at=now - 10, content="zap zap zap the zap"
+    )
+    recent = event.RegularEvent.build(
+        keys, kind=1000, created_at=now, content="zap me when you have a moment"
+    )
+    await repo.add(relevant)
+    await repo.add(recent)
+
+    fltr = event_filter.EventFilter(authors=[keys.public], search="zap")
+
+    assert await repo.get([fltr]) == [relevant, recent]
+    fltr.limit = 1
+    assert await repo.get([fltr]) == [relevant]
+
+
+async def test_search_ignores_extensions(repo, keys):
+    ev = event.RegularEvent.build(keys, kind=1000, content="gm")
+    await repo.add(ev)
+
+    fltr = event_filter.EventFilter(authors=[keys.public], search="gm language:en")
+
+    assert await repo.get([fltr]) == [ev]
+    assert await repo.count([fltr]) == 1
+
+
+def build_db_repo(db, **kwargs):
+    return postgres_event_repo.PostgresEventRepo(
+        db._engine, **kwargs  # pylint: disable=protected-access
+    )
+
+
+async def test_db_sweep_deletes_expired_in_batches(db, keys):
+    repo = build_db_repo(
+        db, sweep_cfg=postgres_event_repo.SweepConfig(batch_size=2, batch_pause=0)
+    )
+    now = int(time.time())
+    evs = [build_text_note(keys, [["expiration", str(now + i)]]) for i in range(5)]
+    for ev in evs:
+        await repo.add(ev)
+
+    stats = await repo.sweep(now=now + 10)
+
+    assert stats.deleted >= 5
+    assert stats.batches >= 3
+    assert repo.sweep_stats.deleted == stats.deleted
+    with mock.patch("time.time", return_value=now - 10):
+        assert not await repo.get([event_filter.EventFilter(authors=[keys.public])])
+
+
+async def test_db_sweep_keeps_unexpired(db, keys):
+    now = int(time.time())
+    ev = build_text_note(keys, [["expiration", str(now + 3600)]])
+    await db.add(ev)
+
+    await db.sweep(now=now)
+
+    assert await db.get([event_filter.EventFilter(ids=[ev.id])]) == [ev]
+
+
+async def test_db_sweep_retention_count(db, keys):
+    kind = random.randint(1000, 9999)
+    repo = build_db_repo(
+        db, policies=[retention.RetentionPolicy(kinds=[kind], count=2)]
+    )
+    now = int(time.time())
+    evs = [
+        event.RegularEvent.build(keys, kind=kind, created_at=now - 3 + i)
+        for i in range(4)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+
+    await repo.sweep()
+
+    items = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+    assert items == [evs[3], evs[2]]
+
+
+async def test_db_sweep_retention_count_ignores_locked_rows(db, keys):
+    kind = random.randint(1000, 9999)
+    repo = build_db_repo(
+        db, policies=[retention.RetentionPolicy(kinds=[kind], count=2)]
+    )
+    now = int(time.time())
+    evs = [
+        event.RegularEvent.build(keys, kind=kind, created_at=now - 3 + i)
+        for i in range(4)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+
+    # a kept event locked by another transaction mustn't move the cutoff
+    async with db._engine.begin() as conn:  # pylint: disable=protected-access
+        await conn.execute(
+            sqlalchemy.select(postgres_event_repo.EVENTS_TABLE.c.id)
+            .where(postgres_event_repo.EVENTS_TABLE.c.event_id == evs[3].id)
+            .with_for_update()
+        )
+        await repo.sweep()
+
+    items = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+    assert items == [evs[3], evs[2]]
+
+
+async def test_db_sweep_retention_time_first_policy_wins(db, keys):
+    kind = random.randint(1000, 9999)
+    repo = build_db_repo(
+        db,
+        policies=[
+            retention.RetentionPolicy(kinds=[kind], time=3600),
+            retention.RetentionPolicy(time=60),
+        ],
+    )
+    now = int(time.time())
+    kept = event.RegularEvent.build(keys, kind=kind, created_at=now - 120)
+    await repo.add(kept)
+    other_kind = kind + 1 if kind < 9999 else kind - 1
+    removed = event.RegularEvent.build(keys, kind=other_kind, created_at=now - 120)
+    await repo.add(removed)
+
+    await repo.sweep()
+
+    items = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+    assert items == [kept]
+
+
+async def test_db_identical_concurrent_gets_share_a_query(db, keys):
+    ev = event.RegularEvent.build(keys, kind=1000)
+    await db.add(ev)
+    fltrs = [event_filter.EventFilter(authors=[keys.public])]
+
+    results = await asyncio.gather(*[db.get(fltrs) for _ in range(10)])
+
+    assert results == [[ev]] * 10
+    assert db.coalescing_stats.saved == 9
+
+
+async def test_db_write_starts_a_new_query(db, keys):
+    fltrs = [event_filter.EventFilter(authors=[keys.public])]
+    release = asyncio.Event()
+    db_get = db._get  # pylint: disable=protected-access
+
+    async def held_get(fltrs):
+        if not release.is_set():
+            # the query that was in flight before the write, without it
+            await release.wait()
+            return []
+        return await db_get(fltrs)
+
+    with mock.patch.object(db, "_get", side_effect=held_get):
+        in_flight = asyncio.ensure_future(db.get(fltrs))
+        await asyncio.sleep(0)
+
+        ev = event.RegularEvent.build(keys, kind=1000)
+        await db.add(ev)
+        release.set()
+        after_write = await db.get(fltrs)
+
+    assert await in_flight == []
+    assert after_write == [ev]
+
+
+@pytest.mark.parametrize(
+    "fltr",
+    [
+        {"kinds": [1000], "since": 1, "until": 2**31 - 1, "limit": 5},
+        {"ids": ["abcd"], "#e": ["ef01"], "#t": ["it's"]},
+        {"search": "gm 100%"},
+        {"ids": ["ab", "cd"], "#t": ["x'); drop table events; --", "a\\'b"]},
+    ],
+)
+async def test_db_slow_query_logged(db, keys, tmp_path, fltr):
+    path = str(tmp_path / "slow.jsonl")
+    repo = build_db_repo(
+        db,
+        slow_query_cfg=slow_query_log.SlowQueryConfig(
+            threshold=0.0, path=path, explain_rate=1.0
+        ),
+    )
+    await repo.add(build_text_note(keys, [["t", "it's"]]))
+    fltrs = [
+        event_filter.EventFilter(authors=[keys.public]),
+        event_filter.EventFilter.from_dict(fltr),
+    ]
+
+    evs = await repo.get(fltrs)
+    await repo.slow_queries.flush()
+
+    (entry,) = slow_query_log.read(path)
+    assert entry["rows"] == len(evs)
+    assert [event_filter.EventFilter.from_dict(d) for d in entry["filters"]] == fltrs
+    assert entry["sql"].startswith("SELECT")
+    assert entry["plan"][0]["Plan"]
+    assert repo.slow_queries.stats.explained == 1
+
+
+async def test_db_fast_query_not_logged(db, keys):
+    repo = build_db_repo(
+        db, slow_query_cfg=slow_query_log.SlowQueryConfig(threshold=60.0)
+    )
+
+    await repo.get([event_filter.EventFilter(authors=[keys.public])])
+
+    assert repo.slow_queries.stats.logged == 0
+
+
+async def test_has_event(repo, keys):
+    ev = build_text_note(keys)
+    assert not await repo.has_event(ev.id)
+
+    await repo.add(ev)
+    assert await repo.has_event(ev.id)
+
+    await repo.remove(ev.id)
+    assert not await repo.has_event(ev.id)
+
+
+async def test_stored_ids(repo, keys):
+    evs = [build_text_note(keys, [["t", str(i)]]) for i in range(3)]
+    for ev in evs:
+        await repo.add(ev)
+    await repo.remove(evs[0].id)
+
+    # the db fixture keeps events of other tests
+    stored = {event_id async for event_id in repo.stored_ids()}
+    assert {ev.id for ev in evs[1:]} <= stored
+    assert evs[0].id not in stored
+
+
+async def test_instrumented_times_each_method(metadata_ev):
+    latency = metrics.Histogram("repo_seconds", "test", ("method",))
+    repo = instrumented_event_repo.InstrumentedEventRepo(
+        memory_event_repo.MemoryEventRepo(), latency
+    )
+
+    await repo.add(metadata_ev)
+    await repo.get([event_filter.EventFilter()])
+    await repo.has_event(metadata_ev.id)
+    await repo.remove(metadata_ev.id)
+
+    for method in ["add", "get", "has_event", "remove"]:
+        assert latency.series(method).samples == 1, method
+    assert latency.series("count").samples == 0
+
+
+async def test_cached_instrumented_repo_adds_through_add(metadata_ev):
+    latency = metrics.Histogram("repo_seconds", "test", ("method",))
+    repo = caching_event_repo.CachingEventRepo(
+        instrumented_event_repo.InstrumentedEventRepo(
+            memory_event_repo.MemoryEventRepo(), latency
+        )
+    )
+    fltr = event_filter.EventFilter(authors=[metadata_ev.pubkey])
+    assert not await repo.get([fltr])
+
+    await repo.add(metadata_ev)
+
+    assert await repo.get([fltr]) == [metadata_ev]
+    assert latency.series("add").samples == 1
+
+
+async def test_wrapped_repo_marks_persist_once(metadata_ev):
+    latency = metrics.Histogram("repo_seconds", "test", ("method",))
+    repo = caching_event_repo.CachingEventRepo(
+        instrumented_event_repo.InstrumentedEventRepo(
+            memory_event_repo.MemoryEventRepo(), latency
+        )
+    )
+
+    # each mark takes one of a trace's few stage slots
+    with mock.patch.object(tracing, "mark", wraps=tracing.mark) as mark:
+        await repo.add(metadata_ev)
+
+    mark.assert_called_once_with("persist")
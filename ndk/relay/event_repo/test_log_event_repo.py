@@ -0,0 +1,302 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name, protected-access
+
+import asyncio
+import os
+import threading
+import time
+
+import mock
+import pytest
+
+from ndk import exceptions, serialize
+from ndk.event import event, event_filter, event_tags, metadata_event
+from ndk.relay.event_repo import log_event_repo
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "events")
+
+
+@pytest.fixture
+async def repo(path):
+    repo = await log_event_repo.LogEventRepo.create(path)
+    yield repo
+    repo.close()
+
+
+async def reopen(repo, path, cfg=log_event_repo.LogConfig()):
+    repo.close()
+    return await log_event_repo.LogEventRepo.create(path, cfg)
+
+
+def note(keys, i: int, **kwargs) -> event.Event:
+    return event.RegularEvent.build(
+        keys,
+        kind=1000,
+        created_at=1000 + i,
+        tags=event_tags.EventTags([["t", str(i % 3)]]),
+        content=f"note {i}",
+        **kwargs,
+    )
+
+
+async def test_events_survive_reopen(repo, path, keys):
+    evs = [note(keys, i) for i in range(5)]
+    for ev in evs:
+        await repo.add(ev)
+
+    repo = await reopen(repo, path)
+    try:
+        items = await repo.get([event_filter.EventFilter()])
+        tagged = await repo.get([event_filter.EventFilter(generic_tags={"t": ["0"]})])
+    finally:
+        repo.close()
+
+    assert items == evs[::-1]
+    assert tagged == [evs[3], evs[0]]
+
+
+async def test_flushed_and_unflushed_records_are_merged(path, keys):
+    repo = await log_event_repo.LogEventRepo.create(
+        path, log_event_repo.LogConfig(index_flush_records=10)
+    )
+    evs = [note(keys, i) for i in range(7)]
+    for ev in evs:
+        await repo.add(ev)
+
+    assert len(repo._indexes["id"].records) > 0
+    assert len(repo._indexes["id"].memtable) > 0
+
+    repo = await reopen(repo, path)
+    try:
+        items = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+        counted = await repo.count([event_filter.EventFilter(since=1002)])
+        limited = await repo.get([event_filter.EventFilter(kinds=[1000], limit=2)])
+    finally:
+        repo.close()
+
+    assert items == evs[::-1]
+    assert counted == 4
+    assert limited == [evs[6], evs[5]]
+
+
+async def test_stored_ids_walk_the_id_index(path, keys, monkeypatch):
+    repo = await log_event_repo.LogEventRepo.create(
+        path, log_event_repo.LogConfig(index_flush_records=10)
+    )
+    evs = [note(keys, i) for i in range(7)]
+    for ev in evs:
+        await repo.add(ev)
+    await repo.remove(evs[0].id)
+    await repo.remove(evs[6].id)
+    await repo.add(evs[6])
+    assert len(repo._indexes["id"].records) > 0
+    assert len(repo._indexes["id"].memtable) > 0
+
+    async def get(fltrs):
+        raise AssertionError(f"loaded events for {fltrs}")
+
+    monkeypatch.setattr(repo, "get", get)
+    try:
+        stored = [event_id async for event_id in repo.stored_ids()]
+    finally:
+        repo.close()
+
+    assert sorted(stored) == sorted(ev.id for ev in evs[1:])
+
+
+async def test_segments_roll_over(path, keys):
+    repo = await log_event_repo.LogEventRepo.create(
+        path, log_event_repo.LogConfig(segment_bytes=1000)
+    )
+    evs = [note(keys, i) for i in range(10)]
+    for ev in evs:
+        await repo.add(ev)
+
+    repo = await reopen(repo, path)
+    try:
+        items = await repo.get([event_filter.EventFilter()])
+        segments = repo._segments
+    finally:
+        repo.close()
+
+    assert len(segments) > 1
+    assert items == evs[::-1]
+
+
+async def test_torn_tail_is_truncated(repo, path, keys):
+    ev = note(keys, 0)
+    await repo.add(ev)
+    segment = os.path.join(path, repo._segment_name(repo._segments[-1]))
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as f:
+        f.write(b'{"id":"')
+
+    repo = await reopen(repo, path)
+    try:
+        await repo.add(note(keys, 1))
+        items = await repo.get([event_filter.EventFilter()])
+    finally:
+        repo.close()
+
+    assert os.path.getsize(segment) > size
+    assert len(items) == 2
+
+
+@pytest.mark.parametrize("created_at", [-5, 1.5, 2**64, "1000"])
+async def test_unindexable_event_is_not_appended(repo, path, keys, created_at):
+    ev = note(keys, 0)
+    await repo.add(ev)
+    bad = event.RegularEvent.build(keys, kind=1000)
+    bad.created_at = created_at
+
+    with pytest.raises(exceptions.ValidationError):
+        await repo.add(bad)
+
+    repo = await reopen(repo, path)
+    try:
+        assert await repo.get([event_filter.EventFilter()]) == [ev]
+        assert not await repo.has_event(bad.id)
+    finally:
+        repo.close()
+
+
+async def test_unindexable_event_already_appended_is_skipped(repo, path, keys):
+    bad = event.RegularEvent.build(keys, kind=1000)
+    bad.created_at = -5
+    segment = os.path.join(path, repo._segment_name(repo._segments[-1]))
+    with open(segment, "ab") as f:
+        f.write(serialize.serialize_as_bytes(bad.__dict__) + b"\n")
+    ev = note(keys, 0)
+
+    repo = await reopen(repo, path)
+    try:
+        await repo.add(ev)
+        await repo.compact()
+        assert await repo.get([event_filter.EventFilter()]) == [ev]
+    finally:
+        repo.close()
+
+
+async def test_serialized_events_are_stored_bytes(repo, keys):
+    ev = event.RegularEvent.build(keys, kind=1000, content='héllo "wörld"\n')
+    await repo.add(ev)
+
+    assert await repo.get_serialized([event_filter.EventFilter()]) == [
+        serialize.serialize_as_str(ev.__dict__)
+    ]
+
+
+async def test_removed_events_stay_removed_after_reopen(repo, path, keys):
+    first, second = note(keys, 0), note(keys, 1)
+    await repo.add(first)
+    await repo.add(second)
+    await repo.remove(first.id)
+
+    repo = await reopen(repo, path)
+    try:
+        items = await repo.get([event_filter.EventFilter()])
+        with pytest.raises(ValueError):
+            await repo.remove(first.id)
+    finally:
+        repo.close()
+
+    assert items == [second]
+
+
+async def test_compaction_drops_dead_events(repo, path, keys):
+    kept = note(keys, 0)
+    removed = note(keys, 1)
+    expired = event.RegularEvent.build(
+        keys,
+        kind=1000,
+        tags=event_tags.EventTags([["expiration", str(int(time.time()) - 1)]]),
+    )
+    old_metadata = metadata_event.MetadataEvent.build(
+        keys, kind=0, created_at=100, content='{"name":"old"}'
+    )
+    new_metadata = metadata_event.MetadataEvent.build(
+        keys, kind=0, created_at=200, content='{"name":"new"}'
+    )
+    for ev in [kept, removed, expired]:
+        await repo.add(ev)
+    await repo.remove(removed.id)
+    # bypass add() so the superseded event is only dropped by the compaction
+    await repo._persist(new_metadata)
+    await repo._persist(old_metadata)
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+    await repo.compact()
+
+    assert await repo.get([event_filter.EventFilter()]) == [kept, new_metadata]
+    assert sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)) < size
+
+    repo = await reopen(repo, path)
+    try:
+        await repo.add(note(keys, 3))
+        assert await repo.count([event_filter.EventFilter()]) == 3
+    finally:
+        repo.close()
+
+
+async def test_concurrent_adds_share_one_fsync(repo, keys):
+    evs = [note(keys, i) for i in range(10)]
+
+    with mock.patch.object(log_event_repo.os, "fsync") as fsync:
+        await asyncio.gather(*[repo.add(ev) for ev in evs])
+
+    # the active segment and the tombstone file, once for the whole group
+    assert fsync.call_count == 2
+    assert await repo.count([event_filter.EventFilter()]) == 10
+
+
+async def test_compaction_waits_for_running_queries(repo, keys):
+    evs = [note(keys, i) for i in range(5)]
+    for ev in evs:
+        await repo.add(ev)
+
+    reading, release = threading.Event(), threading.Event()
+    read = repo._read
+
+    def slow_read(pointer):
+        reading.set()
+        release.wait(timeout=5)
+        return read(pointer)
+
+    with mock.patch.object(repo, "_read", slow_read):
+        query = asyncio.create_task(repo.get([event_filter.EventFilter()]))
+        while not reading.is_set():
+            await asyncio.sleep(0.001)
+
+        compaction = asyncio.create_task(repo.compact())
+        await asyncio.sleep(0.05)
+        # the query is on a worker thread and still owns the files it reads
+        compacted_early = compaction.done()
+
+        release.set()
+        assert await query == evs[::-1]
+        await compaction
+
+    assert not compacted_early
+    assert await repo.get([event_filter.EventFilter()]) == evs[::-1]
@@ -0,0 +1,287 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import asyncio
+import time
+
+import mock
+import pytest
+
+from ndk import exceptions
+from ndk.event import event, event_filter, event_tags
+from ndk.relay.event_repo import memory_event_repo, retention, snapshot
+
+
+def build_events(keys, kind, count, created_at=100):
+    return [
+        event.RegularEvent.build(keys, kind=kind, created_at=created_at + i)
+        for i in range(count)
+    ]
+
+
+async def test_unbounded_by_default(keys):
+    repo = memory_event_repo.MemoryEventRepo()
+    for ev in build_events(keys, 1000, 5):
+        await repo.add(ev)
+
+    assert len(await repo.get([event_filter.EventFilter()])) == 5
+    assert repo.evicted_count == 0
+
+
+async def test_bytes_used_tracks_add_and_remove(keys):
+    repo = memory_event_repo.MemoryEventRepo()
+    ev = event.RegularEvent.build(keys, kind=1000, content="hello")
+
+    await repo.add(ev)
+    assert repo.bytes_used == retention.approximate_size(ev)
+
+    await repo.remove(ev.id)
+    assert repo.bytes_used == 0
+
+
+async def test_count_policy_evicts_oldest(keys):
+    repo = memory_event_repo.MemoryEventRepo(
+        [retention.RetentionPolicy(kinds=[1000], count=3)]
+    )
+    evs = build_events(keys, 1000, 5)
+    for ev in evs:
+        await repo.add(ev)
+
+    assert await repo.get([event_filter.EventFilter()]) == list(reversed(evs[2:]))
+    assert repo.evicted_count == 2
+
+
+async def test_count_policy_only_applies_to_its_kinds(keys):
+    repo = memory_event_repo.MemoryEventRepo(
+        [retention.RetentionPolicy(kinds=[1000], count=1)]
+    )
+    for ev in build_events(keys, 1001, 3):
+        await repo.add(ev)
+
+    assert len(await repo.get([event_filter.EventFilter()])) == 3
+
+
+async def test_time_policy_evicts_on_insert(keys):
+    repo = memory_event_repo.MemoryEventRepo([retention.RetentionPolicy(time=10)])
+    old, new = build_events(keys, 1000, 2, created_at=1000)
+
+    with mock.patch("time.time", return_value=1000 + 10):
+        await repo.add(old)
+        await repo.add(new)
+        assert len(await repo.get([event_filter.EventFilter()])) == 2
+
+    with mock.patch("time.time", return_value=1000 + 11):
+        await repo.add(event.RegularEvent.build(keys, kind=1000, created_at=1005))
+
+    assert old not in await repo.get([event_filter.EventFilter()])
+
+
+async def test_sweep_evicts_expired(keys):
+    repo = memory_event_repo.MemoryEventRepo([retention.RetentionPolicy(time=10)])
+    now = int(time.time())
+    await repo.add(event.RegularEvent.build(keys, kind=1000, created_at=now))
+
+    with mock.patch("time.time", return_value=now + 11):
+        await repo.sweep()
+
+    assert len(await repo.get([event_filter.EventFilter()])) == 0
+    assert repo.bytes_used == 0
+
+
+async def test_bytes_policy_evicts_oldest(keys):
+    evs = build_events(keys, 1000, 4)
+    size = retention.approximate_size(evs[0])
+    repo = memory_event_repo.MemoryEventRepo(
+        [retention.RetentionPolicy(bytes=size * 2)]
+    )
+    for ev in evs:
+        await repo.add(ev)
+
+    assert await repo.get([event_filter.EventFilter()]) == [evs[3], evs[2]]
+
+
+async def test_max_bytes_applies_across_policies(keys):
+    evs = build_events(keys, 1001, 2) + build_events(keys, 1000, 2, created_at=200)
+    size = retention.approximate_size(evs[0])
+    repo = memory_event_repo.MemoryEventRepo(
+        [retention.RetentionPolicy(kinds=[1000], count=10)], max_bytes=size * 3
+    )
+    for ev in evs:
+        await repo.add(ev)
+
+    # oldest events go first regardless of policy, down to the low watermark
+    assert await repo.get([event_filter.EventFilter()]) == list(reversed(evs[2:]))
+    assert repo.bytes_used <= size * 3
+
+
+async def test_bulk_eviction_keeps_indexes_consistent(keys):
+    repo = memory_event_repo.MemoryEventRepo([retention.RetentionPolicy(count=1000)])
+    now = int(time.time())
+    for ev in build_events(keys, 1000, 1001, created_at=now):
+        await repo.add(ev)
+
+    remaining = await repo.get([event_filter.EventFilter(authors=[keys.public])])
+    assert len(remaining) == retention.low_watermark(1000)
+    assert remaining == await repo.get([event_filter.EventFilter(kinds=[1000])])
+    assert repo.bytes_used == sum(retention.approximate_size(ev) for ev in remaining)
+
+
+async def test_sweep_evicts_nip40_expired(keys):
+    repo = memory_event_repo.MemoryEventRepo()
+    now = int(time.time())
+    ev = event.RegularEvent.build(
+        keys, kind=1000, tags=event_tags.EventTags([["expiration", str(now + 5)]])
+    )
+    await repo.add(ev)
+
+    await repo.sweep()
+    assert repo.bytes_used > 0
+
+    with mock.patch("time.time", return_value=now + 5):
+        await repo.sweep()
+
+    assert repo.bytes_used == 0
+    with mock.patch("time.time", return_value=now):
+        assert not await repo.get([event_filter.EventFilter()])
+
+
+@pytest.mark.parametrize(
+    "fltr",
+    [
+        event_filter.EventFilter(),
+        event_filter.EventFilter(kinds=[1000, 1001], since=1, until=4),
+        event_filter.EventFilter(generic_tags={"t": ["a"]}),
+        event_filter.EventFilter(generic_tags={"t": ["a", "b"]}),
+        event_filter.EventFilter(kinds=[1000], generic_tags={"t": ["b"]}),
+    ],
+)
+async def test_count_matches_get(keys, fltr):
+    repo = memory_event_repo.MemoryEventRepo()
+    for i in range(5):
+        await repo.add(
+            event.RegularEvent.build(
+                keys,
+                kind=1000 + i % 2,
+                created_at=i,
+                tags=event_tags.EventTags([["t", "a"], ["t", "b"]][: i % 3]),
+            )
+        )
+
+    assert await repo.count([fltr]) == len(await repo.get([fltr]))
+
+
+async def test_snapshot_restores_events_and_indexes(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    repo = memory_event_repo.MemoryEventRepo()
+    evs = [
+        event.RegularEvent.build(
+            keys,
+            kind=1000 + i % 2,
+            created_at=100 + i,
+            tags=event_tags.EventTags([["t", str(i % 3)]]),
+            content=f"note {i} ✓",
+        )
+        for i in range(10)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+    assert await repo.save_snapshot(path) == 10
+
+    restored = memory_event_repo.MemoryEventRepo()
+    assert restored.load_snapshot(path) == 10
+
+    for fltr in [
+        event_filter.EventFilter(),
+        event_filter.EventFilter(authors=[keys.public[:8]], kinds=[1001], limit=2),
+        event_filter.EventFilter(generic_tags={"t": ["1"]}, since=101),
+        event_filter.EventFilter(ids=[evs[3].id]),
+        event_filter.EventFilter(search="note 4"),
+    ]:
+        assert await restored.get([fltr]) == await repo.get([fltr])
+    assert restored.bytes_used == repo.bytes_used
+
+
+@pytest.mark.parametrize("created_at", ["1000", 1000.5j, None])
+async def test_event_with_unsortable_created_at_is_not_stored(keys, created_at):
+    repo = memory_event_repo.MemoryEventRepo()
+    ev = event.RegularEvent.build(keys, kind=1000)
+    await repo.add(ev)
+    bad = event.RegularEvent.build(keys, kind=1000, content="bad")
+    bad.created_at = created_at
+
+    with pytest.raises(exceptions.ValidationError):
+        await repo.add(bad)
+
+    assert not await repo.has_event(bad.id)
+    later = event.RegularEvent.build(keys, kind=1000, content="later")
+    await repo.add(later)
+    assert await repo.count([event_filter.EventFilter()]) == 2
+
+
+async def test_snapshotter_survives_a_failed_save(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    repo = memory_event_repo.MemoryEventRepo()
+    await repo.add(event.RegularEvent.build(keys, kind=1000))
+    write = snapshot.write
+    saved = []
+
+    def failing_once(p, evs):
+        if not saved:
+            saved.append(None)
+            raise RuntimeError("unexpected")
+        saved.append(write(p, evs))
+        return saved[-1]
+
+    with mock.patch.object(snapshot, "write", failing_once):
+        snapshotter = asyncio.create_task(repo.start_snapshotter(path, 0.001))
+        while len(saved) < 2 and not snapshotter.done():
+            await asyncio.sleep(0.001)
+        snapshotter.cancel()
+
+    assert saved[1] == 1
+    assert memory_event_repo.MemoryEventRepo().load_snapshot(path) == 1
+
+
+async def test_snapshot_skips_signature_validation(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    repo = memory_event_repo.MemoryEventRepo()
+    await repo.add(event.RegularEvent.build(keys, kind=1000))
+    await repo.save_snapshot(path)
+
+    with mock.patch.object(event.Event, "validate") as validate:
+        memory_event_repo.MemoryEventRepo().load_snapshot(path)
+
+    validate.assert_not_called()
+
+
+async def test_load_applies_retention(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    repo = memory_event_repo.MemoryEventRepo()
+    for ev in build_events(keys, 1000, 5):
+        await repo.add(ev)
+    await repo.save_snapshot(path)
+
+    restored = memory_event_repo.MemoryEventRepo([retention.RetentionPolicy(count=2)])
+    restored.load_snapshot(path)
+
+    assert len(await restored.get([event_filter.EventFilter()])) <= 2
+    assert restored.evicted_count >= 3
@@ -0,0 +1,85 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+from ndk.event import event
+from ndk.relay.event_repo import retention
+
+
+def test_policy_without_kinds_applies_to_all():
+    assert retention.RetentionPolicy(time=1).applies_to(12345)
+
+
+@pytest.mark.parametrize(
+    "kind,expected",
+    [(0, True), (1, False), (5, True), (6, True), (7, True), (8, False)],
+)
+def test_policy_kinds_and_ranges(kind, expected):
+    policy = retention.RetentionPolicy.from_dict({"kinds": [0, [5, 7]], "count": 1})
+    assert policy.applies_to(kind) == expected
+
+
+@pytest.mark.parametrize(
+    "d",
+    [
+        {"kinds": 1},
+        {"kinds": [[1, 2, 3]]},
+        {"kinds": ["1"]},
+        {"time": -1},
+        {"count": "10"},
+        {"unknown": 1},
+    ],
+)
+def test_invalid_policy_raises(d):
+    with pytest.raises(ValueError):
+        retention.RetentionPolicy.from_dict(d)
+
+
+def test_to_dict_round_trip():
+    d = {"kinds": [[30000, 39999]], "count": 1000}
+    assert retention.RetentionPolicy.from_dict(d).to_dict() == d
+
+
+def test_find_policy_first_match_wins():
+    policies = [
+        retention.RetentionPolicy(kinds=[1], time=10),
+        retention.RetentionPolicy(time=100),
+    ]
+
+    assert retention.find_policy(policies, 1) == 0
+    assert retention.find_policy(policies, 2) == 1
+    assert retention.find_policy(policies[:1], 2) is None
+
+
+def test_approximate_size_grows_with_content_and_tags(keys):
+    small = event.RegularEvent.build(keys, kind=1000)
+    large = event.RegularEvent.build(keys, kind=1000, content="a" * 1000)
+
+    assert retention.approximate_size(large) == (
+        retention.approximate_size(small) + 1000
+    )
+
+
+def test_low_watermark_never_drops_below_one():
+    assert retention.low_watermark(1) == 1
+    assert retention.low_watermark(1000) == 950
@@ -0,0 +1,107 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+
+import pytest
+
+from ndk.relay.event_repo import single_flight
+
+
+async def test_concurrent_calls_share_one_run():
+    sf = single_flight.SingleFlight()
+    runs = 0
+    release = asyncio.Event()
+
+    async def fn():
+        nonlocal runs
+        runs += 1
+        await release.wait()
+        return 42
+
+    tasks = [asyncio.create_task(sf.do("key", fn)) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*tasks) == [42] * 5
+    assert runs == 1
+    assert sf.stats.calls == 5
+    assert sf.stats.saved == 4
+
+
+async def test_calls_after_completion_run_again():
+    sf = single_flight.SingleFlight()
+
+    async def fn():
+        return 1
+
+    await sf.do("key", fn)
+    await sf.do("key", fn)
+
+    assert sf.stats.saved == 0
+
+
+async def test_different_keys_run_separately():
+    sf = single_flight.SingleFlight()
+
+    async def fn(value):
+        await asyncio.sleep(0)
+        return value
+
+    results = await asyncio.gather(
+        sf.do("a", lambda: fn("a")), sf.do("b", lambda: fn("b"))
+    )
+
+    assert results == ["a", "b"]
+    assert sf.stats.saved == 0
+
+
+async def test_errors_reach_every_waiter():
+    sf = single_flight.SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0)
+        raise RuntimeError("boom")
+
+    results = await asyncio.gather(
+        sf.do("key", fn), sf.do("key", fn), return_exceptions=True
+    )
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+async def test_cancelled_waiter_doesnt_cancel_others():
+    sf = single_flight.SingleFlight()
+    release = asyncio.Event()
+
+    async def fn():
+        await release.wait()
+        return 7
+
+    first = asyncio.create_task(sf.do("key", fn))
+    second = asyncio.create_task(sf.do("key", fn))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+
+    assert await second == 7
+    with pytest.raises(asyncio.CancelledError):
+        await first
@@ -0,0 +1,154 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import json
+
+import pytest
+
+from ndk.event import event_filter
+from ndk.relay.event_repo import slow_query_log
+
+FLTRS = [event_filter.EventFilter(kinds=[1], generic_tags={"t": ["nostr"]})]
+
+
+def build_log(tmp_path, **kwargs) -> slow_query_log.SlowQueryLog:
+    cfg = slow_query_log.SlowQueryConfig(
+        threshold=0.5, path=str(tmp_path / "slow.jsonl"), **kwargs
+    )
+    return slow_query_log.SlowQueryLog(cfg)
+
+
+def test_disabled_by_default():
+    assert not slow_query_log.SlowQueryConfig().enabled()
+    assert slow_query_log.SlowQueryConfig(threshold=1).enabled()
+
+
+def test_is_slow(tmp_path):
+    log = build_log(tmp_path)
+
+    assert not log.is_slow(0.1)
+    assert log.is_slow(0.5)
+
+
+async def test_entry_written(tmp_path):
+    log = build_log(tmp_path)
+
+    log.record(FLTRS, "SELECT 1", 3, 0.75)
+    await log.flush()
+
+    (entry,) = slow_query_log.read(str(tmp_path / "slow.jsonl"))
+    assert entry["filters"] == [{"kinds": [1], "#t": ["nostr"]}]
+    assert entry["sql"] == "SELECT 1"
+    assert entry["rows"] == 3
+    assert entry["seconds"] == 0.75
+    assert "plan" not in entry
+    assert log.stats.logged == 1
+
+
+async def test_without_path_only_logged(tmp_path):
+    log = slow_query_log.SlowQueryLog(slow_query_log.SlowQueryConfig(threshold=0.5))
+
+    log.record(FLTRS, "SELECT 1", 3, 0.75)
+    await log.flush()
+
+    assert log.stats.logged == 1
+    assert not list(tmp_path.iterdir())
+
+
+async def test_plan_sampled(tmp_path):
+    calls = []
+
+    async def explain():
+        calls.append(1)
+        return [{"Plan": {"Node Type": "Seq Scan"}}]
+
+    log = build_log(tmp_path, explain_rate=1.0)
+    log.record(FLTRS, "SELECT 1", 3, 0.75, explain)
+    unsampled = tmp_path / "unsampled"
+    unsampled.mkdir()
+    log_without = build_log(unsampled, explain_rate=0.0)
+    log_without.record(FLTRS, "SELECT 1", 3, 0.75, explain)
+    await log.flush()
+    await log_without.flush()
+
+    (entry,) = slow_query_log.read(str(tmp_path / "slow.jsonl"))
+    assert entry["plan"][0]["Plan"]["Node Type"] == "Seq Scan"
+    assert calls == [1]
+    assert log.stats.explained == 1
+
+
+async def test_failed_explain_counted(tmp_path):
+    async def explain():
+        raise RuntimeError("connection lost")
+
+    log = build_log(tmp_path, explain_rate=1.0)
+    log.record(FLTRS, "SELECT 1", 3, 0.75, explain)
+    await log.flush()
+
+    assert log.stats.failed == 1
+    assert not list(slow_query_log.read(str(tmp_path / "slow.jsonl")))
+
+
+@pytest.mark.parametrize("entries", [1, 5, 20])
+async def test_bounded_on_disk(tmp_path, entries):
+    path = tmp_path / "slow.jsonl"
+    max_bytes = 1000
+    log = build_log(tmp_path, max_bytes=max_bytes)
+
+    for i in range(entries):
+        log.record(FLTRS, f"SELECT {i}", i, 0.75)
+        await log.flush()
+
+    read = list(slow_query_log.read(str(path)))
+    assert [entry["rows"] for entry in read] == list(range(entries))[-len(read) :]
+    assert read[-1]["rows"] == entries - 1
+    assert path.stat().st_size <= max_bytes
+    rotated = tmp_path / "slow.jsonl.1"
+    assert not rotated.exists() or rotated.stat().st_size <= max_bytes
+
+
+async def test_concurrent_entries_rotate_in_order(tmp_path):
+    path = tmp_path / "slow.jsonl"
+    max_bytes = 1000
+    log = build_log(tmp_path, max_bytes=max_bytes)
+
+    for i in range(50):
+        log.record(FLTRS, f"SELECT {i}", i, 0.75)
+    await log.flush()
+
+    read = list(slow_query_log.read(str(path)))
+    assert [entry["rows"] for entry in read] == list(range(50))[-len(read) :]
+    assert path.stat().st_size <= max_bytes
+    assert (tmp_path / "slow.jsonl.1").stat().st_size <= max_bytes
+
+
+def test_read_missing(tmp_path):
+    assert not list(slow_query_log.read(str(tmp_path / "slow.jsonl")))
+
+
+def test_entries_replayable(tmp_path):
+    path = tmp_path / "slow.jsonl"
+    path.write_text(json.dumps({"filters": [fltr.for_req() for fltr in FLTRS]}) + "\n")
+
+    (entry,) = slow_query_log.read(str(path))
+
+    assert [event_filter.EventFilter.from_dict(d) for d in entry["filters"]] == FLTRS
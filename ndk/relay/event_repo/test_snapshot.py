@@ -0,0 +1,73 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import pytest
+
+from ndk.event import event
+from ndk.relay.event_repo import snapshot
+
+
+def test_round_trip(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    evs = [event.RegularEvent.build(keys, kind=1000, content=c) for c in ["a", "ü"]]
+
+    snapshot.write(path, evs)
+
+    assert list(snapshot.read(path)) == evs
+
+
+@pytest.mark.parametrize("created_at", [-5, 1.5, 2**64, True])
+def test_unencodable_events_left_out(keys, tmp_path, created_at):
+    path = str(tmp_path / "snapshot")
+    good = event.RegularEvent.build(keys, kind=1000)
+    bad = event.RegularEvent.build(keys, kind=1000)
+    bad.created_at = created_at
+
+    assert snapshot.write(path, [bad, good]) == 1
+
+    assert list(snapshot.read(path)) == [good]
+
+
+def test_write_replaces_atomically(keys, tmp_path):
+    path = str(tmp_path / "snapshot")
+    snapshot.write(path, [event.RegularEvent.build(keys, kind=1000)])
+    snapshot.write(path, [])
+
+    assert not list(snapshot.read(path))
+    assert [p.name for p in tmp_path.iterdir()] == ["snapshot"]
+
+
+@pytest.mark.parametrize("data", [b"", b"NOTASNAP" + bytes(8)])
+def test_rejects_other_files(tmp_path, data):
+    path = tmp_path / "snapshot"
+    path.write_bytes(data)
+
+    with pytest.raises(snapshot.SnapshotError):
+        list(snapshot.read(str(path)))
+
+
+def test_rejects_truncated_snapshot(keys, tmp_path):
+    path = tmp_path / "snapshot"
+    snapshot.write(str(path), [event.RegularEvent.build(keys, kind=1000)])
+    path.write_bytes(path.read_bytes()[:-1])
+
+    with pytest.raises(snapshot.SnapshotError):
+        list(snapshot.read(str(path)))
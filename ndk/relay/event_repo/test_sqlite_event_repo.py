@@ -0,0 +1,138 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name, protected-access
+
+import sqlite3
+import time
+
+import pytest
+
+from ndk.event import event, event_filter, event_tags
+from ndk.relay.event_repo import retention, sqlite_event_repo
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "events.db")
+
+
+@pytest.fixture
+async def repo(path):
+    repo = await sqlite_event_repo.SqliteEventRepo.create(path)
+    yield repo
+    repo.close()
+
+
+@pytest.mark.usefixtures("repo")
+async def test_wal_mode(path):
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+async def test_events_survive_reopen(repo, path, keys):
+    ev = event.RegularEvent.build(
+        keys, kind=1000, tags=event_tags.EventTags([["t", "nostr"]])
+    )
+    await repo.add(ev)
+    repo.close()
+
+    reopened = await sqlite_event_repo.SqliteEventRepo.create(path)
+    try:
+        items = await reopened.get(
+            [event_filter.EventFilter(generic_tags={"t": ["nostr"]})]
+        )
+    finally:
+        reopened.close()
+
+    assert items == [ev]
+
+
+@pytest.mark.parametrize(
+    "fltr",
+    [
+        event_filter.EventFilter(limit=10),
+        event_filter.EventFilter(ids=["abcd"]),
+        event_filter.EventFilter(authors=["a" * 64], limit=10),
+        event_filter.EventFilter(authors=["a" * 64], kinds=[1], limit=10),
+        event_filter.EventFilter(kinds=[1, 7], since=100, limit=10),
+        event_filter.EventFilter(generic_tags={"p": ["a" * 64]}, limit=10),
+    ],
+)
+async def test_filter_shapes_use_an_index(repo, fltr):
+    params: list = []
+    where = sqlite_event_repo._where(fltr, int(time.time()), params)
+    plan = repo._connection().execute(
+        f"EXPLAIN QUERY PLAN SELECT event_id FROM events WHERE {where} "
+        "ORDER BY created_at DESC LIMIT 10",
+        params,
+    )
+
+    details = [row[3] for row in plan]
+    assert not any(d == "SCAN events" for d in details), details
+
+
+async def test_sweep_deletes_expired(repo, keys):
+    now = int(time.time())
+    ev = event.RegularEvent.build(
+        keys, kind=1000, tags=event_tags.EventTags([["expiration", str(now + 5)]])
+    )
+    await repo.add(ev)
+
+    assert await repo.sweep(now=now) == 0
+    assert await repo.sweep(now=now + 5) == 1
+
+
+async def test_sweep_retention_count_in_batches(path, keys):
+    repo = await sqlite_event_repo.SqliteEventRepo.create(
+        path,
+        policies=[retention.RetentionPolicy(kinds=[1000], count=2)],
+        cfg=sqlite_event_repo.SqliteConfig(sweep_batch_size=2),
+    )
+    evs = [
+        event.RegularEvent.build(keys, kind=1000, created_at=100 + i) for i in range(7)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+
+    deleted = await repo.sweep()
+    items = await repo.get([event_filter.EventFilter()])
+    repo.close()
+
+    assert deleted == 5
+    assert items == [evs[6], evs[5]]
+
+
+async def test_stored_ids_are_paged_without_loading_events(repo, keys, monkeypatch):
+    monkeypatch.setattr(sqlite_event_repo, "_ID_BATCH_SIZE", 2)
+    evs = [
+        event.RegularEvent.build(keys, kind=1000, created_at=100 + i) for i in range(5)
+    ]
+    for ev in evs:
+        await repo.add(ev)
+    await repo.remove(evs[1].id)
+
+    async def get(fltrs):
+        raise AssertionError(f"loaded events for {fltrs}")
+
+    monkeypatch.setattr(repo, "get", get)
+    stored = [event_id async for event_id in repo.stored_ids()]
+
+    assert stored == [ev.id for ev in evs if ev is not evs[1]]
@@ -0,0 +1,161 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name, protected-access
+
+import time
+
+import mock
+import pytest
+
+from ndk.event import event, event_filter, metadata_event
+from ndk.relay.event_repo import memory_event_repo, tiered_event_repo
+
+WINDOW = 1000
+
+
+@pytest.fixture
+def cold():
+    return memory_event_repo.MemoryEventRepo()
+
+
+@pytest.fixture
+async def repo(cold):
+    return await tiered_event_repo.TieredEventRepo.create(
+        cold, tiered_event_repo.TierConfig(window=WINDOW)
+    )
+
+
+def note(keys, created_at: int, **kwargs) -> event.Event:
+    return event.RegularEvent.build(
+        keys, kind=1000, created_at=created_at, content=str(created_at), **kwargs
+    )
+
+
+async def test_recent_filters_skip_cold(repo, cold, keys):
+    now = int(time.time())
+    old, recent = note(keys, now - 2 * WINDOW), note(keys, now - 10)
+    await repo.add(old)
+    await repo.add(recent)
+
+    with mock.patch.object(cold, "get", wraps=cold.get) as cold_get:
+        assert await repo.get([event_filter.EventFilter(since=now - 60)]) == [recent]
+        assert await repo.get([event_filter.EventFilter(limit=1)]) == [recent]
+        assert await repo.get([event_filter.EventFilter(ids=[recent.id])]) == [recent]
+
+    cold_get.assert_not_called()
+    assert repo.stats["since"].hits == 1
+    assert repo.stats["limit"].hit_rate == 1.0
+
+
+async def test_merges_with_cold_beyond_window(repo, cold, keys):
+    now = int(time.time())
+    evs = [note(keys, now - 2 * WINDOW), note(keys, now - WINDOW // 2), note(keys, now)]
+    for ev in evs:
+        await cold.add(ev)
+    await repo.warm()
+
+    with mock.patch.object(cold, "get", wraps=cold.get) as cold_get:
+        items = await repo.get([event_filter.EventFilter(limit=3)])
+
+    assert items == evs[::-1]
+    # only the part before the horizon, for only as many events as still missing
+    [[fltr]] = cold_get.call_args.args
+    assert fltr.limit == 1
+    assert fltr.until == repo._horizon()
+    assert repo.stats["limit"].merges == 1
+
+
+async def test_old_filters_go_to_cold(repo, keys):
+    now = int(time.time())
+    old = note(keys, now - 2 * WINDOW)
+    await repo.add(old)
+
+    assert await repo.get([event_filter.EventFilter(until=now - WINDOW)]) == [old]
+    assert repo.stats["until"].misses == 1
+    assert old.id not in repo._hot._stored_events
+
+
+async def test_replaceable_latest_skips_cold(repo, cold, keys):
+    metadata = metadata_event.MetadataEvent.from_metadata_parts(keys, name="x")
+    await repo.add(metadata)
+
+    with mock.patch.object(cold, "get", wraps=cold.get) as cold_get:
+        items = await repo.get(
+            [event_filter.EventFilter(authors=[keys.public], kinds=[0])]
+        )
+
+    assert items == [metadata]
+    cold_get.assert_not_called()
+
+
+async def test_replacing_removes_from_both_tiers(repo, cold, keys):
+    now = int(time.time())
+    first = event.ReplaceableEvent.build(keys, kind=10000, created_at=now - 1)
+    second = event.ReplaceableEvent.build(keys, kind=10000, created_at=now)
+    await repo.add(first)
+    await repo.add(second)
+
+    fltr = event_filter.EventFilter(kinds=[10000])
+    assert await repo.get([fltr]) == [second]
+    assert await cold.get([fltr]) == [second]
+
+
+async def test_early_eviction_raises_horizon(cold, keys):
+    repo = await tiered_event_repo.TieredEventRepo.create(
+        cold, tiered_event_repo.TierConfig(window=WINDOW, max_events=10)
+    )
+    now = int(time.time())
+    evs = [note(keys, now - 20 + i) for i in range(11)]
+    for ev in evs:
+        await repo.add(ev)
+
+    assert repo._horizon() > now - WINDOW
+    assert await repo.get([event_filter.EventFilter()]) == evs[::-1]
+    assert await repo.count([event_filter.EventFilter()]) == 11
+
+
+async def test_warm_loads_recent_window(cold, keys):
+    now = int(time.time())
+    old, recent = note(keys, now - 2 * WINDOW), note(keys, now - 10)
+    await cold.add(old)
+    await cold.add(recent)
+
+    repo = await tiered_event_repo.TieredEventRepo.create(
+        cold, tiered_event_repo.TierConfig(window=WINDOW)
+    )
+
+    assert list(repo._hot._stored_events) == [recent.id]
+
+
+@pytest.mark.parametrize(
+    "fltr,shape",
+    [
+        (event_filter.EventFilter(), "empty"),
+        (
+            event_filter.EventFilter(authors=["a"], kinds=[1], limit=5),
+            "authors+kinds+limit",
+        ),
+        (event_filter.EventFilter(generic_tags={"e": ["a"]}), "generic_tags"),
+        (event_filter.EventFilter(search="nostr", since=1), "since+search"),
+    ],
+)
+def test_filter_shape(fltr, shape):
+    assert tiered_event_repo.filter_shape(fltr) == shape
@@ -0,0 +1,284 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+"""EventRepo keeping the most recent events in memory in front of a slower repo
+
+The hot tier holds every event created at or after a moving horizon: the start
+of the configured window, raised whenever the tier has to evict events early
+to stay within its size. Each filter is split at the horizon. The part newer
+than it is answered from memory, and the cold repo is only asked for the older
+part when the hot results can't already be the complete answer.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import logging
+import time
+import typing
+
+from ndk import types
+from ndk.event import event, event_filter
+from ndk.relay.event_repo import event_repo, memory_event_repo, retention
+
+logger = logging.getLogger(__name__)
+
+FILTER_FIELDS = ["ids", "authors", "kinds", "generic_tags", "since", "until", "limit"]
+
+
+@dataclasses.dataclass
+class TierConfig:
+    # seconds of recent events kept in memory
+    window: int = 24 * 60 * 60
+    max_events: int = 500_000
+
+
+@dataclasses.dataclass
+class TierStats:
+    # answered by the hot tier alone
+    hits: int = 0
+    # hot results merged with a narrowed query to the cold repo
+    merges: int = 0
+    # answered by the cold repo alone
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.merges + self.misses
+        return self.hits / total if total else 0.0
+
+
+def filter_shape(fltr: event_filter.EventFilter) -> str:
+    """Names of the fields set in fltr, e.g. "authors+kinds+limit" """
+    fields = [name for name in FILTER_FIELDS if getattr(fltr, name)]
+    if fltr.search:
+        fields.append("search")
+    return "+".join(fields) or "empty"
+
+
+def _is_replaceable(kind: int) -> bool:
+    # only one event per pubkey and kind is ever stored, see EventRepo.add()
+    return kind in (types.EventKind.SET_METADATA, types.EventKind.CONTACT_LIST) or (
+        10000 <= kind < 20000
+    )
+
+
+def _is_complete(fltr: event_filter.EventFilter, evs: list[event.Event]) -> bool:
+    """True if evs, all newer than the horizon, are every match of fltr"""
+    if fltr.limit and len(evs) >= fltr.limit:
+        # anything only in the cold repo is older than all of evs
+        return True
+
+    if fltr.ids and all(len(ev_id) == 64 for ev_id in fltr.ids):
+        if len(evs) == len(set(fltr.ids)):
+            return True
+
+    if (
+        fltr.authors
+        and fltr.kinds
+        and all(len(author) == 64 for author in fltr.authors)
+        and all(_is_replaceable(kind) for kind in fltr.kinds)
+    ):
+        found = {(ev.pubkey, ev.kind) for ev in evs}
+        if all((a, k) in found for a in fltr.authors for k in fltr.kinds):
+            return True
+
+    return False
+
+
+class TieredEventRepo(event_repo.EventRepo):
+    _hot: memory_event_repo.MemoryEventRepo
+    _cold: event_repo.EventRepo
+    _cfg: TierConfig
+    _floor: int
+    _seen_evictions: int
+    _stats: collections.defaultdict[str, TierStats]
+
+    def __init__(self, cold: event_repo.EventRepo, cfg: TierConfig = TierConfig()):
+        self._hot = memory_event_repo.MemoryEventRepo(
+            [retention.RetentionPolicy(time=cfg.window, count=cfg.max_events)]
+        )
+        self._cold = cold
+        self._cfg = cfg
+        # far enough in the future that nothing is hot until warm() runs
+        self._floor = 2**62
+        self._seen_evictions = 0
+        self._stats = collections.defaultdict(TierStats)
+        super().__init__()
+
+    @classmethod
+    async def create(
+        cls, cold: event_repo.EventRepo, cfg: TierConfig = TierConfig()
+    ) -> "TieredEventRepo":
+        repo = cls(cold, cfg)
+        await repo.warm()
+        return repo
+
+    @property
+    def cold(self) -> event_repo.EventRepo:
+        return self._cold
+
+    @property
+    def stats(self) -> dict[str, TierStats]:
+        """Hit, merge and miss counts for each filter shape"""
+        return dict(self._stats)
+
+    async def warm(self):
+        """Loads the most recent window of events from the cold repo"""
+        start = time.monotonic()
+        since = int(time.time()) - self._cfg.window
+        evs = await self._cold.get(
+            [event_filter.EventFilter(since=since - 1, limit=self._cfg.max_events)]
+        )
+        self._hot.load(evs)
+
+        self._floor = since
+        if len(evs) >= self._cfg.max_events:
+            # older events of the same second may have been cut off by the limit
+            self._floor = evs[-1].created_at + 1
+        self._seen_evictions = self._hot.evicted_count
+
+        logger.info(
+            "Warmed hot tier with %s events in %.3fs",
+            len(evs),
+            time.monotonic() - start,
+        )
+
+    def _horizon(self) -> int:
+        return max(int(time.time()) - self._cfg.window, self._floor)
+
+    def _track_evictions(self):
+        if self._hot.evicted_count == self._seen_evictions:
+            return
+        self._seen_evictions = self._hot.evicted_count
+
+        # evictions go oldest first, but may have split the oldest second left
+        oldest = self._hot.oldest_created_at
+        if oldest is not None:
+            self._floor = max(self._floor, oldest + 1)
+
+    async def _delete_old_events(self, ev: event.Event):
+        pass  # each tier replaces its own events when added
+
+    async def _persist(self, ev: event.Event) -> types.EventID:
+        await self._cold.add(ev)
+
+        if ev.created_at >= self._horizon():
+            await self._hot.add(ev)
+            self._track_evictions()
+
+        return ev.id
+
+    async def has_event(self, event_id: types.EventID) -> bool:
+        return await self._hot.has_event(event_id) or await self._cold.has_event(
+            event_id
+        )
+
+    async def stored_ids(self) -> typing.AsyncIterator[types.EventID]:
+        # the hot tier is a subset of the cold one
+        async for event_id in self._cold.stored_ids():
+            yield event_id
+
+    async def remove(self, event_id: types.EventID):
+        await self._cold.remove(event_id)
+        try:
+            await self._hot.remove(event_id)
+        except ValueError:
+            pass  # older than the horizon
+
+    async def sweep(self):
+        await self._hot.sweep()
+        self._track_evictions()
+
+    async def start_sweeper(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.sweep()
+
+    @staticmethod
+    def _split(
+        fltr: event_filter.EventFilter, horizon: int
+    ) -> tuple[
+        typing.Optional[event_filter.EventFilter],
+        typing.Optional[event_filter.EventFilter],
+    ]:
+        """The parts of fltr at or after the horizon and before it, if any
+
+        since and until are both exclusive.
+        """
+        hot = None
+        if not fltr.until or fltr.until > horizon:
+            hot = dataclasses.replace(fltr, since=max(fltr.since or 0, horizon - 1))
+
+        cold = None
+        if not fltr.since or fltr.since < horizon - 1:
+            until = min(fltr.until, horizon) if fltr.until else horizon
+            cold = dataclasses.replace(fltr, until=until)
+
+        return hot, cold
+
+    async def get(self, fltrs: list[event_filter.EventFilter]) -> list[event.Event]:
+        if any(fltr.search for fltr in fltrs):
+            # relevance ranks of the two tiers aren't comparable
+            for fltr in fltrs:
+                self._stats[filter_shape(fltr)].misses += 1
+            return await self._cold.get(fltrs)
+
+        horizon = self._horizon()
+        fetched: dict[types.EventID, event.Event] = {}
+        cold_fltrs = []
+        for fltr in fltrs:
+            stats = self._stats[filter_shape(fltr)]
+            hot_fltr, cold_fltr = self._split(fltr, horizon)
+
+            evs = await self._hot.get([hot_fltr]) if hot_fltr is not None else []
+            for ev in evs:
+                fetched.setdefault(ev.id, ev)
+
+            if cold_fltr is None or _is_complete(fltr, evs):
+                stats.hits += 1
+                continue
+
+            if hot_fltr is None:
+                stats.misses += 1
+            else:
+                stats.merges += 1
+
+            if fltr.limit:
+                cold_fltr.limit = fltr.limit - len(evs)
+            cold_fltrs.append(cold_fltr)
+
+        if cold_fltrs:
+            for ev in await self._cold.get(cold_fltrs):
+                fetched.setdefault(ev.id, ev)
+
+        return sorted(fetched.values(), key=lambda ev: ev.created_at, reverse=True)
+
+    async def count(self, fltrs: list[event_filter.EventFilter]) -> int:
+        if len(fltrs) == 1 and not fltrs[0].search:
+            hot_fltr, cold_fltr = self._split(fltrs[0], self._horizon())
+            if cold_fltr is None and hot_fltr is not None:
+                self._stats[filter_shape(fltrs[0])].hits += 1
+                return await self._hot.count([hot_fltr])
+
+        for fltr in fltrs:
+            self._stats[filter_shape(fltr)].misses += 1
+        return await self._cold.count(fltrs)
@@ -0,0 +1,233 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Event loop lag monitoring and adaptive load shedding
+
+The relay serves every connection from one asyncio loop, so once it's
+saturated every client slows down at once. LagMonitor measures how late the
+loop wakes it from a short sleep, which is how long every other ready
+callback waited as well. LoadShedder turns that lag into a shedding level:
+the higher the lag, the more work the relay turns away, and it steps back
+down on its own as the lag drops.
+"""
+
+import asyncio
+import dataclasses
+import enum
+import logging
+import typing
+
+from ndk.relay import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Level(enum.IntEnum):
+    """Each level also sheds everything the levels below it do"""
+
+    NORMAL = 0
+    CLAMP_LIMITS = 1  # REQ limits are reduced to clamped_limit
+    REJECT_SUBSCRIPTIONS = 2  # new REQs are refused
+    DEFER_EVENTS = 3  # low priority events wait for the lag to drop
+
+
+@dataclasses.dataclass
+class SheddingConfig:
+    # lag in seconds at which each level starts, None to never shed that way
+    clamp_lag: typing.Optional[float] = None
+    reject_lag: typing.Optional[float] = None
+    defer_lag: typing.Optional[float] = None
+    clamped_limit: int = 100
+    low_priority_kinds: list[int] = dataclasses.field(
+        default_factory=lambda: [7]  # reactions
+    )
+    # deferred events beyond max_deferred are rejected, and a deferred event is
+    # processed after max_defer seconds even if the lag is still high
+    max_deferred: int = 1000
+    max_defer: float = 5.0
+    sample_interval: float = 0.1
+    # fraction of the peak lag kept after each sample, so a spike sheds load
+    # right away and the levels step back down gradually
+    decay: float = 0.8
+
+    def enabled(self) -> bool:
+        return any(
+            lag is not None for lag in (self.clamp_lag, self.reject_lag, self.defer_lag)
+        )
+
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+@dataclasses.dataclass
+class LagHistogram(metrics.HistogramSeries):
+    bounds: tuple[float, ...] = LAG_BUCKETS
+    max: float = 0.0
+
+    def observe(self, value: float):
+        super().observe(value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile, inf past the last"""
+        if not self.samples:
+            return 0.0
+        rank = q * self.samples
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+@dataclasses.dataclass
+class SheddingStats:
+    lag: LagHistogram = dataclasses.field(default_factory=LagHistogram, repr=False)
+    # samples spent at each level
+    levels: dict[str, int] = dataclasses.field(
+        default_factory=lambda: dict.fromkeys((level.name for level in Level), 0)
+    )
+    clamped: int = 0
+    rejected: int = 0
+    deferred: int = 0
+    # low priority events refused because too many were already deferred
+    dropped: int = 0
+
+
+class LoadShedder:
+    """Relay-wide shedding level, shared by the MessageHandler of each connection"""
+
+    _cfg: SheddingConfig
+    _thresholds: list[tuple[float, Level]]
+    _stats: SheddingStats
+    _peak: float
+    _level: Level
+    _recovered: asyncio.Event
+    _waiting: int
+
+    def __init__(self, cfg: SheddingConfig = SheddingConfig()):
+        self._cfg = cfg
+        self._thresholds = sorted(
+            (lag, level)
+            for lag, level in (
+                (cfg.clamp_lag, Level.CLAMP_LIMITS),
+                (cfg.reject_lag, Level.REJECT_SUBSCRIPTIONS),
+                (cfg.defer_lag, Level.DEFER_EVENTS),
+            )
+            if lag is not None
+        )
+        self._stats = SheddingStats()
+        self._peak = 0.0
+        self._level = Level.NORMAL
+        self._recovered = asyncio.Event()
+        self._recovered.set()
+        self._waiting = 0
+
+    @property
+    def cfg(self) -> SheddingConfig:
+        return self._cfg
+
+    @property
+    def stats(self) -> SheddingStats:
+        return self._stats
+
+    @property
+    def level(self) -> Level:
+        return self._level
+
+    def observe(self, lag: float):
+        self._stats.lag.observe(lag)
+        self._peak = max(lag, self._peak * self._cfg.decay)
+
+        level = Level.NORMAL
+        for threshold, candidate in self._thresholds:
+            if self._peak >= threshold:
+                level = max(level, candidate)
+
+        if level != self._level:
+            log = logger.warning if level > self._level else logger.info
+            log(
+                "Event loop lag %.3fs, shedding level %s -> %s",
+                lag,
+                self._level.name,
+                level.name,
+            )
+            self._level = level
+            if level >= Level.DEFER_EVENTS:
+                self._recovered.clear()
+            else:
+                self._recovered.set()
+        self._stats.levels[level.name] += 1
+
+    def clamp_limit(self, limit: typing.Optional[int]) -> typing.Optional[int]:
+        """Limit to apply to a REQ filter, clamped if the relay is busy"""
+        if self._level < Level.CLAMP_LIMITS:
+            return limit
+        if limit is not None and limit <= self._cfg.clamped_limit:
+            return limit
+        self._stats.clamped += 1
+        return self._cfg.clamped_limit
+
+    def accepts_subscriptions(self) -> bool:
+        if self._level < Level.REJECT_SUBSCRIPTIONS:
+            return True
+        self._stats.rejected += 1
+        return False
+
+    def should_defer(self, kind: typing.Optional[int]) -> bool:
+        return (
+            self._level >= Level.DEFER_EVENTS and kind in self._cfg.low_priority_kinds
+        )
+
+    async def defer(self) -> bool:
+        """Wait until the lag drops, False if too many events are waiting already"""
+        if self._waiting >= self._cfg.max_deferred:
+            self._stats.dropped += 1
+            return False
+
+        self._stats.deferred += 1
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._recovered.wait(), self._cfg.max_defer)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiting -= 1
+        return True
+
+
+class LagMonitor:
+    """Samples the event loop's lag and feeds it to a LoadShedder"""
+
+    _shedder: LoadShedder
+
+    def __init__(self, shedder: LoadShedder):
+        self._shedder = shedder
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        interval = self._shedder.cfg.sample_interval
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self._shedder.observe(max(0.0, loop.time() - start - interval))
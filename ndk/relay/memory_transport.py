@@ -0,0 +1,149 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Websocket connections held in memory, for driving the relay without sockets
+
+A MemoryWebSocket has the recv()/send()/close() surface that
+protocol_handler's read_handler and write_handler use, so relay/server.py's
+handler_wrapper serves one unchanged. Thousands of connections then run the
+whole relay stack in one process, with no socket or TLS work in a profile of
+it and no scheduling left to the network.
+"""
+
+import asyncio
+import itertools
+import logging
+import typing
+
+from websockets import exceptions as websockets_exceptions
+
+logger = logging.getLogger(__name__)
+
+# put in an inbox behind everything sent before the connection closed
+_CLOSED = object()
+
+
+class MemoryWebSocket:
+    """One end of an in-memory connection, see pair()"""
+
+    remote_address: tuple[str, int]
+    _inbox: asyncio.Queue
+    _peer: "MemoryWebSocket"
+    _closed: bool
+
+    def __init__(self, remote_address: tuple[str, int]):
+        self.remote_address = remote_address
+        self._inbox = asyncio.Queue()
+        self._peer = self
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def recv(self) -> str:
+        """Next message from the peer, raising ConnectionClosed once it's gone"""
+        if self._closed:
+            raise websockets_exceptions.ConnectionClosed(None, None)
+
+        data = await self._inbox.get()
+        if data is _CLOSED:
+            self._closed = True
+            raise websockets_exceptions.ConnectionClosed(None, None)
+        return data
+
+    async def send(self, data: str):
+        if self._closed or self._peer.closed:
+            raise websockets_exceptions.ConnectionClosed(None, None)
+
+        self._peer.deliver(data)
+
+    async def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._peer.deliver(_CLOSED)
+        # wakes a recv() already waiting on this end
+        self._inbox.put_nowait(_CLOSED)
+
+    def deliver(self, data: typing.Any):
+        """Queues data sent by the peer for recv()"""
+        self._inbox.put_nowait(data)
+
+
+def pair(
+    remote_address: tuple[str, int] = ("127.0.0.1", 0)
+) -> tuple[MemoryWebSocket, MemoryWebSocket]:
+    """Server and client end of a new connection from remote_address"""
+    server = MemoryWebSocket(remote_address)
+    client = MemoryWebSocket(("memory", 0))
+    server._peer = client  # pylint: disable=protected-access
+    client._peer = server  # pylint: disable=protected-access
+    return server, client
+
+
+class MemoryServer:
+    """Runs a handler on the server end of each connection, as websockets.serve does"""
+
+    _handler: typing.Callable[[MemoryWebSocket], typing.Awaitable[None]]
+    _connections: dict[MemoryWebSocket, asyncio.Task]
+    _ports: typing.Iterator[int]
+
+    def __init__(
+        self, handler: typing.Callable[[MemoryWebSocket], typing.Awaitable[None]]
+    ):
+        self._handler = handler
+        self._connections = {}
+        self._ports = itertools.count(1)
+
+    @property
+    def connections(self) -> int:
+        return len(self._connections)
+
+    async def connect(
+        self, remote_address: typing.Optional[tuple[str, int]] = None
+    ) -> MemoryWebSocket:
+        """Client end of a new connection, which the handler is serving"""
+        if remote_address is None:
+            remote_address = ("127.0.0.1", next(self._ports))
+
+        server, client = pair(remote_address)
+        task = asyncio.create_task(self._serve(server))
+        self._connections[server] = task
+        task.add_done_callback(lambda _: self._connections.pop(server, None))
+        return client
+
+    async def _serve(self, websocket: MemoryWebSocket):
+        try:
+            await self._handler(websocket)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Connection handler failed")
+        finally:
+            await websocket.close()
+
+    async def close(self):
+        """Closes every connection and waits for their handlers to return"""
+        tasks = list(self._connections.values())
+        for websocket in list(self._connections):
+            await websocket.close()
+        await asyncio.gather(*tasks)
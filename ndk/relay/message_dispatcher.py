@@ -21,21 +21,36 @@
 
 import dataclasses
 import logging
+import re
+import time
+import typing
 
 from ndk import exceptions
 from ndk.messages import (
     auth,
     close,
+    command_result,
+    count,
     event_message,
     message,
     message_factory,
     notice,
     request,
 )
-from ndk.relay import message_handler
+from ndk.relay import message_handler, metrics, rate_limiter, tracing
 
 logger = logging.getLogger(__name__)
 
+_EVENT_ID = re.compile(r'"id"\s*:\s*"([0-9a-f]{64})"')
+
+_MESSAGE_TYPES: dict[type, str] = {
+    event_message.Event: "EVENT",
+    request.Request: "REQ",
+    count.CountRequest: "COUNT",
+    close.Close: "CLOSE",
+    auth.AuthResponse: "AUTH",
+}
+
 
 def create_notice(text: str) -> str:
     return notice.Notice(text).serialize()
@@ -46,42 +61,112 @@ class MessageHandlerConfig:
     max_message_length: int = 16384
 
 
+def create_unparsable(data: str) -> str:
+    text = f"Unable to parse message: {data}"
+    logger.info(text, exc_info=True)
+    return create_notice(text)
+
+
+def create_rate_limited(data: str, scope: str) -> str:
+    text = f"rate-limited: slow down, too many messages from this {scope}"
+    if rate_limiter.message_type(data) == "EVENT":
+        event_id = _EVENT_ID.search(data)
+        if event_id:
+            return command_result.CommandResult(
+                event_id.group(1), False, text
+            ).serialize()
+    return create_notice(text)
+
+
 class MessageDispatcher:
     _cfg: MessageHandlerConfig
+    _limiter: typing.Optional[rate_limiter.ConnectionRateLimiter]
+    _metrics: typing.Optional[metrics.RelayMetrics]
+    _tracer: typing.Optional[tracing.Tracer]
 
     def __init__(
         self,
         msg_handler: message_handler.MessageHandler,
         cfg: MessageHandlerConfig = MessageHandlerConfig(),
+        limiter: typing.Optional[rate_limiter.ConnectionRateLimiter] = None,
+        relay_metrics: typing.Optional[metrics.RelayMetrics] = None,
+        tracer: typing.Optional[tracing.Tracer] = None,
     ):
         self._cfg = cfg
         self._msg_handler = msg_handler
+        self._limiter = limiter
+        self._metrics = relay_metrics
+        self._tracer = tracer
+        # resolved once per connection rather than for every message
+        self._latency: dict[typing.Optional[type], metrics.HistogramSeries] = {}
+        if relay_metrics is not None:
+            self._latency = {
+                msg_class: relay_metrics.handled_series(msg_type)
+                for msg_class, msg_type in _MESSAGE_TYPES.items()
+            }
+            self._latency[None] = relay_metrics.handled_series(None)
+
+    def trace(self) -> typing.ContextManager:
+        """Context manager tracing the stages of the message handled in it, if sampled
+
+        Covers whatever the caller does with the responses too, e.g. queueing them.
+        """
+        if self._tracer is None:
+            return tracing.UNTRACED
+        return self._tracer.trace()
 
     async def process_message(self, data: str) -> list[str]:
         if len(data) > self._cfg.max_message_length:
+            self._count_unhandled(data)
             return [
                 create_notice(
                     f"Relay doesn't support messages longer than {self._cfg.max_message_length} bytes"
                 )
             ]
 
+        if self._limiter is not None:
+            scope = self._limiter.admit(data)
+            if scope is not None:
+                self._count_unhandled(data)
+                return [create_rate_limited(data, scope)]
+
+        start = time.perf_counter()
         try:
             msg = message_factory.from_str(data)
-            return await self._handle_msg(msg)
         except (exceptions.ParseError, ValueError):
-            text = f"Unable to parse message: {data}"
-            logger.info(text, exc_info=True)
-            return [create_notice(text)]
+            self._count_unhandled(data)
+            return [create_unparsable(data)]
+
+        trace = tracing.current()
+        if trace is not None:
+            trace.message_type = _MESSAGE_TYPES.get(type(msg))
+            trace.mark("parse")
+
+        try:
+            responses = await self._handle_msg(msg)
+        except ValueError:
+            responses = [create_unparsable(data)]
         except PermissionError as exc:
             text = f"restricted: action requires NIP-42 authentication: {exc.args[0]} {data}"
             logger.info(text)
-            return [create_notice(text)]
+            responses = [create_notice(text)]
+
+        if self._latency:
+            series = self._latency.get(type(msg)) or self._latency[None]
+            series.observe(time.perf_counter() - start)
+        return responses
+
+    def _count_unhandled(self, data: str):
+        if self._metrics is not None:
+            self._metrics.count_message(rate_limiter.message_type(data))
 
     async def _handle_msg(self, msg: message.Message) -> list[str]:
         if isinstance(msg, event_message.Event):
             return await self._msg_handler.handle_event_message(msg)
         elif isinstance(msg, request.Request):
             return await self._msg_handler.handle_request(msg)
+        elif isinstance(msg, count.CountRequest):
+            return await self._msg_handler.handle_count(msg)
         elif isinstance(msg, close.Close):
             return await self._msg_handler.handle_close(msg)
         elif isinstance(msg, auth.AuthResponse):
@@ -22,20 +22,28 @@
 import dataclasses
 import functools
 import logging
+import typing
 
 from ndk import exceptions
-from ndk.event import event_builder, event_filter
+from ndk.event import event_filter
 from ndk.messages import (
     auth,
     close,
     command_result,
+    count,
     eose,
     event_message,
     notice,
     relay_event,
     request,
 )
-from ndk.relay import auth_handler, event_handler, subscription_handler
+from ndk.relay import (
+    auth_handler,
+    event_handler,
+    load_shedder,
+    subscription_handler,
+    tracing,
+)
 from ndk.relay.event_repo import event_repo
 
 logger = logging.getLogger(__name__)
@@ -71,12 +79,19 @@ def create_notice(text: str) -> str:
     return notice.Notice(text).serialize()
 
 
+def _event_id(msg: event_message.Event) -> str:
+    """Id to answer msg with, empty when it has none that could be echoed"""
+    ev_id = msg.event_dict.get("id", "")
+    return ev_id if isinstance(ev_id, str) else ""
+
+
 class MessageHandler:
     _auth: auth_handler.AuthHandler
     _cfg: MessageHandlerConfig
     _event_handler: event_handler.EventHandler
     _repo: event_repo.EventRepo
     _subscription_handler: subscription_handler.SubscriptionHandler
+    _shedder: typing.Optional[load_shedder.LoadShedder]
 
     def __init__(
         self,
@@ -85,78 +100,157 @@ class MessageHandler:
         sh: subscription_handler.SubscriptionHandler,
         eh: event_handler.EventHandler,
         cfg: MessageHandlerConfig = MessageHandlerConfig(),
+        *,
+        shedder: typing.Optional[load_shedder.LoadShedder] = None,
     ):
         self._auth = auth_hndlr
         self._cfg = cfg
         self._event_handler = eh
         self._repo = repo
         self._subscription_handler = sh
+        self._shedder = shedder
 
     async def handle_event_message(self, msg: event_message.Event) -> list[str]:
+        notices = []
+        kind = msg.event_dict.get("kind")
+        if self._shedder is not None and self._shedder.should_defer(kind):
+            if not await self._shedder.defer():
+                return [
+                    command_result.CommandResult(
+                        _event_id(msg),
+                        False,
+                        "rate-limited: relay is overloaded, try again later",
+                    ).serialize()
+                ]
+            tracing.mark("defer")
+            notices.append(
+                create_notice(f"Relay is busy, kind {kind} events are delayed")
+            )
+
+        return notices + await self._process_event(msg)
+
+    async def _process_event(self, msg: event_message.Event) -> list[str]:
         try:
-            ev = event_builder.from_dict(msg.event_dict)
+            ev = await self._event_handler.ingest(msg.event_dict)
+            if ev is None:
+                return [
+                    command_result.CommandResult(
+                        _event_id(msg), True, "duplicate: already have this event"
+                    ).serialize()
+                ]
+
             await self._event_handler.handle_event(ev)
             return [command_result.CommandResult(ev.id, True, "").serialize()]
         except exceptions.ValidationError as exc:
-            text = f"Event validation failed: {exc.args[0]} {msg}"
-            logger.info(text, exc_info=True)
-            ev_id = msg.event_dict["id"]  # guaranteed if passed Type check above
-            return [command_result.CommandResult(ev_id, False, text).serialize()]
+            logger.info(
+                "Event validation failed: %s %s", exc.args[0], msg, exc_info=True
+            )
+            return [
+                command_result.CommandResult(
+                    _event_id(msg), False, f"invalid: {exc.args[0]}"
+                ).serialize()
+            ]
 
     async def handle_close(self, msg: close.Close) -> list[str]:
         await self._subscription_handler.clear_filters(msg.sub_id)
         return []
 
-    @authentication_retry()
-    async def handle_request(self, msg: request.Request) -> list[str]:
-        if len(msg.filter_list) > self._cfg.max_filters:
-            return [
-                create_notice(
-                    f"Relay does not support more than {self._cfg.max_filters} filters."
-                )
-            ]
+    def _filters_from(self, filter_list: list[dict]) -> list[event_filter.EventFilter]:
+        if len(filter_list) > self._cfg.max_filters:
+            raise subscription_handler.ConfigLimitsExceeded(
+                f"Relay does not support more than {self._cfg.max_filters} filters."
+            )
 
         fltrs = []
-        for d in msg.filter_list:
+        for d in filter_list:
             fltr = event_filter.AuthenticatedEventFilter.from_dict_and_auth_pubkey(
                 d, self._auth.authenticated_pubkey()
             )
 
             if fltr.ids and any(len(val) < self._cfg.min_prefix for val in fltr.ids):
-                return [
-                    create_notice(
-                        f"Relay does not support filters with id prefixes shorter than {self._cfg.min_prefix} characters."
-                    )
-                ]
+                raise subscription_handler.ConfigLimitsExceeded(
+                    f"Relay does not support filters with id prefixes shorter than {self._cfg.min_prefix} characters."
+                )
 
             if fltr.authors and any(
                 len(val) < self._cfg.min_prefix for val in fltr.authors
             ):
-                return [
-                    create_notice(
-                        f"Relay does not support filters with author prefixes shorter than {self._cfg.min_prefix} characters."
-                    )
-                ]
+                raise subscription_handler.ConfigLimitsExceeded(
+                    f"Relay does not support filters with author prefixes shorter than {self._cfg.min_prefix} characters."
+                )
 
             if fltr.limit and fltr.limit > self._cfg.max_limit:
+                raise subscription_handler.ConfigLimitsExceeded(
+                    f"Relay does not support filters with a limit greater than {self._cfg.max_limit}."
+                )
+
+            fltrs.append(fltr)
+
+        return fltrs
+
+    @authentication_retry()
+    async def handle_request(self, msg: request.Request) -> list[str]:
+        try:
+            fltrs = self._filters_from(msg.filter_list)
+        except subscription_handler.ConfigLimitsExceeded as exc:
+            return [create_notice(exc.args[0])]
+
+        notices = []
+        queried = fltrs
+        if self._shedder is not None:
+            if not self._shedder.accepts_subscriptions():
                 return [
                     create_notice(
-                        f"Relay does not support filters with a limit greater than {self._cfg.max_limit}."
+                        "Relay is overloaded, not accepting new subscriptions. Try again later."
                     )
                 ]
+            queried = self._clamp_limits(fltrs)
+            if queried != fltrs:
+                notices.append(
+                    create_notice(
+                        f"Relay is busy, limits reduced to {self._shedder.cfg.clamped_limit}."
+                    )
+                )
 
-            fltrs.append(fltr)
-
-        fetched = await self._repo.get(fltrs)
+        fetched = await self._repo.get_serialized(queried)
         try:
             await self._subscription_handler.set_filters(msg.sub_id, fltrs)
         except subscription_handler.ConfigLimitsExceeded as exc:
             return [create_notice(exc.args[0])]
 
-        return [
-            relay_event.RelayEvent(msg.sub_id, ev.__dict__).serialize()
-            for ev in fetched
-        ] + [eose.EndOfStoredEvents(msg.sub_id).serialize()]
+        responses = (
+            notices
+            + [
+                relay_event.RelayEvent.serialize_raw(msg.sub_id, event_json)
+                for event_json in fetched
+            ]
+            + [eose.EndOfStoredEvents(msg.sub_id).serialize()]
+        )
+        tracing.mark("serialize")
+        return responses
+
+    def _clamp_limits(
+        self, fltrs: list[event_filter.EventFilter]
+    ) -> list[event_filter.EventFilter]:
+        """Copies of fltrs with limits the shedder allows, the subscription keeps fltrs"""
+        assert self._shedder is not None
+        clamped = []
+        for fltr in fltrs:
+            limit = self._shedder.clamp_limit(fltr.limit)
+            clamped.append(
+                fltr if limit == fltr.limit else dataclasses.replace(fltr, limit=limit)
+            )
+        return clamped
+
+    @authentication_retry()
+    async def handle_count(self, msg: count.CountRequest) -> list[str]:
+        try:
+            fltrs = self._filters_from(msg.filter_list)
+        except subscription_handler.ConfigLimitsExceeded as exc:
+            return [create_notice(exc.args[0])]
+
+        total = await self._repo.count(fltrs)
+        return [count.CountResponse(msg.sub_id, total).serialize()]
 
     async def handle_auth_response(self, msg: auth.AuthResponse) -> list[str]:
         self._auth.handle_auth_event(msg.ev)
@@ -0,0 +1,341 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Relay metrics, rendered in the Prometheus text exposition format
+
+Counters and histograms updated on the hot path are a dict lookup and an
+add, with no locking since the relay runs on one event loop. Everything
+that can be read off existing state instead, like queue depths or the
+ingest stats, is a Callback evaluated only when the metrics are scraped.
+"""
+
+import abc
+import bisect
+import dataclasses
+import time
+import typing
+
+# seconds, for latencies from an in-memory lookup to a slow query
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+
+Labels = tuple[str, ...]
+
+
+def _format_labels(names: Labels, values: Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(abc.ABC):
+    name: str
+    help: str
+    kind: str
+    labelnames: Labels
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: Labels):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+    @abc.abstractmethod
+    def samples(self) -> typing.Iterable[str]:
+        pass
+
+
+class Counter(Metric):
+    _values: dict[Labels, float]
+
+    def __init__(self, name: str, help_text: str, labelnames: Labels = ()):
+        super().__init__(name, help_text, "counter", labelnames)
+        self._values = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> typing.Iterable[str]:
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+@dataclasses.dataclass
+class HistogramSeries:
+    """Observations counted in the first bucket whose upper bound they fit"""
+
+    bounds: tuple[float, ...]
+    # one count per bound, plus one for observations above the last
+    counts: list[int] = dataclasses.field(init=False)
+    total: float = 0.0
+
+    def __post_init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    @property
+    def samples(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def time(self) -> "_Timer":
+        """Context manager observing the seconds spent in its block"""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("_series", "_start")
+
+    def __init__(self, series: HistogramSeries):
+        self._series = series
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self._series.observe(time.perf_counter() - self._start)
+
+
+def _histogram_samples(
+    name: str, labelnames: Labels, labels: Labels, series
+) -> typing.Iterable[str]:
+    cumulative = 0
+    for bound, count in zip(series.bounds + (float("inf"),), series.counts):
+        cumulative += count
+        le = _format_labels(labelnames, labels, f'le="{_format_value(bound)}"')
+        yield f"{name}_bucket{le} {cumulative}"
+    suffix = _format_labels(labelnames, labels)
+    yield f"{name}_sum{suffix} {_format_value(series.total)}"
+    yield f"{name}_count{suffix} {series.samples}"
+
+
+class Histogram(Metric):
+    _bounds: tuple[float, ...]
+    _series: dict[Labels, HistogramSeries]
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Labels = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_text, "histogram", labelnames)
+        self._bounds = buckets
+        self._series = {}
+
+    def series(self, *labels: str) -> HistogramSeries:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = HistogramSeries(self._bounds)
+        return series
+
+    def observe(self, value: float, *labels: str):
+        self.series(*labels).observe(value)
+
+    def time(self, *labels: str) -> _Timer:
+        """Context manager observing the seconds spent in its block"""
+        return self.series(*labels).time()
+
+    def samples(self) -> typing.Iterable[str]:
+        for labels, series in sorted(self._series.items()):
+            yield from _histogram_samples(self.name, self.labelnames, labels, series)
+
+
+class Callback(Metric):
+    """Read when scraped, fn returns a value or a value per tuple of labels"""
+
+    _fn: typing.Callable[[], typing.Union[float, dict[Labels, float]]]
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        fn: typing.Callable[[], typing.Union[float, dict[Labels, float]]],
+        labelnames: Labels = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, help_text, kind, labelnames)
+        self._fn = fn
+
+    def samples(self) -> typing.Iterable[str]:
+        values = self._fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class HistogramCallback(Metric):
+    """Histogram kept elsewhere, e.g. by a component that also reads it"""
+
+    _fn: typing.Callable[[], HistogramSeries]
+
+    def __init__(
+        self, name: str, help_text: str, fn: typing.Callable[[], HistogramSeries]
+    ):
+        super().__init__(name, help_text, "histogram", ())
+        self._fn = fn
+
+    def samples(self) -> typing.Iterable[str]:
+        yield from _histogram_samples(self.name, (), (), self._fn())
+
+
+M = typing.TypeVar("M", bound=Metric)
+
+
+class Registry:
+    _metrics: dict[str, Metric]
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# connections an event is sent to
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+MESSAGE_TYPES = frozenset(("EVENT", "REQ", "CLOSE", "COUNT", "AUTH"))
+
+
+class RelayMetrics:
+    """Metrics updated while handling messages, shared by all connections"""
+
+    registry: Registry
+    handler_latency: Histogram
+    # messages turned away before they were parsed, by type
+    unhandled: Counter
+    repo_latency: Histogram
+    fanout: Histogram
+    kafka_produce_latency: Histogram
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.handler_latency = registry.register(
+            Histogram(
+                "nostr_message_handling_seconds",
+                "Time spent parsing and handling a message, by type",
+                ("type",),
+            )
+        )
+        self.unhandled = Counter("unhandled", "", ("type",))
+        # handled messages are counted by their latency histogram alone
+        self._handled = {
+            msg_type: self.handler_latency.series(msg_type)
+            for msg_type in MESSAGE_TYPES | {"other"}
+        }
+        registry.register(
+            Callback(
+                "nostr_messages_total",
+                "Messages received, by type",
+                self.messages,
+                ("type",),
+                kind="counter",
+            )
+        )
+        self.repo_latency = registry.register(
+            Histogram(
+                "nostr_repo_seconds",
+                "Time spent in event repo calls, by method",
+                ("method",),
+            )
+        )
+        self.fanout = registry.register(
+            Histogram(
+                "nostr_event_fanout",
+                "Connections each published event was sent to",
+                buckets=FANOUT_BUCKETS,
+            )
+        )
+        self.kafka_produce_latency = registry.register(
+            Histogram(
+                "nostr_kafka_produce_seconds",
+                "Time until Kafka acknowledged a produced event",
+            )
+        )
+
+    def messages(self) -> dict[Labels, float]:
+        return {
+            (msg_type,): series.samples + self.unhandled.value(msg_type)
+            for msg_type, series in self._handled.items()
+        }
+
+    def count_message(self, msg_type: typing.Optional[str]):
+        """Counts a message that was turned away before it was handled"""
+        # unknown types are lumped together to bound the number of series
+        if msg_type is None or msg_type not in MESSAGE_TYPES:
+            msg_type = "other"
+        self.unhandled.inc(msg_type)
+
+    def handled_series(self, msg_type: typing.Optional[str]) -> HistogramSeries:
+        """Series counting handled messages of a type and the time they took"""
+        return self._handled[msg_type or "other"]
+
+    def observe_message(self, msg_type: typing.Optional[str], seconds: float):
+        """Counts a handled message and the time it took"""
+        self.handled_series(msg_type).observe(seconds)
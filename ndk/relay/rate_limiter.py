@@ -0,0 +1,226 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Token-bucket admission control for incoming messages
+
+Each message type has a cost in tokens. A message is admitted only if every
+bucket that applies to it (its connection's, its remote IP's and, once the
+connection has authenticated with NIP-42, its pubkey's) holds enough tokens,
+and is then charged to all of them. Buckets refill continuously at their
+rate, up to their burst size.
+"""
+
+import dataclasses
+import re
+import time
+import typing
+
+SCOPES = ("connection", "ip", "pubkey")
+
+_MESSAGE_TYPE = re.compile(r'\s*\[\s*"([A-Z]+)"')
+
+
+def message_type(data: str) -> typing.Optional[str]:
+    """Type of a raw message, e.g. "EVENT", read without parsing it"""
+    match = _MESSAGE_TYPE.match(data)
+    return match.group(1) if match else None
+
+
+@dataclasses.dataclass
+class BucketConfig:
+    rate: float  # tokens per second
+    burst: float
+
+
+@dataclasses.dataclass
+class RateLimitConfig:
+    connection: typing.Optional[BucketConfig] = None
+    ip: typing.Optional[BucketConfig] = None
+    pubkey: typing.Optional[BucketConfig] = None
+    # messages of other types are free, but ones whose type can't be read
+    # without parsing them, e.g. written with escapes, cost the most of these
+    costs: dict[str, float] = dataclasses.field(
+        default_factory=lambda: {"EVENT": 1.0, "REQ": 1.0, "COUNT": 1.0}
+    )
+    # how often buckets of IPs and pubkeys that went quiet are dropped
+    prune_interval: float = 60.0
+
+    def enabled(self) -> bool:
+        return any((self.connection, self.ip, self.pubkey))
+
+
+@dataclasses.dataclass
+class RateLimitStats:
+    # messages rejected, by message type and by the bucket that ran out
+    by_type: dict[str, int] = dataclasses.field(default_factory=dict)
+    by_scope: dict[str, int] = dataclasses.field(
+        default_factory=lambda: dict.fromkeys(SCOPES, 0)
+    )
+
+    @property
+    def limited(self) -> int:
+        return sum(self.by_scope.values())
+
+
+class TokenBucket:
+    __slots__ = ("_cfg", "tokens", "updated")
+
+    def __init__(self, cfg: BucketConfig, now: float):
+        self._cfg = cfg
+        self.tokens = cfg.burst
+        self.updated = now
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        self.tokens = min(self._cfg.burst, self.tokens + elapsed * self._cfg.rate)
+        self.updated = now
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self._cfg.burst
+
+
+class RateLimiter:
+    """Relay-wide limits, shared by the ConnectionRateLimiter of each connection"""
+
+    _cfg: RateLimitConfig
+    _clock: typing.Callable[[], float]
+    _by_ip: dict[str, TokenBucket]
+    _by_pubkey: dict[str, TokenBucket]
+    _stats: RateLimitStats
+    _pruned_at: float
+
+    def __init__(
+        self,
+        cfg: RateLimitConfig,
+        clock: typing.Callable[[], float] = time.monotonic,
+    ):
+        self._cfg = cfg
+        self._clock = clock
+        self._by_ip = {}
+        self._by_pubkey = {}
+        self._stats = RateLimitStats()
+        self._pruned_at = clock()
+
+    @property
+    def stats(self) -> RateLimitStats:
+        return self._stats
+
+    def tracked(self) -> int:
+        """Number of IP and pubkey buckets held"""
+        return len(self._by_ip) + len(self._by_pubkey)
+
+    def for_connection(
+        self,
+        ip: typing.Optional[str],
+        authenticated_pubkey: typing.Callable[[], typing.Optional[str]] = lambda: None,
+    ) -> "ConnectionRateLimiter":
+        return ConnectionRateLimiter(self, ip, authenticated_pubkey)
+
+    def admit(
+        self,
+        msg_type: typing.Optional[str],
+        conn_bucket: typing.Optional[TokenBucket],
+        ip: typing.Optional[str],
+        pubkey: typing.Optional[str],
+    ) -> typing.Optional[str]:
+        """None if the message may be processed, else the scope that limited it"""
+        if msg_type is None:
+            cost = max(self._cfg.costs.values(), default=0.0)
+        else:
+            cost = self._cfg.costs.get(msg_type, 0.0)
+        if not cost:
+            return None
+
+        now = self._clock()
+        if now - self._pruned_at >= self._cfg.prune_interval:
+            self._prune(now)
+
+        buckets = []
+        if conn_bucket is not None:
+            buckets.append(("connection", conn_bucket))
+        if self._cfg.ip is not None and ip is not None:
+            buckets.append(("ip", self._bucket(self._by_ip, ip, self._cfg.ip, now)))
+        if self._cfg.pubkey is not None and pubkey is not None:
+            buckets.append(
+                (
+                    "pubkey",
+                    self._bucket(self._by_pubkey, pubkey, self._cfg.pubkey, now),
+                )
+            )
+
+        for scope, bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < cost:
+                key = msg_type or "other"
+                self._stats.by_type[key] = self._stats.by_type.get(key, 0) + 1
+                self._stats.by_scope[scope] += 1
+                return scope
+
+        for _, bucket in buckets:
+            bucket.tokens -= cost
+        return None
+
+    def new_connection_bucket(self) -> typing.Optional[TokenBucket]:
+        if self._cfg.connection is None:
+            return None
+        return TokenBucket(self._cfg.connection, self._clock())
+
+    @staticmethod
+    def _bucket(
+        buckets: dict[str, TokenBucket], key: str, cfg: BucketConfig, now: float
+    ) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(cfg, now)
+        return bucket
+
+    def _prune(self, now: float):
+        # a full bucket is the same as a new one
+        for buckets in (self._by_ip, self._by_pubkey):
+            for key in [k for k, bucket in buckets.items() if bucket.is_full(now)]:
+                del buckets[key]
+        self._pruned_at = now
+
+
+class ConnectionRateLimiter:
+    _limiter: RateLimiter
+    _bucket: typing.Optional[TokenBucket]
+    _ip: typing.Optional[str]
+    _authenticated_pubkey: typing.Callable[[], typing.Optional[str]]
+
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        ip: typing.Optional[str],
+        authenticated_pubkey: typing.Callable[[], typing.Optional[str]],
+    ):
+        self._limiter = limiter
+        self._bucket = limiter.new_connection_bucket()
+        self._ip = ip
+        self._authenticated_pubkey = authenticated_pubkey
+
+    def admit(self, data: str) -> typing.Optional[str]:
+        """None if the raw message may be processed, else the scope that limited it"""
+        return self._limiter.admit(
+            message_type(data), self._bucket, self._ip, self._authenticated_pubkey()
+        )
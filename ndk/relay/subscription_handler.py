@@ -22,9 +22,12 @@
 import asyncio
 import dataclasses
 import functools
+import typing
 
+from ndk import serialize
 from ndk.event import event, event_filter
 from ndk.messages import relay_event
+from ndk.relay import metrics
 
 
 def locked():
@@ -49,32 +52,140 @@ class SubscriptionHandlerConfig:
     max_subid_length: int = 100
 
 
+@dataclasses.dataclass
+class _Group:
+    fltr: event_filter.EventFilter
+    subscribers: dict["SubscriptionHandler", set[str]] = dataclasses.field(
+        default_factory=dict
+    )
+    compiled: event_filter.CompiledFilter = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        self.compiled = self.fltr.compile()
+
+
+class SubscriptionGroups:
+    """Relay-wide live subscriptions, grouped by identical filter
+
+    Filters are interned by their canonical key without the limit, which
+    doesn't apply to live events, so each distinct filter is matched once per
+    event no matter how many subscriptions hold it. Every
+    (connection, sub_id) of a matching filter then gets the event, serialized
+    only once.
+    """
+
+    _groups: dict[tuple, _Group]
+    _fanout: typing.Optional[metrics.HistogramSeries]
+
+    def __init__(self, fanout: typing.Optional[metrics.Histogram] = None):
+        self._groups = {}
+        self._fanout = fanout.series() if fanout is not None else None
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def subscriber_count(self) -> int:
+        return sum(
+            len(sub_ids)
+            for group in self._groups.values()
+            for sub_ids in group.subscribers.values()
+        )
+
+    def add(
+        self,
+        sh: "SubscriptionHandler",
+        sub_id: str,
+        fltrs: list[event_filter.EventFilter],
+    ) -> list[event_filter.EventFilter]:
+        """Subscribes sub_id of sh to fltrs, returns the interned filters"""
+        interned = []
+        for fltr in fltrs:
+            key = fltr.live_key()
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _Group(fltr)
+            group.subscribers.setdefault(sh, set()).add(sub_id)
+            interned.append(group.fltr)
+        return interned
+
+    def discard(
+        self,
+        sh: "SubscriptionHandler",
+        sub_id: str,
+        fltrs: list[event_filter.EventFilter],
+    ):
+        for fltr in fltrs:
+            key = fltr.live_key()
+            group = self._groups.get(key)
+            if group is None or sh not in group.subscribers:
+                continue
+
+            group.subscribers[sh].discard(sub_id)
+            if not group.subscribers[sh]:
+                del group.subscribers[sh]
+            if not group.subscribers:
+                del self._groups[key]
+
+    async def handle_event(self, ev: event.Event):
+        matched: dict[SubscriptionHandler, set[str]] = {}
+        for group in list(self._groups.values()):
+            if group.compiled.matches(ev):
+                for sh, sub_ids in group.subscribers.items():
+                    matched.setdefault(sh, set()).update(sub_ids)
+
+        if self._fanout is not None:
+            self._fanout.observe(len(matched))
+
+        if not matched:
+            return
+
+        ev_json = serialize.serialize_as_str(ev.__dict__)
+        for sh, sub_ids in matched.items():
+            await sh.send_event(sub_ids, ev_json)
+
+
 class SubscriptionHandler:
     _cfg: SubscriptionHandlerConfig
     _sub_id_to_fltrs: dict[str, list[event_filter.EventFilter]]
+    _sub_id_to_compiled: dict[str, list[event_filter.CompiledFilter]]
     _response_queue: asyncio.Queue[str]
     _pending_deletes: set[str]
     _lock: asyncio.Lock
+    _groups: typing.Optional[SubscriptionGroups]
 
     def __init__(
         self,
         response_queue: asyncio.Queue[str],
         cfg: SubscriptionHandlerConfig = SubscriptionHandlerConfig(),
+        groups: typing.Optional[SubscriptionGroups] = None,
     ):
+        """With groups, events are matched by the groups instead of handle_event()"""
         self._cfg = cfg
         self._sub_id_to_fltrs = {}
+        self._sub_id_to_compiled = {}
         self._response_queue = response_queue
         self._pending_deletes = set()
         self._lock = asyncio.Lock()
+        self._groups = groups
 
     @locked()
     async def handle_event(self, ev: event.Event):
-        for sub_id, fltrs in self._sub_id_to_fltrs.items():
-            if fltrs and any(fltr.matches_event(ev) for fltr in fltrs):
+        for sub_id, compiled in self._sub_id_to_compiled.items():
+            if any(fltr.matches(ev) for fltr in compiled):
                 await self._response_queue.put(
                     relay_event.RelayEvent(sub_id, ev.__dict__).serialize()
                 )
 
+    @locked()
+    async def send_event(self, sub_ids: set[str], ev_json: str):
+        """Sends an event already matched to sub_ids by SubscriptionGroups"""
+        for sub_id in sub_ids:
+            # the subscription may have been closed while the event was matched
+            if sub_id in self._sub_id_to_fltrs:
+                await self._response_queue.put(
+                    relay_event.RelayEvent.serialize_raw(sub_id, ev_json)
+                )
+
     @locked()
     async def set_filters(self, sub_id: str, fltrs: list[event_filter.EventFilter]):
         if sub_id in self._pending_deletes:
@@ -90,6 +201,14 @@ class SubscriptionHandler:
                     f"Relay does not support more than {self._cfg.max_subscriptions} subscriptions."
                 )
 
+            if self._groups is not None:
+                if sub_id in self._sub_id_to_fltrs:
+                    self._groups.discard(self, sub_id, self._sub_id_to_fltrs[sub_id])
+                fltrs = self._groups.add(self, sub_id, fltrs)
+            else:
+                # compiled once here rather than for every event handled
+                self._sub_id_to_compiled[sub_id] = [fltr.compile() for fltr in fltrs]
+
             self._sub_id_to_fltrs[sub_id] = fltrs
 
     @locked()
@@ -97,4 +216,16 @@ class SubscriptionHandler:
         if sub_id not in self._sub_id_to_fltrs:
             self._pending_deletes.add(sub_id)
         else:
+            if self._groups is not None:
+                self._groups.discard(self, sub_id, self._sub_id_to_fltrs[sub_id])
             del self._sub_id_to_fltrs[sub_id]
+            self._sub_id_to_compiled.pop(sub_id, None)
+
+    @locked()
+    async def close(self):
+        """Drops every subscription, called when the connection goes away"""
+        if self._groups is not None:
+            for sub_id, fltrs in self._sub_id_to_fltrs.items():
+                self._groups.discard(self, sub_id, fltrs)
+        self._sub_id_to_fltrs = {}
+        self._sub_id_to_compiled = {}
@@ -0,0 +1,117 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import hashlib
+
+import pytest
+
+from ndk.relay import bloom_filter
+
+
+def ids(start: int, count: int) -> list[str]:
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(start, count)]
+
+
+def test_empty():
+    bloom = bloom_filter.ScalableBloomFilter()
+    assert len(bloom) == 0
+    assert "a" * 64 not in bloom
+
+
+def test_added_keys_are_always_found():
+    bloom = bloom_filter.ScalableBloomFilter(bloom_filter.BloomConfig(1000))
+    keys = ids(0, 10_000)
+    bloom.update(keys)
+
+    assert all(key in bloom for key in keys)
+
+
+def test_adding_twice_counts_once():
+    bloom = bloom_filter.ScalableBloomFilter()
+    bloom.add("a")
+    bloom.add("a")
+    assert len(bloom) == 1
+
+
+def test_false_positive_rate_stays_under_target_while_growing():
+    cfg = bloom_filter.BloomConfig(initial_capacity=1000, error_rate=0.01)
+    bloom = bloom_filter.ScalableBloomFilter(cfg)
+    bloom.update(ids(0, 20_000))
+
+    false_positives = sum(key in bloom for key in ids(20_000, 40_000))
+    assert false_positives / 20_000 < cfg.error_rate
+
+
+def test_grows_by_adding_layers():
+    bloom = bloom_filter.ScalableBloomFilter(bloom_filter.BloomConfig(1000))
+    before = bloom.size_bytes
+
+    bloom.update(ids(0, 500))
+    assert bloom.size_bytes == before
+
+    bloom.update(ids(500, 2000))
+    assert bloom.size_bytes > before
+
+
+def test_write_read(tmp_path):
+    path = str(tmp_path / "ids.bloom")
+    bloom = bloom_filter.ScalableBloomFilter(bloom_filter.BloomConfig(100))
+    keys = ids(0, 500)
+    bloom.update(keys)
+
+    bloom.write(path)
+    restored = bloom_filter.ScalableBloomFilter.read(path)
+
+    assert len(restored) == len(bloom)
+    assert restored.size_bytes == bloom.size_bytes
+    assert all(key in restored for key in keys)
+    assert sum(key in restored for key in ids(500, 1500)) == sum(
+        key in bloom for key in ids(500, 1500)
+    )
+
+
+def test_read_keeps_growing(tmp_path):
+    path = str(tmp_path / "ids.bloom")
+    bloom = bloom_filter.ScalableBloomFilter(bloom_filter.BloomConfig(100))
+    bloom.update(ids(0, 100))
+    bloom.write(path)
+
+    restored = bloom_filter.ScalableBloomFilter.read(path)
+    restored.update(ids(100, 1000))
+
+    assert all(key in restored for key in ids(0, 1000))
+
+
+def test_read_not_a_bloom_filter(tmp_path):
+    path = tmp_path / "ids.bloom"
+    path.write_bytes(b"NOTBLOOM" + bytes(100))
+
+    with pytest.raises(bloom_filter.BloomFilterError):
+        bloom_filter.ScalableBloomFilter.read(str(path))
+
+
+def test_read_truncated(tmp_path):
+    path = tmp_path / "ids.bloom"
+    bloom_filter.ScalableBloomFilter().write(str(path))
+    path.write_bytes(path.read_bytes()[:-1])
+
+    with pytest.raises(bloom_filter.BloomFilterError):
+        bloom_filter.ScalableBloomFilter.read(str(path))
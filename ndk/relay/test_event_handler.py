@@ -27,7 +27,7 @@ import pytest
 
 from ndk import exceptions
 from ndk.event import event, event_tags
-from ndk.relay import event_handler, event_notifier
+from ndk.relay import bloom_filter, event_handler, event_notifier
 from ndk.relay.event_repo import memory_event_repo
 
 
@@ -58,7 +58,17 @@ def mock_event(
     content="",
     tags=event_tags.EventTags(),
 ):
-    return mock.Mock(spec=typ, id="1", content=content, tags=tags)
+    ev = mock.Mock(
+        spec=typ,
+        id="1",
+        pubkey="1",
+        created_at=0,
+        kind=1000,
+        content=content,
+        tags=tags,
+    )
+    ev.get_expiration.return_value = None
+    return ev
 
 
 def test_init(repo, notifier, eh):
@@ -123,6 +133,7 @@ async def test_handle_replaceable_event_behavior(repo, notifier, eh):
         content="",
         tags=[],
     )
+    existing_ev.get_expiration.return_value = None
     await repo.add(existing_ev)
     repo.reset_mock()
 
@@ -135,6 +146,7 @@ async def test_handle_replaceable_event_behavior(repo, notifier, eh):
         content="",
         tags=[],
     )
+    newer_ev.get_expiration.return_value = None
     await eh.handle_event(newer_ev)
 
     repo.add.assert_called_once_with(newer_ev)
@@ -187,3 +199,100 @@ async def test_insert_callback_after_unregister(real_eh):
     await real_eh.handle_event(ev)
 
     cb.assert_not_called()
+
+
+def event_dict(keys, content="hello", tags=None) -> dict:
+    return dict(
+        event.RegularEvent.build(
+            keys, kind=1000, content=content, tags=event_tags.EventTags(tags or [])
+        ).__dict__
+    )
+
+
+async def test_ingest_accepts_valid_event(real_eh, keys):
+    fields = event_dict(keys)
+
+    ev = await real_eh.ingest(fields)
+
+    assert ev is not None and ev.id == fields["id"]
+    assert real_eh.stats.accepted == 1
+    assert not any(real_eh.stats.rejected.values())
+
+
+@pytest.mark.parametrize(
+    "fields, stage, error",
+    [
+        ({"content": "x" * 10000}, "size", exceptions.ValidationError),
+        ({"tags": [["t", "x"]] * 101}, "size", exceptions.ValidationError),
+        ({"pubkey": "not hex"}, "structure", ValueError),
+        ({"created_at": -5}, "structure", exceptions.ValidationError),
+        ({"created_at": 1.5}, "structure", exceptions.ValidationError),
+        ({"created_at": "1700000000"}, "structure", exceptions.ValidationError),
+        ({"created_at": True}, "structure", exceptions.ValidationError),
+        ({"kind": 7, "tags": []}, "kind", exceptions.ValidationError),
+        ({"content": "tampered"}, "signature", exceptions.ValidationError),
+    ],
+)
+async def test_ingest_counts_rejections_per_stage(real_eh, keys, fields, stage, error):
+    original = event.Event.verify
+    fields = event_dict(keys) | fields
+    with mock.patch.object(
+        event.Event, "verify", autospec=True, side_effect=original
+    ) as verify:
+        with pytest.raises(error):
+            await real_eh.ingest(fields)
+
+    assert real_eh.stats.rejected == dict(
+        dict.fromkeys(event_handler.STAGES, 0), **{stage: 1}
+    )
+    assert real_eh.stats.accepted == 0
+    # nothing is verified before the cheaper stages pass
+    assert verify.called == (stage == "signature")
+
+
+async def test_ingest_skips_verification_of_stored_events(real_eh, keys):
+    fields = event_dict(keys)
+    await real_eh.handle_event(await real_eh.ingest(fields))
+
+    with mock.patch.object(event.Event, "verify") as verify:
+        assert await real_eh.ingest(dict(fields)) is None
+
+    verify.assert_not_called()
+    assert real_eh.stats.rejected["duplicate"] == 1
+
+
+async def test_ingest_stats_can_be_shared(repo, notifier, keys):
+    stats = event_handler.IngestStats()
+    handlers = [event_handler.EventHandler(repo, notifier, stats=stats) for _ in "ab"]
+
+    for eh in handlers:
+        await eh.ingest(event_dict(keys, content=f"{id(eh)}"))
+
+    assert stats.accepted == 2
+
+
+async def test_ingest_skips_lookup_of_ids_not_in_bloom_filter(repo, notifier, keys):
+    stored_ids = bloom_filter.ScalableBloomFilter()
+    eh = event_handler.EventHandler(repo, notifier, stored_ids=stored_ids)
+    fields = event_dict(keys)
+
+    ev = await eh.ingest(fields)
+    repo.has_event.assert_not_awaited()
+    assert eh.stats.lookups_skipped == 1
+
+    await eh.handle_event(ev)
+    assert fields["id"] in stored_ids
+
+    assert await eh.ingest(dict(fields)) is None
+    repo.has_event.assert_awaited_once_with(fields["id"])
+    assert eh.stats.rejected["duplicate"] == 1
+
+
+async def test_ingest_confirms_bloom_filter_hits(repo, notifier, keys):
+    fields = event_dict(keys)
+    stored_ids = bloom_filter.ScalableBloomFilter()
+    stored_ids.add(fields["id"])  # false positive, never stored
+    eh = event_handler.EventHandler(repo, notifier, stored_ids=stored_ids)
+
+    assert await eh.ingest(fields) is not None
+    repo.has_event.assert_awaited_once_with(fields["id"])
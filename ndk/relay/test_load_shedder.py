@@ -0,0 +1,191 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import asyncio
+import time
+
+import pytest
+
+from ndk.relay import load_shedder
+
+Level = load_shedder.Level
+
+
+@pytest.fixture
+def shedder():
+    return load_shedder.LoadShedder(
+        load_shedder.SheddingConfig(
+            clamp_lag=0.1, reject_lag=0.2, defer_lag=0.4, decay=0.5, max_defer=0.05
+        )
+    )
+
+
+def test_disabled_by_default():
+    assert not load_shedder.SheddingConfig().enabled()
+    assert load_shedder.SheddingConfig(reject_lag=1).enabled()
+
+
+@pytest.mark.parametrize(
+    "lag,expected",
+    [
+        (0.0, Level.NORMAL),
+        (0.05, Level.NORMAL),
+        (0.1, Level.CLAMP_LIMITS),
+        (0.3, Level.REJECT_SUBSCRIPTIONS),
+        (1.0, Level.DEFER_EVENTS),
+    ],
+)
+def test_level_follows_lag(shedder, lag, expected):
+    shedder.observe(lag)
+
+    assert shedder.level == expected
+
+
+def test_unset_levels_are_skipped():
+    shedder = load_shedder.LoadShedder(load_shedder.SheddingConfig(reject_lag=0.1))
+
+    shedder.observe(10)
+
+    assert shedder.level == Level.REJECT_SUBSCRIPTIONS
+
+
+def test_recovers_gradually(shedder):
+    shedder.observe(1.0)
+    levels = []
+    for _ in range(5):
+        shedder.observe(0.0)
+        levels.append(shedder.level)
+
+    assert levels == [
+        Level.DEFER_EVENTS,
+        Level.REJECT_SUBSCRIPTIONS,
+        Level.CLAMP_LIMITS,
+        Level.NORMAL,
+        Level.NORMAL,
+    ]
+    assert shedder.stats.levels == {
+        "NORMAL": 2,
+        "CLAMP_LIMITS": 1,
+        "REJECT_SUBSCRIPTIONS": 1,
+        "DEFER_EVENTS": 2,
+    }
+
+
+def test_clamp_limit(shedder):
+    assert shedder.clamp_limit(None) is None
+    assert shedder.clamp_limit(5000) == 5000
+
+    shedder.observe(0.1)
+
+    assert shedder.clamp_limit(None) == 100
+    assert shedder.clamp_limit(5000) == 100
+    assert shedder.clamp_limit(10) == 10
+    assert shedder.stats.clamped == 2
+
+
+def test_accepts_subscriptions(shedder):
+    shedder.observe(0.1)
+    assert shedder.accepts_subscriptions()
+
+    shedder.observe(0.2)
+    assert not shedder.accepts_subscriptions()
+    assert shedder.stats.rejected == 1
+
+
+def test_should_defer_low_priority_kinds_only(shedder):
+    assert not shedder.should_defer(7)
+
+    shedder.observe(0.4)
+
+    assert shedder.should_defer(7)
+    assert not shedder.should_defer(1)
+
+
+async def test_defer_waits_for_recovery(shedder):
+    shedder.observe(0.4)
+    deferred = asyncio.create_task(shedder.defer())
+    await asyncio.sleep(0)
+    assert not deferred.done()
+
+    shedder.observe(0.0)
+
+    assert await asyncio.wait_for(deferred, 0.01)
+
+
+async def test_defer_gives_up_after_max_defer(shedder):
+    shedder.observe(0.4)
+
+    start = time.monotonic()
+    assert await shedder.defer()
+    assert time.monotonic() - start >= 0.05
+
+
+async def test_defer_rejects_past_max_deferred():
+    shedder = load_shedder.LoadShedder(
+        load_shedder.SheddingConfig(defer_lag=0.1, max_deferred=1, max_defer=1)
+    )
+    shedder.observe(0.1)
+    deferred = asyncio.create_task(shedder.defer())
+    await asyncio.sleep(0)
+
+    assert not await shedder.defer()
+    assert shedder.stats.dropped == 1
+
+    deferred.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await deferred
+
+
+def test_histogram():
+    hist = load_shedder.LagHistogram()
+    for lag in [0.0, 0.001, 0.002, 0.07, 10.0]:
+        hist.observe(lag)
+
+    assert hist.counts[:3] == [2, 1, 0]
+    assert hist.counts[-1] == 1
+    assert hist.samples == 5
+    assert hist.max == 10.0
+    assert hist.quantile(0.5) == 0.005
+    assert hist.quantile(0.8) == 0.1
+    assert hist.quantile(1.0) == float("inf")
+
+
+def test_histogram_without_samples():
+    hist = load_shedder.LagHistogram()
+
+    assert hist.quantile(0.5) == 0.0
+    assert hist.quantile(0.99) == 0.0
+
+
+async def test_monitor_measures_blocked_loop():
+    shedder = load_shedder.LoadShedder(
+        load_shedder.SheddingConfig(clamp_lag=0.02, sample_interval=0.001)
+    )
+    monitor = asyncio.create_task(load_shedder.LagMonitor(shedder).run())
+    await asyncio.sleep(0.005)
+
+    time.sleep(0.05)
+    await asyncio.sleep(0.005)
+    monitor.cancel()
+
+    assert shedder.stats.lag.max >= 0.04
+    assert shedder.stats.levels["CLAMP_LIMITS"] > 0
@@ -0,0 +1,127 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+
+import pytest
+from websockets import exceptions as websockets_exceptions
+
+from ndk.relay import memory_transport
+from ndk.repos.event_repo import protocol_handler
+
+
+async def test_pair_delivers_both_ways():
+    server, client = memory_transport.pair(("10.0.0.1", 1234))
+
+    await client.send("ping")
+    await server.send("pong")
+
+    assert await server.recv() == "ping"
+    assert await client.recv() == "pong"
+    assert server.remote_address == ("10.0.0.1", 1234)
+
+
+async def test_peer_close_delivers_pending_first():
+    server, client = memory_transport.pair()
+
+    await client.send("last words")
+    await client.close()
+
+    assert await server.recv() == "last words"
+    with pytest.raises(websockets_exceptions.ConnectionClosed):
+        await server.recv()
+    with pytest.raises(websockets_exceptions.ConnectionClosed):
+        await server.send("too late")
+
+
+async def test_close_wakes_waiting_recv():
+    server, _ = memory_transport.pair()
+    recv = asyncio.create_task(server.recv())
+    await asyncio.sleep(0)
+
+    await server.close()
+
+    with pytest.raises(websockets_exceptions.ConnectionClosed):
+        await recv
+    assert server.closed
+
+
+async def test_protocol_handlers_stop_on_close():
+    server, client = memory_transport.pair()
+    read_queue: asyncio.Queue[str] = asyncio.Queue()
+    write_queue: asyncio.Queue[str] = asyncio.Queue()
+    reader = asyncio.create_task(protocol_handler.read_handler(server, read_queue))
+    writer = asyncio.create_task(protocol_handler.write_handler(server, write_queue))
+
+    await client.send("in")
+    await write_queue.put("out")
+
+    assert await read_queue.get() == "in"
+    assert await client.recv() == "out"
+
+    await client.close()
+    await reader
+    await write_queue.put("dropped")
+    await writer
+
+
+async def echo(websocket):
+    while True:
+        try:
+            data = await websocket.recv()
+        except websockets_exceptions.ConnectionClosed:
+            return
+        await websocket.send(data)
+
+
+async def test_server_runs_handler_per_connection():
+    memory_server = memory_transport.MemoryServer(echo)
+    clients = [await memory_server.connect() for _ in range(3)]
+
+    for i, client in enumerate(clients):
+        await client.send(str(i))
+    assert [await client.recv() for client in clients] == ["0", "1", "2"]
+    assert memory_server.connections == 3
+
+    await clients[0].close()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert memory_server.connections == 2
+
+    await memory_server.close()
+    assert memory_server.connections == 0
+    with pytest.raises(websockets_exceptions.ConnectionClosed):
+        await clients[1].recv()
+
+
+async def test_server_gives_each_connection_an_address():
+    addresses = []
+
+    async def handler(websocket):
+        addresses.append(websocket.remote_address)
+
+    memory_server = memory_transport.MemoryServer(handler)
+    await memory_server.connect()
+    await memory_server.connect(("10.0.0.2", 80))
+    await memory_server.close()
+
+    assert addresses[1] == ("10.0.0.2", 80)
+    assert addresses[0] != addresses[1]
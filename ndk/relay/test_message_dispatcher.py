@@ -26,13 +26,25 @@ import mock
 import pytest
 
 from ndk import serialize
-from ndk.messages import close, eose, event_message, message_factory, notice, request
+from ndk.event import event
+from ndk.messages import (
+    close,
+    command_result,
+    count,
+    eose,
+    event_message,
+    message_factory,
+    notice,
+    request,
+)
 from ndk.relay import (
     auth_handler,
     event_handler,
     event_notifier,
     message_dispatcher,
     message_handler,
+    metrics,
+    rate_limiter,
     subscription_handler,
 )
 from ndk.relay.event_repo import memory_event_repo
@@ -105,6 +117,16 @@ async def test_handle_request_no_match(md):
     assert isinstance(response_msg, eose.EndOfStoredEvents)
 
 
+async def test_handle_count_no_match(md):
+    response = await md.process_message(count.CountRequest("1", [{}]).serialize())
+
+    assert len(response) == 1
+    response_msg = message_factory.from_str(response[0])
+
+    assert isinstance(response_msg, count.CountResponse)
+    assert response_msg.count == 0
+
+
 async def test_process_unauthenticated_ev():
     msg_handler = mock.AsyncMock()
     msg_handler.handle_event_message = mock.AsyncMock(
@@ -145,3 +167,74 @@ async def test_process_message_too_long_override():
 
     assert isinstance(response_msg, notice.Notice)
     assert "messages longer than" in response_msg.message
+
+
+@pytest.fixture
+def limited_md():
+    auth = auth_handler.AuthHandler("wss://unittests", allow_all=True)
+    sh = subscription_handler.SubscriptionHandler(asyncio.Queue())
+    repo = memory_event_repo.MemoryEventRepo()
+    eh = event_handler.EventHandler(repo, event_notifier.EventNotifier())
+    msg_handler = message_handler.MessageHandler(auth, repo, sh, eh)
+    limiter = rate_limiter.RateLimiter(
+        rate_limiter.RateLimitConfig(connection=rate_limiter.BucketConfig(1, 1))
+    )
+    return message_dispatcher.MessageDispatcher(
+        msg_handler, limiter=limiter.for_connection("1.2.3.4")
+    )
+
+
+async def test_rate_limited_event_gets_command_result(limited_md, keys):
+    evs = [event.RegularEvent.build(keys, kind=1000, content=str(i)) for i in "ab"]
+    await limited_md.process_message(event_message.Event.from_event(evs[0]).serialize())
+
+    with mock.patch.object(message_factory, "from_str") as from_str:
+        response = await limited_md.process_message(
+            event_message.Event.from_event(evs[1]).serialize()
+        )
+
+    from_str.assert_not_called()
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert response_msg.event_id == evs[1].id
+    assert not response_msg.accepted
+    assert response_msg.message.startswith("rate-limited:")
+
+
+async def test_rate_limited_req_gets_notice(limited_md):
+    await limited_md.process_message(request.Request("sub", [{}]).serialize())
+    response = await limited_md.process_message(
+        request.Request("sub", [{}]).serialize()
+    )
+
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, notice.Notice)
+    assert response_msg.message.startswith("rate-limited:")
+
+    response = await limited_md.process_message(close.Close("sub").serialize())
+    assert response == []
+
+
+async def test_messages_counted_by_type():
+    auth = auth_handler.AuthHandler("wss://unittests", allow_all=True)
+    sh = subscription_handler.SubscriptionHandler(asyncio.Queue())
+    repo = memory_event_repo.MemoryEventRepo()
+    eh = event_handler.EventHandler(repo, event_notifier.EventNotifier())
+    msg_handler = message_handler.MessageHandler(auth, repo, sh, eh)
+    relay_metrics = metrics.RelayMetrics(metrics.Registry())
+    md = message_dispatcher.MessageDispatcher(msg_handler, relay_metrics=relay_metrics)
+
+    await md.process_message(request.Request("sub", [{}]).serialize())
+    await md.process_message(close.Close("sub").serialize())
+    await md.process_message(close.Close("sub").serialize())
+    await md.process_message("{}")
+    await md.process_message('["REQ", "' + "x" * 16384 + '"]')
+
+    assert relay_metrics.messages()[("REQ",)] == 2
+    assert relay_metrics.messages()[("CLOSE",)] == 2
+    assert relay_metrics.messages()[("other",)] == 1
+    latency = relay_metrics.handler_latency
+    assert latency.series("REQ").samples == 1  # the long one was turned away
+    assert latency.series("CLOSE").samples == 2
+    # counted, but not timed, since it failed to parse
+    assert latency.series("other").samples == 0
@@ -20,6 +20,8 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 # pylint: disable=redefined-outer-name
 
+import asyncio
+
 import mock
 import pytest
 
@@ -29,6 +31,7 @@ from ndk.messages import (
     auth,
     close,
     command_result,
+    count,
     event_message,
     message_factory,
     notice,
@@ -37,6 +40,7 @@ from ndk.messages import (
 from ndk.relay import (
     event_handler,
     event_notifier,
+    load_shedder,
     message_handler,
     subscription_handler,
 )
@@ -86,9 +90,40 @@ async def test_event_validation_failure_returns_command_result_false(mh):
         assert not response_msg.accepted
 
 
+@pytest.mark.parametrize("created_at", [-5, 1.5, "1700000000"])
+async def test_unusable_created_at_is_invalid(mh, repo, keys, created_at):
+    fields = dict(event.RegularEvent.build(keys, kind=1000).__dict__)
+    fields["created_at"] = created_at
+
+    response = await mh.handle_event_message(event_message.Event(fields))
+
+    (response_msg,) = [message_factory.from_str(r) for r in response]
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert not response_msg.accepted
+    assert response_msg.message.startswith("invalid:")
+    assert not await repo.get([event_filter.EventFilter()])
+
+
+@pytest.mark.parametrize("event_dict", [{}, {"id": 5}])
+async def test_invalid_event_without_usable_id_gets_empty_id(mh, event_dict):
+    def raise_validation_error():
+        raise exceptions.ValidationError("Failed validation")
+
+    with mock.patch.object(
+        event_builder, "from_dict", lambda self, **kwargs: raise_validation_error()
+    ):
+        response = await mh.handle_event_message(event_message.Event(event_dict))
+
+    (response_msg,) = [message_factory.from_str(r) for r in response]
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert response_msg.event_id == ""
+    assert response_msg.message.startswith("invalid:")
+
+
 async def test_accepted_returns_command_result_true(mh):
     mocked = mock.MagicMock()
     mocked.id = "1"
+    mocked.created_at = 0
 
     with mock.patch.object(event_builder, "from_dict", lambda self, **kwargs: mocked):
         response = await mh.handle_event_message(event_message.Event({"id": "1"}))
@@ -103,6 +138,7 @@ async def test_accepted_returns_command_result_true(mh):
 async def test_accepted_calls_event_handler(mh, eh_mock):
     mocked = mock.MagicMock()
     mocked.id = "1"
+    mocked.created_at = 0
 
     with mock.patch.object(event_builder, "from_dict", lambda self, **kwargs: mocked):
         await mh.handle_event_message(event_message.Event({"id": "1"}))
@@ -138,7 +174,11 @@ async def test_new_req_overwrites_filter(mh, sh_mock):
 async def test_accepted_calls_subscription_handler(mh, eh_mock, sh_mock):
     await eh_mock.register_received_cb(sh_mock.handle_event)
     mocked = mock.AsyncMock(
-        spec=event.EphemeralEvent, id="1", content="", tags=event_tags.EventTags()
+        spec=event.EphemeralEvent,
+        id="1",
+        created_at=0,
+        content="",
+        tags=event_tags.EventTags(),
     )
     with mock.patch.object(event_builder, "from_dict", lambda self, **kwargs: mocked):
         response = await mh.handle_event_message(event_message.Event({"id": "1"}))
@@ -284,3 +324,169 @@ async def test_handle_req_config_exception_returns_notice(sh_mock, mh):
 
     assert isinstance(response_msg, notice.Notice)
     assert "test" in response_msg.message
+
+
+async def test_count_returns_count_without_subscribing(mh, repo, sh_mock, keys):
+    await repo.add(event.RegularEvent.build(keys, kind=1000))
+
+    response = await mh.handle_count(count.CountRequest("sub", [{"kinds": [1000]}]))
+
+    assert response == [count.CountResponse("sub", 1).serialize()]
+    sh_mock.set_filters.assert_not_called()
+
+
+async def test_count_too_many_filters(mh):
+    response = await mh.handle_count(
+        count.CountRequest("sub", [{} for _ in range(101)])
+    )
+
+    assert len(response) == 1
+    response_msg = message_factory.from_str(response[0])
+
+    assert isinstance(response_msg, notice.Notice)
+    assert "more than 100 filters" in response_msg.message
+
+
+async def test_duplicate_event_accepted_without_storing_again(mh, eh_mock, keys):
+    msg = event_message.Event.from_event(event.RegularEvent.build(keys, kind=1000))
+    await mh.handle_event_message(msg)
+    eh_mock.handle_event.reset_mock()
+
+    response = await mh.handle_event_message(msg)
+
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert response_msg.accepted
+    assert response_msg.message.startswith("duplicate:")
+    eh_mock.handle_event.assert_not_called()
+
+
+@pytest.fixture
+def shedder():
+    return load_shedder.LoadShedder(
+        load_shedder.SheddingConfig(
+            clamp_lag=0.1,
+            reject_lag=0.2,
+            defer_lag=0.3,
+            clamped_limit=2,
+            low_priority_kinds=[1000],
+            max_deferred=1,
+            max_defer=0.01,
+        )
+    )
+
+
+@pytest.fixture
+def shedding_mh(auth_hndlr, repo, sh_mock, eh_mock, shedder):
+    return message_handler.MessageHandler(
+        auth_hndlr,
+        repo,
+        sh_mock,
+        eh_mock,
+        message_handler.MessageHandlerConfig(),
+        shedder=shedder,
+    )
+
+
+async def test_busy_relay_clamps_req_limits(shedding_mh, sh_mock, shedder, repo, keys):
+    for i in range(3):
+        await repo.add(event.RegularEvent.build(keys, kind=1000, content=str(i)))
+    shedder.observe(0.1)
+
+    response = await shedding_mh.handle_request(request.Request("sub", [{}]))
+
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, notice.Notice)
+    assert "limits reduced to 2" in response_msg.message
+    assert len(response) == 4  # notice, 2 events and EOSE
+    # only the stored events are clamped, the subscription keeps the REQ's filters
+    sh_mock.set_filters.assert_called_once_with("sub", [event_filter.EventFilter()])
+
+
+async def test_busy_relay_keeps_smaller_limits(shedding_mh, shedder):
+    shedder.observe(0.1)
+
+    response = await shedding_mh.handle_request(request.Request("sub", [{"limit": 1}]))
+
+    assert not isinstance(message_factory.from_str(response[0]), notice.Notice)
+
+
+async def test_overloaded_relay_rejects_subscriptions(shedding_mh, sh_mock, shedder):
+    shedder.observe(0.2)
+
+    response = await shedding_mh.handle_request(request.Request("sub", [{}]))
+
+    assert len(response) == 1
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, notice.Notice)
+    assert "not accepting new subscriptions" in response_msg.message
+    sh_mock.set_filters.assert_not_called()
+    assert shedder.stats.rejected == 1
+
+
+async def test_overloaded_relay_defers_low_priority_events(
+    shedding_mh, eh_mock, shedder, keys
+):
+    shedder.observe(0.3)
+    ev = event.RegularEvent.build(keys, kind=1000)
+
+    response = await shedding_mh.handle_event_message(
+        event_message.Event.from_event(ev)
+    )
+
+    assert isinstance(message_factory.from_str(response[0]), notice.Notice)
+    response_msg = message_factory.from_str(response[1])
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert response_msg.accepted
+    eh_mock.handle_event.assert_called_once()
+    assert shedder.stats.deferred == 1
+
+
+async def test_overloaded_relay_rejects_events_past_max_deferred(
+    shedding_mh, eh_mock, shedder, keys
+):
+    shedder.observe(0.3)
+    msgs = [
+        event_message.Event.from_event(
+            event.RegularEvent.build(keys, kind=1000, content=str(i))
+        )
+        for i in range(2)
+    ]
+
+    _, response = await asyncio.gather(
+        *(shedding_mh.handle_event_message(msg) for msg in msgs)
+    )
+
+    assert len(response) == 1
+    response_msg = message_factory.from_str(response[0])
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert not response_msg.accepted
+    assert response_msg.message.startswith("rate-limited:")
+    eh_mock.handle_event.assert_called_once()
+    assert shedder.stats.dropped == 1
+
+
+async def test_overloaded_relay_rejects_events_without_id(shedding_mh, shedder, keys):
+    shedder.observe(0.3)
+    first = event_message.Event.from_event(event.RegularEvent.build(keys, kind=1000))
+
+    _, response = await asyncio.gather(
+        shedding_mh.handle_event_message(first),
+        shedding_mh.handle_event_message(event_message.Event({"kind": 1000})),
+    )
+
+    (response_msg,) = [message_factory.from_str(r) for r in response]
+    assert isinstance(response_msg, command_result.CommandResult)
+    assert response_msg.event_id == ""
+    assert response_msg.message.startswith("rate-limited:")
+
+
+async def test_overloaded_relay_does_not_defer_other_kinds(shedding_mh, shedder, keys):
+    shedder.observe(0.3)
+
+    response = await shedding_mh.handle_event_message(
+        event_message.Event.from_event(event.RegularEvent.build(keys, kind=1))
+    )
+
+    assert len(response) == 1
+    assert shedder.stats.deferred == 0
@@ -0,0 +1,136 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import pytest
+
+from ndk.relay import metrics
+
+
+def test_counter():
+    counter = metrics.Counter("msgs_total", "Messages", ("type",))
+    counter.inc("REQ")
+    counter.inc("EVENT", amount=2)
+    counter.inc("EVENT")
+
+    assert counter.value("EVENT") == 3
+    assert counter.render() == [
+        "# HELP msgs_total Messages",
+        "# TYPE msgs_total counter",
+        'msgs_total{type="EVENT"} 3',
+        'msgs_total{type="REQ"} 1',
+    ]
+
+
+def test_unlabeled_counter():
+    counter = metrics.Counter("errors_total", "Errors")
+    counter.inc(amount=0.5)
+
+    assert counter.render()[-1] == "errors_total 0.5"
+
+
+def test_label_values_escaped():
+    counter = metrics.Counter("c", "help", ("v",))
+    counter.inc('a"b\\')
+
+    assert counter.render()[-1] == 'c{v="a\\"b\\\\"} 1'
+
+
+def test_histogram():
+    hist = metrics.Histogram("latency_seconds", "Latency", ("op",), (0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 3.0]:
+        hist.observe(value, "get")
+
+    assert hist.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{op="get",le="0.1"} 2',
+        'latency_seconds_bucket{op="get",le="1"} 3',
+        'latency_seconds_bucket{op="get",le="+Inf"} 4',
+        'latency_seconds_sum{op="get"} 3.65',
+        'latency_seconds_count{op="get"} 4',
+    ]
+
+
+def test_histogram_time():
+    hist = metrics.Histogram("t", "help")
+
+    with hist.time():
+        pass
+
+    assert hist.series().samples == 1
+    assert hist.series().total < 0.1
+
+
+def test_callback():
+    values = {("a",): 1, ("b",): 2}
+    cb = metrics.Callback("g", "help", lambda: values, ("k",))
+
+    assert cb.render()[2:] == ['g{k="a"} 1', 'g{k="b"} 2']
+
+    values[("a",)] = 5
+    assert cb.render()[2] == 'g{k="a"} 5'
+
+
+def test_histogram_callback():
+    series = metrics.HistogramSeries((1.0,))
+    series.observe(2.0)
+    cb = metrics.HistogramCallback("h", "help", lambda: series)
+
+    assert cb.render()[2:] == [
+        'h_bucket{le="1"} 0',
+        'h_bucket{le="+Inf"} 1',
+        "h_sum 2",
+        "h_count 1",
+    ]
+
+
+def test_registry_renders_all_metrics():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter("a_total", "A")).inc()
+    registry.register(metrics.Callback("b", "B", lambda: 7))
+
+    assert registry.render() == (
+        "# HELP a_total A\n"
+        "# TYPE a_total counter\n"
+        "a_total 1\n"
+        "# HELP b B\n"
+        "# TYPE b gauge\n"
+        "b 7\n"
+    )
+
+
+def test_registry_rejects_duplicate_names():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter("a_total", "A"))
+
+    with pytest.raises(ValueError):
+        registry.register(metrics.Counter("a_total", "A"))
+
+
+def test_unknown_message_types_share_a_series():
+    relay_metrics = metrics.RelayMetrics(metrics.Registry())
+    for msg_type in ["EVENT", "FOO", None]:
+        relay_metrics.count_message(msg_type)
+    relay_metrics.observe_message(None, 0.1)
+
+    assert relay_metrics.messages()[("EVENT",)] == 1
+    assert relay_metrics.messages()[("other",)] == 3
+    assert relay_metrics.handler_latency.series("other").samples == 1
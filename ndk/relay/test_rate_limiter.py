@@ -0,0 +1,190 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import pytest
+
+from ndk.relay import rate_limiter
+
+EVENT = '["EVENT", {}]'
+REQ = '["REQ", "sub", {}]'
+CLOSE = '["CLOSE", "sub"]'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def limiter_with(clock, connection=None, ip=None, pubkey=None):
+    def bucket(spec):
+        return rate_limiter.BucketConfig(*spec) if spec else None
+
+    return rate_limiter.RateLimiter(
+        rate_limiter.RateLimitConfig(
+            connection=bucket(connection),
+            ip=bucket(ip),
+            pubkey=bucket(pubkey),
+            costs={"EVENT": 1.0, "REQ": 2.0},
+        ),
+        clock,
+    )
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    [
+        (EVENT, "EVENT"),
+        (' [ "REQ", "sub"]', "REQ"),
+        ('["COUNT"]', "COUNT"),
+        ("{}", None),
+        ("not json", None),
+    ],
+)
+def test_message_type(data, expected):
+    assert rate_limiter.message_type(data) == expected
+
+
+def test_disabled_by_default():
+    assert not rate_limiter.RateLimitConfig().enabled()
+
+
+def test_connection_burst_then_limited(clock):
+    limiter = limiter_with(clock, connection=(1, 3))
+    conn = limiter.for_connection("1.2.3.4")
+
+    assert [conn.admit(EVENT) for _ in range(4)] == [None, None, None, "connection"]
+
+
+def test_refills_at_rate(clock):
+    limiter = limiter_with(clock, connection=(2, 2))
+    conn = limiter.for_connection("1.2.3.4")
+    assert conn.admit(EVENT) is None
+    assert conn.admit(EVENT) is None
+    assert conn.admit(EVENT) == "connection"
+
+    clock.now += 0.5
+    assert conn.admit(EVENT) is None
+    assert conn.admit(EVENT) == "connection"
+
+    clock.now += 100  # never more than the burst
+    assert [conn.admit(EVENT) for _ in range(3)] == [None, None, "connection"]
+
+
+def test_costs_per_message_type(clock):
+    limiter = limiter_with(clock, connection=(1, 3))
+    conn = limiter.for_connection("1.2.3.4")
+
+    assert conn.admit(REQ) is None
+    assert conn.admit(REQ) == "connection"
+    assert conn.admit(EVENT) is None
+    # free messages are never limited
+    assert all(conn.admit(CLOSE) is None for _ in range(10))
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        '["\\u0045VENT",{}]',
+        '["\\u0052EQ","s",{}]',
+        '["EV\\u0045NT",{}]',
+        "garbage",
+    ],
+)
+def test_unreadable_types_cost_the_most(clock, data):
+    limiter = limiter_with(clock, connection=(1, 3))
+    conn = limiter.for_connection("1.2.3.4")
+
+    assert rate_limiter.message_type(data) is None
+    # charged as a REQ, the dearest type
+    assert [conn.admit(data) for _ in range(2)] == [None, "connection"]
+    assert conn.admit(EVENT) is None
+    assert limiter.stats.by_type == {"other": 1}
+
+
+def test_ip_bucket_shared_by_connections(clock):
+    limiter = limiter_with(clock, connection=(1, 10), ip=(1, 2))
+    conns = [limiter.for_connection("1.2.3.4") for _ in range(3)]
+    other = limiter.for_connection("5.6.7.8")
+
+    assert [conn.admit(EVENT) for conn in conns] == [None, None, "ip"]
+    assert other.admit(EVENT) is None
+
+
+def test_pubkey_bucket_after_auth(clock):
+    limiter = limiter_with(clock, pubkey=(1, 1))
+    pubkey = None
+    conns = [limiter.for_connection(ip, lambda: pubkey) for ip in ["a", "b"]]
+
+    assert all(conn.admit(EVENT) is None for conn in conns)
+
+    pubkey = "pk"
+    assert conns[0].admit(EVENT) is None
+    assert conns[1].admit(EVENT) == "pubkey"
+
+
+def test_limited_message_charges_no_bucket(clock):
+    limiter = limiter_with(clock, connection=(1, 2), ip=(1, 1))
+    first = limiter.for_connection("1.2.3.4")
+    second = limiter.for_connection("1.2.3.4")
+
+    assert first.admit(EVENT) is None
+    assert second.admit(EVENT) == "ip"
+    assert second.admit(EVENT) == "ip"
+
+    clock.now += 1
+    # the second connection's own bucket was never charged
+    assert second.admit(EVENT) is None
+
+
+def test_stats(clock):
+    limiter = limiter_with(clock, connection=(1, 2), ip=(1, 3))
+    conn = limiter.for_connection("1.2.3.4")
+    for _ in range(3):
+        conn.admit(EVENT)
+    for _ in range(2):
+        limiter.for_connection("1.2.3.4").admit(REQ)
+
+    assert limiter.stats.by_type == {"EVENT": 1, "REQ": 2}
+    assert limiter.stats.by_scope == {"connection": 1, "ip": 2, "pubkey": 0}
+    assert limiter.stats.limited == 3
+
+
+def test_quiet_buckets_are_pruned(clock):
+    limiter = limiter_with(clock, ip=(1, 2))
+    limiter.for_connection("a").admit(EVENT)
+    limiter.for_connection("b").admit(EVENT)
+    assert limiter.tracked() == 2
+
+    clock.now += 30
+    limiter.for_connection("c").admit(EVENT)
+    clock.now += 30
+    limiter.for_connection("c").admit(EVENT)
+
+    assert limiter.tracked() == 1
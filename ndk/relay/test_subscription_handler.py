@@ -24,8 +24,10 @@ import asyncio
 import mock
 import pytest
 
-from ndk.event import metadata_event
-from ndk.relay import subscription_handler
+from ndk import crypto
+from ndk.event import event, event_filter, metadata_event
+from ndk.messages import relay_event
+from ndk.relay import metrics, subscription_handler
 
 
 def test_init():
@@ -38,7 +40,7 @@ async def test_clear_before_set_no_output():
     await sh.clear_filters("subid")
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = False
+    fltr.compile.return_value.matches.return_value = False
     await sh.set_filters("subid", [fltr])
 
     ev = mock.MagicMock()
@@ -60,7 +62,7 @@ async def test_no_output_with_wrong_filter():
     sh = subscription_handler.SubscriptionHandler(q)
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = False
+    fltr.compile.return_value.matches.return_value = False
     await sh.set_filters("subid", [fltr])
 
     ev = mock.MagicMock()
@@ -73,11 +75,11 @@ async def test_output_with_matching_filter(keys):
     sh = subscription_handler.SubscriptionHandler(q)
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = True
+    fltr.compile.return_value.matches.return_value = True
     await sh.set_filters("subid", [fltr])
 
-    event = metadata_event.MetadataEvent.from_metadata_parts(keys=keys)
-    await sh.handle_event(event)
+    ev = metadata_event.MetadataEvent.from_metadata_parts(keys=keys)
+    await sh.handle_event(ev)
     assert not q.empty()
 
 
@@ -86,12 +88,12 @@ async def test_two_output_with_two_matching_filter(keys):
     sh = subscription_handler.SubscriptionHandler(q)
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = True
+    fltr.compile.return_value.matches.return_value = True
     await sh.set_filters("subid", [fltr])
     await sh.set_filters("subid2", [fltr])
 
-    event = metadata_event.MetadataEvent.from_metadata_parts(keys=keys)
-    await sh.handle_event(event)
+    ev = metadata_event.MetadataEvent.from_metadata_parts(keys=keys)
+    await sh.handle_event(ev)
     assert q.qsize() == 2
 
 
@@ -100,11 +102,11 @@ async def test_output_with_filter_overwrite():
     sh = subscription_handler.SubscriptionHandler(q)
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = True
+    fltr.compile.return_value.matches.return_value = True
     await sh.set_filters("subid", [fltr])
 
     fltr2 = mock.MagicMock()
-    fltr2.matches_event.return_value = False
+    fltr2.compile.return_value.matches.return_value = False
     await sh.set_filters("subid", [fltr2])
 
     ev = mock.MagicMock()
@@ -117,7 +119,7 @@ async def test_no_output_with_matching_filter_after_clear():
     sh = subscription_handler.SubscriptionHandler(q)
 
     fltr = mock.MagicMock()
-    fltr.matches_event.return_value = True
+    fltr.compile.return_value.matches.return_value = True
     await sh.set_filters("subid", [fltr])
     await sh.clear_filters(
         "subid",
@@ -128,6 +130,22 @@ async def test_no_output_with_matching_filter_after_clear():
     assert q.empty()
 
 
+async def test_filters_are_compiled_once_per_subscription(keys):
+    q = asyncio.Queue()
+    sh = subscription_handler.SubscriptionHandler(q)
+    await sh.set_filters("subid", [event_filter.EventFilter(authors=[keys.public])])
+
+    ev = metadata_event.MetadataEvent.from_metadata_parts(keys=keys)
+    with mock.patch.object(
+        event_filter.EventFilter, "compile", autospec=True
+    ) as compile_filter:
+        for _ in range(3):
+            await sh.handle_event(ev)
+
+    assert compile_filter.call_count == 0
+    assert q.qsize() == 3
+
+
 async def test_more_than_max_subs_default():
     q = asyncio.Queue()
     sh = subscription_handler.SubscriptionHandler(q)
@@ -167,3 +185,98 @@ async def test_subid_too_long_override():
     fltr = mock.MagicMock()
     with pytest.raises(subscription_handler.ConfigLimitsExceeded):
         await sh.set_filters("aa", [fltr])
+
+
+async def test_groups_match_each_distinct_filter_once(keys):
+    groups = subscription_handler.SubscriptionGroups()
+    queues = [asyncio.Queue() for _ in range(3)]
+    handlers = [
+        subscription_handler.SubscriptionHandler(q, groups=groups) for q in queues
+    ]
+    for i, sh in enumerate(handlers):
+        # same filter with its values in a different order on every connection
+        kinds = [0, 1] if i % 2 else [1, 0]
+        await sh.set_filters("sub", [event_filter.EventFilter(kinds=kinds)])
+    assert len(groups) == 1
+
+    ev = metadata_event.MetadataEvent.from_metadata_parts(keys)
+    with mock.patch.object(
+        event_filter.CompiledFilter,
+        "matches",
+        autospec=True,
+        side_effect=event_filter.CompiledFilter.matches,
+    ) as matches:
+        await groups.handle_event(ev)
+
+    assert matches.call_count == 1
+    expected = relay_event.RelayEvent("sub", ev.__dict__).serialize()
+    assert [q.get_nowait() for q in queues] == [expected] * 3
+
+
+async def test_groups_share_filters_that_differ_only_in_limit(keys):
+    groups = subscription_handler.SubscriptionGroups()
+    q = asyncio.Queue()
+    sh = subscription_handler.SubscriptionHandler(q, groups=groups)
+    await sh.set_filters("a", [event_filter.EventFilter(kinds=[0], limit=10)])
+    await sh.set_filters("b", [event_filter.EventFilter(kinds=[0], limit=500)])
+    await sh.set_filters("c", [event_filter.EventFilter(kinds=[0])])
+    assert len(groups) == 1
+
+    await sh.clear_filters("a")
+    await groups.handle_event(metadata_event.MetadataEvent.from_metadata_parts(keys))
+    assert q.qsize() == 2
+
+    await sh.close()
+    assert len(groups) == 0
+
+
+async def test_groups_send_once_per_subscription(keys):
+    groups = subscription_handler.SubscriptionGroups()
+    q = asyncio.Queue()
+    sh = subscription_handler.SubscriptionHandler(q, groups=groups)
+    await sh.set_filters(
+        "sub",
+        [
+            event_filter.EventFilter(kinds=[0]),
+            event_filter.EventFilter(authors=[keys.public]),
+        ],
+    )
+
+    await groups.handle_event(metadata_event.MetadataEvent.from_metadata_parts(keys))
+
+    assert q.qsize() == 1
+
+
+async def test_groups_forget_cleared_and_replaced_subscriptions(keys):
+    groups = subscription_handler.SubscriptionGroups()
+    q = asyncio.Queue()
+    sh = subscription_handler.SubscriptionHandler(q, groups=groups)
+    await sh.set_filters("a", [event_filter.EventFilter(kinds=[0])])
+    await sh.set_filters("a", [event_filter.EventFilter(kinds=[1])])
+    await sh.set_filters("b", [event_filter.EventFilter(kinds=[1])])
+    assert len(groups) == 1
+    assert groups.subscriber_count() == 2
+
+    await sh.clear_filters("a")
+    assert groups.subscriber_count() == 1
+
+    await sh.close()
+    assert len(groups) == 0
+
+    await groups.handle_event(metadata_event.MetadataEvent.from_metadata_parts(keys))
+    assert q.empty()
+
+
+async def test_groups_record_fanout(keys):
+    fanout = metrics.Histogram("fanout", "test", buckets=metrics.FANOUT_BUCKETS)
+    groups = subscription_handler.SubscriptionGroups(fanout)
+    for _ in range(2):
+        sh = subscription_handler.SubscriptionHandler(asyncio.Queue(), groups=groups)
+        await sh.set_filters("a", [event_filter.EventFilter(kinds=[0])])
+        await sh.set_filters("b", [event_filter.EventFilter(authors=[keys.public])])
+
+    await groups.handle_event(metadata_event.MetadataEvent.from_metadata_parts(keys))
+    await groups.handle_event(event.RegularEvent.build(crypto.KeyPair(), kind=1000))
+
+    assert fanout.series().samples == 2
+    assert fanout.series().total == 2
@@ -0,0 +1,252 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name
+
+import asyncio
+import json
+import threading
+
+import mock
+import pytest
+
+from ndk.event import event
+from ndk.messages import event_message, request
+from ndk.relay import (
+    auth_handler,
+    event_handler,
+    event_notifier,
+    message_dispatcher,
+    message_handler,
+    subscription_handler,
+    tracing,
+)
+from ndk.relay.event_repo import memory_event_repo
+
+
+async def test_cancelled_export_still_writes_before_the_next(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = tracing.Tracer(tracing.TracingConfig(sample_rate=1.0, path=str(path)))
+    exporter = tracing.TraceExporter(tracer)
+    writing, release = threading.Event(), threading.Event()
+    append = tracing._append_lines  # pylint: disable=protected-access
+
+    def slow_append(p, traces):
+        writing.set()
+        release.wait(timeout=5)
+        append(p, traces)
+
+    with mock.patch.object(tracing, "_append_lines", slow_append):
+        with tracer.trace():
+            tracing.mark("parse")
+        # as run() is cancelled at shutdown, in the middle of a write
+        export = asyncio.create_task(exporter.export())
+        while not writing.is_set():
+            await asyncio.sleep(0.001)
+        export.cancel()
+        with tracer.trace():
+            tracing.mark("query")
+        final = asyncio.create_task(exporter.export())
+        await asyncio.sleep(0.05)
+        overlapped = final.done()
+        release.set()
+        await final
+
+    assert not overlapped
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [list(json.loads(line)["stages"]) for line in lines] == [
+        ["parse"],
+        ["query"],
+    ]
+
+
+@pytest.fixture
+def tracer():
+    return tracing.Tracer(tracing.TracingConfig(sample_rate=1.0, capacity=4))
+
+
+def build_dispatcher(tracer=None):
+    auth = auth_handler.AuthHandler("wss://unittests", allow_all=True)
+    sh = subscription_handler.SubscriptionHandler(asyncio.Queue())
+    repo = memory_event_repo.MemoryEventRepo()
+    eh = event_handler.EventHandler(repo, event_notifier.EventNotifier())
+    msg_handler = message_handler.MessageHandler(auth, repo, sh, eh)
+    return message_dispatcher.MessageDispatcher(msg_handler, tracer=tracer)
+
+
+@pytest.fixture
+def md(tracer):
+    return build_dispatcher(tracer)
+
+
+async def handle(md, data: str):
+    with md.trace():
+        await md.process_message(data)
+        tracing.mark("enqueue")
+
+
+def test_disabled_by_default():
+    assert not tracing.TracingConfig().enabled()
+    assert tracing.TracingConfig(sample_rate=0.01).enabled()
+
+
+def test_mark_without_trace():
+    tracing.mark("parse")
+
+    assert tracing.current() is None
+
+
+def test_untraced_without_tracer():
+    with build_dispatcher().trace():
+        assert tracing.current() is None
+
+
+def test_unsampled():
+    tracer = tracing.Tracer(tracing.TracingConfig(sample_rate=0.0))
+
+    with tracer.trace():
+        tracing.mark("parse")
+
+    assert not tracer.drain()
+    assert tracer.stats.sampled == 0
+
+
+def test_capacity_validated():
+    with pytest.raises(ValueError):
+        tracing.Tracer(tracing.TracingConfig(capacity=0))
+
+
+async def test_event_stages(md, tracer, keys):
+    ev = event.RegularEvent.build(keys, kind=1, content="hi")
+
+    await handle(md, event_message.Event.from_event(ev).serialize())
+
+    (trace,) = tracer.drain()
+    assert trace["type"] == "EVENT"
+    assert list(trace["stages"]) == [
+        "parse",
+        "validate",
+        "persist",
+        "fanout",
+        "enqueue",
+    ]
+    assert trace["total_us"] == pytest.approx(sum(trace["stages"].values()))
+
+
+async def test_duplicate_event_stages(md, tracer, keys):
+    data = event_message.Event.from_event(
+        event.RegularEvent.build(keys, kind=1)
+    ).serialize()
+    await handle(md, data)
+    tracer.drain()
+
+    await handle(md, data)
+
+    (trace,) = tracer.drain()
+    assert list(trace["stages"]) == ["parse", "validate", "enqueue"]
+
+
+async def test_request_stages(md, tracer):
+    await handle(md, request.Request("sub", [{}]).serialize())
+
+    (trace,) = tracer.drain()
+    assert trace["type"] == "REQ"
+    assert list(trace["stages"]) == ["parse", "query", "serialize", "enqueue"]
+
+
+async def test_context_restored(tracer):
+    with tracer.trace():
+        assert tracing.current() is not None
+
+    assert tracing.current() is None
+
+
+async def test_concurrent_traces_kept_apart(tracer):
+    async def traced(stage: str):
+        with tracer.trace():
+            await asyncio.sleep(0)
+            tracing.mark(stage)
+
+    await asyncio.gather(traced("a"), traced("b"))
+
+    assert sorted(list(trace["stages"]) for trace in tracer.drain()) == [["a"], ["b"]]
+
+
+def test_in_flight_slot_not_reused(tracer):
+    with tracer.trace():
+        in_flight = tracing.current()
+        for _ in range(tracer.cfg.capacity - 1):
+            with tracer.trace():
+                pass
+
+        # wraps around to the slot still in use
+        with tracer.trace():
+            assert tracing.current() is in_flight
+
+    assert len(tracer.drain()) == tracer.cfg.capacity
+    assert tracer.stats.dropped == 1
+
+
+def test_oldest_overwritten(tracer):
+    for stage in "abcde":
+        with tracer.trace():
+            tracing.mark(stage)
+
+    traces = tracer.drain()
+
+    assert [list(trace["stages"]) for trace in traces] == [["b"], ["c"], ["d"], ["e"]]
+    assert tracer.stats.dropped == 1
+    assert tracer.stats.exported == 4
+
+
+def test_marks_capped(tracer):
+    with tracer.trace():
+        for i in range(tracing.MAX_STAGES + 1):
+            tracing.mark(str(i))
+
+    (trace,) = tracer.drain()
+    assert len(trace["stages"]) == tracing.MAX_STAGES
+
+
+def test_repeated_stage_summed(tracer):
+    with tracer.trace():
+        tracing.mark("query")
+        tracing.mark("query")
+
+    (trace,) = tracer.drain()
+    assert list(trace["stages"]) == ["query"]
+    assert trace["stages"]["query"] == pytest.approx(trace["total_us"])
+
+
+async def test_exporter_appends_jsonl(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = tracing.Tracer(tracing.TracingConfig(sample_rate=1.0, path=str(path)))
+    exporter = tracing.TraceExporter(tracer)
+    for stage in ["parse", "query"]:
+        with tracer.trace():
+            tracing.mark(stage)
+        assert await exporter.export() == 1
+
+    assert await exporter.export() == 0
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert [list(json.loads(line)["stages"]) for line in lines] == [
+        ["parse"],
+        ["query"],
+    ]
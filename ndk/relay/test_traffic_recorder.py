@@ -0,0 +1,140 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import gzip
+import threading
+
+import mock
+
+from ndk.relay import memory_transport, traffic_recorder
+
+
+def test_records_connection_lifetime():
+    recorder = traffic_recorder.TrafficRecorder(traffic_recorder.RecorderConfig())
+
+    conn = recorder.open()
+    recorder.record(conn, '["REQ","sub",{}]')
+    recorder.record(conn, b'["CLOSE","sub"]')
+    recorder.close(conn)
+
+    records = recorder.drain()
+    assert [{k: v for k, v in r.items() if k != "t"} for r in records] == [
+        {"conn": conn, "event": "open"},
+        {"conn": conn, "frame": '["REQ","sub",{}]'},
+        {"conn": conn, "frame": '["CLOSE","sub"]'},
+        {"conn": conn, "event": "close"},
+    ]
+    times = [r["t"] for r in records]
+    assert times == sorted(times)
+    assert not recorder.drain()
+
+
+def test_connections_get_their_own_ids():
+    recorder = traffic_recorder.TrafficRecorder(traffic_recorder.RecorderConfig())
+
+    assert recorder.open() != recorder.open()
+    assert recorder.stats.connections == 2
+
+
+def test_full_buffer_drops():
+    recorder = traffic_recorder.TrafficRecorder(
+        traffic_recorder.RecorderConfig(max_buffered=2)
+    )
+    conn = recorder.open()
+
+    recorder.record(conn, "a")
+    recorder.record(conn, "b")
+
+    assert len(recorder.drain()) == 2
+    assert recorder.stats.frames == 2
+    assert recorder.stats.dropped == 1
+
+
+async def test_wrapped_websocket_records_received():
+    recorder = traffic_recorder.TrafficRecorder(traffic_recorder.RecorderConfig())
+    server, client = memory_transport.pair(("10.0.0.1", 1234))
+    recorded = recorder.wrap(server)
+
+    await client.send("in")
+    assert await recorded.recv() == "in"
+    await recorded.send("out")
+    assert await client.recv() == "out"
+    recorded.record_close()
+
+    assert recorded.remote_address == ("10.0.0.1", 1234)
+    records = recorder.drain()
+    assert [r.get("frame", r.get("event")) for r in records] == ["open", "in", "close"]
+    assert {r["conn"] for r in records} == {recorded.conn}
+
+
+async def test_writer_appends(tmp_path):
+    path = str(tmp_path / "traffic.jsonl.gz")
+    recorder = traffic_recorder.TrafficRecorder(
+        traffic_recorder.RecorderConfig(path=path)
+    )
+    writer = traffic_recorder.RecorderWriter(recorder)
+    conn = recorder.open()
+
+    assert await writer.flush() == 1
+    recorder.record(conn, "frame")
+    assert await writer.flush() == 1
+    assert await writer.flush() == 0
+
+    records = list(traffic_recorder.read(path))
+    assert [r.get("frame", r.get("event")) for r in records] == ["open", "frame"]
+    assert recorder.stats.written == 2
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+
+
+async def test_cancelled_flush_still_writes_before_the_next(tmp_path):
+    path = str(tmp_path / "traffic.jsonl.gz")
+    recorder = traffic_recorder.TrafficRecorder(
+        traffic_recorder.RecorderConfig(path=path)
+    )
+    writer = traffic_recorder.RecorderWriter(recorder)
+    conn = recorder.open()
+    writing, release = threading.Event(), threading.Event()
+    append = traffic_recorder._append  # pylint: disable=protected-access
+
+    def slow_append(p, records):
+        writing.set()
+        release.wait(timeout=5)
+        append(p, records)
+
+    with mock.patch.object(traffic_recorder, "_append", slow_append):
+        # as run() is cancelled at shutdown, in the middle of a write
+        flush = asyncio.create_task(writer.flush())
+        while not writing.is_set():
+            await asyncio.sleep(0.001)
+        flush.cancel()
+        recorder.close(conn)
+        final = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0.05)
+        overlapped = final.done()
+        release.set()
+        await final
+
+    assert not overlapped
+    records = list(traffic_recorder.read(path))
+    assert [r["event"] for r in records] == ["open", "close"]
+    assert recorder.stats.written == 2
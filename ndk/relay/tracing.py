@@ -0,0 +1,259 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Per-message stage timings, for diagnosing tail latency
+
+A Tracer begins a Trace for a sampled fraction of messages, and each layer
+that handles the message marks the end of its stage with mark():
+
+    EVENT: parse, validate, persist, fanout, enqueue
+    REQ: parse, query, serialize, enqueue
+
+The trace being recorded is found through a ContextVar, since the relay
+handles every message in a task of its own, so it isn't passed between
+layers. Without a Tracer, or for a message that isn't sampled, mark() is one
+lookup that finds nothing.
+
+Traces are recorded into a ring of slots allocated up front and written out
+as JSON lines by a TraceExporter.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import dataclasses
+import json
+import logging
+import random
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+# marks past this many are ignored
+MAX_STAGES = 8
+
+# states of a slot in the ring
+_FREE = 0
+_ACTIVE = 1
+_DONE = 2
+
+
+@dataclasses.dataclass
+class TracingConfig:
+    # fraction of messages traced, tracing is off at 0
+    sample_rate: float = 0.0
+    # traces kept until exported, older ones are overwritten
+    capacity: int = 1024
+    path: str = "traces.jsonl"
+    export_interval: float = 5.0
+
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+
+@dataclasses.dataclass
+class TracingStats:
+    sampled: int = 0
+    # sampled, but lost to a full ring before being exported
+    dropped: int = 0
+    exported: int = 0
+
+
+class Trace:
+    """Stage marks of one message, in a slot that's reused once exported"""
+
+    __slots__ = (
+        "message_type",
+        "started_at",
+        "start",
+        "stages",
+        "times",
+        "size",
+        "state",
+        "_token",
+    )
+
+    def __init__(self):
+        self.message_type: typing.Optional[str] = None
+        # wall clock, to line the trace up with logs
+        self.started_at = 0.0
+        self.start = 0
+        self.stages = [""] * MAX_STAGES
+        self.times = [0] * MAX_STAGES
+        self.size = 0
+        self.state = _FREE
+        self._token: typing.Optional[contextvars.Token] = None
+
+    def __enter__(self):
+        self._token = _current.set(self)
+
+    def __exit__(self, *exc_info):
+        assert self._token is not None
+        _current.reset(self._token)
+        self._token = None
+        self.state = _DONE
+
+    def begin(self):
+        self.message_type = None
+        self.started_at = time.time()
+        self.size = 0
+        self.state = _ACTIVE
+        self.start = time.perf_counter_ns()
+
+    def mark(self, stage: str):
+        if self.size < MAX_STAGES:
+            self.times[self.size] = time.perf_counter_ns()
+            self.stages[self.size] = stage
+            self.size += 1
+
+    def to_dict(self) -> dict:
+        """Microseconds spent in each stage, from the end of the one before"""
+        stages: dict[str, float] = {}
+        prev = self.start
+        for i in range(self.size):
+            stage, now = self.stages[i], self.times[i]
+            stages[stage] = stages.get(stage, 0.0) + (now - prev) / 1000
+            prev = now
+        return {
+            "type": self.message_type,
+            "ts": self.started_at,
+            "total_us": (prev - self.start) / 1000,
+            "stages": stages,
+        }
+
+
+_current: contextvars.ContextVar[typing.Optional[Trace]] = contextvars.ContextVar(
+    "trace", default=None
+)
+
+# entered for every message that isn't traced
+UNTRACED: typing.ContextManager = contextlib.nullcontext()
+
+
+def current() -> typing.Optional[Trace]:
+    return _current.get()
+
+
+def mark(stage: str):
+    """Marks the end of stage in the trace of the message being handled, if any"""
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+class Tracer:
+    _cfg: TracingConfig
+    _ring: list[Trace]
+    _next: int
+    _stats: TracingStats
+
+    def __init__(self, cfg: TracingConfig):
+        if cfg.capacity < 1:
+            raise ValueError("Tracing capacity must be at least 1")
+        self._cfg = cfg
+        self._ring = [Trace() for _ in range(cfg.capacity)]
+        self._next = 0
+        self._stats = TracingStats()
+
+    @property
+    def cfg(self) -> TracingConfig:
+        return self._cfg
+
+    @property
+    def stats(self) -> TracingStats:
+        return self._stats
+
+    def trace(self) -> typing.ContextManager:
+        """Context manager recording a trace of the message handled in it, if sampled"""
+        if random.random() >= self._cfg.sample_rate:
+            return UNTRACED
+
+        self._stats.sampled += 1
+        slot = self._ring[self._next]
+        if slot.state != _FREE:
+            self._stats.dropped += 1
+            # a message still in flight keeps its slot, this one goes untraced
+            if slot.state == _ACTIVE:
+                return UNTRACED
+
+        self._next = (self._next + 1) % len(self._ring)
+        slot.begin()
+        return slot
+
+    def drain(self) -> list[dict]:
+        """Finished traces, oldest first, freeing their slots"""
+        n = len(self._ring)
+        finished = []
+        for i in range(n):
+            slot = self._ring[(self._next + i) % n]
+            if slot.state == _DONE:
+                finished.append(slot.to_dict())
+                slot.state = _FREE
+        self._stats.exported += len(finished)
+        return finished
+
+
+def _append_lines(path: str, traces: list[dict]):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(trace) + "\n" for trace in traces)
+
+
+class TraceExporter:
+    """Appends the finished traces to a JSONL file every export_interval"""
+
+    _tracer: Tracer
+    _write_lock: asyncio.Lock
+
+    def __init__(self, tracer: Tracer):
+        self._tracer = tracer
+        # one append at a time, so the final export at shutdown can't overlap
+        # one that run() started before it was cancelled
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def tracer(self) -> Tracer:
+        return self._tracer
+
+    async def export(self) -> int:
+        traces = self._tracer.drain()
+        if traces:
+            # the traces are already drained, so they're written even if the
+            # caller is cancelled
+            await asyncio.shield(self._write(traces))
+        return len(traces)
+
+    async def _write(self, traces: list[dict]):
+        async with self._write_lock:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _append_lines, self._tracer.cfg.path, traces
+            )
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._tracer.cfg.export_interval)
+            try:
+                await self.export()
+            except OSError as exc:
+                logger.error(
+                    "Failed to write traces to %s", self._tracer.cfg.path, exc_info=exc
+                )
@@ -0,0 +1,214 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Recording of the frames clients send, for replaying real traffic later
+
+A TrafficRecorder notes when each connection opens and closes and every frame
+it sends, with a monotonic time since recording started, and a RecorderWriter
+appends them to a gzip-compressed file of JSON lines:
+
+    {"t": 0.51, "conn": 7, "event": "open"}
+    {"t": 0.52, "conn": 7, "frame": "[\"REQ\",\"feed\",{...}]"}
+    {"t": 9.03, "conn": 7, "event": "close"}
+
+benchmarks/replay_traffic.py drives a relay with a capture. Captures hold
+everything clients sent, AUTH events included, so treat them like the
+database they were recorded from.
+"""
+
+import asyncio
+import dataclasses
+import gzip
+import itertools
+import json
+import logging
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class RecorderConfig:
+    # capture file, recording is off without one
+    path: typing.Optional[str] = None
+    flush_interval: float = 1.0
+    # records held until flushed, past this new ones are dropped
+    max_buffered: int = 100_000
+
+    def enabled(self) -> bool:
+        return self.path is not None
+
+
+@dataclasses.dataclass
+class RecorderStats:
+    connections: int = 0
+    frames: int = 0
+    # lost to a full buffer
+    dropped: int = 0
+    written: int = 0
+
+
+class TrafficRecorder:
+    _cfg: RecorderConfig
+    _stats: RecorderStats
+    _start: float
+    _ids: typing.Iterator[int]
+    _buffer: list[dict]
+
+    def __init__(self, cfg: RecorderConfig):
+        self._cfg = cfg
+        self._stats = RecorderStats()
+        self._start = time.monotonic()
+        self._ids = itertools.count(1)
+        self._buffer = []
+
+    @property
+    def cfg(self) -> RecorderConfig:
+        return self._cfg
+
+    @property
+    def stats(self) -> RecorderStats:
+        return self._stats
+
+    def _add(self, record: dict):
+        if len(self._buffer) >= self._cfg.max_buffered:
+            self._stats.dropped += 1
+            return
+        record["t"] = round(time.monotonic() - self._start, 6)
+        self._buffer.append(record)
+
+    def open(self) -> int:
+        """Id of a new connection, for recording its frames"""
+        conn = next(self._ids)
+        self._stats.connections += 1
+        self._add({"conn": conn, "event": "open"})
+        return conn
+
+    def record(self, conn: int, frame: typing.Union[str, bytes]):
+        if isinstance(frame, bytes):
+            frame = frame.decode("utf-8", errors="replace")
+        self._stats.frames += 1
+        self._add({"conn": conn, "frame": frame})
+
+    def close(self, conn: int):
+        self._add({"conn": conn, "event": "close"})
+
+    def wrap(self, websocket) -> "RecordedWebSocket":
+        """websocket, with each frame it receives recorded on a new connection"""
+        return RecordedWebSocket(websocket, self, self.open())
+
+    def drain(self) -> list[dict]:
+        """Records since the last drain, oldest first"""
+        records, self._buffer = self._buffer, []
+        return records
+
+
+class RecordedWebSocket:
+    """Passes recv() and send() through to a websocket, recording what's received"""
+
+    _websocket: typing.Any
+    _recorder: TrafficRecorder
+    _conn: int
+
+    def __init__(self, websocket, recorder: TrafficRecorder, conn: int):
+        self._websocket = websocket
+        self._recorder = recorder
+        self._conn = conn
+
+    @property
+    def remote_address(self):
+        return self._websocket.remote_address
+
+    @property
+    def conn(self) -> int:
+        return self._conn
+
+    async def recv(self):
+        data = await self._websocket.recv()
+        self._recorder.record(self._conn, data)
+        return data
+
+    async def send(self, data):
+        await self._websocket.send(data)
+
+    def record_close(self):
+        """Records the connection as closed, leaving the websocket to its server"""
+        self._recorder.close(self._conn)
+
+
+def _append(path: str, records: list[dict]):
+    # each append is a gzip member of its own, which gzip reads as one stream
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+
+
+def read(path: str) -> typing.Iterator[dict]:
+    """Records of a capture file, in the order they were recorded"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class RecorderWriter:
+    """Appends the recorded traffic to the capture file every flush_interval"""
+
+    _recorder: TrafficRecorder
+    _write_lock: asyncio.Lock
+
+    def __init__(self, recorder: TrafficRecorder):
+        self._recorder = recorder
+        # one append at a time, so the final flush at shutdown can't overlap
+        # one that run() started before it was cancelled
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def recorder(self) -> TrafficRecorder:
+        return self._recorder
+
+    async def flush(self) -> int:
+        records = self._recorder.drain()
+        path = self._recorder.cfg.path
+        if records and path is not None:
+            # the records are already drained, so they're written even if
+            # the caller is cancelled
+            await asyncio.shield(self._write(path, records))
+        return len(records)
+
+    async def _write(self, path: str, records: list[dict]):
+        async with self._write_lock:
+            await asyncio.get_running_loop().run_in_executor(
+                None, _append, path, records
+            )
+        self._recorder.stats.written += len(records)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self._recorder.cfg.flush_interval)
+            try:
+                await self.flush()
+            except OSError as exc:
+                logger.error(
+                    "Failed to write traffic to %s",
+                    self._recorder.cfg.path,
+                    exc_info=exc,
+                )
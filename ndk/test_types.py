@@ -37,3 +37,14 @@ def test_event_id_non_hex():
 def test_event_id_non_str():
     with pytest.raises(ValueError):
         types.EventID([])  # type: ignore
+
+
+def test_event_id_validate_many():
+    types.EventID.validate_many([])
+    types.EventID.validate_many(["a" * 64, "B" * 64, "0" * 64])
+
+
+@pytest.mark.parametrize("bad", ["a" * 63, "g" * 64, 1])
+def test_event_id_validate_many_bad(bad):
+    with pytest.raises(ValueError):
+        types.EventID.validate_many(["a" * 64, bad, "b" * 64])  # type: ignore
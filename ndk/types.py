@@ -21,6 +21,8 @@
 
 import re
 
+_HEX = re.compile("^[0-9a-fA-F]+$")
+
 
 class FixedLengthHexStr(str):
     _length: int
@@ -40,9 +42,22 @@ class FixedLengthHexStr(str):
                 f"{cls.__name__} must be {cls._length} bytes long, not {value}"
             )
 
-        if not re.match("^[0-9a-fA-F]+$", value):
+        if not _HEX.match(value):
             raise ValueError(f"{cls.__name__} must be a hex string, not {value}")
 
+    @classmethod
+    def validate_many(cls, values: list[str]):
+        """validate() for each value, with one regex match for all of them"""
+        if (
+            set(map(type, values)) <= {str}
+            and set(map(len, values)) <= {cls._length}
+            and (not values or _HEX.match("".join(values)))
+        ):
+            return
+
+        for value in values:  # find the bad one
+            cls.validate(value)
+
 
 class EventID(FixedLengthHexStr):
     _length: int = 64
@@ -21,8 +21,11 @@
 
 import configparser
 import dataclasses
+import typing
 
 from ndk import serialize
+from ndk.relay import load_shedder, rate_limiter, tracing, traffic_recorder
+from ndk.relay.event_repo import retention, slow_query_log
 
 
 @dataclasses.dataclass
@@ -101,16 +104,163 @@ class LimitationsConfig:
         return self.__dict__
 
 
+@dataclasses.dataclass
+class RetentionConfig:
+    policies: list[retention.RetentionPolicy]
+    max_bytes: typing.Optional[int]
+    sweep_interval: int
+    sweep_batch_size: int
+    sweep_batch_pause: float
+
+    @classmethod
+    def from_config(cls, cfg: configparser.ConfigParser):
+        policies = serialize.deserialize_str(
+            cfg.get("Event Retention", "policies", fallback="[]")
+        )
+        if not isinstance(policies, list):
+            raise ValueError("Event Retention policies must be a list")
+
+        return cls(
+            policies=[retention.RetentionPolicy.from_dict(d) for d in policies],
+            max_bytes=cfg.getint("Event Retention", "max_bytes", fallback=None),
+            sweep_interval=cfg.getint("Event Retention", "sweep_interval", fallback=60),
+            sweep_batch_size=cfg.getint(
+                "Event Retention", "sweep_batch_size", fallback=500
+            ),
+            sweep_batch_pause=cfg.getfloat(
+                "Event Retention", "sweep_batch_pause", fallback=0.05
+            ),
+        )
+
+    def to_rid_section(self) -> list[dict]:
+        # NIP-11 only defines kinds, time and count
+        rid = []
+        for policy in self.policies:
+            d = {k: v for k, v in policy.to_dict().items() if k != "bytes"}
+            if "time" in d or "count" in d:
+                rid.append(d)
+        return rid
+
+
+def rate_limits_from_config(
+    cfg: configparser.ConfigParser,
+) -> rate_limiter.RateLimitConfig:
+    def bucket(scope: str) -> typing.Optional[rate_limiter.BucketConfig]:
+        rate = cfg.getfloat("Rate Limits", f"{scope}_rate", fallback=None)
+        if rate is None:
+            return None
+        burst = cfg.getfloat("Rate Limits", f"{scope}_burst", fallback=rate)
+        return rate_limiter.BucketConfig(rate, burst)
+
+    return rate_limiter.RateLimitConfig(
+        connection=bucket("connection"),
+        ip=bucket("ip"),
+        pubkey=bucket("pubkey"),
+        costs={
+            "EVENT": cfg.getfloat("Rate Limits", "event_cost", fallback=1.0),
+            "REQ": cfg.getfloat("Rate Limits", "req_cost", fallback=1.0),
+            "COUNT": cfg.getfloat("Rate Limits", "count_cost", fallback=1.0),
+        },
+    )
+
+
+def shedding_from_config(cfg: configparser.ConfigParser) -> load_shedder.SheddingConfig:
+    defaults = load_shedder.SheddingConfig()
+    return load_shedder.SheddingConfig(
+        clamp_lag=cfg.getfloat("Load Shedding", "clamp_lag", fallback=None),
+        reject_lag=cfg.getfloat("Load Shedding", "reject_lag", fallback=None),
+        defer_lag=cfg.getfloat("Load Shedding", "defer_lag", fallback=None),
+        clamped_limit=cfg.getint(
+            "Load Shedding", "clamped_limit", fallback=defaults.clamped_limit
+        ),
+        low_priority_kinds=serialize.deserialize_str(
+            cfg.get(
+                "Load Shedding",
+                "low_priority_kinds",
+                fallback=str(defaults.low_priority_kinds),
+            )
+        ),
+        max_deferred=cfg.getint(
+            "Load Shedding", "max_deferred", fallback=defaults.max_deferred
+        ),
+        max_defer=cfg.getfloat(
+            "Load Shedding", "max_defer", fallback=defaults.max_defer
+        ),
+        sample_interval=cfg.getfloat(
+            "Load Shedding", "sample_interval", fallback=defaults.sample_interval
+        ),
+    )
+
+
+def tracing_from_config(cfg: configparser.ConfigParser) -> tracing.TracingConfig:
+    defaults = tracing.TracingConfig()
+    return tracing.TracingConfig(
+        sample_rate=cfg.getfloat(
+            "Tracing", "sample_rate", fallback=defaults.sample_rate
+        ),
+        capacity=cfg.getint("Tracing", "capacity", fallback=defaults.capacity),
+        path=cfg.get("Tracing", "path", fallback=defaults.path),
+        export_interval=cfg.getfloat(
+            "Tracing", "export_interval", fallback=defaults.export_interval
+        ),
+    )
+
+
+def recording_from_config(
+    cfg: configparser.ConfigParser,
+) -> traffic_recorder.RecorderConfig:
+    defaults = traffic_recorder.RecorderConfig()
+    return traffic_recorder.RecorderConfig(
+        path=cfg.get("Recording", "path", fallback=None),
+        flush_interval=cfg.getfloat(
+            "Recording", "flush_interval", fallback=defaults.flush_interval
+        ),
+        max_buffered=cfg.getint(
+            "Recording", "max_buffered", fallback=defaults.max_buffered
+        ),
+    )
+
+
+def slow_queries_from_config(
+    cfg: configparser.ConfigParser,
+) -> slow_query_log.SlowQueryConfig:
+    defaults = slow_query_log.SlowQueryConfig()
+    return slow_query_log.SlowQueryConfig(
+        threshold=cfg.getfloat("Slow Queries", "threshold", fallback=None),
+        path=cfg.get("Slow Queries", "path", fallback=None),
+        max_bytes=cfg.getint("Slow Queries", "max_bytes", fallback=defaults.max_bytes),
+        explain_rate=cfg.getfloat(
+            "Slow Queries", "explain_rate", fallback=defaults.explain_rate
+        ),
+    )
+
+
 class RelayConfig:
     general: GeneralConfig
     limitations: LimitationsConfig
+    retention: RetentionConfig
+    rate_limits: rate_limiter.RateLimitConfig
+    shedding: load_shedder.SheddingConfig
+    tracing: tracing.TracingConfig
+    slow_queries: slow_query_log.SlowQueryConfig
+    recording: traffic_recorder.RecorderConfig
 
     def __init__(self, cfg: configparser.ConfigParser):
         self.general = GeneralConfig.from_config(cfg)
         self.limitations = LimitationsConfig.from_config(cfg)
+        self.retention = RetentionConfig.from_config(cfg)
+        self.rate_limits = rate_limits_from_config(cfg)
+        self.shedding = shedding_from_config(cfg)
+        self.tracing = tracing_from_config(cfg)
+        self.slow_queries = slow_queries_from_config(cfg)
+        self.recording = recording_from_config(cfg)
 
     def to_rid(self) -> dict:
         ret = self.general.to_rid_section()
         ret["limitation"] = self.limitations.to_rid_section()
 
+        retention_rid = self.retention.to_rid_section()
+        if retention_rid:
+            ret["retention"] = retention_rid
+
         return ret
@@ -22,29 +22,43 @@
 import argparse
 import asyncio
 import configparser
+import dataclasses
 import functools
 import http
 import logging
 import os
 import signal
+import time
+import typing
 
 from websockets.legacy.server import serve
 
 from ndk import serialize
 from ndk.relay import (
     auth_handler,
+    bloom_filter,
     event_handler,
     event_notifier,
+    load_shedder,
     message_dispatcher,
     message_handler,
+    metrics,
+    rate_limiter,
     subscription_handler,
+    tracing,
+    traffic_recorder,
 )
 from ndk.relay.event_repo import (
+    caching_event_repo,
     event_repo,
+    instrumented_event_repo,
     kafka_event_persister,
     kafka_event_repo,
+    log_event_repo,
     memory_event_repo,
     postgres_event_repo,
+    sqlite_event_repo,
+    tiered_event_repo,
 )
 from ndk.repos.event_repo import protocol_handler
 from relay import config
@@ -65,6 +79,18 @@ DB_PASSWORD = os.environ.get("DB_PASSWORD", None)
 DROP_DB = os.environ.get("DROP_DB", None)
 KAFKA_URL = os.environ.get("KAFKA_URL", None)
 KAFKA_TOPIC = os.environ.get("KAFKA_TOPIC", None)
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "events.db")
+LOG_PATH = os.environ.get("LOG_PATH", "events")
+LOG_COMPACT_INTERVAL = float(os.environ.get("LOG_COMPACT_INTERVAL", "3600"))
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", None)
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "300"))
+TIER_WINDOW = int(os.environ.get("TIER_WINDOW", "86400"))
+TIER_MAX_EVENTS = int(os.environ.get("TIER_MAX_EVENTS", "500000"))
+CACHE_MAX_ENTRIES = os.environ.get("CACHE_MAX_ENTRIES", None)
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "60"))
+BLOOM_CAPACITY = os.environ.get("BLOOM_CAPACITY", None)
+BLOOM_ERROR_RATE = float(os.environ.get("BLOOM_ERROR_RATE", "0.001"))
+BLOOM_PATH = os.environ.get("BLOOM_PATH", None)
 
 logging.basicConfig(level=DEBUG_LEVEL, format="%(asctime)s %(levelname)s %(message)s")
 logging.getLogger("websockets").setLevel(logging.WARNING)
@@ -74,14 +100,16 @@ logging.getLogger("aiokafka").setLevel(logging.WARNING)
 async def process_message(
     data: str, write_queue: asyncio.Queue[str], md: message_dispatcher.MessageDispatcher
 ):
-    try:
-        responses = await md.process_message(data)
-    except:  # pylint: disable=bare-except
-        logger.exception("Error processing message: %s", data)
-        return
+    with md.trace():
+        try:
+            responses = await md.process_message(data)
+        except:  # pylint: disable=bare-except
+            logger.exception("Error processing message: %s", data)
+            return
 
-    for response in responses:
-        await write_queue.put(response)
+        for response in responses:
+            await write_queue.put(response)
+        tracing.mark("enqueue")
 
 
 async def connection_handler(
@@ -95,10 +123,275 @@ async def connection_handler(
         asyncio.create_task(process_message(data, write_queue, md))
 
 
-async def handler_wrapper(
-    cfg: config.RelayConfig, repo: event_repo.EventRepo, websocket
+@dataclasses.dataclass
+class RelayState:
+    """Relay-wide objects shared by every connection"""
+
+    repo: event_repo.EventRepo
+    # events received on any connection go to the subscriptions of all of them
+    ev_notifier: event_notifier.EventNotifier
+    groups: subscription_handler.SubscriptionGroups
+    ingest_stats: event_handler.IngestStats
+    shedder: load_shedder.LoadShedder
+    relay_metrics: metrics.RelayMetrics
+    stored_ids: typing.Optional[bloom_filter.ScalableBloomFilter] = None
+    limiter: typing.Optional[rate_limiter.RateLimiter] = None
+    tracer: typing.Optional[tracing.Tracer] = None
+    recorder: typing.Optional[traffic_recorder.TrafficRecorder] = None
+    # the storage repo under the instrumentation and cache wrapping repo
+    store: typing.Optional[event_repo.EventRepo] = None
+    # request and response queue of each open connection
+    queues: set[tuple[asyncio.Queue[str], asyncio.Queue[str]]] = dataclasses.field(
+        default_factory=set
+    )
+
+
+def register_state_metrics(registry: metrics.Registry, state: RelayState):
+    def queue_depths():
+        return {
+            ("request",): sum(rq.qsize() for rq, _ in state.queues),
+            ("response",): sum(wq.qsize() for _, wq in state.queues),
+        }
+
+    registry.register(
+        metrics.Callback(
+            "nostr_connections", "Open websocket connections", lambda: len(state.queues)
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_queue_depth",
+            "Messages waiting in connection queues, summed over connections",
+            queue_depths,
+            ("queue",),
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_subscriptions",
+            "Live subscriptions",
+            state.groups.subscriber_count,
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_subscription_filters",
+            "Distinct filters of live subscriptions",
+            lambda: len(state.groups),
+        )
+    )
+
+    ingest = state.ingest_stats
+    registry.register(
+        metrics.Callback(
+            "nostr_events_accepted_total",
+            "Events that passed validation",
+            lambda: ingest.accepted,
+            kind="counter",
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_events_rejected_total",
+            "Events rejected, by ingestion stage",
+            lambda: {(stage,): n for stage, n in ingest.rejected.items()},
+            ("stage",),
+            kind="counter",
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_duplicate_lookups_skipped_total",
+            "Duplicate checks answered by the bloom filter alone",
+            lambda: ingest.lookups_skipped,
+            kind="counter",
+        )
+    )
+
+    shedder = state.shedder
+    registry.register(
+        metrics.HistogramCallback(
+            "nostr_event_loop_lag_seconds",
+            "How late the event loop ran a callback that was due",
+            lambda: shedder.stats.lag,
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_shedding_level",
+            "Current load shedding level, 0 when not shedding",
+            lambda: int(shedder.level),
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_shed_total",
+            "Requests shed under load, by action",
+            lambda: {
+                ("clamped",): shedder.stats.clamped,
+                ("rejected",): shedder.stats.rejected,
+                ("deferred",): shedder.stats.deferred,
+                ("dropped",): shedder.stats.dropped,
+            },
+            ("action",),
+            kind="counter",
+        )
+    )
+
+    limiter = state.limiter
+    if limiter is not None:
+        registry.register(
+            metrics.Callback(
+                "nostr_rate_limited_total",
+                "Messages rejected by rate limits, by the bucket that ran out",
+                lambda: {(scope,): n for scope, n in limiter.stats.by_scope.items()},
+                ("scope",),
+                kind="counter",
+            )
+        )
+
+    stored_ids = state.stored_ids
+    if stored_ids is not None:
+        registry.register(
+            metrics.Callback(
+                "nostr_bloom_filter_ids",
+                "Event ids added to the bloom filter",
+                lambda: len(stored_ids),
+            )
+        )
+        registry.register(
+            metrics.Callback(
+                "nostr_bloom_filter_bytes",
+                "Memory held by the bloom filter",
+                lambda: stored_ids.size_bytes,
+            )
+        )
+
+    tracer = state.tracer
+    if tracer is not None:
+        registry.register(
+            metrics.Callback(
+                "nostr_traces_total",
+                "Messages traced, by what became of the trace",
+                lambda: {
+                    ("sampled",): tracer.stats.sampled,
+                    ("dropped",): tracer.stats.dropped,
+                    ("exported",): tracer.stats.exported,
+                },
+                ("result",),
+                kind="counter",
+            )
+        )
+
+    store = state.repo if state.store is None else state.store
+    stores = [store]
+    if isinstance(store, tiered_event_repo.TieredEventRepo):
+        stores.append(store.cold)
+    for pg_repo in stores:
+        if isinstance(pg_repo, postgres_event_repo.PostgresEventRepo):
+            register_postgres_metrics(registry, pg_repo)
+    if isinstance(store, tiered_event_repo.TieredEventRepo):
+        register_tier_metrics(registry, store)
+
+    repo = state.repo
+    if isinstance(repo, caching_event_repo.CachingEventRepo):
+        registry.register(
+            metrics.Callback(
+                "nostr_cache_lookups_total",
+                "Query cache lookups, by result",
+                lambda: {("hit",): repo.stats.hits, ("miss",): repo.stats.misses},
+                ("result",),
+                kind="counter",
+            )
+        )
+        registry.register(
+            metrics.Callback(
+                "nostr_cache_invalidations_total",
+                "Query cache entries dropped because a write changed their results",
+                lambda: repo.stats.invalidations,
+                kind="counter",
+            )
+        )
+
+
+def register_postgres_metrics(
+    registry: metrics.Registry, repo: postgres_event_repo.PostgresEventRepo
+):
+    coalescing = repo.coalescing_stats
+    registry.register(
+        metrics.Callback(
+            "nostr_postgres_queries_coalesced_total",
+            "Queries answered by an identical one already in flight",
+            lambda: coalescing.saved,
+            kind="counter",
+        )
+    )
+
+    # rates of these give the per-batch throughput and lock wait
+    sweep = repo.sweep_stats
+    for name, help_text, value in [
+        ("batches_total", "Batches deleted by the sweeper", lambda: sweep.batches),
+        ("deleted_total", "Events deleted by the sweeper", lambda: sweep.deleted),
+        (
+            "seconds_total",
+            "Time spent deleting sweep batches",
+            lambda: sweep.seconds,
+        ),
+        (
+            "lock_wait_seconds_total",
+            "Time sweep batches waited to lock their victims",
+            lambda: sweep.lock_wait_seconds,
+        ),
+        (
+            "lock_timeouts_total",
+            "Sweep batches given up on a lock timeout",
+            lambda: sweep.lock_timeouts,
+        ),
+    ]:
+        registry.register(
+            metrics.Callback(
+                f"nostr_postgres_sweep_{name}", help_text, value, kind="counter"
+            )
+        )
+
+
+def register_tier_metrics(
+    registry: metrics.Registry, repo: tiered_event_repo.TieredEventRepo
 ):
+    def queries():
+        return {
+            (shape, result): n
+            for shape, stats in repo.stats.items()
+            for result, n in [
+                ("hit", stats.hits),
+                ("merge", stats.merges),
+                ("miss", stats.misses),
+            ]
+        }
+
+    registry.register(
+        metrics.Callback(
+            "nostr_tier_queries_total",
+            "Queries to the tiered repo, by filter shape and the tiers answering",
+            queries,
+            ("shape", "result"),
+            kind="counter",
+        )
+    )
+    registry.register(
+        metrics.Callback(
+            "nostr_tier_hit_ratio",
+            "Share of queries answered by the hot tier alone, by filter shape",
+            lambda: {(shape,): stats.hit_rate for shape, stats in repo.stats.items()},
+            ("shape",),
+        )
+    )
+
+
+async def handler_wrapper(cfg: config.RelayConfig, state: RelayState, websocket):
     logger.debug("New connection established from: %s", websocket.remote_address)
+    if state.recorder is not None:
+        websocket = state.recorder.wrap(websocket)
     request_queue: asyncio.Queue[str] = asyncio.Queue()
     response_queue: asyncio.Queue[str] = asyncio.Queue()
 
@@ -108,18 +401,20 @@ async def handler_wrapper(
         subscription_handler.SubscriptionHandlerConfig(
             cfg.limitations.max_subscriptions, cfg.limitations.max_subid_length
         ),
+        state.groups,
     )
-    ev_notifier = event_notifier.EventNotifier()
     eh = event_handler.EventHandler(
-        repo,
-        ev_notifier,
+        state.repo,
+        state.ev_notifier,
         event_handler.EventHandlerConfig(
             cfg.limitations.max_event_tags, cfg.limitations.max_content_length
         ),
+        state.ingest_stats,
+        state.stored_ids,
     )
     mh = message_handler.MessageHandler(
         auth,
-        repo,
+        state.repo,
         sh,
         eh,
         message_handler.MessageHandlerConfig(
@@ -127,10 +422,19 @@ async def handler_wrapper(
             cfg.limitations.max_limit,
             cfg.limitations.min_prefix,
         ),
+        shedder=state.shedder,
+    )
+    limiter = None
+    if state.limiter is not None:
+        limiter = state.limiter.for_connection(
+            websocket.remote_address[0], auth.authenticated_pubkey
+        )
+    md = message_dispatcher.MessageDispatcher(
+        mh, limiter=limiter, relay_metrics=state.relay_metrics, tracer=state.tracer
     )
-    md = message_dispatcher.MessageDispatcher(mh)
-    eh.register_received_cb(sh.handle_event)
     await response_queue.put(auth.build_auth_message())
+    queues = (request_queue, response_queue)
+    state.queues.add(queues)
 
     consumer_task = asyncio.create_task(
         protocol_handler.read_handler(websocket, request_queue)
@@ -142,18 +446,30 @@ async def handler_wrapper(
         connection_handler(request_queue, response_queue, md)
     )
 
-    _, pending = await asyncio.wait(
-        [consumer_task, producer_task, processing_task],
-        return_when=asyncio.FIRST_COMPLETED,
-    )
-    for task in pending:
-        task.cancel()
-
-
-async def health_check(rid_bytes: bytes, path, headers):
+    tasks = [consumer_task, producer_task, processing_task]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # also when the server cancels this handler while it's shutting down
+        for task in tasks:
+            task.cancel()
+        await sh.close()
+        state.queues.discard(queues)
+        if isinstance(websocket, traffic_recorder.RecordedWebSocket):
+            websocket.record_close()
+
+
+async def health_check(rid_bytes: bytes, registry: metrics.Registry, path, headers):
     if path == "/healthz":
         return http.HTTPStatus.OK, [], b"OK"
 
+    if path == "/metrics":
+        return (
+            http.HTTPStatus.OK,
+            [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")],
+            registry.render().encode(),
+        )
+
     if (
         path == "/"
         and "Accept" in headers
@@ -185,18 +501,61 @@ def parse_args():
     return parser.parse_args()
 
 
-async def create_repo_from_env():
+def load_config() -> config.RelayConfig:
+    args = parse_args()
+    ini_parser = configparser.ConfigParser()
+    ini_parser.read(args.config)
+    return config.RelayConfig(ini_parser)
+
+
+def sweep_config_from(cfg: config.RelayConfig) -> postgres_event_repo.SweepConfig:
+    return postgres_event_repo.SweepConfig(
+        batch_size=cfg.retention.sweep_batch_size,
+        batch_pause=cfg.retention.sweep_batch_pause,
+    )
+
+
+async def create_repo_from_env(
+    cfg: config.RelayConfig, relay_metrics: metrics.RelayMetrics
+):
     if MODE is None:
         raise ValueError("Required MODE environment variable is not set")
 
-    valid_modes = ["MEMORY", "POSTGRES", "POSTGRES_KAFKA"]
+    valid_modes = [
+        "MEMORY",
+        "SQLITE",
+        "LOG",
+        "POSTGRES",
+        "POSTGRES_TIERED",
+        "POSTGRES_KAFKA",
+    ]
     if MODE not in valid_modes:
         raise ValueError(
             f"Invalid MODE environment variable value. Must be one of {valid_modes}"
         )
 
     if MODE == "MEMORY":
-        return memory_event_repo.MemoryEventRepo()
+        memory_repo = memory_event_repo.MemoryEventRepo(
+            cfg.retention.policies, cfg.retention.max_bytes
+        )
+        if SNAPSHOT_PATH is not None and os.path.exists(SNAPSHOT_PATH):
+            start = time.monotonic()
+            n = memory_repo.load_snapshot(SNAPSHOT_PATH)
+            logger.info(
+                "Restored %s events from %s in %.3fs",
+                n,
+                SNAPSHOT_PATH,
+                time.monotonic() - start,
+            )
+        return memory_repo
+
+    if MODE == "SQLITE":
+        return await sqlite_event_repo.SqliteEventRepo.create(
+            SQLITE_PATH, cfg.retention.policies
+        )
+
+    if MODE == "LOG":
+        return await log_event_repo.LogEventRepo.create(LOG_PATH)
 
     for e in [DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]:
         if e is None:
@@ -207,12 +566,28 @@ async def create_repo_from_env():
         drop_db = True
 
     postgres_repo = await postgres_event_repo.PostgresEventRepo.create(
-        DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME, drop_db=drop_db
+        DB_HOST,
+        DB_PORT,
+        DB_USER,
+        DB_PASSWORD,
+        DB_NAME,
+        drop_db=drop_db,
+        policies=cfg.retention.policies,
+        sweep_cfg=sweep_config_from(cfg),
+        slow_query_cfg=cfg.slow_queries,
     )
 
     if MODE == "POSTGRES":
         return postgres_repo
 
+    if MODE == "POSTGRES_TIERED":
+        return await tiered_event_repo.TieredEventRepo.create(
+            postgres_repo,
+            tiered_event_repo.TierConfig(
+                window=TIER_WINDOW, max_events=TIER_MAX_EVENTS
+            ),
+        )
+
     if MODE == "POSTGRES_KAFKA":
         if KAFKA_URL is None:
             raise ValueError("Required KAFKA_URL environment variable is not set")
@@ -221,7 +596,10 @@ async def create_repo_from_env():
             raise ValueError("Required KAFKA_TOPIC environment variable is not set")
 
         kafka_repo = kafka_event_repo.KafkaEventRepo(
-            KAFKA_URL, postgres_repo, KAFKA_TOPIC
+            KAFKA_URL,
+            postgres_repo,
+            KAFKA_TOPIC,
+            relay_metrics.kafka_produce_latency,
         )
         await kafka_repo.start()
         return kafka_repo
@@ -229,29 +607,180 @@ async def create_repo_from_env():
     raise ValueError("Invalid MODE environment variable value")
 
 
+async def load_stored_ids(
+    repo: event_repo.EventRepo,
+) -> bloom_filter.ScalableBloomFilter:
+    assert BLOOM_CAPACITY is not None
+    bloom_cfg = bloom_filter.BloomConfig(int(BLOOM_CAPACITY), BLOOM_ERROR_RATE)
+    start = time.monotonic()
+
+    if BLOOM_PATH is not None and os.path.exists(BLOOM_PATH):
+        try:
+            stored_ids = bloom_filter.ScalableBloomFilter.read(BLOOM_PATH, bloom_cfg)
+        except bloom_filter.BloomFilterError:
+            logger.exception("Rebuilding unreadable bloom filter %s", BLOOM_PATH)
+        else:
+            # only written at shutdown, so after a crash it may miss ids
+            os.remove(BLOOM_PATH)
+            logger.info(
+                "Restored %s event ids from %s in %.3fs",
+                len(stored_ids),
+                BLOOM_PATH,
+                time.monotonic() - start,
+            )
+            return stored_ids
+
+    stored_ids = bloom_filter.ScalableBloomFilter(bloom_cfg)
+    async for event_id in repo.stored_ids():
+        stored_ids.add(event_id)
+    logger.info(
+        "Indexed %s event ids (%s bytes) in %.3fs",
+        len(stored_ids),
+        stored_ids.size_bytes,
+        time.monotonic() - start,
+    )
+    return stored_ids
+
+
 async def start_relay():
-    args = parse_args()
-    repo = await create_repo_from_env()
-    ini_parser = configparser.ConfigParser()
-    ini_parser.read(args.config)
-    cfg = config.RelayConfig(ini_parser)
+    cfg = load_config()
+    registry = metrics.Registry()
+    relay_metrics = metrics.RelayMetrics(registry)
+    repo = await create_repo_from_env(cfg, relay_metrics)
 
     logger.info("%s initialized", repo.__class__)
 
+    # in POSTGRES_KAFKA mode the persister owns deletes
+    background_tasks = []
+    swept = [repo]
+    if isinstance(repo, tiered_event_repo.TieredEventRepo):
+        swept.append(repo.cold)
+    for r in swept:
+        if isinstance(
+            r,
+            (
+                memory_event_repo.MemoryEventRepo,
+                postgres_event_repo.PostgresEventRepo,
+                sqlite_event_repo.SqliteEventRepo,
+                tiered_event_repo.TieredEventRepo,
+            ),
+        ):
+            background_tasks.append(
+                asyncio.create_task(r.start_sweeper(cfg.retention.sweep_interval))
+            )
+
+    if (
+        isinstance(repo, memory_event_repo.MemoryEventRepo)
+        and SNAPSHOT_PATH is not None
+    ):
+        background_tasks.append(
+            asyncio.create_task(
+                repo.start_snapshotter(SNAPSHOT_PATH, SNAPSHOT_INTERVAL)
+            )
+        )
+
+    if isinstance(repo, log_event_repo.LogEventRepo):
+        background_tasks.append(
+            asyncio.create_task(repo.start_compactor(LOG_COMPACT_INTERVAL))
+        )
+
+    served_repo: event_repo.EventRepo = instrumented_event_repo.InstrumentedEventRepo(
+        repo, relay_metrics.repo_latency
+    )
+    # in POSTGRES_KAFKA mode writes land in another process and can't invalidate
+    if CACHE_MAX_ENTRIES is not None and MODE != "POSTGRES_KAFKA":
+        served_repo = caching_event_repo.CachingEventRepo(
+            served_repo,
+            caching_event_repo.CacheConfig(
+                max_entries=int(CACHE_MAX_ENTRIES), ttl=CACHE_TTL
+            ),
+        )
+
+    state = RelayState(
+        served_repo,
+        event_notifier.EventNotifier(),
+        subscription_handler.SubscriptionGroups(relay_metrics.fanout),
+        event_handler.IngestStats(),
+        load_shedder.LoadShedder(cfg.shedding),
+        relay_metrics,
+        store=repo,
+    )
+    state.ev_notifier.register(state.groups.handle_event)
+    # in POSTGRES_KAFKA mode other relays store events this one never sees
+    if BLOOM_CAPACITY is not None and MODE != "POSTGRES_KAFKA":
+        state.stored_ids = await load_stored_ids(repo)
+    if cfg.rate_limits.enabled():
+        state.limiter = rate_limiter.RateLimiter(cfg.rate_limits)
+    exporter = None
+    if cfg.tracing.enabled():
+        state.tracer = tracing.Tracer(cfg.tracing)
+        exporter = tracing.TraceExporter(state.tracer)
+        background_tasks.append(asyncio.create_task(exporter.run()))
+    writer = None
+    if cfg.recording.enabled():
+        state.recorder = traffic_recorder.TrafficRecorder(cfg.recording)
+        writer = traffic_recorder.RecorderWriter(state.recorder)
+        background_tasks.append(asyncio.create_task(writer.run()))
+    # lag is sampled even without shedding levels so it shows up in the stats
+    background_tasks.append(
+        asyncio.create_task(load_shedder.LagMonitor(state.shedder).run())
+    )
+
+    register_state_metrics(registry, state)
+
     loop = asyncio.get_event_loop()
     stop = loop.create_future()
     loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
 
     async with serve(
-        functools.partial(handler_wrapper, cfg, repo),
+        functools.partial(handler_wrapper, cfg, state),
         HOST,
         PORT,
         process_request=functools.partial(
-            health_check, serialize.serialize_as_bytes(cfg.to_rid())
+            health_check, serialize.serialize_as_bytes(cfg.to_rid()), registry
         ),
     ):
         await stop
 
+    for task in background_tasks:
+        task.cancel()
+    # so the final snapshot, export and flush below never overlap periodic ones
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    logger.info("Ingested events: %s", state.ingest_stats)
+    if state.limiter is not None:
+        logger.info("Rate limited messages: %s", state.limiter.stats)
+    lag = state.shedder.stats.lag
+    logger.info(
+        "Event loop lag: p50 <= %ss, p99 <= %ss, max %.3fs",
+        lag.quantile(0.5),
+        lag.quantile(0.99),
+        lag.max,
+    )
+    logger.info("Load shedding: %s", state.shedder.stats)
+    if exporter is not None:
+        await exporter.export()
+        logger.info("Traces: %s", exporter.tracer.stats)
+    if writer is not None:
+        await writer.flush()
+        logger.info("Recorded traffic: %s", writer.recorder.stats)
+
+    slow_queries = None
+    if isinstance(repo, postgres_event_repo.PostgresEventRepo):
+        slow_queries = repo.slow_queries
+    if slow_queries is not None:
+        await slow_queries.flush()
+        logger.info("Slow queries: %s", slow_queries.stats)
+
+    if state.stored_ids is not None and BLOOM_PATH is not None:
+        state.stored_ids.write(BLOOM_PATH)
+
+    if (
+        isinstance(repo, memory_event_repo.MemoryEventRepo)
+        and SNAPSHOT_PATH is not None
+    ):
+        await repo.save_snapshot(SNAPSHOT_PATH)
+
 
 async def start_kafka_persister():
     for e in [DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASSWORD]:
@@ -264,11 +793,20 @@ async def start_kafka_persister():
     if KAFKA_TOPIC is None:
         raise ValueError("Required KAFKA_TOPIC environment variable is not set")
 
+    cfg = load_config()
     repo = await postgres_event_repo.PostgresEventRepo.create(
-        DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME
+        DB_HOST,
+        DB_PORT,
+        DB_USER,
+        DB_PASSWORD,
+        DB_NAME,
+        policies=cfg.retention.policies,
+        sweep_cfg=sweep_config_from(cfg),
     )
+    sweeper = asyncio.create_task(repo.start_sweeper(cfg.retention.sweep_interval))
     persister = kafka_event_persister.KafkaEventPersister(KAFKA_URL, KAFKA_TOPIC, repo)
     await persister.start()
+    sweeper.cancel()
 
 
 async def main():
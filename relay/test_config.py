@@ -22,6 +22,7 @@
 
 import configparser
 
+from ndk.relay import rate_limiter
 from relay import config
 
 
@@ -36,3 +37,136 @@ def test_override():
     cfg = config.RelayConfig(ini)
 
     assert cfg.to_rid()["name"] == "test"
+
+
+def test_retention_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+
+    assert not cfg.retention.policies
+    assert cfg.retention.max_bytes is None
+    assert "retention" not in cfg.to_rid()
+
+
+def test_retention_policies():
+    ini = configparser.ConfigParser()
+    ini["Event Retention"] = {
+        "policies": '[{"kinds": [[30000, 39999]], "count": 1000}, {"time": 3600}]',
+        "max_bytes": "1024",
+    }
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.retention.policies[0].count == 1000
+    assert cfg.retention.policies[1].time == 3600
+    assert cfg.retention.max_bytes == 1024
+
+
+def test_retention_in_rid_without_bytes():
+    ini = configparser.ConfigParser()
+    ini["Event Retention"] = {
+        "policies": '[{"kinds": [1], "time": 60, "bytes": 10}, {"bytes": 10}]',
+    }
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.to_rid()["retention"] == [{"kinds": [1], "time": 60}]
+
+
+def test_rate_limits_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    assert not cfg.rate_limits.enabled()
+
+
+def test_rate_limits():
+    ini = configparser.ConfigParser()
+    ini.read_dict(
+        {
+            "Rate Limits": {
+                "connection_rate": "5",
+                "connection_burst": "20",
+                "ip_rate": "10",
+                "req_cost": "3",
+            }
+        }
+    )
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.rate_limits.enabled()
+    assert cfg.rate_limits.connection == rate_limiter.BucketConfig(5, 20)
+    assert cfg.rate_limits.ip == rate_limiter.BucketConfig(10, 10)
+    assert cfg.rate_limits.pubkey is None
+    assert cfg.rate_limits.costs == {"EVENT": 1.0, "REQ": 3.0, "COUNT": 1.0}
+
+
+def test_shedding_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    assert not cfg.shedding.enabled()
+    assert cfg.shedding.low_priority_kinds == [7]
+
+
+def test_shedding():
+    ini = configparser.ConfigParser()
+    ini.read_dict(
+        {
+            "Load Shedding": {
+                "clamp_lag": "0.05",
+                "defer_lag": "0.5",
+                "clamped_limit": "10",
+                "low_priority_kinds": "[7, 1984]",
+            }
+        }
+    )
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.shedding.enabled()
+    assert cfg.shedding.clamp_lag == 0.05
+    assert cfg.shedding.reject_lag is None
+    assert cfg.shedding.defer_lag == 0.5
+    assert cfg.shedding.clamped_limit == 10
+    assert cfg.shedding.low_priority_kinds == [7, 1984]
+
+
+def test_tracing_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    assert not cfg.tracing.enabled()
+
+
+def test_tracing():
+    ini = configparser.ConfigParser()
+    ini.read_dict({"Tracing": {"sample_rate": "0.01", "path": "/tmp/traces.jsonl"}})
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.tracing.enabled()
+    assert cfg.tracing.sample_rate == 0.01
+    assert cfg.tracing.path == "/tmp/traces.jsonl"
+    assert cfg.tracing.capacity == 1024
+
+
+def test_slow_queries_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    assert not cfg.slow_queries.enabled()
+
+
+def test_slow_queries():
+    ini = configparser.ConfigParser()
+    ini.read_dict({"Slow Queries": {"threshold": "0.25", "path": "slow.jsonl"}})
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.slow_queries.enabled()
+    assert cfg.slow_queries.threshold == 0.25
+    assert cfg.slow_queries.path == "slow.jsonl"
+    assert cfg.slow_queries.explain_rate == 0.0
+
+
+def test_recording_disabled_by_default():
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    assert not cfg.recording.enabled()
+
+
+def test_recording():
+    ini = configparser.ConfigParser()
+    ini.read_dict({"Recording": {"path": "traffic.jsonl.gz", "flush_interval": "2"}})
+    cfg = config.RelayConfig(ini)
+
+    assert cfg.recording.enabled()
+    assert cfg.recording.path == "traffic.jsonl.gz"
+    assert cfg.recording.flush_interval == 2.0
+    assert cfg.recording.max_buffered == 100_000
@@ -20,20 +20,38 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import asyncio
+import configparser
+import functools
+import http
+import time
+
+import mock
 
 from ndk import crypto
-from ndk.event import metadata_event
+from ndk.event import event_filter, metadata_event
+from ndk.messages import event_message, message_factory, request
 from ndk.relay import (
     auth_handler,
     event_handler,
     event_notifier,
+    load_shedder,
+    memory_transport,
     message_dispatcher,
     message_handler,
+    metrics,
     subscription_handler,
+    tracing,
+    traffic_recorder,
+)
+from ndk.relay.event_repo import (
+    caching_event_repo,
+    memory_event_repo,
+    postgres_event_repo,
+    single_flight,
+    tiered_event_repo,
 )
-from ndk.relay.event_repo import memory_event_repo
 from ndk.repos.event_repo import protocol_handler, relay_event_repo
-from relay import server
+from relay import config, server
 
 
 async def test_init():
@@ -71,3 +89,218 @@ async def test_init():
         await handler_task
     except asyncio.CancelledError:
         pass
+
+
+def relay_state() -> server.RelayState:
+    registry = metrics.Registry()
+    return server.RelayState(
+        memory_event_repo.MemoryEventRepo(),
+        event_notifier.EventNotifier(),
+        subscription_handler.SubscriptionGroups(),
+        event_handler.IngestStats(),
+        load_shedder.LoadShedder(),
+        metrics.RelayMetrics(registry),
+    )
+
+
+async def test_metrics_endpoint():
+    state = relay_state()
+    state.relay_metrics.count_message("EVENT")
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    status, headers, body = await server.health_check(b"", registry, "/metrics", {})
+
+    assert status == http.HTTPStatus.OK
+    assert headers[0][1].startswith("text/plain")
+    text = body.decode()
+    assert 'nostr_messages_total{type="EVENT"} 1' in text
+    assert "nostr_connections 0" in text
+    assert 'nostr_events_rejected_total{stage="signature"} 0' in text
+    assert 'nostr_event_loop_lag_seconds_bucket{le="+Inf"} 0' in text
+    assert "nostr_rate_limited_total" not in text
+
+
+async def test_metrics_follow_state():
+    state = relay_state()
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+    rq: asyncio.Queue[str] = asyncio.Queue()
+    wq: asyncio.Queue[str] = asyncio.Queue()
+    await wq.put("response")
+    state.queues.add((rq, wq))
+    state.ingest_stats.accepted = 3
+
+    text = registry.render()
+
+    assert "nostr_connections 1" in text
+    assert 'nostr_queue_depth{queue="response"} 1' in text
+    assert "nostr_events_accepted_total 3" in text
+
+
+def postgres_repo() -> postgres_event_repo.PostgresEventRepo:
+    repo = mock.MagicMock(spec=postgres_event_repo.PostgresEventRepo)
+    repo.coalescing_stats = single_flight.SingleFlightStats(calls=5, saved=2)
+    repo.sweep_stats = postgres_event_repo.SweepStats()
+    return repo
+
+
+async def test_metrics_cover_the_postgres_store():
+    state = relay_state()
+    state.store = postgres_repo()
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    state.store.coalescing_stats.saved += 1
+    text = registry.render()
+
+    assert "# TYPE nostr_postgres_queries_coalesced_total counter" in text
+    assert "nostr_postgres_queries_coalesced_total 3" in text
+
+
+async def test_metrics_cover_postgres_sweeps():
+    state = relay_state()
+    state.store = postgres_repo()
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    state.store.sweep_stats.merge(
+        postgres_event_repo.SweepStats(
+            batches=4, deleted=400, seconds=0.5, lock_wait_seconds=0.25
+        )
+    )
+    text = registry.render()
+
+    assert "nostr_postgres_sweep_batches_total 4" in text
+    assert "nostr_postgres_sweep_deleted_total 400" in text
+    assert "nostr_postgres_sweep_seconds_total 0.5" in text
+    assert "nostr_postgres_sweep_lock_wait_seconds_total 0.25" in text
+    assert "nostr_postgres_sweep_lock_timeouts_total 0" in text
+
+
+async def test_metrics_cover_the_postgres_cold_tier():
+    state = relay_state()
+    state.store = tiered_event_repo.TieredEventRepo(postgres_repo())
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    assert "nostr_postgres_queries_coalesced_total 2" in registry.render()
+
+
+async def test_metrics_cover_tier_hit_rates_by_filter_shape():
+    state = relay_state()
+    state.store = await tiered_event_repo.TieredEventRepo.create(
+        memory_event_repo.MemoryEventRepo()
+    )
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    now = int(time.time())
+    for since in [now - 60, now - 30]:
+        await state.store.get([event_filter.EventFilter(since=since)])
+    await state.store.get([event_filter.EventFilter(until=now - 7 * 24 * 60 * 60)])
+    text = registry.render()
+
+    assert 'nostr_tier_queries_total{shape="since",result="hit"} 2' in text
+    assert 'nostr_tier_queries_total{shape="until",result="miss"} 1' in text
+    assert 'nostr_tier_hit_ratio{shape="since"} 1' in text
+    assert 'nostr_tier_hit_ratio{shape="until"} 0' in text
+
+
+async def test_metrics_cover_cache_invalidations():
+    state = relay_state()
+    state.repo = caching_event_repo.CachingEventRepo(state.repo)
+    registry = state.relay_metrics.registry
+    server.register_state_metrics(registry, state)
+
+    keys = crypto.KeyPair()
+    await state.repo.get([event_filter.EventFilter(authors=[keys.public])])
+    await state.repo.add(metadata_event.MetadataEvent.from_metadata_parts(keys))
+    text = registry.render()
+
+    assert 'nostr_cache_lookups_total{result="miss"} 1' in text
+    assert "nostr_cache_invalidations_total 1" in text
+
+
+async def test_trace_covers_enqueue():
+    auth = auth_handler.AuthHandler("wss://tests", allow_all=True)
+    wq: asyncio.Queue[str] = asyncio.Queue()
+    sh = subscription_handler.SubscriptionHandler(wq)
+    repo = memory_event_repo.MemoryEventRepo()
+    eh = event_handler.EventHandler(repo, event_notifier.EventNotifier())
+    mh = message_handler.MessageHandler(auth, repo, sh, eh)
+    tracer = tracing.Tracer(tracing.TracingConfig(sample_rate=1.0))
+    md = message_dispatcher.MessageDispatcher(mh, tracer=tracer)
+
+    await server.process_message(request.Request("sub", [{}]).serialize(), wq, md)
+
+    assert wq.qsize() == 1
+    traces = tracer.drain()
+    assert len(traces) == 1
+    assert list(traces[0]["stages"])[-1] == "enqueue"
+
+
+async def test_handler_over_memory_transport():
+    state = relay_state()
+    state.ev_notifier.register(state.groups.handle_event)
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    memory_server = memory_transport.MemoryServer(
+        functools.partial(server.handler_wrapper, cfg, state)
+    )
+    subscriber = await memory_server.connect()
+    publisher = await memory_server.connect()
+    for ws in [subscriber, publisher]:
+        assert (await ws.recv()).startswith('["AUTH"')
+
+    await subscriber.send(request.Request("live", [{"kinds": [0]}]).serialize())
+    assert await subscriber.recv() == '["EOSE","live"]'
+    ev = metadata_event.MetadataEvent.from_metadata_parts(crypto.KeyPair())
+    await publisher.send(event_message.Event.from_event(ev).serialize())
+
+    assert message_factory.from_str(await publisher.recv()).event_id == ev.id
+    delivered = message_factory.from_str(await subscriber.recv())
+    assert delivered.event_dict["id"] == ev.id
+    assert len(state.queues) == 2
+
+    await memory_server.close()
+    assert not state.queues
+
+
+async def test_cancelled_handler_cleans_up():
+    state = relay_state()
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    server_ws, client_ws = memory_transport.pair()
+    handler = asyncio.create_task(server.handler_wrapper(cfg, state, server_ws))
+    await client_ws.recv()  # AUTH
+    await client_ws.send(request.Request("live", [{"kinds": [0]}]).serialize())
+    await client_ws.recv()  # EOSE
+    assert len(state.groups) == 1
+    tasks = asyncio.all_tasks()
+
+    # as the server does to the connections still open when it shuts down
+    handler.cancel()
+    await asyncio.gather(handler, return_exceptions=True)
+    await asyncio.sleep(0)
+
+    assert not state.groups
+    assert not state.queues
+    assert all(task.done() for task in tasks - {asyncio.current_task()})
+
+
+async def test_handler_records_traffic():
+    state = relay_state()
+    state.recorder = traffic_recorder.TrafficRecorder(traffic_recorder.RecorderConfig())
+    cfg = config.RelayConfig(configparser.ConfigParser())
+    memory_server = memory_transport.MemoryServer(
+        functools.partial(server.handler_wrapper, cfg, state)
+    )
+    ws = await memory_server.connect()
+    await ws.recv()  # AUTH
+    req = request.Request("sub", [{"kinds": [1]}]).serialize()
+
+    await ws.send(req)
+    await ws.recv()  # EOSE
+    await memory_server.close()
+
+    records = state.recorder.drain()
+    assert [r.get("frame", r.get("event")) for r in records] == ["open", req, "close"]
@@ -0,0 +1,67 @@
+# Copyright 2023 Julian Knutsen
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the “Software”), to deal in
+# the Software without restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+# pylint: disable=redefined-outer-name, unused-argument
+
+import pytest
+
+import testing_utils
+from ndk.event import reaction_event, text_note_event
+from spec_tests import utils
+
+
+@pytest.fixture
+def local(local_relay):
+    yield
+
+
+@pytest.fixture
+def remote(remote_relay):
+    yield
+
+
+@pytest.fixture(params=["local", "remote"])
+def ctx(request):
+    return request.getfixturevalue(request.param)
+
+
+@pytest.mark.usefixtures("ctx")
+async def test_count_no_match(keys, request_queue, response_queue):
+    await utils.send_count_with_filter("1", [{"authors": [keys.public]}], request_queue)
+
+    assert await utils.expect_count(response_queue) == 0
+
+
+@pytest.mark.usefixtures("ctx")
+async def test_count_reactions(keys, request_queue, response_queue):
+    text_note = text_note_event.TextNoteEvent.from_content(keys, "Hello World!")
+    await utils.send_and_expect_command_result(text_note, request_queue, response_queue)
+
+    reaction = reaction_event.ReactionEvent.from_text_note_event(keys, text_note)
+    await utils.send_and_expect_command_result(reaction, request_queue, response_queue)
+
+    fltr = {"kinds": [reaction.kind], "#e": [text_note.id]}
+
+    async def validate_response():
+        await utils.send_count_with_filter("1", [fltr], request_queue)
+
+        assert await utils.expect_count(response_queue) == 1
+
+    await testing_utils.retry_on_assert_coro(validate_response)
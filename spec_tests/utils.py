@@ -33,6 +33,7 @@ from ndk.event import (
 from ndk.messages import (
     close,
     command_result,
+    count,
     eose,
     event_message,
     message_factory,
@@ -53,6 +54,17 @@ async def send_req_with_filter(sub_id, fltrs, request_queue):
     await request_queue.put(r.serialize())
 
 
+async def send_count_with_filter(sub_id, fltrs, request_queue):
+    r = count.CountRequest(sub_id, fltrs)
+    await request_queue.put(r.serialize())
+
+
+async def expect_count(response_queue) -> int:
+    msg = message_factory.from_str(await response_queue.get())
+    assert isinstance(msg, count.CountResponse)
+    return msg.count
+
+
 async def send_close(sub_id, request_queue):
     r = close.Close(sub_id)
     await request_queue.put(r.serialize())